@@ -0,0 +1,1142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+DeepSeek API 代理服务器 - 异步引擎
+功能：与 api_proxy_server.py 提供相同的 /api/chat、/api/stats、/health 接口，
+     但使用 ASGI + httpx 异步客户端（支持 HTTP/2），单个进程即可同时挂起数百个慢速上游请求
+
+启动方式：
+    PROXY_ENGINE=async python api_proxy_server.py
+    或 gunicorn -k uvicorn.workers.UvicornWorker -w 1 -b 0.0.0.0:5000 api_proxy_async:app
+"""
+
+import asyncio
+import contextvars
+import json
+import os
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+import httpx
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+import api_proxy_server as core
+
+logger = logging.getLogger(__name__)
+
+# 单进程允许同时挂起的上游请求数（超出的请求排队等待，内存占用有上限）
+ASYNC_MAX_INFLIGHT = int(os.getenv('ASYNC_MAX_INFLIGHT', 500))
+# 是否对上游启用 HTTP/2（需要安装 h2）
+ASYNC_HTTP2 = os.getenv('ASYNC_HTTP2', 'True').lower() == 'true'
+
+# 当前请求的阶段计时器（StageTimer），上游客户端用它记录排队时间
+current_timer = contextvars.ContextVar('current_timer', default=None)
+# 不等待结果的后台任务（保留引用直到完成，避免任务被回收）
+background_tasks = set()
+
+
+async def offload(fn, *args, blocking=True):
+    """
+    在线程池中执行同步的存储调用（SQLite、磁盘缓存），等待期间事件循环继续处理其他请求；
+    blocking 为 False（只涉及内存）时直接调用，省去线程切换
+    """
+    if not blocking:
+        return fn(*args)
+    return await asyncio.to_thread(fn, *args)
+
+
+def run_in_background(fn, *args, blocking=True):
+    """在线程池中执行同步调用，不等待完成（用于请求被取消后仍要完成的清理）；blocking 的含义与 offload 一致"""
+    if not blocking:
+        fn(*args)
+        return
+    task = asyncio.ensure_future(asyncio.to_thread(fn, *args))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
+class AsyncUpstreamClient:
+    """基于 httpx.AsyncClient 的上游客户端，连接池由 httpx 管理"""
+
+    def __init__(self):
+        self.client = None
+        self.semaphore = None
+        self.active = 0
+        self.waiting = 0
+        self.total_requests = 0
+        self.connections_opened = 0
+
+    async def start(self):
+        # 信号量需要在事件循环内创建
+        self.semaphore = asyncio.Semaphore(ASYNC_MAX_INFLIGHT)
+        # httpx 的连接上限是所有上游共用的，按 key 数量放大，多个 key 时吞吐不受连接数限制
+        pool_size = core.UPSTREAM_POOL_SIZE * len(core.upstream_keys.keys)
+        limits = httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=60
+        )
+        timeout = httpx.Timeout(core.UPSTREAM_READ_TIMEOUT, connect=core.UPSTREAM_CONNECT_TIMEOUT)
+        try:
+            self.client = httpx.AsyncClient(http2=ASYNC_HTTP2, limits=limits, timeout=timeout)
+        except ImportError:
+            # 未安装 h2 时退回 HTTP/1.1
+            logger.warning("h2 is not installed, falling back to HTTP/1.1 for upstream")
+            self.client = httpx.AsyncClient(limits=limits, timeout=timeout)
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+
+    async def post(self, url, **kwargs):
+        """发送 POST 请求；超过 ASYNC_MAX_INFLIGHT 时排队等待"""
+        self.waiting += 1
+        queued = time.perf_counter()
+        async with self.semaphore:
+            self._record_queue_wait(queued)
+            self.waiting -= 1
+            self.active += 1
+            self.total_requests += 1
+            try:
+                return await self.client.post(url, extensions={'trace': self._trace}, **kwargs)
+            finally:
+                self.active -= 1
+
+    async def stream(self, url, **kwargs):
+        """
+        发送流式 POST 请求，返回未读取响应体的 response，调用方负责 aclose()；
+        并发名额和 active 计数一直占用到 aclose()（响应体转发完或客户端断开），而不是收到响应头为止
+        """
+        self.waiting += 1
+        queued = time.perf_counter()
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self._record_queue_wait(queued)
+        self.active += 1
+        self.total_requests += 1
+        try:
+            request = self.client.build_request('POST', url, extensions={'trace': self._trace}, **kwargs)
+            response = await self.client.send(request, stream=True)
+        except BaseException:
+            self._release()
+            raise
+
+        close = response.aclose
+        released = False
+
+        async def aclose():
+            nonlocal released
+            try:
+                await close()
+            finally:
+                # 可能被调用多次（429 重试、转发结束），名额只归还一次
+                if not released:
+                    released = True
+                    self._release()
+
+        response.aclose = aclose
+        return response
+
+    def _release(self):
+        self.active -= 1
+        self.semaphore.release()
+
+    async def _trace(self, event_name, info):
+        """httpcore 的 trace 回调：统计新建的连接数（用于连接复用率）"""
+        if event_name == 'connection.connect_tcp.complete':
+            self.connections_opened += 1
+
+    def _record_queue_wait(self, queued):
+        timer = current_timer.get()
+        if timer is not None:
+            timer.add('queue', time.perf_counter() - queued)
+
+    def idle_connections(self):
+        """httpx 连接池中的空闲连接数（读取 httpcore 内部状态，取不到时返回 0）"""
+        pool = getattr(getattr(self.client, '_transport', None), '_pool', None)
+        connections = getattr(pool, 'connections', [])
+        return sum(1 for conn in connections if conn.is_idle())
+
+    def stats(self):
+        """连接池统计，字段与同步引擎的 UpstreamClient.stats 相同"""
+        reuse_ratio = 1 - self.connections_opened / self.total_requests if self.total_requests else 0.0
+        return {
+            'engine': 'async',
+            'http2': ASYNC_HTTP2,
+            'pool_size': core.UPSTREAM_POOL_SIZE,
+            'max_inflight': ASYNC_MAX_INFLIGHT,
+            'idle_connections': self.idle_connections(),
+            'active_connections': self.active,
+            'waiting_requests': self.waiting,
+            'connections_opened': self.connections_opened,
+            'requests': self.total_requests,
+            'reuse_ratio': round(max(reuse_ratio, 0.0), 4)
+        }
+
+
+class AsyncCoalescer:
+    """
+    相同 key 的并发请求共享同一个上游调用（异步引擎版的 RequestCoalescer）。
+    进程内等待同一个任务；配置了共享存储时，其他 worker 通过 flights 表发现进行中的请求并轮询结果
+    （SQLite 读写复用 core.RequestCoalescer，在线程池中执行）
+    """
+
+    def __init__(self, store=None):
+        self.shared = core.RequestCoalescer(store) if store is not None else None
+        self._flights = {}
+        self.leaders = 0
+        self.coalesced = 0
+        self.shared_coalesced = 0
+
+    async def run(self, key, fn):
+        if not core.COALESCE_ENABLED:
+            return await fn()
+
+        task = self._flights.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            # 共享的上游调用在独立的任务中执行：发起请求的客户端断开时，其他等待方照常拿到结果
+            task = asyncio.ensure_future(self._run_shared(key, fn) if self.shared is not None else fn())
+            self._flights[key] = task
+            self.leaders += 1
+            task.add_done_callback(lambda done: self._finished(key, done))
+        # shield：任何一个请求（包括发起方）断开时都不取消共享的上游调用
+        return await asyncio.shield(task)
+
+    async def _run_shared(self, key, fn):
+        """跨 worker 合并，与同步引擎的 RequestCoalescer._run_shared 一致"""
+        shared = self.shared
+        if not await offload(shared.claim_shared, key):
+            deadline = time.time() + shared.timeout
+            while time.time() < deadline:
+                done, result = await offload(shared.poll_shared, key)
+                if done:
+                    if result is None:
+                        break
+                    self.shared_coalesced += 1
+                    return result
+                await asyncio.sleep(core.COALESCE_POLL_INTERVAL)
+            # 持有者超时或记录已清理，自己调用上游
+            return await fn()
+
+        try:
+            status_code, result = await fn()
+        except Exception as e:
+            await offload(shared.publish_error, key, e)
+            raise
+        await offload(shared.publish, key, status_code, result)
+        return status_code, result
+
+    def _finished(self, key, task):
+        if self._flights.get(key) is task:
+            del self._flights[key]
+        if not task.cancelled():
+            # 所有请求都已断开时避免 "exception was never retrieved" 警告
+            task.exception()
+
+    def stats(self):
+        return {
+            'enabled': core.COALESCE_ENABLED,
+            'shared': self.shared is not None,
+            'in_flight': len(self._flights),
+            'upstream_calls': self.leaders,
+            'saved_upstream_calls': self.coalesced + self.shared_coalesced
+        }
+
+
+class AsyncConcurrencyGate:
+    """
+    全局上游并发上限 + 优先级类别预算 + 有界等待队列（异步引擎版的 ConcurrencyGate）。
+    名额释放时按 core.pick_next_class 直接交给选中类别的队首等待者。
+    配置了共享存储时用 slots 表在所有 worker 之间计数（SQLite 读写复用 core.ConcurrencyGate，在线程池中执行），
+    同一类别的名额记录可以互换，release 时归还该类别任意一条
+    """
+
+    def __init__(self, store=None, limit=core.PROXY_MAX_CONCURRENCY, max_queue=core.PROXY_MAX_QUEUE,
+                 queue_timeout=core.PROXY_QUEUE_TIMEOUT, budgets=core.PRIORITY_BUDGETS,
+                 max_wait=core.PRIORITY_MAX_WAIT):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.budgets = budgets
+        self.max_wait = max_wait
+        self.active_by_class = {cls: 0 for cls in core.PRIORITY_CLASSES}
+        self.rejected = 0
+        self._queues = {cls: deque() for cls in core.PRIORITY_CLASSES}
+        self.shared = None
+        if store is not None and self.enabled:
+            self.shared = core.ConcurrencyGate(store, limit, max_queue, queue_timeout, budgets, max_wait)
+        # 共享存储中当前 worker 持有的名额记录 id（按类别）
+        self._shared_slots = {cls: [] for cls in core.PRIORITY_CLASSES}
+        self._shared_waiting = 0
+
+    @property
+    def enabled(self):
+        return self.limit > 0 or any(budget > 0 for budget in self.budgets.values())
+
+    @property
+    def waiting(self):
+        return sum(len(queue) for queue in self._queues.values()) + self._shared_waiting
+
+    async def acquire(self, priority='normal'):
+        """获取一个上游名额，返回排队秒数；失败时抛出 RateLimited"""
+        if not self.enabled:
+            return 0.0
+        if self.shared is not None:
+            return await self._acquire_shared(priority)
+        if self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise core.RateLimited('Server is busy, queue is full', 1)
+
+        started = time.perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        self._queues[priority].append((time.time(), future))
+        self._dispatch()
+        if not future.done():
+            try:
+                await asyncio.wait_for(future, self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                raise core.RateLimited('Timed out waiting for an upstream slot', 1)
+            except asyncio.CancelledError:
+                # 已分到名额但请求被取消时归还名额
+                if future.done() and not future.cancelled():
+                    self.release(priority)
+                raise
+            finally:
+                queue = self._queues[priority]
+                for entry in queue:
+                    if entry[1] is future:
+                        queue.remove(entry)
+                        break
+        return time.perf_counter() - started
+
+    async def _acquire_shared(self, priority):
+        started = time.perf_counter()
+        try:
+            slot_id = await offload(self.shared.enqueue_shared, priority)
+        except core.RateLimited:
+            self.rejected += 1
+            raise
+        self._shared_waiting += 1
+        try:
+            deadline = time.monotonic() + self.queue_timeout
+            while time.monotonic() < deadline:
+                if await offload(self.shared.promote_shared, slot_id, priority):
+                    self._granted_shared(priority, slot_id)
+                    return time.perf_counter() - started
+                await asyncio.sleep(core.COALESCE_POLL_INTERVAL)
+        except BaseException:
+            # 请求被取消（可能已经在线程池中改成了 active）时删除记录
+            run_in_background(self.shared.delete_shared, slot_id)
+            raise
+        finally:
+            self._shared_waiting -= 1
+        await offload(self.shared.delete_shared, slot_id)
+        self.rejected += 1
+        raise core.RateLimited('Timed out waiting for an upstream slot', 1)
+
+    def _granted_shared(self, priority, slot_id):
+        self.active_by_class[priority] += 1
+        self._shared_slots[priority].append(slot_id)
+
+    async def try_acquire(self, priority='normal'):
+        """不排队地获取一个名额（用于对冲请求），与同步引擎的 ConcurrencyGate.try_acquire 一致，返回是否获得"""
+        if not self.enabled:
+            return True
+        if self.shared is not None:
+            slot_id = await offload(self.shared.claim_shared, priority)
+            if slot_id is None:
+                return False
+            self._granted_shared(priority, slot_id)
+            return True
+        if self.waiting or core.pick_next_class({priority: time.time()}, self.active_by_class,
+                                                sum(self.active_by_class.values()), self.limit, self.budgets,
+                                                self.max_wait, time.time()) != priority:
+            return False
+        self.active_by_class[priority] += 1
+        return True
+
+    def release(self, priority='normal'):
+        if not self.enabled:
+            return
+        self.active_by_class[priority] -= 1
+        if self.shared is not None:
+            # 在 finally 和完成回调中调用，不等待 SQLite 写入
+            run_in_background(self.shared.delete_shared, self._shared_slots[priority].pop())
+            return
+        self._dispatch()
+
+    def _dispatch(self):
+        """把空闲名额依次交给选中类别的队首等待者"""
+        while True:
+            # 丢弃已超时（被取消）的等待者
+            for queue in self._queues.values():
+                while queue and queue[0][1].done():
+                    queue.popleft()
+            heads = {cls: queue[0][0] for cls, queue in self._queues.items() if queue}
+            cls = core.pick_next_class(heads, self.active_by_class, sum(self.active_by_class.values()),
+                                       self.limit, self.budgets, self.max_wait, time.time())
+            if cls is None:
+                return
+            _, future = self._queues[cls].popleft()
+            self.active_by_class[cls] += 1
+            future.set_result(None)
+
+    def stats(self):
+        return {
+            'limit': self.limit,
+            'budgets': self.budgets,
+            'active': sum(self.active_by_class.values()),
+            'active_by_class': dict(self.active_by_class),
+            'waiting': self.waiting,
+            'max_queue': self.max_queue,
+            'rejected': self.rejected
+        }
+
+
+class AsyncPeerClient:
+    """转发给其他代理节点的 httpx 客户端，只在多节点模式下创建"""
+
+    def __init__(self):
+        self.client = None
+
+    async def start(self):
+        if not core.peer_ring.enabled:
+            return
+        pool_size = core.UPSTREAM_POOL_SIZE * len(core.peer_ring.nodes)
+        self.client = httpx.AsyncClient(limits=httpx.Limits(max_connections=pool_size,
+                                                            max_keepalive_connections=pool_size,
+                                                            keepalive_expiry=60))
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+
+
+upstream = AsyncUpstreamClient()
+peers = AsyncPeerClient()
+coalescer = AsyncCoalescer(core.shared_store)
+concurrency_gate = AsyncConcurrencyGate(core.shared_store)
+
+
+async def health_check(request):
+    """健康检查"""
+    return JSONResponse({
+        'status': 'ok',
+        'message': 'API Proxy Server is running',
+        'upstream_pool': upstream.stats(),
+        'upstream_circuit': core.circuit_breaker.state
+    })
+
+
+async def chat_completion(request):
+    """聊天完成接口（代理 DeepSeek API），请求/响应格式与同步引擎一致"""
+    timer = core.StageTimer(core.request_id(request.headers))
+    token = current_timer.set(timer)
+    core.metrics.request_started()
+    try:
+        response = await _chat_completion(request, timer)
+    finally:
+        core.metrics.request_finished()
+        current_timer.reset(token)
+    # Server-Timing：各阶段耗时（毫秒）
+    timer.finish()
+    response.headers['Server-Timing'] = timer.server_timing()
+    response.headers[core.REQUEST_ID_HEADER] = timer.request_id
+    core.metrics.observe_request(request.url.path, timer)
+    core.priority_latency.observe(timer.priority, timer.stages['total'])
+    core.workload_stats.observe(timer.workload, timer.stages['total'])
+    # 流式响应在转发结束后（stream_completion）写访问日志
+    if not (isinstance(response, StreamingResponse) and response.media_type == 'text/event-stream'):
+        core.log_request(timer, request.url.path, response.status_code)
+    return response
+
+
+async def _chat_completion(request, timer):
+    idempotency_key = None
+    try:
+        if not core.check_client_auth(request.headers.get('Authorization', '')):
+            return JSONResponse({'error': 'Unauthorized'}, status_code=401)
+
+        try:
+            data = await request.json()
+        except ValueError:
+            data = None
+        if not data:
+            return JSONResponse({'error': 'Invalid request body'}, status_code=400)
+
+        workload = core.classify_workload(data, request.headers)
+        # 模板请求：在代理端用已上传的简历展开提示词
+        if 'template_id' in data:
+            data = await offload(core.expand_prompt_template, data)
+        # 按工作负载类别路由模型和参数
+        data = core.apply_model_route(data, workload)
+
+        api_data = core.build_upstream_payload(data)
+        client = core.client_id(request.headers.get('Authorization', ''))
+        timer.priority = core.classify_priority(api_data, request.headers)
+        timer.workload = workload
+        timer.client = client
+        timer.model = api_data.get('model')
+
+        # 幂等键：已有保存的响应（或相同的请求正在处理）时直接返回，不再调用上游
+        idempotency_key = core.idempotency_store.scoped_key(client, request.headers.get(core.IDEMPOTENCY_HEADER))
+        if idempotency_key:
+            stored = await begin_idempotent(idempotency_key, api_data,
+                                            core.request_deadline(request.headers, timer.start))
+            if stored is not None:
+                idempotency_key = None
+                body, content_type, headers = core.idempotent_replay(stored, request.headers)
+                return Response(body, media_type=content_type, headers=headers)
+
+        if api_data.get('stream'):
+            core.traffic_capture.request(api_data, request.headers, client, request.url.path)
+            await offload(core.rate_limiter.check, client, blocking=core.rate_limiter.shared)
+            return await stream_completion(api_data, client, timer,
+                                           core.request_deadline(request.headers, timer.start), idempotency_key)
+
+        status_code, result, cache_state = await complete_chat(
+            api_data, client, request.headers, request.url.path, timer)
+
+        timer.cache = cache_state
+        if status_code == 200:
+            await complete_idempotent(idempotency_key, 'application/json', result)
+            timer.tokens = core.scan_total_tokens(result)
+            # 原样返回上游（或缓存）的响应字节，不做解析和重新序列化
+            if core.wants_lean(request.headers):
+                started = time.perf_counter()
+                result = core.lean_body(result)
+                timer.add('serialize', time.perf_counter() - started)
+            return Response(result, media_type='application/json', headers={'X-Proxy-Cache': cache_state})
+        else:
+            await abandon_idempotent(idempotency_key)
+            return JSONResponse({
+                'error': 'API request failed',
+                'status_code': status_code,
+                'message': result
+            }, status_code=status_code)
+
+    except core.IdempotencyConflict as e:
+        body, headers = core.idempotency_conflict_response(e)
+        return JSONResponse(body, status_code=e.status_code, headers=headers)
+    except core.RateLimited as e:
+        await abandon_idempotent(idempotency_key)
+        body, headers = core.rate_limited_response(e)
+        return JSONResponse(body, status_code=429, headers=headers)
+    except core.CircuitOpen as e:
+        await abandon_idempotent(idempotency_key)
+        body, headers = core.circuit_open_response(e)
+        return JSONResponse(body, status_code=503, headers=headers)
+    except core.TemplateError as e:
+        return JSONResponse(core.template_error_response(e), status_code=e.status_code)
+    except Exception as e:
+        await abandon_idempotent(idempotency_key)
+        logger.error(f"Error processing request: {str(e)}", extra=core.log_fields(request_id=timer.request_id))
+        return JSONResponse({'error': str(e)}, status_code=500)
+    except asyncio.CancelledError:
+        # 客户端断开：下次重试时重新处理（已被取消，不能再等待线程池）
+        if idempotency_key is not None:
+            run_in_background(core.idempotency_store.abandon, idempotency_key)
+        raise
+
+
+async def begin_idempotent(key, api_data, deadline=None):
+    """
+    开始处理带幂等键的请求，与同步引擎的 IdempotencyStore.begin 一致：
+    查询在线程池中执行，等待处理中的请求时用 asyncio.sleep，不阻塞事件循环
+    """
+    store = core.idempotency_store
+    wait_until = store.wait_until(deadline)
+    while True:
+        state, stored = await offload(store.try_begin, key, api_data)
+        if state != 'pending':
+            return stored
+        if time.perf_counter() + store.poll_interval >= wait_until:
+            raise store.still_pending()
+        await asyncio.sleep(store.poll_interval)
+
+
+async def complete_idempotent(key, content_type, body):
+    """保存幂等键对应的成功响应（SQLite 写入在线程池中执行）"""
+    if key is not None:
+        await offload(core.idempotency_store.complete, key, content_type, body)
+
+
+async def abandon_idempotent(key):
+    """删除幂等键的 pending 记录（SQLite 写入在线程池中执行）"""
+    if key is not None:
+        await offload(core.idempotency_store.abandon, key)
+
+
+async def complete_chat(api_data, client, headers, route, timer, from_peer=False):
+    """处理一个非流式聊天请求，返回 (状态码, 结果, 缓存状态)，与同步引擎的 complete_chat 一致（包括多节点转发）"""
+    priority = timer.priority
+    deadline = core.request_deadline(headers, timer.start)
+    hedge = core.hedger.applies(api_data, priority)
+
+    # 查询响应缓存，命中则直接返回，不调用上游（由其他节点负责的键只在 owner 上缓存）
+    key = core.cache_key(api_data)
+    if not from_peer:
+        core.traffic_capture.request(api_data, headers, client, route, key)
+    cacheable = core.is_cacheable(api_data, headers)
+    owner = core.peer_ring.owner(key) if cacheable and not from_peer else None
+    if cacheable and owner is None:
+        # 内存层直接查，磁盘层在线程池中查
+        cached = core.response_cache.get_memory(key)
+        if cached is None:
+            cached = await offload(core.response_cache.get_disk, key, blocking=core.response_cache.uses_disk)
+        if cached is not None:
+            return 200, cached, 'HIT'
+
+    # 限流：按客户端的请求速率和 token 额度
+    if not from_peer:
+        await offload(core.rate_limiter.check, client, blocking=core.rate_limiter.shared)
+
+    cache_route = route if cacheable else None
+    cache_state = 'MISS' if cacheable else 'BYPASS'
+
+    async def forward():
+        # 只有真正调用上游的请求占用并发名额
+        timer.add('queue', await concurrency_gate.acquire(priority))
+        try:
+            return await call_upstream(api_data, client, key, cache_route, deadline, hedge, timer.workload)
+        finally:
+            concurrency_gate.release(priority)
+
+    async def forward_peer():
+        nonlocal cache_state
+        try:
+            status_code, result, cache_state = await forward_to_peer(owner, api_data, client, route, timer, deadline)
+            return status_code, result
+        except core.PeerUnavailable:
+            return await forward()
+
+    # 相同的并发请求只调用一次上游（或只转发一次）；只合并可缓存的请求，与同步引擎一致
+    started = time.perf_counter()
+    if cacheable:
+        status_code, result = await coalescer.run(key, forward if owner is None else forward_peer)
+    else:
+        status_code, result = await forward()
+    timer.add('upstream', time.perf_counter() - started - timer.stages.get('queue', 0.0))
+    return status_code, result, cache_state
+
+
+async def forward_to_peer(node, api_data, client, route, timer, deadline):
+    """把可缓存的请求转发给 owner 节点，返回 (状态码, 结果, 缓存状态)，与同步引擎的 forward_to_peer 一致"""
+    timeout = core.upstream_timeout(deadline)
+    if timeout is None:
+        return 504, 'Request deadline exceeded', 'MISS'
+    connect_timeout, read_timeout = core.peer_timeout(timeout)
+    try:
+        response = await peers.client.post(f"{node}{core.PEER_PATH}", json=api_data,
+                                           headers=core.peer_request_headers(client, route, timer, deadline),
+                                           timeout=httpx.Timeout(read_timeout, connect=connect_timeout))
+    except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+        core.peer_ring.mark_down(node)
+        raise core.PeerUnavailable(str(e))
+    except httpx.TimeoutException:
+        return 504, 'Upstream request timed out', 'MISS'
+    return core.parse_peer_response(response.status_code, response.headers, response.content)
+
+
+async def peer_chat(request):
+    """节点间接口：处理其他节点转发来的、本节点负责的可缓存请求，与同步引擎的 peer_chat 一致"""
+    if not core.peer_ring.check_token(request.headers.get(core.PEER_TOKEN_HEADER, '')):
+        return JSONResponse({'error': 'Forbidden'}, status_code=403)
+    try:
+        api_data = await request.json()
+    except ValueError:
+        api_data = None
+    if not isinstance(api_data, dict):
+        return JSONResponse({'error': 'Invalid request body'}, status_code=400)
+
+    core.peer_ring.record_served()
+    timer = core.StageTimer(core.request_id(request.headers))
+    timer.priority = core.classify_priority(api_data, request.headers)
+    timer.workload = request.headers.get('X-Workload', 'default')
+    client = request.headers.get(core.PEER_CLIENT_HEADER, 'anonymous')
+    route = request.headers.get(core.PEER_ROUTE_HEADER, '/api/chat')
+    token = current_timer.set(timer)
+    try:
+        status_code, result, cache_state = await complete_chat(api_data, client, request.headers, route, timer,
+                                                               from_peer=True)
+    except core.RateLimited as e:
+        status_code, body, headers = core.peer_error_response('rate_limited', e)
+        return JSONResponse(body, status_code=status_code, headers=headers)
+    except core.CircuitOpen as e:
+        status_code, body, headers = core.peer_error_response('circuit_open', e)
+        return JSONResponse(body, status_code=status_code, headers=headers)
+    finally:
+        current_timer.reset(token)
+
+    if status_code == 200:
+        return Response(result, media_type='application/json',
+                        headers={'X-Proxy-Cache': cache_state, core.PEER_RESULT_HEADER: 'ok'})
+    return JSONResponse({'status_code': status_code, 'message': result}, status_code=status_code,
+                        headers={core.PEER_RESULT_HEADER: 'upstream'})
+
+
+async def chat_completion_batch(request):
+    """批量聊天接口，请求/响应格式与同步引擎一致"""
+    try:
+        if not core.check_client_auth(request.headers.get('Authorization', '')):
+            return JSONResponse({'error': 'Unauthorized'}, status_code=401)
+
+        try:
+            data = await request.json()
+        except ValueError:
+            data = None
+        items = data.get('requests') if isinstance(data, dict) else None
+        if not isinstance(items, list) or not items:
+            return JSONResponse({'error': 'Invalid request body'}, status_code=400)
+        if len(items) > core.BATCH_MAX_ITEMS:
+            return JSONResponse({'error': f'Too many requests in batch (max {core.BATCH_MAX_ITEMS})'},
+                                status_code=400)
+
+        client = core.client_id(request.headers.get('Authorization', ''))
+        headers = request.headers
+        route = request.url.path
+        # 每个批次的上游并发数有上限
+        semaphore = asyncio.Semaphore(core.BATCH_MAX_CONCURRENCY)
+
+        async def run_item(index, item):
+            async with semaphore:
+                return await run_batch_item(index, item, client, headers, route)
+
+        tasks = [asyncio.ensure_future(run_item(index, item)) for index, item in enumerate(items)]
+
+        if data.get('stream'):
+            async def generate():
+                try:
+                    for next_done in asyncio.as_completed(tasks):
+                        yield json.dumps(await next_done, ensure_ascii=False) + '\n'
+                finally:
+                    # 客户端断开时取消尚未完成的项
+                    for task in tasks:
+                        task.cancel()
+            return StreamingResponse(generate(), media_type='application/x-ndjson',
+                                     headers={'X-Accel-Buffering': 'no'})
+
+        return JSONResponse({'results': await asyncio.gather(*tasks)})
+
+    except Exception as e:
+        logger.error(f"Error processing batch request: {str(e)}")
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+
+async def run_batch_item(index, item, client, headers, route):
+    """执行批量请求中的一项，返回该项的结果（不抛出异常）"""
+    timer = core.StageTimer()
+    token = current_timer.set(timer)
+    try:
+        timer.workload = core.classify_workload(item, headers)
+        if isinstance(item, dict) and 'template_id' in item:
+            item = await offload(core.expand_prompt_template, item)
+        if not isinstance(item, dict) or not item.get('messages'):
+            return {'index': index, 'status_code': 400, 'error': 'Invalid request item'}
+        item = core.apply_model_route(item, timer.workload)
+        api_data = core.build_upstream_payload(dict(item, stream=False))
+        timer.priority = core.classify_priority(api_data, headers)
+        status_code, result, cache_state = await complete_chat(api_data, client, headers, route, timer)
+        core.workload_stats.observe(timer.workload, time.perf_counter() - timer.start)
+        if status_code == 200:
+            result = json.loads(result)
+            if core.wants_lean(headers):
+                result = core.lean_result(result)
+            return {'index': index, 'status_code': 200, 'cache': cache_state, 'response': result}
+        return {'index': index, 'status_code': status_code, 'error': 'API request failed', 'message': result}
+    except core.RateLimited as e:
+        body, _ = core.rate_limited_response(e)
+        return dict(body, index=index, status_code=429)
+    except core.CircuitOpen as e:
+        body, _ = core.circuit_open_response(e)
+        return dict(body, index=index, status_code=503)
+    except core.TemplateError as e:
+        return dict(core.template_error_response(e), index=index, status_code=e.status_code)
+    except Exception as e:
+        logger.error(f"Error processing batch item {index}: {str(e)}")
+        return {'index': index, 'status_code': 500, 'error': str(e)}
+    finally:
+        current_timer.reset(token)
+
+
+async def call_upstream(api_data, client, key=None, cache_route=None, deadline=None, hedge=False, workload=None):
+    """调用 DeepSeek API（非流式），返回 (状态码, 结果)，与同步引擎的 call_upstream 一致"""
+    timeout = core.upstream_timeout(deadline)
+    if timeout is None:
+        return 504, 'Request deadline exceeded'
+    core.circuit_breaker.before_call()
+    started = time.perf_counter()
+    try:
+        response = await before_deadline(post_upstream(api_data, deadline, hedge, client, workload), deadline)
+    except (httpx.TimeoutException, asyncio.TimeoutError):
+        # 客户端给的截止时间比上游超时短时，超时不算上游故障
+        core.circuit_breaker.record(timeout[1] >= core.UPSTREAM_READ_TIMEOUT, time.perf_counter() - started)
+        logger.error(f"DeepSeek API timed out after {time.perf_counter() - started:.1f}s")
+        return 504, 'Upstream request timed out'
+    except core.RateLimited:
+        raise
+    except Exception:
+        core.circuit_breaker.record(True, time.perf_counter() - started)
+        raise
+    core.circuit_breaker.record(response.status_code >= 500, time.perf_counter() - started)
+    core.traffic_capture.upstream(api_data, response.status_code, time.perf_counter() - started, response.content)
+
+    model = api_data.get('model')
+    core.record_request(client, model)
+    core.metrics.observe_upstream(model, response.status_code, time.perf_counter() - started)
+
+    if response.status_code == 200:
+        body = response.content
+        # 统计 token 使用量（只扫描 usage，不解析整个响应）
+        await offload(core.record_tokens, client, model, core.scan_total_tokens(body), workload,
+                      blocking=core.rate_limiter.shared)
+
+        if cache_route is not None:
+            await offload(core.response_cache.set, key, body, core.cache_ttl_for(cache_route),
+                          blocking=core.response_cache.uses_disk)
+        return 200, body
+
+    message = core.error_excerpt(response.content)
+    logger.error(f"DeepSeek API error: {response.status_code} - {message}",
+                 extra=core.log_fields(upstream_status=response.status_code, model=model))
+    return response.status_code, message
+
+
+async def before_deadline(awaitable, deadline):
+    """等待 awaitable，deadline 不为空时超过截止时间取消并抛出 asyncio.TimeoutError（按总耗时，不是单次读取的间隔）"""
+    if deadline is None:
+        return await awaitable
+    return await asyncio.wait_for(awaitable, max(deadline - time.perf_counter(), 0))
+
+
+async def send_upstream(api_data, deadline=None, stream=False):
+    """把请求发给在途请求最少的上游 key，返回 (响应, key)，与同步引擎的 send_upstream 一致"""
+    keys = core.upstream_keys
+    attempts = len(keys.keys)
+    for attempt in range(attempts):
+        # 每次重试按剩余时间计算超时
+        timeout = core.upstream_timeout(deadline)
+        if timeout is None:
+            raise httpx.TimeoutException('Request deadline exceeded')
+        key = keys.acquire()
+        kwargs = {
+            'headers': core.build_upstream_headers(key.api_key),
+            'json': api_data,
+            'timeout': httpx.Timeout(timeout[1], connect=timeout[0])
+        }
+        try:
+            if stream:
+                response = await upstream.stream(key.url, **kwargs)
+            else:
+                response = await upstream.post(key.url, **kwargs)
+        except BaseException:
+            # 包括对冲请求被取消
+            keys.release(key)
+            raise
+        keys.observe(key, response.status_code, response.headers)
+        if response.status_code != 429 or attempt == attempts - 1 or not keys.has_ready_key():
+            return response, key
+        await response.aclose()
+        keys.release(key)
+
+
+async def post_upstream(api_data, deadline=None, hedge=False, client=None, workload=None):
+    """
+    发送非流式上游请求，hedge 为 True 时按对冲策略发送（与同步引擎一致）；
+    落后的请求直接取消，已经返回成功的仍按 client / workload 统计 token
+    """
+    async def send():
+        response, key = await send_upstream(api_data, deadline)
+        core.upstream_keys.release(key)
+        return response
+    if not hedge:
+        return await send()
+
+    hedge_delay = core.hedger.delay()
+    if hedge_delay is None:
+        # 样本不足：正常发送，只记录耗时
+        sent = time.perf_counter()
+        response = await send()
+        if response.status_code == 200:
+            core.hedger.observe(time.perf_counter() - sent)
+        return response
+
+    primary = asyncio.ensure_future(send())
+    started = {primary: time.perf_counter()}
+    attempts = [primary]
+    chosen = None
+    try:
+        done, _ = await asyncio.wait(attempts, timeout=hedge_delay)
+        if not done:
+            # 对冲请求同样占用并发名额，没有空闲名额时不对冲
+            if await concurrency_gate.try_acquire(core.hedger.priority):
+                core.hedger.hedged += 1
+                hedge_task = asyncio.ensure_future(send())
+                # 用完成回调归还名额：任务在开始执行前就被取消时也会调用
+                hedge_task.add_done_callback(lambda _: concurrency_gate.release(core.hedger.priority))
+                attempts.append(hedge_task)
+                started[hedge_task] = time.perf_counter()
+            else:
+                core.hedger.skipped += 1
+
+        # 先成功的响应直接返回；都失败时等所有请求结束，返回最后一个失败的响应
+        winner = None
+        failed = None
+        error = None
+        pending = set(attempts)
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                try:
+                    result = task.result()
+                except httpx.HTTPError as e:
+                    error = e
+                    continue
+                if result.status_code == 200 and winner is None:
+                    winner = task
+                elif result.status_code != 200:
+                    failed = task
+        chosen = winner or failed
+        if winner is not None:
+            # 记录的是胜出请求自身的耗时，避免对冲等待时间逐步抬高
+            core.hedger.observe(time.perf_counter() - started[winner])
+            if winner is not primary:
+                core.hedger.hedge_wins += 1
+            return winner.result()
+        if failed is not None:
+            return failed.result()
+        raise error
+    finally:
+        for task in attempts:
+            if not task.done():
+                task.cancel()
+            elif task is not chosen and not task.cancelled() and task.exception() is None:
+                response = task.result()
+                if response.status_code == 200:
+                    run_in_background(core.record_tokens, client, api_data.get('model'),
+                                      core.scan_total_tokens(response.content), workload,
+                                      blocking=core.rate_limiter.shared)
+                await response.aclose()
+
+
+async def stream_completion(api_data, client, timer, deadline=None, idempotency_key=None):
+    """流式请求：逐块转发上游 SSE 响应，结束后统计 token；idempotency_key 的处理与同步引擎的 proxy_stream 一致"""
+    # 流式请求在整个转发期间占用并发名额
+    priority = timer.priority
+    timer.add('queue', await concurrency_gate.acquire(priority))
+    timeout = core.upstream_timeout(deadline)
+    if timeout is None:
+        concurrency_gate.release(priority)
+        await abandon_idempotent(idempotency_key)
+        return JSONResponse({'error': 'Request deadline exceeded'}, status_code=504)
+    try:
+        core.circuit_breaker.before_call()
+        started = time.perf_counter()
+        response, key = await before_deadline(send_upstream(api_data, deadline, stream=True), deadline)
+    except (httpx.TimeoutException, asyncio.TimeoutError):
+        concurrency_gate.release(priority)
+        await abandon_idempotent(idempotency_key)
+        core.circuit_breaker.record(timeout[1] >= core.UPSTREAM_READ_TIMEOUT, time.perf_counter() - started)
+        return JSONResponse({'error': 'Upstream request timed out'}, status_code=504)
+    except (core.CircuitOpen, core.RateLimited):
+        concurrency_gate.release(priority)
+        raise
+    except Exception:
+        concurrency_gate.release(priority)
+        core.circuit_breaker.record(True, time.perf_counter() - started)
+        raise
+    # 流式请求按首字节时间判断慢调用
+    core.circuit_breaker.record(response.status_code >= 500, time.perf_counter() - started)
+    model = api_data.get('model')
+    core.record_request(client, model)
+    # 流式请求记录的是收到响应头（首字节）的时间
+    timer.add('upstream', time.perf_counter() - started)
+    core.metrics.observe_upstream(model, response.status_code, time.perf_counter() - started)
+
+    if response.status_code != 200:
+        concurrency_gate.release(priority)
+        core.upstream_keys.release(key)
+        await abandon_idempotent(idempotency_key)
+        body = await response.aread()
+        await response.aclose()
+        core.traffic_capture.upstream(api_data, response.status_code, time.perf_counter() - started, body)
+        message = core.error_excerpt(body)
+        logger.error(f"DeepSeek API error: {response.status_code} - {message}",
+                     extra=core.log_fields(request_id=timer.request_id, upstream_status=response.status_code,
+                                           model=model))
+        return JSONResponse({
+            'error': 'API request failed',
+            'status_code': response.status_code,
+            'message': message
+        }, status_code=response.status_code)
+
+    recorder = core.traffic_capture.stream(api_data, time.perf_counter() - started)
+
+    async def relay():
+        scanner = core.SSEUsageScanner()
+        chunks = [] if idempotency_key else None
+        finished = False
+        expired = False
+        iterator = response.aiter_bytes().__aiter__()
+        try:
+            while True:
+                try:
+                    chunk = await before_deadline(iterator.__anext__(), deadline)
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    # 超过截止时间后不再转发，与同步引擎一致
+                    expired = True
+                    logger.warning("Request deadline exceeded while streaming, closing the upstream response")
+                    break
+                scanner.feed(chunk)
+                if recorder is not None:
+                    recorder.feed(chunk)
+                if chunks is not None:
+                    chunks.append(chunk)
+                yield chunk
+            finished = not expired
+        finally:
+            concurrency_gate.release(priority)
+            core.upstream_keys.release(key)
+            scanner.close()
+            # SQLite 写入（幂等记录、共享的 token 额度）放到线程池且不等待：客户端断开时这里的 await 会被取消
+            if idempotency_key is not None:
+                if finished:
+                    run_in_background(core.idempotency_store.complete, idempotency_key, 'text/event-stream',
+                                      b''.join(chunks))
+                else:
+                    run_in_background(core.idempotency_store.abandon, idempotency_key)
+            run_in_background(core.record_tokens, client, model, scanner.total_tokens, timer.workload,
+                              blocking=core.rate_limiter.shared)
+            if recorder is not None:
+                recorder.finish(scanner.total_tokens)
+            timer.tokens = scanner.total_tokens
+            timer.finish()
+            # 客户端中途断开记为 499，超过截止时间被截断记为 504
+            core.log_request(timer, '/api/chat', 200 if finished else 504 if expired else 499, stream=True)
+            await response.aclose()
+
+    return StreamingResponse(relay(), media_type='text/event-stream', headers=core.SSE_HEADERS)
+
+
+async def prometheus_metrics(request):
+    """Prometheus 指标"""
+    core.metrics.set_pool(upstream.idle_connections(), upstream.active)
+    body, content_type = core.metrics.render()
+    return Response(body, headers={'Content-Type': content_type})
+
+
+async def upload_resume(request):
+    """上传简历，返回内容哈希，与同步引擎一致"""
+    if not core.check_client_auth(request.headers.get('Authorization', '')):
+        return JSONResponse({'error': 'Unauthorized'}, status_code=401)
+
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    resume = data.get('resume') if isinstance(data, dict) else None
+    if not isinstance(resume, str) or not resume.strip():
+        return JSONResponse({'error': 'Invalid request body'}, status_code=400)
+    size = len(resume.encode('utf-8'))
+    if size > core.RESUME_MAX_BYTES:
+        return JSONResponse({'error': f'Resume too large (max {core.RESUME_MAX_BYTES} bytes)'}, status_code=413)
+
+    return JSONResponse({'resume_hash': await offload(core.resume_store.put, resume), 'bytes': size})
+
+
+async def check_resume(request):
+    """检查简历是否已上传（不返回简历内容）"""
+    if not core.check_client_auth(request.headers.get('Authorization', '')):
+        return JSONResponse({'error': 'Unauthorized'}, status_code=401)
+    resume_hash = request.path_params['resume_hash']
+    if await offload(core.resume_store.get, resume_hash) is None:
+        return JSONResponse({'error': 'Resume not found', 'code': 'resume_not_found'}, status_code=404)
+    return JSONResponse({'resume_hash': resume_hash})
+
+
+async def list_templates(request):
+    """可用的提示词模板"""
+    if not core.check_client_auth(request.headers.get('Authorization', '')):
+        return JSONResponse({'error': 'Unauthorized'}, status_code=401)
+    return JSONResponse({'templates': core.template_catalog()})
+
+
+async def get_stats(request):
+    """获取使用统计（需要认证），查询参数与同步引擎一致"""
+    if not core.check_client_auth(request.headers.get('Authorization', ''), required=True):
+        return JSONResponse({'error': 'Unauthorized'}, status_code=401)
+
+    # 使用量汇总需要写入和查询 SQLite，在线程池中执行
+    stats = dict(await offload(core.usage_summary), cache=core.response_cache.stats(), coalescing=coalescer.stats(),
+                 rate_limit=core.rate_limiter.stats(), concurrency=concurrency_gate.stats(),
+                 priority_latency=core.priority_latency.stats(), circuit_breaker=core.circuit_breaker.stats(),
+                 hedging=core.hedger.stats(), upstream_keys=core.upstream_keys.stats(),
+                 resumes=core.resume_store.stats(), capture=core.traffic_capture.stats(),
+                 workloads=core.workload_stats.stats(), idempotency=core.idempotency_store.stats(),
+                 logging=core.log_handler.stats() if core.log_handler else None, peers=core.peer_ring.stats())
+    params = request.query_params
+    if params.get('from') or params.get('to') or params.get('group_by'):
+        stats['usage'] = await offload(
+            core.usage_accounting.query, params.get('from'), params.get('to'), params.get('group_by', 'day').split(',')
+        )
+    return JSONResponse(stats)
+
+
+async def reset_stats(request):
+    """重置统计（需要认证）"""
+    if not core.check_client_auth(request.headers.get('Authorization', ''), required=True):
+        return JSONResponse({'error': 'Unauthorized'}, status_code=401)
+
+    await offload(core.reset_usage_stats)
+    return JSONResponse({'message': 'Stats reset successfully'})
+
+
+@asynccontextmanager
+async def lifespan(app):
+    """进程启动时创建上游客户端（多节点模式下还有转发用的客户端），退出时关闭连接池"""
+    await upstream.start()
+    await peers.start()
+    try:
+        yield
+    finally:
+        await peers.close()
+        await upstream.close()
+
+
+app = Starlette(
+    routes=[
+        Route('/health', health_check, methods=['GET']),
+        Route('/metrics', prometheus_metrics, methods=['GET']),
+        Route('/api/chat', chat_completion, methods=['POST']),
+        Route('/api/chat/batch', chat_completion_batch, methods=['POST']),
+        Route(core.PEER_PATH, peer_chat, methods=['POST']),
+        Route('/api/resumes', upload_resume, methods=['POST']),
+        Route('/api/resumes/{resume_hash}', check_resume, methods=['GET']),
+        Route('/api/templates', list_templates, methods=['GET']),
+        Route('/api/stats', get_stats, methods=['GET']),
+        Route('/api/reset-stats', reset_stats, methods=['POST']),
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])],
+    lifespan=lifespan
+)
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    host = os.getenv('HOST', '0.0.0.0')
+    port = int(os.getenv('PORT', 5000))
+    uvicorn.run(app, host=host, port=port, log_level='info')
@@ -5,48 +5,3079 @@ DeepSeek API 代理服务器
 功能：作为中间层，隐藏真实的 API Key，客户端通过代理服务器调用 API
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context, g
 from flask_cors import CORS
+from werkzeug.datastructures import Headers
 import requests
+from requests.adapters import HTTPAdapter
+import atexit
+import bisect
+import copy
+import gzip
+import hashlib
+import hmac
+import json
 import os
+import queue
+import random
+import re
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 from datetime import datetime
+from urllib.parse import urlparse
 import logging
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+    PROMETHEUS_AVAILABLE = True
+except ImportError:
+    PROMETHEUS_AVAILABLE = False
 
 app = Flask(__name__)
 CORS(app)  # 允许跨域请求
 
-# 配置日志
-logging.basicConfig(level=logging.INFO)
+# 配置日志（处理器见下方“日志”一节）
 logger = logging.getLogger(__name__)
 
 # 从环境变量或配置文件读取 API Key
 DEEPSEEK_API_KEY = os.getenv('DEEPSEEK_API_KEY', 'sk-aa830600ff6b46839da3e59734f82c89')
 DEEPSEEK_API_URL = "https://api.deepseek.com/v1/chat/completions"
+# 多个上游 key（逗号分隔）：每个请求发给在途请求最少、且没有在冷却中的 key；为空则只用 DEEPSEEK_API_KEY
+DEEPSEEK_API_KEYS = [key.strip() for key in os.getenv('DEEPSEEK_API_KEYS', '').split(',') if key.strip()]
+# 上游地址（逗号分隔，可选）：数量与 key 相同时按顺序一一对应，否则每个 key 搭配每个地址
+DEEPSEEK_API_URLS = [url.strip() for url in os.getenv('DEEPSEEK_API_URLS', '').split(',') if url.strip()]
+# key 收到 429 且响应头没有给出重置时间时的冷却秒数
+UPSTREAM_KEY_COOLDOWN = float(os.getenv('UPSTREAM_KEY_COOLDOWN', 10))
 
 # API 密钥（用于验证客户端请求，可选）
 SERVER_API_KEY = os.getenv('SERVER_API_KEY', 'your-server-api-key-here')
+# 额外的客户端密钥（逗号分隔），可调用 /api/chat，限流按密钥分别计算；统计接口仍只认 SERVER_API_KEY
+SERVER_API_KEYS = [key.strip() for key in os.getenv('SERVER_API_KEYS', '').split(',') if key.strip()]
 
-# 使用量统计
-usage_stats = {
-    'total_requests': 0,
-    'total_tokens': 0,
-    'requests_today': 0,
-    'last_reset_date': datetime.now().strftime('%Y-%m-%d')
+# 服务引擎：sync（Flask + gunicorn 同步 worker）或 async（ASGI + httpx，见 api_proxy_async.py）
+PROXY_ENGINE = os.getenv('PROXY_ENGINE', 'sync').lower()
+
+# 上游连接池配置（每个 worker 进程一个连接池）
+UPSTREAM_POOL_SIZE = int(os.getenv('UPSTREAM_POOL_SIZE', 20))
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv('UPSTREAM_CONNECT_TIMEOUT', 5))
+UPSTREAM_READ_TIMEOUT = float(os.getenv('UPSTREAM_READ_TIMEOUT', 60))
+UPSTREAM_DNS_TTL = float(os.getenv('UPSTREAM_DNS_TTL', 300))
+UPSTREAM_WARMUP_CONNECTIONS = int(os.getenv('UPSTREAM_WARMUP_CONNECTIONS', 2))
+
+# 响应缓存配置（只缓存低温度、非流式的确定性请求）
+CACHE_ENABLED = os.getenv('CACHE_ENABLED', 'True').lower() == 'true'
+CACHE_MAX_BYTES = int(os.getenv('CACHE_MAX_BYTES', 64 * 1024 * 1024))
+CACHE_MAX_TEMPERATURE = float(os.getenv('CACHE_MAX_TEMPERATURE', 0.3))
+CACHE_DEFAULT_TTL = int(os.getenv('CACHE_DEFAULT_TTL', 24 * 3600))
+# 按路由设置 TTL（秒），格式："/api/chat=86400,/api/chat/batch=86400"
+CACHE_ROUTE_TTLS = {
+    route.strip(): int(ttl)
+    for route, ttl in (item.split('=', 1) for item in os.getenv('CACHE_ROUTE_TTLS', '').split(',') if '=' in item)
+}
+# 磁盘缓存目录（可选，多个 gunicorn worker 共享），为空则只用内存缓存
+CACHE_DIR = os.getenv('CACHE_DIR', '')
+CACHE_DISK_MAX_BYTES = int(os.getenv('CACHE_DISK_MAX_BYTES', 512 * 1024 * 1024))
+
+# 共享存储（SQLite 文件，多个 gunicorn worker 共用），为空则各 worker 独立
+SHARED_DB_PATH = os.getenv('SHARED_DB_PATH', '')
+
+# 请求合并：相同的并发请求只调用一次上游
+COALESCE_ENABLED = os.getenv('COALESCE_ENABLED', 'True').lower() == 'true'
+# 跨 worker 合并时，等待方轮询共享存储的间隔（秒）
+COALESCE_POLL_INTERVAL = float(os.getenv('COALESCE_POLL_INTERVAL', 0.05))
+# 跨 worker 合并的结果在共享存储中保留的时间（秒）
+COALESCE_RESULT_GRACE = 1.0
+
+# 多节点缓存分片：PEER_NODES 为所有代理节点的地址（逗号分隔，包括本节点），PEER_SELF 为本节点在其中的地址。
+# 可缓存的请求按缓存键一致性哈希到一个 owner 节点，由它查缓存、合并请求并调用上游，其他节点把请求转发给它；
+# 节点之间用 PEER_SECRET 认证，三项都设置时才启用
+PEER_NODES = [url.strip().rstrip('/') for url in os.getenv('PEER_NODES', '').split(',') if url.strip()]
+PEER_SELF = os.getenv('PEER_SELF', '').strip().rstrip('/')
+PEER_SECRET = os.getenv('PEER_SECRET', '')
+# 每个节点在哈希环上的虚拟节点数（越多各节点分到的键越均匀）
+PEER_VNODES = int(os.getenv('PEER_VNODES', 100))
+# 连接 owner 节点的超时（秒）；连接失败的节点在 PEER_RETRY_SECONDS 秒内跳过，它的键由环上的下一个节点负责
+PEER_CONNECT_TIMEOUT = float(os.getenv('PEER_CONNECT_TIMEOUT', 1))
+PEER_RETRY_SECONDS = float(os.getenv('PEER_RETRY_SECONDS', 10))
+
+# 使用量统计：按 (日期, 客户端, 模型) 汇总写入 SQLite，所有 worker 共用，重启不丢失
+USAGE_DB_PATH = os.getenv('USAGE_DB_PATH', SHARED_DB_PATH or 'proxy_usage.db')
+# 每个 worker 批量写入统计的间隔（秒）
+USAGE_FLUSH_INTERVAL = float(os.getenv('USAGE_FLUSH_INTERVAL', 2))
+
+# 限流：每个客户端的请求速率（次/秒，0 表示不限）和突发上限
+RATE_LIMIT_RPS = float(os.getenv('RATE_LIMIT_RPS', 0))
+RATE_LIMIT_BURST = float(os.getenv('RATE_LIMIT_BURST', max(1, RATE_LIMIT_RPS * 2)))
+# 每个客户端每分钟 token 上限（0 表示不限）
+RATE_LIMIT_TPM = float(os.getenv('RATE_LIMIT_TPM', 0))
+# 全局上游并发上限（0 表示不限）、排队上限和最长排队时间（秒）
+PROXY_MAX_CONCURRENCY = int(os.getenv('PROXY_MAX_CONCURRENCY', 0))
+PROXY_MAX_QUEUE = int(os.getenv('PROXY_MAX_QUEUE', 100))
+PROXY_QUEUE_TIMEOUT = float(os.getenv('PROXY_QUEUE_TIMEOUT', 30))
+
+# 优先级类别（从高到低）：短请求（匹配度评分）排在长请求（简历生成）前面
+PRIORITY_CLASSES = ('high', 'normal', 'low')
+# max_tokens 不超过该值的请求默认归为 high
+PRIORITY_HIGH_MAX_TOKENS = int(os.getenv('PRIORITY_HIGH_MAX_TOKENS', 200))
+# 每个类别的上游并发预算，格式："high=8,normal=4,low=2"（0 或不写表示只受全局上限约束）
+PRIORITY_BUDGETS = {
+    cls.strip(): int(budget)
+    for cls, budget in (item.split('=', 1) for item in os.getenv('PRIORITY_BUDGETS', '').split(',') if '=' in item)
+}
+# 防饿死：排队超过该秒数的请求不论类别优先放行
+PRIORITY_MAX_WAIT = float(os.getenv('PRIORITY_MAX_WAIT', 5))
+
+# 批量接口：单次最多请求数和每个批次的上游并发数
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', 100))
+BATCH_MAX_CONCURRENCY = int(os.getenv('BATCH_MAX_CONCURRENCY', 8))
+
+# 熔断：最近 CIRCUIT_WINDOW 次上游调用中失败或慢调用比例超过阈值时打开，打开期间直接返回 503
+CIRCUIT_ENABLED = os.getenv('CIRCUIT_ENABLED', 'True').lower() == 'true'
+CIRCUIT_WINDOW = int(os.getenv('CIRCUIT_WINDOW', 20))
+CIRCUIT_MIN_CALLS = int(os.getenv('CIRCUIT_MIN_CALLS', 10))
+CIRCUIT_ERROR_RATE = float(os.getenv('CIRCUIT_ERROR_RATE', 0.5))
+# 超过该秒数的调用算作慢调用
+CIRCUIT_SLOW_SECONDS = float(os.getenv('CIRCUIT_SLOW_SECONDS', 30))
+CIRCUIT_SLOW_RATE = float(os.getenv('CIRCUIT_SLOW_RATE', 0.8))
+# 打开后多久放行一个探测请求（秒）
+CIRCUIT_OPEN_SECONDS = float(os.getenv('CIRCUIT_OPEN_SECONDS', 30))
+
+# 对冲请求：短的确定性请求（匹配度评分）超过近期 p95 延迟仍未返回时，再发一个相同请求，用先返回的结果
+HEDGE_ENABLED = os.getenv('HEDGE_ENABLED', 'False').lower() == 'true'
+# 对冲等待时间的下限（秒），样本不足 HEDGE_MIN_SAMPLES 个时不对冲
+HEDGE_MIN_DELAY = float(os.getenv('HEDGE_MIN_DELAY', 0.5))
+HEDGE_MIN_SAMPLES = int(os.getenv('HEDGE_MIN_SAMPLES', 20))
+
+# 请求截止时间：客户端通过该请求头给出剩余预算（毫秒），限制排队之后的上游耗时
+DEADLINE_HEADER = 'X-Deadline-Ms'
+
+# 上游错误响应体在日志和返回给客户端的错误信息中最多保留的字节数
+UPSTREAM_ERROR_BODY_LIMIT = 500
+
+# 简历存储：单份简历的最大字节数，以及多少天没有上传/使用后删除
+RESUME_MAX_BYTES = int(os.getenv('RESUME_MAX_BYTES', 200 * 1024))
+RESUME_TTL_DAYS = float(os.getenv('RESUME_TTL_DAYS', 30))
+
+# 幂等键：带 Idempotency-Key 请求头的 /api/chat 请求，成功的响应保存 IDEMPOTENCY_TTL 秒，
+# 客户端超时后用相同的键重试时直接返回保存的响应（处理中则等待其完成），不再调用上游
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+IDEMPOTENCY_TTL = int(os.getenv('IDEMPOTENCY_TTL', 3600))
+# 超过该大小的响应（主要是流式响应）不保存
+IDEMPOTENCY_MAX_BYTES = int(os.getenv('IDEMPOTENCY_MAX_BYTES', 1024 * 1024))
+# 相同的请求仍在处理时，重试最多等待的秒数（不超过请求的 X-Deadline-Ms），仍未完成返回 409；
+# 同步引擎等待期间占用一个 worker，因此远小于上游超时
+IDEMPOTENCY_WAIT_SECONDS = float(os.getenv('IDEMPOTENCY_WAIT_SECONDS', 15))
+
+# 按工作负载类别路由模型：类别由 X-Workload 请求头或模板 id 的名称（如 score@1 → score）确定，否则为 default。
+# 格式为 JSON，如 '{"score": {"model": "deepseek-chat", "max_tokens": 50}}'；
+# 配置的 model / temperature / max_tokens 替换客户端（或模板）给出的值，未配置的类别原样转发
+MODEL_ROUTES = json.loads(os.getenv('MODEL_ROUTES', '') or '{}')
+# 每百万 token 的价格（按类别估算成本），格式："deepseek-chat=0.5,deepseek-reasoner=1.2"
+MODEL_PRICES = {
+    model.strip(): float(price)
+    for model, price in (item.split('=', 1) for item in os.getenv('MODEL_PRICES', '').split(',') if '=' in item)
+}
+
+# 流量录制：CAPTURE_DIR 非空时开启，按缓存键抽样 CAPTURE_SAMPLE_RATE 比例的请求，
+# 写入 gzip 压缩的 JSONL 文件；单个文件超过 CAPTURE_FILE_BYTES（未压缩）后轮转，最多保留 CAPTURE_MAX_FILES 个
+CAPTURE_DIR = os.getenv('CAPTURE_DIR', '')
+CAPTURE_SAMPLE_RATE = float(os.getenv('CAPTURE_SAMPLE_RATE', 0.01))
+CAPTURE_FILE_BYTES = int(os.getenv('CAPTURE_FILE_BYTES', 64 * 1024 * 1024))
+CAPTURE_MAX_FILES = int(os.getenv('CAPTURE_MAX_FILES', 20))
+# 默认把消息和回复内容替换为等长的哈希填充（相同内容替换结果相同），只保留结构、长度和时序
+CAPTURE_REDACT_CONTENT = os.getenv('CAPTURE_REDACT_CONTENT', 'True').lower() == 'true'
+
+# 日志：请求线程只把日志记录放进有界队列（LOG_QUEUE_SIZE 条），由后台线程写到 stderr，队列满时丢弃并计数。
+# LOG_FORMAT 为 json（每行一个 JSON 对象）或 text
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json').lower()
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+# 访问日志：每个 /api/chat 请求结束时一条（request_id、客户端、模型、token 数、各阶段耗时），
+# 失败的请求都记录，成功的请求按该比例抽样
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', 0.1))
+# 单条日志消息的最大字符数，超出部分截断（如异常信息中带的整段响应）
+LOG_MESSAGE_MAX_CHARS = int(os.getenv('LOG_MESSAGE_MAX_CHARS', 2000))
+
+
+# ========== 日志 ==========
+
+REQUEST_ID_HEADER = 'X-Request-Id'
+_REQUEST_ID_RE = re.compile(r'[A-Za-z0-9._:-]{1,64}')
+
+
+class JsonLogFormatter(logging.Formatter):
+    """每条日志一行 JSON：时间、级别、进程号、logger 名、消息，以及 extra={'fields': {...}} 给出的字段"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'pid': record.process,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class AsyncLogHandler(logging.Handler):
+    """
+    非阻塞日志处理器：emit 只把记录放进有界队列，由后台线程交给 target 写出，请求线程从不等待 stderr。
+    队列满时丢弃记录并计数。写线程按进程启动（gunicorn fork 出的每个 worker 各有一个）。
+    """
+
+    def __init__(self, target, maxsize=LOG_QUEUE_SIZE, max_chars=LOG_MESSAGE_MAX_CHARS):
+        super().__init__()
+        self.target = target
+        self.max_chars = max_chars
+        self.maxsize = maxsize
+        self.queue = queue.Queue(maxsize)
+        self.dropped = 0
+        self._pid = None
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._exc_formatter = logging.Formatter()
+
+    def _ensure_writer(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid != os.getpid():
+                # fork 之后父进程的写线程不存在了，队列中的记录由父进程自己写出
+                self.queue = queue.Queue(self.maxsize)
+                self._thread = threading.Thread(target=self._write_loop, name='log-writer', daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def emit(self, record):
+        try:
+            self._ensure_writer()
+            # 在调用线程里展开消息和异常：写线程不再引用请求中的对象，超长的消息在这里截断
+            message = record.getMessage()
+            if len(message) > self.max_chars:
+                message = f"{message[:self.max_chars]}...({len(message) - self.max_chars} chars truncated)"
+            record = copy.copy(record)
+            record.msg, record.args = message, None
+            if record.exc_info:
+                record.exc_text = self._exc_formatter.formatException(record.exc_info)
+                record.exc_info = None
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def _write_loop(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                return
+            self.target.handle(record)
+
+    def close(self):
+        """进程退出时（logging.shutdown）写完队列中剩余的日志"""
+        if self._pid == os.getpid() and self._thread is not None:
+            # 队列满时等写线程腾出位置再放入结束标记，总共最多等 2 秒
+            deadline = time.monotonic() + 2
+            try:
+                self.queue.put(None, timeout=2)
+            except queue.Full:
+                pass
+            self._thread.join(timeout=max(deadline - time.monotonic(), 0))
+            self._thread = None
+        self.target.flush()
+        super().close()
+
+    def stats(self):
+        return {'format': LOG_FORMAT, 'queued': self.queue.qsize(), 'dropped': self.dropped}
+
+
+def configure_logging():
+    """
+    根 logger 挂一个 AsyncLogHandler（代替 logging.basicConfig 的同步 StreamHandler）。
+    与 basicConfig 一样，根 logger 已有处理器时（由宿主程序配置）不做改动，返回 None
+    """
+    root = logging.getLogger()
+    if root.handlers:
+        return None
+    target = logging.StreamHandler()
+    if LOG_FORMAT == 'json':
+        target.setFormatter(JsonLogFormatter())
+    else:
+        target.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    handler = AsyncLogHandler(target)
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+    return handler
+
+
+log_handler = configure_logging()
+
+
+def request_id(headers):
+    """沿用客户端（或前面的负载均衡）给出的 X-Request-Id，否则生成一个"""
+    value = headers.get(REQUEST_ID_HEADER, '')
+    return value if _REQUEST_ID_RE.fullmatch(value) else uuid.uuid4().hex
+
+
+def log_request(timer, route, status, stream=False):
+    """
+    请求结束时写一条结构化访问日志（各阶段耗时为毫秒）
+    失败的请求（status >= 400）都记录，成功的请求按 LOG_SAMPLE_RATE 抽样
+    """
+    if status < 400 and random.random() >= LOG_SAMPLE_RATE:
+        return
+    level = logging.WARNING if status >= 500 else logging.INFO
+    if not logger.isEnabledFor(level):
+        return
+    logger.log(level, f"{route} {status}", extra={'fields': {
+        'event': 'request',
+        'request_id': timer.request_id,
+        'route': route,
+        'status': status,
+        'client': timer.client,
+        'model': timer.model,
+        'workload': timer.workload,
+        'priority': timer.priority,
+        'stream': stream,
+        'cache': timer.cache,
+        'tokens': timer.tokens,
+        'stages_ms': {stage: round(seconds * 1000, 1) for stage, seconds in timer.stages.items()},
+    }})
+
+
+def log_fields(**fields):
+    """logger 调用的 extra 参数：JSON 格式时作为额外字段输出"""
+    return {'fields': fields}
+
+
+# ========== 请求处理公共函数（同步/异步引擎共用） ==========
+
+def check_client_auth(auth_header, required=False):
+    """
+    校验客户端 Authorization 头
+    required=False 时，未配置 SERVER_API_KEY 则放行
+    """
+    server_key_set = SERVER_API_KEY and SERVER_API_KEY != 'your-server-api-key-here'
+    if not required and not server_key_set and not SERVER_API_KEYS:
+        return True
+    if not auth_header.startswith('Bearer '):
+        return False
+    token = auth_header[7:]
+    if required:
+        return token == SERVER_API_KEY
+    return (server_key_set and token == SERVER_API_KEY) or token in SERVER_API_KEYS
+
+
+def build_upstream_headers(api_key=None):
+    """构建发往 DeepSeek API 的请求头（api_key 为空时使用 DEEPSEEK_API_KEY）"""
+    return {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_key or DEEPSEEK_API_KEY}"
+    }
+
+
+def build_upstream_payload(data):
+    """从客户端请求体构建 DeepSeek API 请求体"""
+    api_data = {
+        "model": data.get('model', 'deepseek-chat'),
+        "messages": data.get('messages', []),
+        "temperature": data.get('temperature', 0.7),
+        "max_tokens": data.get('max_tokens', 2000)
+    }
+    if data.get('stream'):
+        # 流式请求：要求上游在最后一个 chunk 中返回 usage，便于统计 token
+        api_data['stream'] = True
+        api_data['stream_options'] = {'include_usage': True}
+    return api_data
+
+
+# SSE 流式响应头（X-Accel-Buffering 关闭 nginx 的响应缓冲）
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no'
+}
+
+
+class SSEUsageScanner:
+    """
+    在原样转发 SSE 字节流的同时，从带 usage 的 chunk 中取出 total_tokens。
+    只解析包含 "usage" 的行，其余 chunk 不做 JSON 解析。
+    """
+
+    def __init__(self):
+        self._buffer = b''
+        self.total_tokens = 0
+
+    def feed(self, chunk):
+        self._buffer += chunk
+        *lines, self._buffer = self._buffer.split(b'\n')
+        for line in lines:
+            self._scan_line(line)
+
+    def close(self):
+        if self._buffer:
+            self._scan_line(self._buffer)
+            self._buffer = b''
+
+    def _scan_line(self, line):
+        if not line.startswith(b'data:') or b'"usage"' not in line:
+            return
+        try:
+            usage = json.loads(line[5:].strip()).get('usage')
+        except ValueError:
+            return
+        if usage:
+            self.total_tokens = usage.get('total_tokens', 0)
+
+
+_TOTAL_TOKENS_RE = re.compile(rb'"total_tokens"\s*:\s*(\d+)')
+
+
+def scan_total_tokens(body):
+    """
+    从非流式响应的原始字节中取出 usage.total_tokens，不解析整个 JSON。
+    usage 在响应末尾，从后往前找；正文里出现的同名字符串都带转义引号，不会误匹配。
+    """
+    pos = body.rfind(b'"total_tokens"')
+    if pos < 0:
+        return 0
+    match = _TOTAL_TOKENS_RE.match(body, pos)
+    return int(match.group(1)) if match else 0
+
+
+def wants_lean(headers):
+    """客户端通过 X-Proxy-Response: lean 请求精简响应"""
+    return headers.get('X-Proxy-Response', '').lower() == 'lean'
+
+
+def lean_result(result):
+    """精简响应：只保留 choices[0].message.content 和 usage（桌面客户端只读取这两项），格式与完整响应兼容"""
+    choices = result.get('choices') or [{}]
+    content = (choices[0].get('message') or {}).get('content', '')
+    return {
+        'choices': [{'message': {'role': 'assistant', 'content': content}}],
+        'usage': result.get('usage', {})
+    }
+
+
+_JSON_KEY_VALUE_RE = re.compile(rb'\s*:\s*')
+
+
+def _raw_json_value(body, pos):
+    """返回从 pos 开始的 JSON 字符串或对象的原始字节（对象内不能含带括号的字符串），格式不符时返回 None"""
+    if body[pos:pos + 1] == b'"':
+        end = pos + 1
+        while True:
+            end = body.find(b'"', end)
+            if end < 0:
+                return None
+            # 前面有奇数个反斜杠的引号是转义的
+            backslashes = end - 1
+            while body[backslashes] == 0x5c:
+                backslashes -= 1
+            if (end - 1 - backslashes) % 2 == 0:
+                return body[pos:end + 1]
+            end += 1
+    if body[pos:pos + 1] == b'{':
+        depth = 0
+        for end in range(pos, len(body)):
+            if body[end] == 0x7b:
+                depth += 1
+            elif body[end] == 0x7d:
+                depth -= 1
+                if depth == 0:
+                    return body[pos:end + 1]
+    return None
+
+
+def _raw_json_field(body, key, reverse=False):
+    """取 body 中 key（带引号的字节串）对应值的原始字节"""
+    pos = body.rfind(key) if reverse else body.find(key)
+    if pos < 0:
+        return None
+    match = _JSON_KEY_VALUE_RE.match(body, pos + len(key))
+    return _raw_json_value(body, match.end()) if match else None
+
+
+def lean_body(body):
+    """
+    由上游响应字节生成精简响应字节（内容同 lean_result）。
+    直接截取 content 字符串和 usage 对象的原始字节，不解析整个 JSON；格式不符合预期时退回完整解析。
+    """
+    content = _raw_json_field(body, b'"content"')
+    usage = _raw_json_field(body, b'"usage"', reverse=True)
+    if content is None or usage is None:
+        return json.dumps(lean_result(json.loads(body)), ensure_ascii=False).encode('utf-8')
+    return b''.join((b'{"choices":[{"message":{"role":"assistant","content":', content,
+                     b'}}],"usage":', usage, b'}'))
+
+
+def error_excerpt(body):
+    """上游错误响应体的前 UPSTREAM_ERROR_BODY_LIMIT 个字节（用于日志和错误信息）"""
+    return body[:UPSTREAM_ERROR_BODY_LIMIT].decode('utf-8', 'replace')
+
+
+def client_id(auth_header):
+    """
+    客户端标识：Authorization 中 token 的哈希前缀（不保存明文密钥）
+    未携带 token 的请求记为 anonymous
+    """
+    if not auth_header.startswith('Bearer ') or not auth_header[7:]:
+        return 'anonymous'
+    return hashlib.sha256(auth_header[7:].encode('utf-8')).hexdigest()[:12]
+
+
+def record_request(client, model):
+    """统计一次上游请求"""
+    usage_accounting.record(client, model, requests=1)
+
+
+def record_tokens(client, model, total_tokens, workload=None):
+    """统计 token 使用量（同时扣除该客户端的 token 限额），workload 不为空时同时计入该类别的用量"""
+    if total_tokens:
+        usage_accounting.record(client, model, tokens=total_tokens)
+        metrics.add_tokens(model, total_tokens, workload)
+        rate_limiter.consume_tokens(client, total_tokens)
+        if workload is not None:
+            workload_stats.add_tokens(workload, model, total_tokens)
+
+
+def usage_summary():
+    """/api/stats 的基础统计字段（所有 worker 合计）"""
+    return usage_accounting.summary()
+
+
+def reset_usage_stats():
+    """清零使用统计"""
+    usage_accounting.reset()
+
+
+# ========== 监控指标 ==========
+
+class StageTimer:
+    """记录一次请求各阶段耗时（秒），用于 Server-Timing 响应头和 /metrics 直方图，以及访问日志的字段"""
+
+    __slots__ = ('start', 'stages', 'priority', 'workload', 'request_id', 'client', 'model', 'cache', 'tokens')
+
+    def __init__(self, request_id=None):
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.priority = 'normal'
+        self.workload = 'default'
+        self.request_id = request_id
+        self.client = None
+        self.model = None
+        self.cache = None
+        self.tokens = None
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def finish(self):
+        self.stages['total'] = time.perf_counter() - self.start
+
+    def server_timing(self):
+        return ', '.join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in self.stages.items())
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+OVERHEAD_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1, 5)
+
+
+class ProxyMetrics:
+    """
+    Prometheus 指标。未安装 prometheus_client 时所有方法都是空操作。
+    gunicorn 多 worker 部署时设置 PROMETHEUS_MULTIPROC_DIR，/metrics 会汇总所有 worker 的数据。
+    """
+
+    def __init__(self):
+        self.enabled = PROMETHEUS_AVAILABLE
+        if not self.enabled:
+            return
+        self.request_seconds = prometheus_client.Histogram(
+            'proxy_request_seconds', 'Total time spent handling a request', ['route', 'priority'],
+            buckets=LATENCY_BUCKETS)
+        self.upstream_seconds = prometheus_client.Histogram(
+            'proxy_upstream_seconds', 'Time spent waiting for DeepSeek', ['model'], buckets=LATENCY_BUCKETS)
+        self.queue_seconds = prometheus_client.Histogram(
+            'proxy_queue_wait_seconds', 'Time spent waiting for an upstream slot', ['route', 'priority'],
+            buckets=OVERHEAD_BUCKETS)
+        self.serialize_seconds = prometheus_client.Histogram(
+            'proxy_serialize_seconds', 'Time spent encoding the response body', ['route'], buckets=OVERHEAD_BUCKETS)
+        self.upstream_responses = prometheus_client.Counter(
+            'proxy_upstream_responses_total', 'Upstream responses by status code', ['status'])
+        self.tokens = prometheus_client.Counter(
+            'proxy_tokens_total', 'Tokens reported by the upstream', ['model'])
+        self.workload_seconds = prometheus_client.Histogram(
+            'proxy_workload_seconds', 'Total time spent handling a request by workload class', ['workload'],
+            buckets=LATENCY_BUCKETS)
+        self.workload_tokens = prometheus_client.Counter(
+            'proxy_workload_tokens_total', 'Upstream tokens by workload class and routed model', ['workload', 'model'])
+        self.in_flight = prometheus_client.Gauge(
+            'proxy_requests_in_flight', 'Requests currently being handled', multiprocess_mode='livesum')
+        self.pool_connections = prometheus_client.Gauge(
+            'proxy_upstream_pool_connections', 'Upstream pool connections by state', ['state'],
+            multiprocess_mode='livesum')
+        self.key_in_flight = prometheus_client.Gauge(
+            'proxy_upstream_key_in_flight', 'In-flight upstream calls per API key', ['key'],
+            multiprocess_mode='livesum')
+        self.key_responses = prometheus_client.Counter(
+            'proxy_upstream_key_responses_total', 'Upstream responses per API key by status code', ['key', 'status'])
+        self.key_cooldowns = prometheus_client.Counter(
+            'proxy_upstream_key_cooldowns_total', 'Times an API key was put into rate-limit cooldown', ['key'])
+
+    def request_started(self):
+        if self.enabled:
+            self.in_flight.inc()
+
+    def request_finished(self):
+        if self.enabled:
+            self.in_flight.dec()
+
+    def observe_request(self, route, timer):
+        if not self.enabled:
+            return
+        stages = timer.stages
+        self.request_seconds.labels(route, timer.priority).observe(stages.get('total', 0.0))
+        self.workload_seconds.labels(timer.workload).observe(stages.get('total', 0.0))
+        if 'queue' in stages:
+            self.queue_seconds.labels(route, timer.priority).observe(stages['queue'])
+        if 'serialize' in stages:
+            self.serialize_seconds.labels(route).observe(stages['serialize'])
+
+    def observe_upstream(self, model, status_code, seconds):
+        if self.enabled:
+            self.upstream_seconds.labels(model or '').observe(seconds)
+            self.upstream_responses.labels(str(status_code)).inc()
+
+    def add_tokens(self, model, total_tokens, workload=None):
+        if self.enabled and total_tokens:
+            self.tokens.labels(model or '').inc(total_tokens)
+            if workload is not None:
+                self.workload_tokens.labels(workload, model or '').inc(total_tokens)
+
+    def set_pool(self, idle, active):
+        if self.enabled:
+            self.pool_connections.labels('idle').set(idle)
+            self.pool_connections.labels('active').set(active)
+
+    def key_started(self, key):
+        if self.enabled:
+            self.key_in_flight.labels(key).inc()
+
+    def key_finished(self, key):
+        if self.enabled:
+            self.key_in_flight.labels(key).dec()
+
+    def observe_key(self, key, status_code, cooled_down):
+        if self.enabled:
+            self.key_responses.labels(key, str(status_code)).inc()
+            if cooled_down:
+                self.key_cooldowns.labels(key).inc()
+
+    def render(self):
+        """返回 (响应体, Content-Type)"""
+        if not self.enabled:
+            return b'# prometheus_client is not installed\n', 'text/plain'
+        if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+            registry = prometheus_client.CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        else:
+            registry = prometheus_client.REGISTRY
+        return prometheus_client.generate_latest(registry), prometheus_client.CONTENT_TYPE_LATEST
+
+
+metrics = ProxyMetrics()
+
+
+# ========== 上游连接池 ==========
+
+_dns_cache = {}
+_dns_cache_lock = threading.Lock()
+_dns_cached_hosts = set()
+_original_getaddrinfo = socket.getaddrinfo
+
+
+def _cached_getaddrinfo(host, *args, **kwargs):
+    """带 TTL 的 DNS 缓存，只缓存上游主机，避免每次新建连接都重新解析"""
+    if host not in _dns_cached_hosts or UPSTREAM_DNS_TTL <= 0:
+        return _original_getaddrinfo(host, *args, **kwargs)
+
+    key = (host,) + args + tuple(sorted(kwargs.items()))
+    now = time.monotonic()
+    with _dns_cache_lock:
+        cached = _dns_cache.get(key)
+        if cached and cached[0] > now:
+            return cached[1]
+
+    result = _original_getaddrinfo(host, *args, **kwargs)
+    with _dns_cache_lock:
+        _dns_cache[key] = (now + UPSTREAM_DNS_TTL, result)
+    return result
+
+
+class KeepAliveAdapter(HTTPAdapter):
+    """开启 TCP keep-alive 的连接池适配器"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        socket_options = [(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+                          (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            socket_options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60))
+        kwargs['socket_options'] = socket_options
+        super().init_poolmanager(*args, **kwargs)
+
+
+class UpstreamClient:
+    """
+    上游 HTTP 客户端：复用 TCP/TLS 连接，避免每个请求重新握手。
+    gunicorn 的每个 worker 进程各持有一个实例（按 pid 区分）。
+    """
+
+    def __init__(self, pool_size=UPSTREAM_POOL_SIZE):
+        self.pid = os.getpid()
+        self.pool_size = pool_size
+        self.session = requests.Session()
+        self.adapter = KeepAliveAdapter(pool_connections=4, pool_maxsize=pool_size,
+                                        max_retries=0, pool_block=False)
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+        self.timeout = (UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT)
+        self._lock = threading.Lock()
+        self.active = 0
+        self.total_requests = 0
+
+    def register_host(self, url):
+        """把上游主机加入 DNS 缓存白名单"""
+        host = urlparse(url).hostname
+        if host:
+            _dns_cached_hosts.add(host)
+        if socket.getaddrinfo is not _cached_getaddrinfo:
+            socket.getaddrinfo = _cached_getaddrinfo
+
+    def post(self, url, timeout=None, **kwargs):
+        """发送 POST 请求，timeout 默认使用 (连接超时, 读取超时)"""
+        with self._lock:
+            self.active += 1
+            self.total_requests += 1
+        try:
+            return self.session.post(url, timeout=timeout or self.timeout, **kwargs)
+        finally:
+            with self._lock:
+                self.active -= 1
+
+    def warmup(self, url, connections=UPSTREAM_WARMUP_CONNECTIONS):
+        """预先建立若干条连接（并发 HEAD 请求，完成后连接回到池中）"""
+        def _open():
+            try:
+                self.session.head(url, timeout=self.timeout, allow_redirects=False)
+            except requests.exceptions.RequestException as e:
+                logger.warning(f"Upstream warmup failed: {e}")
+
+        threads = [threading.Thread(target=_open, daemon=True) for _ in range(max(connections, 0))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        logger.info(f"Upstream warmup done: {self.stats()['idle_connections']} idle connections")
+
+    def stats(self):
+        """连接池统计：空闲/活跃连接数和连接复用率"""
+        idle = 0
+        new_connections = 0
+        pool_requests = 0
+        for pool in list(self.adapter.poolmanager.pools._container.values()):
+            # 连接队列里预先填充了 None 占位，只统计真实的空闲连接
+            idle += sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool else 0
+            new_connections += pool.num_connections
+            pool_requests += pool.num_requests
+        reuse_ratio = 1 - new_connections / pool_requests if pool_requests else 0.0
+        # 字段与异步引擎的 AsyncUpstreamClient.stats 相同（同步引擎不限制在途请求数，也不排队）
+        return {
+            'engine': 'sync',
+            'http2': False,
+            'pool_size': self.pool_size,
+            'max_inflight': None,
+            'idle_connections': idle,
+            'active_connections': self.active,
+            'waiting_requests': 0,
+            'connections_opened': new_connections,
+            'requests': self.total_requests,
+            'reuse_ratio': round(max(reuse_ratio, 0.0), 4)
+        }
+
+
+_upstream_client = None
+_upstream_client_lock = threading.Lock()
+
+
+def get_upstream_client():
+    """获取当前 worker 进程的上游客户端（fork 之后会重新创建）"""
+    global _upstream_client
+    client = _upstream_client
+    if client is None or client.pid != os.getpid():
+        with _upstream_client_lock:
+            if _upstream_client is None or _upstream_client.pid != os.getpid():
+                _upstream_client = UpstreamClient()
+                for url in upstream_keys.urls():
+                    _upstream_client.register_host(url)
+            client = _upstream_client
+    return client
+
+
+def warmup_upstream():
+    """worker 启动时在后台预热上游连接（每个上游地址）"""
+    if UPSTREAM_WARMUP_CONNECTIONS <= 0:
+        return
+    for url in upstream_keys.urls():
+        parsed = urlparse(url)
+        base_url = f"{parsed.scheme}://{parsed.netloc}/"
+        threading.Thread(target=get_upstream_client().warmup, args=(base_url,), daemon=True).start()
+
+
+# ========== 上游 key 池 ==========
+
+_DURATION_RE = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+_DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+
+def parse_reset_seconds(value):
+    """解析限流重置时间：秒数（Retry-After）或 1m30s / 250ms 形式的时长，无法解析时返回 None"""
+    value = (value or '').strip()
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_RE.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+
+
+def rate_limit_cooldown(status_code, headers):
+    """根据上游响应的状态码和限流响应头计算 key 的冷却秒数，不需要冷却时返回 0"""
+    if status_code == 429:
+        for name in ('Retry-After', 'X-RateLimit-Reset-Requests', 'X-RateLimit-Reset-Tokens'):
+            seconds = parse_reset_seconds(headers.get(name))
+            if seconds:
+                return seconds
+        return UPSTREAM_KEY_COOLDOWN
+    # 剩余额度已经用完：提前冷却到重置时间，不等收到 429
+    for kind in ('Requests', 'Tokens'):
+        if headers.get(f'X-RateLimit-Remaining-{kind}') == '0':
+            seconds = parse_reset_seconds(headers.get(f'X-RateLimit-Reset-{kind}'))
+            if seconds:
+                return seconds
+    return 0
+
+
+class UpstreamKey:
+    """一个上游 key（及其地址）的在途请求数和冷却状态"""
+
+    __slots__ = ('name', 'api_key', 'url', 'in_flight', 'requests', 'throttled', 'cooldown_until')
+
+    def __init__(self, name, api_key, url):
+        self.name = name
+        self.api_key = api_key
+        self.url = url
+        self.in_flight = 0
+        self.requests = 0
+        self.throttled = 0
+        self.cooldown_until = 0.0
+
+
+class UpstreamKeyPool:
+    """
+    上游 key 池（每个 worker 独立）：每个请求发给在途请求最少、且不在冷却中的 key，
+    在途请求数相同时轮流选择，把各 key 的速率额度用均匀。
+    key 收到 429（或剩余额度为 0）时按上游的限流响应头冷却；所有 key 都在冷却时抛出 RateLimited。
+    """
+
+    def __init__(self, api_keys, urls):
+        if len(urls) == len(api_keys):
+            pairs = list(zip(api_keys, urls))
+        else:
+            pairs = [(api_key, url) for api_key in api_keys for url in urls]
+        self.keys = [UpstreamKey(f'key{index}', api_key, url) for index, (api_key, url) in enumerate(pairs)]
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def acquire(self):
+        """选一个 key 并计入在途请求，用完后调用 release()"""
+        now = time.monotonic()
+        with self._lock:
+            count = len(self.keys)
+            start = self._next
+            self._next = (start + 1) % count
+            ready = [key for key in self.keys[start:] + self.keys[:start] if key.cooldown_until <= now]
+            if not ready:
+                retry_after = min(key.cooldown_until for key in self.keys) - now
+                raise RateLimited('All upstream API keys are rate limited', retry_after)
+            key = min(ready, key=lambda candidate: candidate.in_flight)
+            key.in_flight += 1
+            key.requests += 1
+        metrics.key_started(key.name)
+        return key
+
+    def observe(self, key, status_code, headers):
+        """根据上游响应更新 key 的冷却时间"""
+        cooldown = rate_limit_cooldown(status_code, headers)
+        metrics.observe_key(key.name, status_code, cooldown > 0)
+        if cooldown <= 0:
+            return
+        with self._lock:
+            key.cooldown_until = max(key.cooldown_until, time.monotonic() + cooldown)
+            if status_code == 429:
+                key.throttled += 1
+        logger.warning(f"Upstream {key.name} rate limited, cooling down for {cooldown:.1f}s")
+
+    def release(self, key):
+        with self._lock:
+            key.in_flight -= 1
+        metrics.key_finished(key.name)
+
+    def has_ready_key(self):
+        now = time.monotonic()
+        return any(key.cooldown_until <= now for key in self.keys)
+
+    def urls(self):
+        return list(dict.fromkeys(key.url for key in self.keys))
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return [{
+                'key': key.name,
+                'api_key': f"{key.api_key[:3]}...{key.api_key[-4:]}",
+                'host': urlparse(key.url).netloc,
+                'in_flight': key.in_flight,
+                'requests': key.requests,
+                'throttled': key.throttled,
+                'cooldown_seconds': round(max(0.0, key.cooldown_until - now), 1)
+            } for key in self.keys]
+
+
+upstream_keys = UpstreamKeyPool(DEEPSEEK_API_KEYS or [DEEPSEEK_API_KEY], DEEPSEEK_API_URLS or [DEEPSEEK_API_URL])
+
+
+# ========== 响应缓存 ==========
+
+def cache_key(api_data):
+    """对 (model, messages, temperature, max_tokens) 做规范化 JSON 后取哈希"""
+    canonical = json.dumps(
+        [api_data.get('model'), api_data.get('messages'), api_data.get('temperature'), api_data.get('max_tokens')],
+        sort_keys=True, separators=(',', ':'), ensure_ascii=False
+    )
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def is_low_temperature(api_data, default):
+    """temperature 不超过 CACHE_MAX_TEMPERATURE（结果确定，可以缓存或重复发送）；不是数字时返回 False"""
+    try:
+        return float(api_data.get('temperature', default)) <= CACHE_MAX_TEMPERATURE
+    except (TypeError, ValueError):
+        return False
+
+
+def is_cacheable(api_data, headers):
+    """判断请求是否可以走缓存：确定性（低温度）、非流式、客户端未要求跳过"""
+    if not CACHE_ENABLED or api_data.get('stream'):
+        return False
+    if headers.get('X-Proxy-Cache', '').lower() == 'bypass':
+        return False
+    if 'no-cache' in headers.get('Cache-Control', '').lower():
+        return False
+    return is_low_temperature(api_data, 0.7)
+
+
+class ResponseCache:
+    """
+    两级响应缓存：
+    - 内存层：按字节数限制大小的 LRU，每个条目带过期时间
+    - 磁盘层（可选）：CACHE_DIR 下每个 key 一个文件，所有 worker 共享
+    缓存值是上游返回的原始响应字节，命中时直接返回，不做 JSON 解析
+    """
+
+    def __init__(self, max_bytes=CACHE_MAX_BYTES, cache_dir=CACHE_DIR, disk_max_bytes=CACHE_DISK_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._entries = OrderedDict()  # key -> (expires_at, body)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._disk_writes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    @property
+    def uses_disk(self):
+        """是否启用了磁盘层（读写会访问文件系统）"""
+        return bool(self.cache_dir)
+
+    def get(self, key):
+        body = self.get_memory(key)
+        if body is not None:
+            return body
+        return self.get_disk(key)
+
+    def get_memory(self, key):
+        """只查内存层，不访问磁盘；未命中返回 None（未命中次数由 get_disk 统计）"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                self._remove(key)
+        return None
+
+    def get_disk(self, key):
+        """查磁盘层（命中后回填内存层），在 get_memory 未命中后调用"""
+        body = self._disk_get(key, time.time())
+        with self._lock:
+            if body is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+        return body
+
+    def set(self, key, body, ttl):
+        if ttl <= 0 or len(body) > self.max_bytes:
+            return
+        expires_at = time.time() + ttl
+        self._memory_set(key, expires_at, body)
+        self._disk_set(key, expires_at, body)
+
+    def _memory_set(self, key, expires_at, body):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (expires_at, body)
+            self._bytes += len(body)
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, key):
+        expires_at, body = self._entries.pop(key)
+        self._bytes -= len(body)
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _disk_get(self, key, now):
+        if not self.cache_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, 'rb') as f:
+                expires_at = float(f.readline())
+                body = f.read()
+        except (OSError, ValueError):
+            return None
+        if expires_at <= now:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        # 磁盘命中后回填内存层
+        self._memory_set(key, expires_at, body)
+        return body
+
+    def _disk_set(self, key, expires_at, body):
+        if not self.cache_dir:
+            return
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # 先写临时文件再 rename，其他 worker 不会读到半个文件
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(f"{expires_at}\n".encode('ascii'))
+                f.write(body)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Disk cache write failed: {e}")
+            return
+        with self._lock:
+            self._disk_writes += 1
+            sweep = self._disk_writes % 100 == 0
+        if sweep:
+            self._disk_sweep()
+
+    def _disk_sweep(self):
+        """删除过期文件；总大小超限时按修改时间从旧到新删除"""
+        now = time.time()
+        files = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                    with open(path, 'rb') as f:
+                        expires_at = float(f.readline())
+                except (OSError, ValueError):
+                    continue
+                if expires_at <= now:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.disk_max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                with self._lock:
+                    self.evictions += 1
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'enabled': CACHE_ENABLED,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'disk_enabled': bool(self.cache_dir),
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': round((self.hits + self.disk_hits) / lookups, 4) if lookups else 0.0
+            }
+
+
+def cache_ttl_for(route):
+    """获取路由对应的缓存 TTL"""
+    return CACHE_ROUTE_TTLS.get(route, CACHE_DEFAULT_TTL)
+
+
+response_cache = ResponseCache()
+
+
+# ========== 共享存储 ==========
+
+class SharedStore:
+    """
+    基于 SQLite 的跨 worker 共享存储。
+    每个线程持有自己的连接；使用 WAL 模式，读写互不阻塞。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._schema = []
+        self._schema_lock = threading.Lock()
+
+    def connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            with self._schema_lock:
+                for statement in self._schema:
+                    conn.execute(statement)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def ensure_schema(self, *statements):
+        """登记建表语句；已建立的连接上立即执行"""
+        with self._schema_lock:
+            self._schema.extend(statements)
+        conn = self.connect()
+        for statement in statements:
+            conn.execute(statement)
+
+    def execute(self, sql, params=()):
+        return self.connect().execute(sql, params)
+
+
+shared_store = SharedStore(SHARED_DB_PATH) if SHARED_DB_PATH else None
+
+
+# ========== 使用量统计 ==========
+
+class UsageAccounting:
+    """
+    持久化的使用量统计。
+    请求线程只往 deque 里追加记录（append 是原子操作，不加锁）；
+    后台线程每 USAGE_FLUSH_INTERVAL 秒汇总一次，用一个事务批量 upsert 到按天汇总的表，
+    热路径上没有磁盘写入。按天汇总后，查询几个月的数据也只需扫描少量行。
+    清零时在 usage_meta 表记下清零时间，各 worker 写入时丢弃清零之前记录、尚未写入的数据。
+    """
+
+    def __init__(self, store, flush_interval=USAGE_FLUSH_INTERVAL):
+        self.store = store
+        self.flush_interval = flush_interval
+        self._pending = deque()
+        self._flush_lock = threading.Lock()
+        self._flusher_pid = None
+        self.store.ensure_schema(
+            'CREATE TABLE IF NOT EXISTS usage_daily ('
+            'day TEXT, client TEXT, model TEXT, requests INTEGER DEFAULT 0, tokens INTEGER DEFAULT 0, '
+            'PRIMARY KEY (day, client, model))',
+            'CREATE TABLE IF NOT EXISTS usage_meta (name TEXT PRIMARY KEY, value REAL)'
+        )
+
+    def record(self, client, model, requests=0, tokens=0):
+        self._pending.append((datetime.now().strftime('%Y-%m-%d'), client, model or '', requests, tokens,
+                              time.time()))
+        if self._flusher_pid != os.getpid():
+            self._start_flusher()
+
+    def _start_flusher(self):
+        with self._flush_lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+        threading.Thread(target=self._flush_loop, daemon=True).start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                logger.warning(f"Usage flush failed: {e}")
+
+    def flush(self):
+        """把本 worker 尚未写入的记录汇总后批量写入"""
+        with self._flush_lock:
+            records = []
+            while True:
+                try:
+                    records.append(self._pending.popleft())
+                except IndexError:
+                    break
+            if not records:
+                return
+            conn = self.store.connect()
+            # IMMEDIATE：读取清零时间和写入之间不会插入其他 worker 的清零
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute("SELECT value FROM usage_meta WHERE name = 'reset_at'").fetchone()
+                reset_at = row[0] if row else 0
+                totals = {}
+                for day, client, model, requests_, tokens, recorded in records:
+                    if recorded < reset_at:
+                        continue
+                    total = totals.setdefault((day, client, model), [0, 0])
+                    total[0] += requests_
+                    total[1] += tokens
+                conn.executemany(
+                    'INSERT INTO usage_daily (day, client, model, requests, tokens) VALUES (?, ?, ?, ?, ?) '
+                    'ON CONFLICT (day, client, model) DO UPDATE SET '
+                    'requests = requests + excluded.requests, tokens = tokens + excluded.tokens',
+                    [(day, client, model, r, t) for (day, client, model), (r, t) in totals.items()]
+                )
+                conn.execute('COMMIT')
+            except sqlite3.Error:
+                conn.execute('ROLLBACK')
+                # 写入失败时放回队列，下次重试
+                self._pending.extend(records)
+                raise
+
+    def summary(self):
+        """总请求数、总 token 数和今日请求数"""
+        self.flush()
+        today = datetime.now().strftime('%Y-%m-%d')
+        total_requests, total_tokens = self.store.execute(
+            'SELECT COALESCE(SUM(requests), 0), COALESCE(SUM(tokens), 0) FROM usage_daily'
+        ).fetchone()
+        requests_today, = self.store.execute(
+            'SELECT COALESCE(SUM(requests), 0) FROM usage_daily WHERE day = ?', (today,)
+        ).fetchone()
+        return {
+            'total_requests': total_requests,
+            'total_tokens': total_tokens,
+            'requests_today': requests_today,
+            'last_reset_date': today
+        }
+
+    def query(self, start=None, end=None, group_by=('day',)):
+        """按日期范围查询，group_by 为 day / client / model 的组合"""
+        self.flush()
+        columns = [col for col in group_by if col in ('day', 'client', 'model')] or ['day']
+        select = ', '.join(columns)
+        rows = self.store.execute(
+            f'SELECT {select}, SUM(requests), SUM(tokens) FROM usage_daily '
+            f'WHERE day >= ? AND day <= ? GROUP BY {select} ORDER BY {select}',
+            (start or '0000-00-00', end or '9999-99-99')
+        ).fetchall()
+        return [dict(zip(columns + ['requests', 'tokens'], row)) for row in rows]
+
+    def reset(self):
+        """清零所有 worker 的统计（其他 worker 尚未写入的记录在它们下次写入时丢弃）"""
+        with self._flush_lock:
+            self._pending.clear()
+            conn = self.store.connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute('DELETE FROM usage_daily')
+                conn.execute("INSERT OR REPLACE INTO usage_meta (name, value) VALUES ('reset_at', ?)", (time.time(),))
+                conn.execute('COMMIT')
+            except sqlite3.Error:
+                conn.execute('ROLLBACK')
+                raise
+
+
+usage_accounting = UsageAccounting(
+    shared_store if shared_store is not None and USAGE_DB_PATH == SHARED_DB_PATH else SharedStore(USAGE_DB_PATH)
+)
+
+
+# ========== 流量录制 ==========
+
+# 录制时保留的请求头（不录制 Authorization，客户端只记录哈希后的标识）
+CAPTURE_HEADERS = ('X-Priority', 'X-Proxy-Cache', 'X-Proxy-Response', 'Cache-Control', DEADLINE_HEADER)
+# 疑似密钥的片段：不脱敏内容时也会抹掉，错误信息中始终抹掉
+_SECRET_RE = re.compile(r'sk-[A-Za-z0-9]{16,}|Bearer\s+[A-Za-z0-9._~+/=-]{8,}')
+
+
+def redact_text(text):
+    """
+    脱敏一段消息或回复内容：替换为等长的哈希填充，相同内容的替换结果相同，
+    回放时缓存命中和请求合并与线上一致；CAPTURE_REDACT_CONTENT 关闭时只抹掉疑似密钥
+    """
+    if not isinstance(text, str) or not text:
+        return text
+    if not CAPTURE_REDACT_CONTENT:
+        return _SECRET_RE.sub(lambda m: '*' * len(m.group()), text)
+    digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+    return (digest * (len(text) // len(digest) + 1))[:len(text)]
+
+
+def redact_payload(api_data):
+    """脱敏后的上游请求体（只替换消息内容，其余字段原样保留）"""
+    redacted = dict(api_data)
+    redacted['messages'] = [
+        dict(message, content=redact_text(message.get('content'))) if isinstance(message, dict) else message
+        for message in api_data.get('messages') or []
+    ]
+    return redacted
+
+
+def redact_response(body):
+    """脱敏后的上游响应：choices 中的内容替换为填充，无法解析时只保留字节数"""
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return {'bytes': len(body)}
+    if not isinstance(data, dict):
+        return {'bytes': len(body)}
+    for choice in data.get('choices') or []:
+        message = choice.get('message') if isinstance(choice, dict) else None
+        if isinstance(message, dict):
+            for field in ('content', 'reasoning_content'):
+                if field in message:
+                    message[field] = redact_text(message[field])
+    return data
+
+
+class StreamCapture:
+    """记录流式响应每个 chunk 相对首字节的时间和字节数，结束时写入一条上游记录"""
+
+    __slots__ = ('capture', 'api_data', 'latency', 'started', 'chunks')
+
+    def __init__(self, capture, api_data, latency):
+        self.capture = capture
+        self.api_data = api_data
+        self.latency = latency
+        self.started = time.perf_counter()
+        self.chunks = []
+
+    def feed(self, chunk):
+        self.chunks.append([round(time.perf_counter() - self.started, 4), len(chunk)])
+
+    def finish(self, total_tokens):
+        self.capture.upstream(self.api_data, 200, self.latency, chunks=self.chunks, total_tokens=total_tokens)
+
+
+class TrafficCapture:
+    """
+    抽样录制客户端请求和上游响应，供 benchmarks/replay.py 回放压测。
+    按缓存键抽样：相同的请求要么都录制要么都不录制，回放时缓存命中和请求合并与线上一致。
+    请求线程只把记录放进有界队列（满了直接丢弃），由后台线程压缩写盘，热路径上没有磁盘写入；
+    每个 worker 写自己的文件（文件名带进程号）。
+    """
+
+    def __init__(self, directory=CAPTURE_DIR, sample_rate=CAPTURE_SAMPLE_RATE,
+                 file_bytes=CAPTURE_FILE_BYTES, max_files=CAPTURE_MAX_FILES, max_pending=10000):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.enabled = bool(directory) and sample_rate > 0
+        # 缓存键前 8 位十六进制不超过该值的请求被抽中
+        self.threshold = int(min(sample_rate, 1.0) * 0xFFFFFFFF)
+        self.file_bytes = file_bytes
+        self.max_files = max_files
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._lock = threading.Lock()
+        self._writer = None
+        self._writer_pid = None
+        self.captured = 0
+        self.dropped = 0
+        self.files = 0
+
+    def _sampled(self, api_data, key=None):
+        if not self.enabled:
+            return False
+        return int((key or cache_key(api_data))[:8], 16) <= self.threshold
+
+    def request(self, api_data, headers, client, route, key=None):
+        """录制一个客户端请求：到达时间、客户端标识、相关请求头和脱敏后的请求体"""
+        if not self._sampled(api_data, key):
+            return
+        self._put({
+            'type': 'request', 'ts': time.time(), 'route': route, 'client': client,
+            'headers': {name: headers.get(name) for name in CAPTURE_HEADERS if headers.get(name)},
+            'body': redact_payload(api_data)
+        })
+
+    def upstream(self, api_data, status_code, latency, body=b'', chunks=None, total_tokens=0):
+        """
+        录制一次上游调用：状态码和首字节耗时；
+        非流式成功时带脱敏后的响应，流式时带各 chunk 的 [相对时间, 字节数]，失败时带错误信息
+        key 为脱敏后请求体的缓存键，mock 上游按它匹配收到的请求
+        """
+        if not self._sampled(api_data):
+            return
+        record = {
+            'type': 'upstream', 'ts': time.time(), 'key': cache_key(redact_payload(api_data)),
+            'stream': bool(api_data.get('stream')), 'status': status_code, 'latency': round(latency, 4)
+        }
+        if chunks is not None:
+            record['chunks'] = chunks
+            record['total_tokens'] = total_tokens
+        elif status_code == 200:
+            record['response'] = redact_response(body)
+        else:
+            record['error'] = _SECRET_RE.sub('***', error_excerpt(body))
+        self._put(record)
+
+    def stream(self, api_data, latency):
+        """流式响应的录制器，未抽中时返回 None"""
+        if not self._sampled(api_data):
+            return None
+        return StreamCapture(self, api_data, latency)
+
+    def _put(self, record):
+        if self._writer_pid != os.getpid():
+            self._start_writer()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _start_writer(self):
+        with self._lock:
+            if self._writer_pid == os.getpid():
+                return
+            self._writer_pid = os.getpid()
+            self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def _write_loop(self):
+        out = None
+        written = 0
+        last_flush = time.monotonic()
+        while True:
+            try:
+                record = self._queue.get(timeout=1)
+            except queue.Empty:
+                record = False
+            if record is None:
+                # 进程退出
+                if out is not None:
+                    out.close()
+                return
+            try:
+                if record:
+                    if out is None or written >= self.file_bytes:
+                        if out is not None:
+                            out.close()
+                        out = self._open_file()
+                        written = 0
+                    line = (json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8')
+                    out.write(line)
+                    written += len(line)
+                    self.captured += 1
+                # 定期刷盘，worker 被杀掉时也能读出已写入的记录
+                if out is not None and time.monotonic() - last_flush >= 5:
+                    out.flush()
+                    last_flush = time.monotonic()
+            except OSError as e:
+                logger.warning(f"Capture write failed: {e}")
+                self.dropped += 1
+                out = None
+
+    def _open_file(self):
+        os.makedirs(self.directory, exist_ok=True)
+        # 删掉最旧的文件，包括新文件在内最多保留 max_files 个
+        names = sorted(
+            (name for name in os.listdir(self.directory) if name.startswith('capture-') and name.endswith('.jsonl.gz')),
+            key=lambda name: os.path.getmtime(os.path.join(self.directory, name))
+        )
+        for name in names[:max(len(names) - self.max_files + 1, 0)]:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+        self.files += 1
+        name = f"capture-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{self.files}.jsonl.gz"
+        return gzip.open(os.path.join(self.directory, name), 'wb')
+
+    def close(self, timeout=2):
+        """进程退出时写完队列中的记录并关闭文件"""
+        if self._writer_pid != os.getpid() or self._writer is None:
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self._writer.join(timeout)
+
+    def stats(self):
+        return {'enabled': self.enabled, 'sample_rate': self.sample_rate, 'captured': self.captured,
+                'dropped': self.dropped, 'pending': self._queue.qsize(), 'files': self.files}
+
+
+traffic_capture = TrafficCapture()
+atexit.register(traffic_capture.close)
+
+
+# ========== 简历存储与提示词模板 ==========
+
+class ResumeStore:
+    """
+    按内容哈希（sha256）保存简历文本：客户端上传一次，之后的请求只带哈希。
+    保存在使用量统计的同一个 SQLite 文件中，所有 worker 共用；最近用过的简历缓存在内存里。
+    """
+
+    def __init__(self, store, ttl_days=RESUME_TTL_DAYS, max_cached=256):
+        self.store = store
+        self.ttl = ttl_days * 86400
+        self.max_cached = max_cached
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.uploads = 0
+        self.lookups = 0
+        self.misses = 0
+        self.store.ensure_schema(
+            'CREATE TABLE IF NOT EXISTS resumes ('
+            'hash TEXT PRIMARY KEY, body TEXT, created REAL, last_used REAL)'
+        )
+
+    @staticmethod
+    def hash_of(text):
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def put(self, text):
+        """保存简历，返回哈希（重复上传只刷新使用时间）"""
+        resume_hash = self.hash_of(text)
+        now = time.time()
+        self.store.execute(
+            'INSERT INTO resumes (hash, body, created, last_used) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT(hash) DO UPDATE SET last_used = excluded.last_used',
+            (resume_hash, text, now, now)
+        )
+        # 顺便清理过期的简历
+        self.store.execute('DELETE FROM resumes WHERE last_used < ?', (now - self.ttl,))
+        self._remember(resume_hash, text)
+        with self._lock:
+            self.uploads += 1
+        return resume_hash
+
+    def get(self, resume_hash):
+        """按哈希取简历文本，不存在返回 None"""
+        with self._lock:
+            self.lookups += 1
+            text = self._cache.get(resume_hash)
+            if text is not None:
+                self._cache.move_to_end(resume_hash)
+                return text
+        row = self.store.execute('SELECT body FROM resumes WHERE hash = ?', (resume_hash,)).fetchone()
+        if row is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        self.store.execute('UPDATE resumes SET last_used = ? WHERE hash = ?', (time.time(), resume_hash))
+        self._remember(resume_hash, row[0])
+        return row[0]
+
+    def _remember(self, resume_hash, text):
+        with self._lock:
+            self._cache[resume_hash] = text
+            self._cache.move_to_end(resume_hash)
+            while len(self._cache) > self.max_cached:
+                self._cache.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {'cached': len(self._cache), 'uploads': self.uploads,
+                    'lookups': self.lookups, 'misses': self.misses}
+
+
+resume_store = ResumeStore(usage_accounting.store)
+
+
+# 提示词模板：id 为 "名称@版本"，修改提示词时新增版本，旧版本保留，已缓存的结果仍然有效。
+# prompts 按语言区分；limits 为各字段截断的字符数；fields 为模板额外需要的字段；
+# language 为 auto 时按 detect_from 字段的中文比例选择语言。
+PROMPT_TEMPLATES = {
+    'score@1': {
+        'temperature': 0.3,
+        'max_tokens': 50,
+        'fields': (),
+        'limits': {'job_description': 2000, 'resume': 2000},
+        'detect_from': 'job_description',
+        'prompts': {
+            'zh': """你是一位专业的HR顾问。请评估以下简历与岗位描述的匹配度。
+
+要求：
+1. 仔细分析岗位描述中的关键要求（技能、经验、学历等）
+2. 评估简历中是否包含这些关键要求
+3. 给出0-100分的匹配度评分
+4. 只输出一个数字（0-100之间的整数），不要输出其他文字
+
+【岗位描述】
+{job_description}
+
+【简历内容】
+{resume}
+
+请直接输出匹配度分数（0-100的整数）："""
+        }
+    },
+    'tailor@1': {
+        'temperature': 0.7,
+        'max_tokens': 2000,
+        'fields': (),
+        'limits': {},
+        'detect_from': 'resume',
+        'prompts': {
+            'zh': """你是一位专业的求职顾问。请根据下面的【岗位描述】，重写我的【原始简历】，突出与岗位最匹配的技能和经验。
+
+要求：
+1. 保持简历的专业性和真实性
+2. 突出与岗位要求最相关的经验和技能
+3. 使用专业、简洁的语言
+4. 保持简历结构清晰，不要超过一页
+5. 保留原始简历中的关键信息（姓名、联系方式、教育背景等）
+
+【岗位描述】
+{job_description}
+
+【原始简历】
+{resume}
+
+请生成定制后的简历：""",
+            'en': """You are a professional career consultant. Please rewrite my original resume based on the job description below, highlighting the skills and experiences that best match the position.
+
+Requirements:
+1. Maintain professionalism and authenticity
+2. Highlight the most relevant experiences and skills for the job requirements
+3. Use professional and concise language
+4. Keep the resume structure clear, not exceeding one page
+5. Retain key information from the original resume (name, contact, education, etc.)
+
+【Job Description】
+{job_description}
+
+【Original Resume】
+{resume}
+
+Please generate the customized resume:"""
+        }
+    },
+    'cover_letter@1': {
+        'temperature': 0.7,
+        'max_tokens': 800,
+        'fields': ('job_title', 'company_name'),
+        'limits': {'job_description': 1500, 'resume': 1000},
+        'detect_from': 'job_description',
+        'prompts': {
+            'zh': """你是一位专业的求职顾问。请根据以下信息，为这个岗位写一份专业的求职信（Cover Letter）。
+
+要求：
+1. 简洁专业，不超过300字
+2. 突出申请人的相关技能和经验
+3. 表达对岗位和公司的兴趣
+4. 使用正式、礼貌的语言
+5. 开头称呼使用"Dear Hiring Manager,"，结尾使用"Sincerely,"
+
+【岗位标题】
+{job_title}
+
+【公司名称】
+{company_name}
+
+【岗位描述】
+{job_description}
+
+【申请人简历】
+{resume}
+
+请生成求职信：""",
+            'en': """You are a professional career consultant. Please write a professional cover letter for this job position based on the following information.
+
+Requirements:
+1. Concise and professional, not exceeding 300 words
+2. Highlight the applicant's relevant skills and experience
+3. Express interest in the position and company
+4. Use formal and polite language
+5. Start with "Dear Hiring Manager," and end with "Sincerely,"
+
+【Job Title】
+{job_title}
+
+【Company Name】
+{company_name}
+
+【Job Description】
+{job_description}
+
+【Applicant Resume】
+{resume}
+
+Please generate the cover letter:"""
+        }
+    }
 }
 
 
-def reset_daily_stats():
-    """重置每日统计"""
-    today = datetime.now().strftime('%Y-%m-%d')
-    if usage_stats['last_reset_date'] != today:
-        usage_stats['requests_today'] = 0
-        usage_stats['last_reset_date'] = today
+class TemplateError(Exception):
+    """模板请求无效（未知模板、简历不存在等），code 供客户端判断是否需要先上传简历"""
+
+    def __init__(self, message, status_code=400, code='invalid_template_request'):
+        super().__init__(message)
+        self.status_code = status_code
+        self.code = code
+
+
+def template_error_response(error):
+    return {'error': str(error), 'code': error.code}
+
+
+def detect_language(text):
+    """中文字符超过 30% 视为中文（与桌面客户端的判断一致）"""
+    chinese_chars = sum(1 for c in text if '\u4e00' <= c <= '\u9fff')
+    return 'zh' if chinese_chars / max(len(text), 1) > 0.3 else 'en'
+
+
+def expand_prompt_template(data):
+    """
+    把模板请求 {"template_id", "resume_hash", "job_description", ...} 展开为普通的聊天请求体。
+    请求体中的 model / temperature / max_tokens / stream 等参数原样保留，未指定时使用模板的默认值。
+    """
+    template = PROMPT_TEMPLATES.get(data.get('template_id'))
+    if template is None:
+        raise TemplateError(f"Unknown template_id: {data.get('template_id')}", 400, 'unknown_template')
+    resume = resume_store.get(str(data.get('resume_hash', '')))
+    if resume is None:
+        raise TemplateError('Resume not found, upload it to /api/resumes first', 404, 'resume_not_found')
+    
+    values = {'resume': resume, 'job_description': str(data.get('job_description') or '')}
+    for field in template['fields']:
+        values[field] = str(data.get(field) or '')
+    for field, limit in template['limits'].items():
+        values[field] = values[field][:limit]
+    
+    prompts = template['prompts']
+    language = data.get('language', 'auto')
+    if language not in prompts:
+        language = detect_language(values[template['detect_from']])
+    prompt = (prompts.get(language) or next(iter(prompts.values()))).format(**values)
+    
+    template_keys = {'template_id', 'resume_hash', 'job_description', 'language', *template['fields']}
+    expanded = {key: value for key, value in data.items() if key not in template_keys}
+    expanded['messages'] = [{'role': 'user', 'content': prompt}]
+    expanded.setdefault('temperature', template['temperature'])
+    expanded.setdefault('max_tokens', template['max_tokens'])
+    return expanded
+
+
+def template_catalog():
+    """模板列表（不含提示词正文），供客户端查询"""
+    return {
+        template_id: {
+            'languages': list(template['prompts']),
+            'fields': ['resume_hash', 'job_description', *template['fields']],
+            'temperature': template['temperature'],
+            'max_tokens': template['max_tokens']
+        }
+        for template_id, template in PROMPT_TEMPLATES.items()
+    }
+
+
+# ========== 幂等键 ==========
+
+class IdempotencyConflict(Exception):
+    """同一个幂等键用于不同的请求（422），或使用该键的请求仍在处理中（409）"""
+
+    def __init__(self, message, status_code, code):
+        super().__init__(message)
+        self.status_code = status_code
+        self.code = code
+
+
+def idempotency_conflict_response(error):
+    body = {'error': str(error), 'code': error.code}
+    headers = {'Retry-After': '1'} if error.status_code == 409 else {}
+    return body, headers
+
+
+class IdempotencyStore:
+    """
+    按 (客户端, Idempotency-Key) 保存成功的聊天响应：桌面客户端请求超时后重试时，
+    直接返回第一次请求的结果，不再重复调用上游（温度较高的生成请求无法靠响应缓存去重）。
+    保存在使用量统计的同一个 SQLite 文件中，所有 worker 共用：第一个请求写入 pending 记录，
+    处理中到达的重试最多等待 wait_timeout 秒（不超过请求的截止时间）拿到它的结果，仍未完成返回 409；
+    失败的请求删除记录，重试时重新调用上游。
+    """
+
+    def __init__(self, store, ttl=IDEMPOTENCY_TTL, max_bytes=IDEMPOTENCY_MAX_BYTES,
+                 poll_interval=COALESCE_POLL_INTERVAL, wait_timeout=IDEMPOTENCY_WAIT_SECONDS,
+                 stale_after=UPSTREAM_READ_TIMEOUT * 2):
+        self.store = store
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.poll_interval = poll_interval
+        self.wait_timeout = wait_timeout
+        # pending 记录超过该时间仍未完成，视为处理它的 worker 已退出，由新的请求接管
+        self.stale_after = stale_after
+        self._lock = threading.Lock()
+        self.started = 0
+        self.replayed = 0
+        self.conflicts = 0
+        self.in_progress = 0
+        self.store.ensure_schema(
+            'CREATE TABLE IF NOT EXISTS idempotency ('
+            'key TEXT PRIMARY KEY, fingerprint TEXT, state TEXT, content_type TEXT, body BLOB, created REAL)'
+        )
+
+    @staticmethod
+    def scoped_key(client, header_value):
+        """按客户端区分的幂等键（不同客户端使用相同的键互不影响），没有请求头时返回 None"""
+        if not header_value:
+            return None
+        return hashlib.sha256(f"{client}:{header_value}".encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def fingerprint(api_data):
+        return cache_key(api_data) + (':stream' if api_data.get('stream') else '')
+
+    def try_begin(self, key, api_data):
+        """
+        尝试开始处理带幂等键的请求（不等待），返回：
+        ('new', None)：本请求负责处理，完成后调用 complete 或 abandon；
+        ('done', (content_type, body))：已有保存的响应；
+        ('pending', None)：相同的请求正在处理中
+        请求体与第一次不同时抛出 IdempotencyConflict
+        """
+        now = time.time()
+        fingerprint = self.fingerprint(api_data)
+        self.store.execute('DELETE FROM idempotency WHERE created < ?', (now - self.ttl,))
+        inserted = self.store.execute(
+            "INSERT OR IGNORE INTO idempotency (key, fingerprint, state, created) VALUES (?, ?, 'pending', ?)",
+            (key, fingerprint, now)
+        ).rowcount
+        if inserted:
+            with self._lock:
+                self.started += 1
+            return 'new', None
+        row = self.store.execute(
+            'SELECT fingerprint, state, content_type, body, created FROM idempotency WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None:
+            # 第一次请求失败后记录已删除：重新处理
+            return self.try_begin(key, api_data)
+        if row[0] != fingerprint:
+            with self._lock:
+                self.conflicts += 1
+            raise IdempotencyConflict('Idempotency-Key was already used for a different request', 422,
+                                      'idempotency_key_reused')
+        if row[1] == 'done':
+            with self._lock:
+                self.replayed += 1
+            return 'done', (row[2], row[3])
+        if row[4] < now - self.stale_after:
+            taken = self.store.execute(
+                "UPDATE idempotency SET created = ? WHERE key = ? AND state = 'pending' AND created = ?",
+                (now, key, row[4])
+            ).rowcount
+            if taken:
+                return 'new', None
+        return 'pending', None
+
+    def begin(self, key, api_data, deadline=None):
+        """
+        开始处理带幂等键的请求：返回 None 表示由本请求处理；
+        返回 (content_type, body) 表示已有保存的响应。相同的请求处理中时等待其完成，
+        最多等待到 wait_until(deadline)，仍未完成时抛出 IdempotencyConflict（409）
+        """
+        wait_until = self.wait_until(deadline)
+        while True:
+            state, stored = self.try_begin(key, api_data)
+            if state != 'pending':
+                return stored
+            if time.perf_counter() + self.poll_interval >= wait_until:
+                raise self.still_pending()
+            time.sleep(self.poll_interval)
+
+    def wait_until(self, deadline=None):
+        """重试等待处理中请求的截止时间（perf_counter 时间）：wait_timeout 秒后，且不晚于请求的截止时间"""
+        wait_until = time.perf_counter() + self.wait_timeout
+        return wait_until if deadline is None else min(wait_until, deadline)
+
+    def still_pending(self):
+        with self._lock:
+            self.in_progress += 1
+        return IdempotencyConflict('A request with this Idempotency-Key is still in progress', 409,
+                                   'idempotency_in_progress')
+
+    def complete(self, key, content_type, body):
+        """保存成功的响应；过大的响应不保存（删除记录，重试时重新调用上游）"""
+        if key is None:
+            return
+        if len(body) > self.max_bytes:
+            self.abandon(key)
+            return
+        self.store.execute(
+            "UPDATE idempotency SET state = 'done', content_type = ?, body = ?, created = ? WHERE key = ?",
+            (content_type, body, time.time(), key)
+        )
+
+    def abandon(self, key):
+        """请求失败：删除 pending 记录"""
+        if key is not None:
+            self.store.execute("DELETE FROM idempotency WHERE key = ? AND state = 'pending'", (key,))
+
+    def stats(self):
+        with self._lock:
+            return {'started': self.started, 'replayed': self.replayed, 'conflicts': self.conflicts,
+                    'in_progress': self.in_progress}
+
+
+idempotency_store = IdempotencyStore(usage_accounting.store)
+
+
+def idempotent_replay(stored, headers):
+    """返回保存的响应（JSON 响应按请求头决定是否精简），带 Idempotent-Replayed 头"""
+    content_type, body = stored
+    if content_type == 'application/json' and wants_lean(headers):
+        body = lean_body(body)
+    return body, content_type, {'Idempotent-Replayed': 'true'}
+
+
+# ========== 工作负载路由 ==========
+
+# 已知的工作负载类别：模板名称、路由表中的类别和 default（其他值归为 default，避免指标标签无限增长）
+WORKLOAD_CLASSES = frozenset(
+    {template_id.split('@')[0] for template_id in PROMPT_TEMPLATES} | set(MODEL_ROUTES) | {'default'}
+)
+# 路由表可以替换的参数
+ROUTE_PARAMS = ('model', 'temperature', 'max_tokens')
+
+
+def classify_workload(data, headers):
+    """请求的工作负载类别：X-Workload 请求头，其次模板 id 的名称部分（score@1 → score），否则为 default"""
+    workload = headers.get('X-Workload', '').strip().lower()
+    if not workload and isinstance(data, dict) and data.get('template_id'):
+        workload = str(data['template_id']).split('@')[0]
+    return workload if workload in WORKLOAD_CLASSES else 'default'
+
+
+def apply_model_route(data, workload):
+    """按路由表替换该类别的 model / temperature / max_tokens，没有配置路由时原样返回"""
+    route = MODEL_ROUTES.get(workload)
+    if not route:
+        return data
+    return dict(data, **{param: route[param] for param in ROUTE_PARAMS if param in route})
+
+
+class WorkloadStats:
+    """
+    每个工作负载类别的请求耗时（最近 N 个请求的 p50/p95）、上游 token 数和按 MODEL_PRICES 估算的成本（当前 worker）
+    所有 worker 的汇总见 /metrics 中的 proxy_workload_seconds 和 proxy_workload_tokens_total
+    """
+
+    def __init__(self, window=1000):
+        self.window = window
+        self._latency = {}
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def observe(self, workload, seconds):
+        with self._lock:
+            samples = self._latency.get(workload)
+            if samples is None:
+                samples = self._latency[workload] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def add_tokens(self, workload, model, total_tokens):
+        with self._lock:
+            key = (workload, model or '')
+            self._tokens[key] = self._tokens.get(key, 0) + total_tokens
+
+    def stats(self):
+        with self._lock:
+            latency = {workload: sorted(samples) for workload, samples in self._latency.items()}
+            tokens = dict(self._tokens)
+        result = {}
+        for workload in sorted(set(latency) | {w for w, _ in tokens} | set(MODEL_ROUTES)):
+            ordered = latency.get(workload, [])
+            entry = {'count': len(ordered), 'route': MODEL_ROUTES.get(workload)}
+            if ordered:
+                entry['p50_ms'] = round(ordered[int(len(ordered) * 0.5)] * 1000, 1)
+                entry['p95_ms'] = round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 1)
+            models = {model: count for (w, model), count in tokens.items() if w == workload}
+            entry['tokens'] = models
+            if MODEL_PRICES:
+                entry['estimated_cost'] = round(
+                    sum(count * MODEL_PRICES.get(model, 0.0) for model, count in models.items()) / 1e6, 6)
+            result[workload] = entry
+        return result
+
+
+workload_stats = WorkloadStats()
+
+
+# ========== 限流与排队 ==========
+
+class RateLimited(Exception):
+    """请求被限流，retry_after 为建议的重试等待秒数"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = max(1, int(retry_after + 0.999))
+
+
+def rate_limited_response(error):
+    """429 响应体和响应头"""
+    body = {'error': 'Rate limit exceeded', 'message': str(error), 'retry_after': error.retry_after}
+    return body, {'Retry-After': str(error.retry_after)}
+
+
+def _refill(level, updated, rate, capacity, now):
+    """令牌桶按时间补充"""
+    return min(capacity, level + (now - updated) * rate)
+
+
+class TokenBucketLimiter:
+    """
+    每个客户端两个令牌桶：请求数（RATE_LIMIT_RPS）和 token 数（RATE_LIMIT_TPM）。
+    token 数在请求完成后按实际用量扣除，允许透支；余额为负时拒绝新请求直到补回。
+    配置了共享存储时桶状态保存在 SQLite，所有 worker 共用同一份额度。
+    """
+
+    def __init__(self, store=None, rps=RATE_LIMIT_RPS, burst=RATE_LIMIT_BURST, tpm=RATE_LIMIT_TPM):
+        self.store = store
+        self.rps = rps
+        self.burst = burst
+        self.tpm = tpm
+        self._buckets = {}  # client -> [请求令牌, token 令牌, 更新时间]
+        self._lock = threading.Lock()
+        self.rejected = 0
+        if self.store is not None and self.enabled:
+            self.store.ensure_schema(
+                'CREATE TABLE IF NOT EXISTS rate_buckets ('
+                'client TEXT PRIMARY KEY, requests REAL, tokens REAL, updated REAL)'
+            )
+
+    @property
+    def enabled(self):
+        return self.rps > 0 or self.tpm > 0
+
+    @property
+    def shared(self):
+        """桶状态保存在共享 SQLite 中（check / consume_tokens 会访问数据库）"""
+        return self.store is not None and self.enabled
+
+    def check(self, client):
+        """放行则扣除一个请求令牌，否则抛出 RateLimited"""
+        if not self.enabled:
+            return
+        self._update(client, self._take_request)
+
+    def consume_tokens(self, client, total_tokens):
+        """请求完成后按实际用量扣除 token 额度"""
+        if self.tpm <= 0 or not total_tokens:
+            return
+
+        def take(state, now):
+            state[1] -= total_tokens
+        self._update(client, take)
+
+    def _take_request(self, state, now):
+        if self.tpm > 0 and state[1] < 0:
+            raise RateLimited('Token quota exceeded', -state[1] / (self.tpm / 60))
+        if self.rps > 0:
+            if state[0] < 1:
+                raise RateLimited('Too many requests', (1 - state[0]) / self.rps)
+            state[0] -= 1
+
+    def _update(self, client, fn):
+        now = time.time()
+        try:
+            if self.store is None:
+                with self._lock:
+                    state = self._buckets.setdefault(client, [self.burst, self.tpm, now])
+                    self._refill_state(state, now)
+                    fn(state, now)
+                return
+            self._update_shared(client, fn, now)
+        except RateLimited:
+            with self._lock:
+                self.rejected += 1
+            raise
+
+    def _refill_state(self, state, now):
+        state[0] = _refill(state[0], state[2], self.rps, self.burst, now)
+        state[1] = _refill(state[1], state[2], self.tpm / 60, self.tpm, now)
+        state[2] = now
+
+    def _update_shared(self, client, fn, now):
+        conn = self.store.connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT requests, tokens, updated FROM rate_buckets WHERE client = ?',
+                               (client,)).fetchone()
+            state = list(row) if row else [self.burst, self.tpm, now]
+            self._refill_state(state, now)
+            fn(state, now)
+            conn.execute('INSERT OR REPLACE INTO rate_buckets (client, requests, tokens, updated) '
+                         'VALUES (?, ?, ?, ?)', (client, state[0], state[1], state[2]))
+            conn.execute('COMMIT')
+        except BaseException:
+            # 被拒绝时桶状态不变
+            conn.execute('ROLLBACK')
+            raise
+
+    def stats(self):
+        return {'rps': self.rps, 'burst': self.burst, 'tpm': self.tpm, 'rejected': self.rejected}
+
+
+def classify_priority(api_data, headers):
+    """
+    推断请求的优先级类别：客户端可用 X-Priority 头指定，
+    否则 max_tokens 不超过 PRIORITY_HIGH_MAX_TOKENS 的短请求（如匹配度评分）为 high，其余为 normal
+    """
+    explicit = headers.get('X-Priority', '').lower()
+    if explicit in PRIORITY_CLASSES:
+        return explicit
+    try:
+        max_tokens = int(api_data.get('max_tokens') or 0)
+    except (TypeError, ValueError):
+        max_tokens = 0
+    return 'high' if 0 < max_tokens <= PRIORITY_HIGH_MAX_TOKENS else 'normal'
+
+
+def pick_next_class(heads, active_by_class, active_total, limit, budgets, max_wait, now):
+    """
+    从各优先级队首中选出下一个放行的类别（都不能放行时返回 None）。
+    heads: {类别: 队首入队时间}
+    排队超过 max_wait 的队首优先（按等待时间），防止低优先级饿死；否则按 PRIORITY_CLASSES 顺序
+    """
+    if limit > 0 and active_total >= limit:
+        return None
+    admissible = [cls for cls in heads
+                  if budgets.get(cls, 0) <= 0 or active_by_class.get(cls, 0) < budgets[cls]]
+    if not admissible:
+        return None
+    starving = [cls for cls in admissible if now - heads[cls] >= max_wait]
+    if starving:
+        return min(starving, key=lambda cls: heads[cls])
+    return min(admissible, key=PRIORITY_CLASSES.index)
+
+
+class _Waiter:
+    """排队中的请求"""
+
+    __slots__ = ('event', 'enqueued', 'granted')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.enqueued = time.time()
+        self.granted = False
+
+
+class ConcurrencyGate:
+    """
+    全局上游并发上限 + 每个优先级类别的并发预算 + 有界等待队列。
+    没有空闲名额时排队（所有类别合计最多 max_queue 个），队列也满则立即拒绝；排队超过 queue_timeout 同样拒绝。
+    名额释放时按 pick_next_class 选择下一个类别（高优先级优先，等待过久的低优先级请求会被提前）。
+    配置了共享存储时用 slots 表在所有 worker 之间计数，否则只限制当前 worker。
+    """
+
+    def __init__(self, store=None, limit=PROXY_MAX_CONCURRENCY, max_queue=PROXY_MAX_QUEUE,
+                 queue_timeout=PROXY_QUEUE_TIMEOUT, budgets=PRIORITY_BUDGETS, max_wait=PRIORITY_MAX_WAIT):
+        self.store = store
+        self.limit = limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.budgets = budgets
+        self.max_wait = max_wait
+        # 持有者进程崩溃后残留的记录，超过该时间视为失效
+        self.stale_after = UPSTREAM_CONNECT_TIMEOUT + UPSTREAM_READ_TIMEOUT + queue_timeout
+        self._lock = threading.Lock()
+        self._queues = {cls: deque() for cls in PRIORITY_CLASSES}
+        self.active_by_class = {cls: 0 for cls in PRIORITY_CLASSES}
+        self.waiting = 0
+        self.rejected = 0
+        if self.store is not None and self.enabled:
+            self.store.ensure_schema(
+                'CREATE TABLE IF NOT EXISTS slots ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, state TEXT, started REAL, priority TEXT)'
+            )
+
+    @property
+    def enabled(self):
+        return self.limit > 0 or any(budget > 0 for budget in self.budgets.values())
+
+    @property
+    def active(self):
+        return sum(self.active_by_class.values())
+
+    def acquire(self, priority='normal'):
+        """获取一个上游名额，返回 (名额标识, 排队秒数)；失败时抛出 RateLimited"""
+        if not self.enabled:
+            return None, 0.0
+        started = time.perf_counter()
+        if self.store is not None:
+            slot = self._acquire_shared(priority)
+        else:
+            slot = self._acquire_local(priority)
+        return slot, time.perf_counter() - started
+
+    def try_acquire(self, priority='normal'):
+        """
+        不排队地获取一个名额（用于对冲请求），返回 (是否获得, 名额标识)；
+        没有空闲名额或已有请求在排队时不获得（不挤占排队中的请求）
+        """
+        if not self.enabled:
+            return True, None
+        if self.store is not None:
+            return self._try_acquire_shared(priority)
+        with self._lock:
+            if self.waiting or pick_next_class({priority: time.time()}, self.active_by_class, self.active,
+                                               self.limit, self.budgets, self.max_wait, time.time()) != priority:
+                return False, None
+            self.active_by_class[priority] += 1
+        return True, (True, priority)
+
+    def _try_acquire_shared(self, priority):
+        slot_id = self.claim_shared(priority)
+        if slot_id is None:
+            return False, None
+        with self._lock:
+            self.active_by_class[priority] += 1
+        return True, (slot_id, priority)
+
+    def claim_shared(self, priority):
+        """（共享存储）没有请求排队且有空闲名额时直接占用一个名额，返回记录 id，否则返回 None"""
+        conn = self.store.connect()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            counts = dict(conn.execute('SELECT state, COUNT(*) FROM slots GROUP BY state').fetchall())
+            active_by_class = dict(conn.execute(
+                "SELECT priority, COUNT(*) FROM slots WHERE state = 'active' GROUP BY priority").fetchall())
+            slot_id = None
+            if not counts.get('waiting') and pick_next_class({priority: now}, active_by_class, counts.get('active', 0),
+                                                            self.limit, self.budgets, self.max_wait, now) == priority:
+                slot_id = conn.execute("INSERT INTO slots (state, started, priority) VALUES ('active', ?, ?)",
+                                       (now, priority)).lastrowid
+            conn.execute('COMMIT')
+        except sqlite3.Error:
+            conn.execute('ROLLBACK')
+            raise
+        return slot_id
+
+    def release(self, slot):
+        if not self.enabled or slot is None:
+            return
+        slot_id, priority = slot
+        if self.store is not None:
+            self.delete_shared(slot_id)
+            with self._lock:
+                self.active_by_class[priority] -= 1
+            return
+        with self._lock:
+            self.active_by_class[priority] -= 1
+            self._dispatch()
+
+    def _reject(self, message):
+        with self._lock:
+            self.rejected += 1
+        raise RateLimited(message, 1)
+
+    def _dispatch(self):
+        """（持有锁时调用）把空出的名额交给下一个等待者"""
+        while True:
+            heads = {cls: queue[0].enqueued for cls, queue in self._queues.items() if queue}
+            cls = pick_next_class(heads, self.active_by_class, self.active, self.limit,
+                                  self.budgets, self.max_wait, time.time())
+            if cls is None:
+                return
+            waiter = self._queues[cls].popleft()
+            waiter.granted = True
+            self.active_by_class[cls] += 1
+            waiter.event.set()
+
+    def _acquire_local(self, priority):
+        with self._lock:
+            if self.waiting >= self.max_queue:
+                self.rejected += 1
+                raise RateLimited('Server is busy, queue is full', 1)
+            waiter = _Waiter()
+            self._queues[priority].append(waiter)
+            self.waiting += 1
+            self._dispatch()
+
+        granted = waiter.event.wait(self.queue_timeout)
+        with self._lock:
+            self.waiting -= 1
+            if not (granted or waiter.granted):
+                self._queues[priority].remove(waiter)
+                self.rejected += 1
+                raise RateLimited('Timed out waiting for an upstream slot', 1)
+        return True, priority
+
+    def _acquire_shared(self, priority):
+        slot_id = self.enqueue_shared(priority)
+        with self._lock:
+            self.waiting += 1
+        try:
+            deadline = time.monotonic() + self.queue_timeout
+            while time.monotonic() < deadline:
+                if self.promote_shared(slot_id, priority):
+                    with self._lock:
+                        self.active_by_class[priority] += 1
+                    return slot_id, priority
+                time.sleep(COALESCE_POLL_INTERVAL)
+            self.delete_shared(slot_id)
+            self._reject('Timed out waiting for an upstream slot')
+        finally:
+            with self._lock:
+                self.waiting -= 1
+
+    def enqueue_shared(self, priority):
+        """（共享存储）清理失效记录后加入等待队列，返回记录 id；队列已满时抛出 RateLimited"""
+        conn = self.store.connect()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('DELETE FROM slots WHERE started < ?', (now - self.stale_after,))
+            waiting, = conn.execute("SELECT COUNT(*) FROM slots WHERE state = 'waiting'").fetchone()
+            if waiting >= self.max_queue:
+                conn.execute('COMMIT')
+                self._reject('Server is busy, queue is full')
+            slot_id = conn.execute("INSERT INTO slots (state, started, priority) VALUES ('waiting', ?, ?)",
+                                   (now, priority)).lastrowid
+            conn.execute('COMMIT')
+        except sqlite3.Error:
+            conn.execute('ROLLBACK')
+            raise
+        return slot_id
+
+    def promote_shared(self, slot_id, priority):
+        """（共享存储）轮到自己（按 pick_next_class 选出的类别的队首）时把记录改为 active，返回是否成功"""
+        conn = self.store.connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            active_by_class = dict(conn.execute(
+                "SELECT priority, COUNT(*) FROM slots WHERE state = 'active' GROUP BY priority").fetchall())
+            heads = {}
+            head_ids = {}
+            for cls, head_id, enqueued in conn.execute(
+                    "SELECT priority, MIN(id), MIN(started) FROM slots WHERE state = 'waiting' GROUP BY priority"):
+                heads[cls] = enqueued
+                head_ids[cls] = head_id
+            cls = pick_next_class(heads, active_by_class, sum(active_by_class.values()), self.limit,
+                                  self.budgets, self.max_wait, time.time())
+            promoted = cls == priority and head_ids.get(cls) == slot_id
+            if promoted:
+                conn.execute("UPDATE slots SET state = 'active', started = ? WHERE id = ?", (time.time(), slot_id))
+            conn.execute('COMMIT')
+            return promoted
+        except sqlite3.Error:
+            conn.execute('ROLLBACK')
+            raise
+
+    def delete_shared(self, slot_id):
+        """（共享存储）删除排队或占用中的记录"""
+        self.store.execute('DELETE FROM slots WHERE id = ?', (slot_id,))
+
+    def stats(self):
+        with self._lock:
+            return {
+                'limit': self.limit,
+                'budgets': self.budgets,
+                'active': self.active,
+                'active_by_class': dict(self.active_by_class),
+                'waiting': self.waiting,
+                'max_queue': self.max_queue,
+                'rejected': self.rejected
+            }
+
+
+class PriorityLatency:
+    """每个优先级类别最近 N 个请求的耗时，用于在 /api/stats 中给出 p50/p95（当前 worker）"""
+
+    def __init__(self, window=1000):
+        self._samples = {cls: deque(maxlen=window) for cls in PRIORITY_CLASSES}
+
+    def observe(self, priority, seconds):
+        samples = self._samples.get(priority)
+        if samples is not None:
+            samples.append(seconds)
+
+    def stats(self):
+        result = {}
+        for cls, samples in self._samples.items():
+            ordered = sorted(samples)
+            if not ordered:
+                result[cls] = {'count': 0}
+                continue
+            result[cls] = {
+                'count': len(ordered),
+                'p50_ms': round(ordered[int(len(ordered) * 0.5)] * 1000, 1),
+                'p95_ms': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 1)
+            }
+        return result
+
+
+rate_limiter = TokenBucketLimiter(shared_store)
+concurrency_gate = ConcurrencyGate(shared_store)
+priority_latency = PriorityLatency()
+
+
+# ========== 熔断、对冲请求与截止时间 ==========
+
+class CircuitOpen(Exception):
+    """上游熔断中，retry_after 为建议的重试等待秒数"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = max(1, int(retry_after + 0.999))
+
+
+def circuit_open_response(error):
+    """503 响应体和响应头"""
+    body = {'error': 'Upstream unavailable', 'message': str(error), 'retry_after': error.retry_after}
+    return body, {'Retry-After': str(error.retry_after)}
+
+
+class CircuitBreaker:
+    """
+    上游熔断器（每个 worker 独立）
+    closed：正常放行，记录最近 window 次调用的结果
+    open：失败率或慢调用比例超过阈值后打开，直接抛出 CircuitOpen
+    half_open：打开 open_seconds 秒后放行一个探测请求，成功则关闭，失败则重新打开
+    """
+
+    def __init__(self, enabled=CIRCUIT_ENABLED, window=CIRCUIT_WINDOW, min_calls=CIRCUIT_MIN_CALLS,
+                 error_rate=CIRCUIT_ERROR_RATE, slow_seconds=CIRCUIT_SLOW_SECONDS,
+                 slow_rate=CIRCUIT_SLOW_RATE, open_seconds=CIRCUIT_OPEN_SECONDS):
+        self.enabled = enabled
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_seconds = slow_seconds
+        self.slow_rate = slow_rate
+        self.open_seconds = open_seconds
+        self._lock = threading.Lock()
+        self._calls = deque(maxlen=window)  # (是否失败, 是否慢调用)
+        self.state = 'closed'
+        self.opened_at = 0.0
+        self._probe_started = None
+        self.opened = 0
+        self.rejected = 0
+
+    def before_call(self):
+        """调用上游前检查，熔断中抛出 CircuitOpen"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if self.state == 'closed':
+                return
+            now = time.monotonic()
+            if self.state == 'open' and now - self.opened_at >= self.open_seconds:
+                self.state = 'half_open'
+                self._probe_started = None
+            # 半开：同一时间只放行一个探测请求（探测请求超过上游超时仍无结果则再放行一个）
+            if self.state == 'half_open' and (
+                    self._probe_started is None
+                    or now - self._probe_started > UPSTREAM_CONNECT_TIMEOUT + UPSTREAM_READ_TIMEOUT):
+                self._probe_started = now
+                return
+            self.rejected += 1
+            retry_after = self.opened_at + self.open_seconds - now
+        raise CircuitOpen('Upstream circuit is open', retry_after)
+
+    def record(self, failed, seconds):
+        """记录一次上游调用的结果（失败：5xx、超时、连接错误）"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if self.state == 'half_open':
+                if failed:
+                    self._open()
+                else:
+                    self.state = 'closed'
+                    self._calls.clear()
+                    logger.info("Upstream circuit closed")
+                return
+            if self.state == 'open':
+                # 打开之前发出的请求陆续返回，不再计入
+                return
+            self._calls.append((failed, seconds >= self.slow_seconds))
+            calls = len(self._calls)
+            if calls < self.min_calls:
+                return
+            failures = sum(1 for failed_call, _ in self._calls if failed_call)
+            slow = sum(1 for _, slow_call in self._calls if slow_call)
+            if failures / calls >= self.error_rate or slow / calls >= self.slow_rate:
+                self._open()
+
+    def _open(self):
+        self.state = 'open'
+        self.opened_at = time.monotonic()
+        self.opened += 1
+        self._calls.clear()
+        logger.warning(f"Upstream circuit opened for {self.open_seconds}s")
+
+    def stats(self):
+        with self._lock:
+            calls = list(self._calls)
+        return {
+            'enabled': self.enabled,
+            'state': self.state,
+            'recent_calls': len(calls),
+            'recent_failures': sum(1 for failed, _ in calls if failed),
+            'recent_slow': sum(1 for _, slow in calls if slow),
+            'times_opened': self.opened,
+            'rejected': self.rejected
+        }
+
+
+class Hedger:
+    """
+    对冲请求策略：只对 high 类别（短请求）且低温度（结果确定、可重复发送）的非流式请求生效，
+    等待时间取这类请求最近上游耗时的 p95（不低于 HEDGE_MIN_DELAY）。
+    对冲请求按 high 类别占用并发名额，没有空闲名额时不对冲
+    """
+
+    priority = 'high'
+
+    def __init__(self, enabled=HEDGE_ENABLED, min_delay=HEDGE_MIN_DELAY, min_samples=HEDGE_MIN_SAMPLES,
+                 window=200):
+        self.enabled = enabled
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.skipped = 0
+
+    def applies(self, api_data, priority):
+        return (self.enabled and priority == self.priority and not api_data.get('stream')
+                and is_low_temperature(api_data, 1.0))
+
+    def delay(self):
+        """对冲等待秒数，样本不足时返回 None（不对冲）"""
+        samples = sorted(self._samples)
+        if len(samples) < self.min_samples:
+            return None
+        return max(self.min_delay, samples[min(len(samples) - 1, int(len(samples) * 0.95))])
+
+    def observe(self, seconds):
+        self._samples.append(seconds)
+
+    def stats(self):
+        delay = self.delay()
+        return {
+            'enabled': self.enabled,
+            'delay_ms': round(delay * 1000, 1) if delay is not None else None,
+            'hedged': self.hedged,
+            'hedge_wins': self.hedge_wins,
+            'skipped_no_slot': self.skipped
+        }
+
+
+def request_deadline(headers, start):
+    """从 X-Deadline-Ms 请求头计算截止时间（perf_counter 时间），没有或无效时返回 None"""
+    value = headers.get(DEADLINE_HEADER)
+    if not value:
+        return None
+    try:
+        budget = float(value) / 1000
+    except ValueError:
+        return None
+    return start + budget if budget > 0 else None
+
+
+def upstream_timeout(deadline):
+    """按截止时间计算上游超时 (连接超时, 读取超时)，已超过截止时间时返回 None"""
+    if deadline is None:
+        return (UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT)
+    remaining = deadline - time.perf_counter()
+    if remaining <= 0:
+        return None
+    return (min(UPSTREAM_CONNECT_TIMEOUT, remaining), min(UPSTREAM_READ_TIMEOUT, remaining))
+
+
+circuit_breaker = CircuitBreaker()
+hedger = Hedger()
+_hedge_executor = None
+_hedge_executor_lock = threading.Lock()
+
+
+def get_hedge_executor():
+    """对冲请求使用的线程池（每个 worker 进程一个，按需创建）"""
+    global _hedge_executor
+    if _hedge_executor is None:
+        with _hedge_executor_lock:
+            if _hedge_executor is None:
+                _hedge_executor = ThreadPoolExecutor(max_workers=UPSTREAM_POOL_SIZE,
+                                                     thread_name_prefix='hedge')
+    return _hedge_executor
+
+
+# ========== 请求合并（single-flight） ==========
+
+class UpstreamError(Exception):
+    """上游调用失败（用于把其他 worker 的异常转交给等待方）"""
+
+
+class _Flight:
+    """一次进行中的上游调用"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class RequestCoalescer:
+    """
+    相同 key 的并发请求只调用一次上游，结果（包括异常）分发给所有等待方。
+    进程内用 threading.Event 等待；配置了共享存储时，
+    其他 worker 通过 flights 表发现进行中的请求并轮询结果。
+    """
+
+    def __init__(self, store=None, timeout=UPSTREAM_READ_TIMEOUT + UPSTREAM_CONNECT_TIMEOUT):
+        self.store = store
+        self.timeout = timeout
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+        self.shared_coalesced = 0
+        if self.store is not None:
+            self.store.ensure_schema(
+                'CREATE TABLE IF NOT EXISTS flights ('
+                'key TEXT PRIMARY KEY, started REAL, finished REAL, done INTEGER DEFAULT 0, '
+                'status INTEGER, body BLOB)'
+            )
+
+    def run(self, key, fn):
+        """执行 fn() 或等待相同 key 的进行中调用，返回 (状态码, 结果)"""
+        if not COALESCE_ENABLED:
+            return fn()
+
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                leader = True
+                self.leaders += 1
+            else:
+                flight.waiters += 1
+                self.coalesced += 1
+                leader = False
+
+        if not leader:
+            if not flight.event.wait(self.timeout):
+                raise UpstreamError('Timed out waiting for coalesced upstream request')
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = self._run_shared(key, fn) if self.store is not None else fn()
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.event.set()
+
+    def _run_shared(self, key, fn):
+        """跨 worker 合并：抢到 flights 记录的 worker 调用上游，其他 worker 轮询结果"""
+        if not self.claim_shared(key):
+            result = self._wait_shared(key)
+            if result is not None:
+                with self._lock:
+                    self.shared_coalesced += 1
+                return result
+            # 持有者超时或记录已清理，自己调用上游
+            return fn()
+
+        try:
+            status_code, result = fn()
+        except Exception as e:
+            self.publish_error(key, e)
+            raise
+        self.publish(key, status_code, result)
+        return status_code, result
+
+    def claim_shared(self, key):
+        """（共享存储）清理过期记录后尝试登记为 key 的持有者，返回是否登记成功"""
+        now = time.time()
+        # 清理已完成（超过宽限期）或超时的记录，已完成的结果不会被之后的新请求复用
+        self.store.execute('DELETE FROM flights WHERE finished < ? OR started < ?',
+                           (now - COALESCE_RESULT_GRACE, now - self.timeout))
+        return self.store.execute(
+            'INSERT OR IGNORE INTO flights (key, started) VALUES (?, ?)', (key, now)
+        ).rowcount == 1
+
+    def publish(self, key, status_code, result):
+        """（共享存储）发布持有者的结果"""
+        body = result if status_code == 200 else str(result).encode('utf-8')
+        self._publish(key, status_code, body)
+
+    def publish_error(self, key, error):
+        """（共享存储）发布持有者的异常：限流和熔断保留类型和 retry_after，等待方抛出同样的异常"""
+        kind = type(error).__name__ if isinstance(error, (RateLimited, CircuitOpen)) else 'UpstreamError'
+        body = json.dumps({'kind': kind, 'message': str(error), 'retry_after': getattr(error, 'retry_after', None)})
+        self._publish(key, -1, body.encode('utf-8'))
+
+    def _publish(self, key, status_code, body):
+        # 结果保留 COALESCE_RESULT_GRACE 秒，供正在轮询的 worker 读取
+        self.store.execute('UPDATE flights SET done = 1, finished = ?, status = ?, body = ? WHERE key = ?',
+                           (time.time(), status_code, body, key))
+
+    def _wait_shared(self, key):
+        deadline = time.time() + self.timeout
+        while time.time() < deadline:
+            done, result = self.poll_shared(key)
+            if done:
+                return result
+            time.sleep(COALESCE_POLL_INTERVAL)
+        return None
+
+    def poll_shared(self, key):
+        """
+        （共享存储）查看持有者的结果，返回 (是否结束, 结果)：
+        记录已不存在时为 (True, None)，持有者失败时抛出 UpstreamError
+        """
+        row = self.store.execute('SELECT done, status, body FROM flights WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return True, None
+        done, status_code, body = row
+        if not done:
+            return False, None
+        if status_code == -1:
+            raise shared_error(body)
+        if status_code == 200:
+            return True, (200, body)
+        return True, (status_code, body.decode('utf-8', 'replace'))
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': COALESCE_ENABLED,
+                'shared': self.store is not None,
+                'in_flight': len(self._flights),
+                'upstream_calls': self.leaders,
+                'saved_upstream_calls': self.coalesced + self.shared_coalesced
+            }
+
+
+def shared_error(body):
+    """把 publish_error 发布的异常还原成 RateLimited / CircuitOpen / UpstreamError"""
+    try:
+        error = json.loads(body)
+    except ValueError:
+        return UpstreamError(body.decode('utf-8', 'replace'))
+    if error.get('kind') == 'RateLimited':
+        return RateLimited(error['message'], error['retry_after'])
+    if error.get('kind') == 'CircuitOpen':
+        return CircuitOpen(error['message'], error['retry_after'])
+    return UpstreamError(error.get('message', ''))
+
+
+coalescer = RequestCoalescer(shared_store)
+
+
+# ========== 多节点缓存分片 ==========
+
+PEER_PATH = '/api/peer/chat'
+PEER_TOKEN_HEADER = 'X-Peer-Token'
+PEER_CLIENT_HEADER = 'X-Peer-Client'
+PEER_ROUTE_HEADER = 'X-Peer-Route'
+# owner 节点的处理结果：ok / upstream（上游错误）/ rate_limited / circuit_open
+PEER_RESULT_HEADER = 'X-Peer-Result'
+
+
+class PeerUnavailable(Exception):
+    """owner 节点连接不上或没有给出代理节点的结果，由本节点自己处理请求"""
+
+
+def ring_position(value):
+    """字符串在哈希环上的位置（64 位）"""
+    return int.from_bytes(hashlib.sha256(value.encode('utf-8')).digest()[:8], 'big')
+
+
+class PeerRing:
+    """
+    一致性哈希环：每个节点 vnodes 个虚拟节点，缓存键顺时针遇到的第一个节点为它的 owner。
+    增减一个节点时只有约 1/N 的键换 owner。连接失败的节点暂时跳过，它的键由环上的下一个节点负责。
+    """
+
+    def __init__(self, nodes=PEER_NODES, self_url=PEER_SELF, secret=PEER_SECRET, vnodes=PEER_VNODES,
+                 retry_seconds=PEER_RETRY_SECONDS):
+        self.self_url = self_url
+        self.secret = secret
+        self.retry_seconds = retry_seconds
+        self.enabled = bool(nodes) and bool(secret) and self_url in nodes
+        if nodes and not self.enabled:
+            logger.warning("PEER_NODES is set but PEER_SECRET is empty or PEER_SELF is not one of the nodes, "
+                           "peer mode disabled")
+        self.nodes = list(nodes) if self.enabled else []
+        points = sorted((ring_position(f"{node}#{i}"), node) for node in self.nodes for i in range(vnodes))
+        self._positions = [position for position, _ in points]
+        self._owners = [node for _, node in points]
+        self._down_until = {}
+        self._lock = threading.Lock()
+        self.owned = 0
+        self.forwarded = 0
+        self.served = 0
+        self.fallbacks = 0
+
+    def owner(self, key):
+        """负责该缓存键的其他节点的地址；本节点负责或未启用时返回 None"""
+        if not self.enabled:
+            return None
+        now = time.monotonic()
+        start = bisect.bisect(self._positions, int(key[:16], 16))
+        for offset in range(len(self._owners)):
+            node = self._owners[(start + offset) % len(self._owners)]
+            if node == self.self_url:
+                break
+            if self._down_until.get(node, 0.0) <= now:
+                with self._lock:
+                    self.forwarded += 1
+                return node
+        with self._lock:
+            self.owned += 1
+        return None
+
+    def mark_down(self, node):
+        with self._lock:
+            self._down_until[node] = time.monotonic() + self.retry_seconds
+            self.fallbacks += 1
+        logger.warning(f"Peer {node} unreachable, skipping it for {self.retry_seconds:.0f}s")
+
+    def check_token(self, token):
+        return self.enabled and hmac.compare_digest(token.encode('utf-8'), self.secret.encode('utf-8'))
+
+    def record_served(self):
+        with self._lock:
+            self.served += 1
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'self': self.self_url or None,
+                'nodes': self.nodes,
+                'down': [node for node, until in self._down_until.items() if until > now],
+                'owned': self.owned,
+                'forwarded': self.forwarded,
+                'served_for_peers': self.served,
+                'fallbacks': self.fallbacks
+            }
+
+
+peer_ring = PeerRing()
+_peer_session = None
+_peer_session_lock = threading.Lock()
+
+
+def get_peer_session():
+    """转发给其他节点用的连接池（每个 worker 进程一个，fork 之后重新创建）"""
+    global _peer_session
+    session = _peer_session
+    if session is None or session.pid != os.getpid():
+        with _peer_session_lock:
+            if _peer_session is None or _peer_session.pid != os.getpid():
+                session = requests.Session()
+                adapter = KeepAliveAdapter(pool_connections=len(peer_ring.nodes) or 1, pool_maxsize=UPSTREAM_POOL_SIZE,
+                                           max_retries=0)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                session.pid = os.getpid()
+                _peer_session = session
+            session = _peer_session
+    return session
+
+
+def peer_request_headers(client, route, timer, deadline):
+    """转发给 owner 节点的请求头：认证、客户端标识、原路由、优先级、工作负载类别、请求 id 和剩余的截止时间"""
+    headers = {
+        PEER_TOKEN_HEADER: peer_ring.secret,
+        PEER_CLIENT_HEADER: client,
+        PEER_ROUTE_HEADER: route,
+        'X-Priority': timer.priority,
+        'X-Workload': timer.workload,
+        REQUEST_ID_HEADER: timer.request_id or ''
+    }
+    if deadline is not None:
+        headers[DEADLINE_HEADER] = str(max(int((deadline - time.perf_counter()) * 1000), 1))
+    return headers
+
+
+def peer_timeout(timeout):
+    """转发的超时：连接超时用 PEER_CONNECT_TIMEOUT，读取超时比 owner 调用上游的超时多留出连接时间"""
+    return PEER_CONNECT_TIMEOUT, timeout[1] + timeout[0]
+
+
+def parse_peer_response(status_code, headers, body):
+    """
+    owner 节点的响应 → (状态码, 结果, 缓存状态)，与本节点 complete_chat 的返回值一致；
+    owner 被限流或熔断时抛出相同的异常，响应不是代理节点给出的结果时抛出 PeerUnavailable
+    """
+    kind = headers.get(PEER_RESULT_HEADER)
+    if kind == 'ok':
+        return 200, body, headers.get('X-Proxy-Cache', 'MISS')
+    if kind == 'upstream':
+        return status_code, json.loads(body).get('message', ''), 'MISS'
+    if kind in ('rate_limited', 'circuit_open'):
+        data = json.loads(body)
+        error = RateLimited if kind == 'rate_limited' else CircuitOpen
+        raise error(data.get('message', ''), data.get('retry_after', 1))
+    raise PeerUnavailable(f"Unexpected response from peer: {status_code}")
+
+
+def forward_to_peer(node, api_data, client, route, timer, deadline):
+    """
+    把可缓存的请求转发给 owner 节点，返回 (状态码, 结果, 缓存状态)
+    连接不上时标记该节点并抛出 PeerUnavailable（调用方改为自己处理）；读取超时返回 504，不再重发
+    """
+    timeout = upstream_timeout(deadline)
+    if timeout is None:
+        return 504, 'Request deadline exceeded', 'MISS'
+    try:
+        response = get_peer_session().post(f"{node}{PEER_PATH}", json=api_data,
+                                           headers=peer_request_headers(client, route, timer, deadline),
+                                           timeout=peer_timeout(timeout))
+    except requests.exceptions.ConnectionError as e:
+        peer_ring.mark_down(node)
+        raise PeerUnavailable(str(e))
+    except requests.exceptions.Timeout:
+        return 504, 'Upstream request timed out', 'MISS'
+    return parse_peer_response(response.status_code, response.headers, response.content)
+
+
+def peer_error_response(kind, error):
+    """owner 节点被限流或熔断时返回给入口节点的 (状态码, 响应体, 响应头)"""
+    if kind == 'rate_limited':
+        body, headers = rate_limited_response(error)
+        status_code = 429
+    else:
+        body, headers = circuit_open_response(error)
+        status_code = 503
+    headers[PEER_RESULT_HEADER] = kind
+    return status_code, body, headers
+
+
+@app.before_request
+def start_request_timer():
+    """为 /api/ 请求记录开始时间、请求 id 和进行中请求数"""
+    if request.path.startswith('/api/'):
+        g.timer = StageTimer(request_id(request.headers))
+        metrics.request_started()
+
+
+@app.after_request
+def add_server_timing(response):
+    """
+    在 /api/ 响应上附加 X-Request-Id 头，/api/chat 响应上再附加 Server-Timing 头（各阶段耗时，毫秒）并写访问日志
+    （流式响应在转发结束后由 stream_upstream 记录）
+    """
+    timer = g.get('timer')
+    if timer is None:
+        return response
+    response.headers[REQUEST_ID_HEADER] = timer.request_id
+    if request.path.startswith('/api/chat'):
+        timer.finish()
+        response.headers['Server-Timing'] = timer.server_timing()
+        metrics.observe_request(request.path, timer)
+        priority_latency.observe(timer.priority, timer.stages['total'])
+        workload_stats.observe(timer.workload, timer.stages['total'])
+        if not (response.is_streamed and response.mimetype == 'text/event-stream'):
+            log_request(timer, request.path, response.status_code)
+    return response
+
+
+@app.teardown_request
+def finish_request_timer(exc):
+    if g.pop('timer', None) is not None:
+        metrics.request_finished()
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus 指标"""
+    client = get_upstream_client()
+    pool = client.stats()
+    metrics.set_pool(pool['idle_connections'], pool['active_connections'])
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
 
 
 @app.route('/health', methods=['GET'])
 def health_check():
     """健康检查"""
-    return jsonify({'status': 'ok', 'message': 'API Proxy Server is running'})
+    return jsonify({
+        'status': 'ok',
+        'message': 'API Proxy Server is running',
+        'upstream_pool': get_upstream_client().stats(),
+        'upstream_circuit': circuit_breaker.state
+    })
 
 
 @app.route('/api/chat', methods=['POST'])
@@ -59,106 +3090,689 @@ def chat_completion():
         "messages": [...],
         "model": "deepseek-chat",
         "temperature": 0.7,
-        "max_tokens": 2000
+        "max_tokens": 2000,
+        "stream": false
+    }
+    
+    stream 为 true 时以 text/event-stream 原样转发上游的 SSE chunk
+    
+    也可以用提示词模板代替 messages（简历需先上传到 /api/resumes）：
+    {
+        "template_id": "score@1",
+        "resume_hash": "<sha256>",
+        "job_description": "..."
     }
     
+    可选的优先级头（默认按 max_tokens 推断）：
+    X-Priority: high | normal | low
+    
+    可选的工作负载类别头（默认取模板名称），按 MODEL_ROUTES 路由模型：
+    X-Workload: score | tailor | cover_letter | ...
+    
+    可选的幂等键（客户端超时重试时返回第一次请求的结果，响应带 Idempotent-Replayed: true）：
+    Idempotency-Key: <客户端生成的唯一值>
+    
     可选的认证头：
     Authorization: Bearer <SERVER_API_KEY>
     """
+    idempotency_key = None
     try:
         # 可选：验证客户端 API Key
-        auth_header = request.headers.get('Authorization', '')
-        if SERVER_API_KEY and SERVER_API_KEY != 'your-server-api-key-here':
-            if not auth_header.startswith('Bearer ') or auth_header[7:] != SERVER_API_KEY:
-                return jsonify({'error': 'Unauthorized'}), 401
+        if not check_client_auth(request.headers.get('Authorization', '')):
+            return jsonify({'error': 'Unauthorized'}), 401
         
         # 获取请求数据
-        data = request.get_json()
+        data = request.get_json(silent=True)
         if not data:
             return jsonify({'error': 'Invalid request body'}), 400
         
+        workload = classify_workload(data, request.headers)
+        # 模板请求：在代理端用已上传的简历展开提示词
+        if 'template_id' in data:
+            data = expand_prompt_template(data)
+        # 按工作负载类别路由模型和参数
+        data = apply_model_route(data, workload)
+        
         # 构建 DeepSeek API 请求
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {DEEPSEEK_API_KEY}"
-        }
+        api_data = build_upstream_payload(data)
+        client = client_id(request.headers.get('Authorization', ''))
+        g.timer.priority = priority = classify_priority(api_data, request.headers)
+        g.timer.workload = workload
+        g.timer.client = client
+        g.timer.model = api_data.get('model')
         
-        api_data = {
-            "model": data.get('model', 'deepseek-chat'),
-            "messages": data.get('messages', []),
-            "temperature": data.get('temperature', 0.7),
-            "max_tokens": data.get('max_tokens', 2000)
-        }
+        # 幂等键：已有保存的响应（或相同的请求正在处理）时直接返回，不再调用上游
+        idempotency_key = idempotency_store.scoped_key(client, request.headers.get(IDEMPOTENCY_HEADER))
+        if idempotency_key:
+            stored = idempotency_store.begin(idempotency_key, api_data,
+                                             request_deadline(request.headers, g.timer.start))
+            if stored is not None:
+                idempotency_key = None
+                body, content_type, headers = idempotent_replay(stored, request.headers)
+                return Response(body, content_type=content_type, headers=headers)
         
-        # 调用 DeepSeek API
-        logger.info(f"Proxying request to DeepSeek API: {api_data.get('model')}")
-        response = requests.post(
-            DEEPSEEK_API_URL,
-            headers=headers,
-            json=api_data,
-            timeout=60
-        )
+        if api_data.get('stream'):
+            traffic_capture.request(api_data, request.headers, client, request.path)
+            rate_limiter.check(client)
+            return proxy_stream(api_data, client, priority, request_deadline(request.headers, g.timer.start),
+                                idempotency_key)
         
-        # 更新统计
-        reset_daily_stats()
-        usage_stats['total_requests'] += 1
-        usage_stats['requests_today'] += 1
+        status_code, result, cache_state = complete_chat(api_data, client, request.headers, request.path, g.timer)
         
-        if response.status_code == 200:
-            result = response.json()
-            # 统计 token 使用量
-            if 'usage' in result:
-                usage_stats['total_tokens'] += result['usage'].get('total_tokens', 0)
-            
-            logger.info(f"Request successful. Total requests: {usage_stats['total_requests']}")
-            return jsonify(result)
+        g.timer.cache = cache_state
+        if status_code == 200:
+            idempotency_store.complete(idempotency_key, 'application/json', result)
+            g.timer.tokens = scan_total_tokens(result)
+            # 原样返回上游（或缓存）的响应字节，不做解析和重新序列化
+            if wants_lean(request.headers):
+                started = time.perf_counter()
+                result = lean_body(result)
+                g.timer.add('serialize', time.perf_counter() - started)
+            return Response(result, mimetype='application/json', headers={'X-Proxy-Cache': cache_state})
         else:
-            logger.error(f"DeepSeek API error: {response.status_code} - {response.text}")
+            idempotency_store.abandon(idempotency_key)
             return jsonify({
                 'error': 'API request failed',
-                'status_code': response.status_code,
-                'message': response.text
-            }), response.status_code
+                'status_code': status_code,
+                'message': result
+            }), status_code
             
+    except IdempotencyConflict as e:
+        body, headers = idempotency_conflict_response(e)
+        return jsonify(body), e.status_code, headers
+    except RateLimited as e:
+        idempotency_store.abandon(idempotency_key)
+        body, headers = rate_limited_response(e)
+        return jsonify(body), 429, headers
+    except CircuitOpen as e:
+        idempotency_store.abandon(idempotency_key)
+        body, headers = circuit_open_response(e)
+        return jsonify(body), 503, headers
+    except TemplateError as e:
+        return jsonify(template_error_response(e)), e.status_code
+    except Exception as e:
+        idempotency_store.abandon(idempotency_key)
+        logger.error(f"Error processing request: {str(e)}", extra=log_fields(request_id=g.timer.request_id))
+        return jsonify({'error': str(e)}), 500
+
+
+def complete_chat(api_data, client, headers, route, timer, from_peer=False):
+    """
+    处理一个非流式聊天请求：响应缓存 → 限流 → 请求合并 → 上游
+    返回 (状态码, 结果, 缓存状态)：
+    - 成功时结果为上游响应的原始字节，缓存状态为 HIT（缓存命中）、MISS 或 BYPASS
+    - 上游失败时结果为上游错误信息（截断后的文本）
+    被限流时抛出 RateLimited，上游熔断中抛出 CircuitOpen
+    多节点模式下，可缓存的请求转发给 owner 节点处理（连接不上时自己处理）；
+    from_peer 为 True 表示是其他节点转发来的请求，本节点就是 owner，不再限流（入口节点已限流）和转发
+    """
+    priority = timer.priority
+    deadline = request_deadline(headers, timer.start)
+    hedge = hedger.applies(api_data, priority)
+    
+    # 查询响应缓存，命中则直接返回，不调用上游（由其他节点负责的键只在 owner 上缓存）
+    key = cache_key(api_data)
+    if not from_peer:
+        traffic_capture.request(api_data, headers, client, route, key)
+    cacheable = is_cacheable(api_data, headers)
+    owner = peer_ring.owner(key) if cacheable and not from_peer else None
+    if cacheable and owner is None:
+        cached = response_cache.get(key)
+        if cached is not None:
+            return 200, cached, 'HIT'
+    
+    # 限流：按客户端的请求速率和 token 额度
+    if not from_peer:
+        rate_limiter.check(client)
+    
+    cache_route = route if cacheable else None
+    cache_state = 'MISS' if cacheable else 'BYPASS'
+    
+    def forward():
+        # 只有真正调用上游的请求占用并发名额
+        slot, waited = concurrency_gate.acquire(priority)
+        timer.add('queue', waited)
+        try:
+            return call_upstream(api_data, client, key, cache_route, deadline, hedge, timer.workload)
+        finally:
+            concurrency_gate.release(slot)
+    
+    def forward_peer():
+        nonlocal cache_state
+        try:
+            status_code, result, cache_state = forward_to_peer(owner, api_data, client, route, timer, deadline)
+            return status_code, result
+        except PeerUnavailable:
+            return forward()
+    
+    # 相同的并发请求只调用一次上游（或只转发一次）；只合并可缓存（确定性）的请求，
+    # 高温度或要求跳过缓存的请求即使内容相同，每个客户端也应拿到自己的结果
+    started = time.perf_counter()
+    if cacheable:
+        status_code, result = coalescer.run(key, forward if owner is None else forward_peer)
+    else:
+        status_code, result = forward()
+    timer.add('upstream', time.perf_counter() - started - timer.stages.get('queue', 0.0))
+    return status_code, result, cache_state
+
+
+@app.route(PEER_PATH, methods=['POST'])
+def peer_chat():
+    """
+    节点间接口：其他代理节点把本节点负责（owner）的可缓存请求转发过来，只接受带正确 X-Peer-Token 的请求
+    
+    请求体为上游请求体（已展开模板、已路由），X-Peer-Client / X-Peer-Route 为入口节点上的客户端标识和路由。
+    成功时返回上游响应的原始字节；失败时返回 {"status_code", "message"}，X-Peer-Result 头说明结果类型
+    """
+    if not peer_ring.check_token(request.headers.get(PEER_TOKEN_HEADER, '')):
+        return jsonify({'error': 'Forbidden'}), 403
+    api_data = request.get_json(silent=True)
+    if not isinstance(api_data, dict):
+        return jsonify({'error': 'Invalid request body'}), 400
+    
+    peer_ring.record_served()
+    g.timer.priority = classify_priority(api_data, request.headers)
+    g.timer.workload = request.headers.get('X-Workload', 'default')
+    client = request.headers.get(PEER_CLIENT_HEADER, 'anonymous')
+    route = request.headers.get(PEER_ROUTE_HEADER, '/api/chat')
+    try:
+        status_code, result, cache_state = complete_chat(api_data, client, request.headers, route, g.timer,
+                                                         from_peer=True)
+    except RateLimited as e:
+        status_code, body, headers = peer_error_response('rate_limited', e)
+        return jsonify(body), status_code, headers
+    except CircuitOpen as e:
+        status_code, body, headers = peer_error_response('circuit_open', e)
+        return jsonify(body), status_code, headers
+    
+    if status_code == 200:
+        return Response(result, mimetype='application/json',
+                        headers={'X-Proxy-Cache': cache_state, PEER_RESULT_HEADER: 'ok'})
+    return jsonify({'status_code': status_code, 'message': result}), status_code, {PEER_RESULT_HEADER: 'upstream'}
+
+
+@app.route('/api/chat/batch', methods=['POST'])
+def chat_completion_batch():
+    """
+    批量聊天接口：一次提交多个聊天请求，代理以有限并发调用上游
+    
+    请求体：
+    {
+        "requests": [{"messages": [...], "max_tokens": 50, ...}, ...],
+        "stream": false
+    }
+    
+    stream 为 false 时按提交顺序返回 {"results": [...]}；
+    为 true 时以 application/x-ndjson 每完成一项输出一行。
+    每项结果带 index 和 status_code，失败的项单独返回错误，不影响其他项。
+    缓存、请求合并和限流都按单项生效。
+    """
+    try:
+        if not check_client_auth(request.headers.get('Authorization', '')):
+            return jsonify({'error': 'Unauthorized'}), 401
+        
+        data = request.get_json(silent=True)
+        items = data.get('requests') if isinstance(data, dict) else None
+        if not isinstance(items, list) or not items:
+            return jsonify({'error': 'Invalid request body'}), 400
+        if len(items) > BATCH_MAX_ITEMS:
+            return jsonify({'error': f'Too many requests in batch (max {BATCH_MAX_ITEMS})'}), 400
+        
+        client = client_id(request.headers.get('Authorization', ''))
+        # 工作线程里没有请求上下文，复制一份请求头
+        headers = Headers(request.headers)
+        route = request.path
+        executor = ThreadPoolExecutor(max_workers=min(len(items), BATCH_MAX_CONCURRENCY))
+        futures = [executor.submit(run_batch_item, index, item, client, headers, route)
+                   for index, item in enumerate(items)]
+        
+        if data.get('stream'):
+            def generate():
+                try:
+                    for future in as_completed(futures):
+                        yield json.dumps(future.result(), ensure_ascii=False) + '\n'
+                finally:
+                    # 客户端断开时取消尚未开始的项
+                    executor.shutdown(wait=False, cancel_futures=True)
+            return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                            headers={'X-Accel-Buffering': 'no'})
+        
+        try:
+            results = [future.result() for future in futures]
+        finally:
+            executor.shutdown(wait=False)
+        return jsonify({'results': results})
+    
     except Exception as e:
-        logger.error(f"Error processing request: {str(e)}")
+        logger.error(f"Error processing batch request: {str(e)}", extra=log_fields(request_id=g.timer.request_id))
         return jsonify({'error': str(e)}), 500
 
 
+def run_batch_item(index, item, client, headers, route):
+    """执行批量请求中的一项，返回该项的结果（不抛出异常）"""
+    try:
+        timer = StageTimer()
+        timer.workload = classify_workload(item, headers)
+        if isinstance(item, dict) and 'template_id' in item:
+            item = expand_prompt_template(item)
+        if not isinstance(item, dict) or not item.get('messages'):
+            return {'index': index, 'status_code': 400, 'error': 'Invalid request item'}
+        item = apply_model_route(item, timer.workload)
+        api_data = build_upstream_payload(dict(item, stream=False))
+        timer.priority = classify_priority(api_data, headers)
+        status_code, result, cache_state = complete_chat(api_data, client, headers, route, timer)
+        workload_stats.observe(timer.workload, time.perf_counter() - timer.start)
+        if status_code == 200:
+            result = json.loads(result)
+            if wants_lean(headers):
+                result = lean_result(result)
+            return {'index': index, 'status_code': 200, 'cache': cache_state, 'response': result}
+        return {'index': index, 'status_code': status_code, 'error': 'API request failed', 'message': result}
+    except RateLimited as e:
+        body, _ = rate_limited_response(e)
+        return dict(body, index=index, status_code=429)
+    except CircuitOpen as e:
+        body, _ = circuit_open_response(e)
+        return dict(body, index=index, status_code=503)
+    except TemplateError as e:
+        return dict(template_error_response(e), index=index, status_code=e.status_code)
+    except Exception as e:
+        logger.error(f"Error processing batch item {index}: {str(e)}")
+        return {'index': index, 'status_code': 500, 'error': str(e)}
+
+
+def call_upstream(api_data, client, key=None, cache_route=None, deadline=None, hedge=False, workload=None):
+    """
+    调用 DeepSeek API（非流式），client 为统计用的客户端标识
+    返回 (状态码, 结果)：成功时结果为上游响应的原始字节，失败时为截断后的错误信息
+    cache_route 不为空时把成功的响应写入缓存
+    deadline 为截止时间（超过后返回 504），hedge 为 True 时按对冲策略发送
+    workload 为工作负载类别，token 用量同时计入该类别
+    """
+    timeout = upstream_timeout(deadline)
+    if timeout is None:
+        return 504, 'Request deadline exceeded'
+    circuit_breaker.before_call()
+    upstream_client = get_upstream_client()
+    started = time.perf_counter()
+    try:
+        response = post_upstream(upstream_client, api_data, deadline, hedge, client, workload)
+    except requests.exceptions.Timeout:
+        # 客户端给的截止时间比上游超时短时，超时不算上游故障
+        circuit_breaker.record(timeout[1] >= UPSTREAM_READ_TIMEOUT, time.perf_counter() - started)
+        logger.error(f"DeepSeek API timed out after {time.perf_counter() - started:.1f}s")
+        return 504, 'Upstream request timed out'
+    except RateLimited:
+        raise
+    except Exception:
+        circuit_breaker.record(True, time.perf_counter() - started)
+        raise
+    circuit_breaker.record(response.status_code >= 500, time.perf_counter() - started)
+    traffic_capture.upstream(api_data, response.status_code, time.perf_counter() - started, response.content)
+    
+    # 更新统计
+    model = api_data.get('model')
+    record_request(client, model)
+    metrics.observe_upstream(model, response.status_code, time.perf_counter() - started)
+    if metrics.enabled:
+        pool = upstream_client.stats()
+        metrics.set_pool(pool['idle_connections'], pool['active_connections'])
+    
+    if response.status_code == 200:
+        body = response.content
+        # 统计 token 使用量（只扫描 usage，不解析整个响应）
+        record_tokens(client, model, scan_total_tokens(body), workload)
+        
+        if cache_route is not None:
+            response_cache.set(key, body, cache_ttl_for(cache_route))
+        return 200, body
+    
+    message = error_excerpt(response.content)
+    logger.error(f"DeepSeek API error: {response.status_code} - {message}",
+                 extra=log_fields(upstream_status=response.status_code, model=model))
+    return response.status_code, message
+
+
+def post_upstream(upstream_client, api_data, deadline=None, hedge=False, client=None, workload=None):
+    """
+    发送非流式上游请求，deadline 为截止时间（包括读取响应体在内的总耗时）
+    hedge 为 True 时，超过对冲等待时间仍未返回则再发一个相同请求（通常会发给另一个 key），返回先成功的响应；
+    落后的请求在后台完成后关闭响应，成功的仍按 client / workload 统计 token（上游已经计费）；
+    对冲请求占用一个并发名额直到完成，没有空闲名额时不对冲
+    """
+    def send():
+        response, key = send_upstream(upstream_client, api_data, deadline)
+        upstream_keys.release(key)
+        return response
+
+    def send_primary():
+        # 对冲等待时间从主请求真正开始发送时算起，不包括在线程池里排队的时间
+        primary_sent.append(time.perf_counter())
+        primary_started.set()
+        return send()
+
+    def send_hedge(slot):
+        try:
+            return send()
+        finally:
+            concurrency_gate.release(slot)
+
+    def discard(future):
+        try:
+            response = future.result()
+        except Exception:
+            return
+        if response.status_code == 200:
+            record_tokens(client, api_data.get('model'), scan_total_tokens(response.content), workload)
+        response.close()
+    
+    if not hedge:
+        return send()
+    
+    hedge_delay = hedger.delay()
+    if hedge_delay is None:
+        # 样本不足：正常发送，只记录耗时
+        sent = time.perf_counter()
+        response = send()
+        if response.status_code == 200:
+            hedger.observe(time.perf_counter() - sent)
+        return response
+    
+    executor = get_hedge_executor()
+    primary_sent = []
+    primary_started = threading.Event()
+    primary = executor.submit(send_primary)
+    primary_started.wait()
+    started = {primary: primary_sent[0]}
+    attempts = [primary]
+    done, _ = wait(attempts, timeout=max(started[primary] + hedge_delay - time.perf_counter(), 0))
+    if not done:
+        granted, slot = concurrency_gate.try_acquire(hedger.priority)
+        if granted:
+            hedger.hedged += 1
+            attempts.append(executor.submit(send_hedge, slot))
+            started[attempts[-1]] = time.perf_counter()
+        else:
+            hedger.skipped += 1
+    
+    # 先成功的响应直接返回；都失败时等所有请求结束，返回最后一个失败的响应
+    winner = None
+    failed = None
+    error = None
+    pending = set(attempts)
+    while pending and winner is None:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                result = future.result()
+            except requests.exceptions.RequestException as e:
+                error = e
+                continue
+            if result.status_code == 200 and winner is None:
+                winner = future
+            elif result.status_code != 200:
+                failed = future
+    chosen = winner or failed
+    for future in attempts:
+        if future is not chosen:
+            future.add_done_callback(discard)
+    if winner is not None:
+        # 记录的是胜出请求自身的耗时，避免对冲等待时间逐步抬高
+        hedger.observe(time.perf_counter() - started[winner])
+        if winner is not primary:
+            hedger.hedge_wins += 1
+        return winner.result()
+    if failed is not None:
+        return failed.result()
+    raise error
+
+
+def send_upstream(upstream_client, api_data, deadline=None, stream=False):
+    """
+    把请求发给在途请求最少的上游 key，返回 (响应, key)，调用方用完响应后调用 upstream_keys.release(key)
+    收到 429 时该 key 进入冷却，换一个 key 重试；所有 key 都在冷却时抛出 RateLimited
+    deadline 不为空时，每次重试按剩余时间计算超时，非流式响应体也要在截止时间前读完，否则抛出超时
+    """
+    attempts = len(upstream_keys.keys)
+    for attempt in range(attempts):
+        timeout = upstream_timeout(deadline)
+        if timeout is None:
+            raise requests.exceptions.Timeout('Request deadline exceeded')
+        key = upstream_keys.acquire()
+        try:
+            # 有截止时间时不让 requests 一次读完响应体，由 read_before_deadline 边读边检查总耗时
+            response = upstream_client.post(key.url, headers=build_upstream_headers(key.api_key),
+                                            json=api_data, timeout=timeout, stream=stream or deadline is not None)
+            upstream_keys.observe(key, response.status_code, response.headers)
+            if response.status_code != 429 or attempt == attempts - 1 or not upstream_keys.has_ready_key():
+                if not stream and deadline is not None:
+                    read_before_deadline(response, deadline)
+                return response, key
+        except Exception:
+            upstream_keys.release(key)
+            raise
+        response.close()
+        upstream_keys.release(key)
+
+
+def read_before_deadline(response, deadline):
+    """
+    读取非流式响应体，超过截止时间时关闭连接并抛出超时
+    （读取超时只限制两次收到数据的间隔，上游持续发送保活空行时不会触发）
+    """
+    chunks = []
+    try:
+        for chunk in response.iter_content(chunk_size=16 * 1024):
+            chunks.append(chunk)
+            if time.perf_counter() >= deadline:
+                raise requests.exceptions.Timeout('Request deadline exceeded while reading the upstream response')
+    except Exception:
+        response.close()
+        raise
+    response._content = b''.join(chunks)
+    response._content_consumed = True
+
+
+def proxy_stream(api_data, client, priority='normal', deadline=None, idempotency_key=None):
+    """
+    流式请求：上游返回 200 时逐块转发 SSE，否则返回错误 JSON
+    idempotency_key 不为空时，完整转发的 SSE 响应按幂等键保存，失败时删除 pending 记录
+    """
+    # 流式请求在整个转发期间占用并发名额
+    slot, waited = concurrency_gate.acquire(priority)
+    g.timer.add('queue', waited)
+    timeout = upstream_timeout(deadline)
+    if timeout is None:
+        concurrency_gate.release(slot)
+        idempotency_store.abandon(idempotency_key)
+        return jsonify({'error': 'Request deadline exceeded'}), 504
+    try:
+        circuit_breaker.before_call()
+        started = time.perf_counter()
+        response, key = send_upstream(get_upstream_client(), api_data, deadline, stream=True)
+    except requests.exceptions.Timeout:
+        concurrency_gate.release(slot)
+        idempotency_store.abandon(idempotency_key)
+        circuit_breaker.record(timeout[1] >= UPSTREAM_READ_TIMEOUT, time.perf_counter() - started)
+        return jsonify({'error': 'Upstream request timed out'}), 504
+    except (CircuitOpen, RateLimited):
+        concurrency_gate.release(slot)
+        raise
+    except Exception:
+        concurrency_gate.release(slot)
+        circuit_breaker.record(True, time.perf_counter() - started)
+        raise
+    # 流式请求按首字节时间判断慢调用
+    circuit_breaker.record(response.status_code >= 500, time.perf_counter() - started)
+    record_request(client, api_data.get('model'))
+    # 流式请求记录的是收到响应头（首字节）的时间
+    g.timer.add('upstream', time.perf_counter() - started)
+    metrics.observe_upstream(api_data.get('model'), response.status_code, time.perf_counter() - started)
+    
+    if response.status_code == 200:
+        recorder = traffic_capture.stream(api_data, time.perf_counter() - started)
+        return Response(stream_with_context(stream_upstream(response, client, api_data.get('model'), slot, key,
+                                                            recorder, g.timer.workload, idempotency_key,
+                                                            g.timer, deadline)),
+                        mimetype='text/event-stream', headers=SSE_HEADERS)
+    
+    concurrency_gate.release(slot)
+    upstream_keys.release(key)
+    idempotency_store.abandon(idempotency_key)
+    traffic_capture.upstream(api_data, response.status_code, time.perf_counter() - started, response.content)
+    message = error_excerpt(response.content)
+    logger.error(f"DeepSeek API error: {response.status_code} - {message}",
+                 extra=log_fields(request_id=g.timer.request_id, upstream_status=response.status_code,
+                                  model=api_data.get('model')))
+    return jsonify({
+        'error': 'API request failed',
+        'status_code': response.status_code,
+        'message': message
+    }), response.status_code
+
+
+def stream_upstream(response, client, model, slot=None, key=None, recorder=None, workload=None,
+                    idempotency_key=None, timer=None, deadline=None):
+    """
+    逐块转发上游 SSE 响应，不做缓冲，结束后统计 token（计入 workload 类别）并释放并发名额和上游 key
+    recorder 不为空时（流量录制抽中）记录每个 chunk 的时间和大小
+    idempotency_key 不为空时，完整转发后按幂等键保存整个响应，中途断开则删除 pending 记录
+    timer 不为空时在结束后写访问日志（客户端中途断开记为 499，超过截止时间被截断记为 504）
+    deadline 不为空时，超过截止时间后不再转发，关闭上游连接
+    """
+    scanner = SSEUsageScanner()
+    chunks = [] if idempotency_key else None
+    finished = False
+    expired = False
+    try:
+        for chunk in response.iter_content(chunk_size=None):
+            if chunk:
+                scanner.feed(chunk)
+                if recorder is not None:
+                    recorder.feed(chunk)
+                if chunks is not None:
+                    chunks.append(chunk)
+                yield chunk
+            if deadline is not None and time.perf_counter() >= deadline:
+                expired = True
+                logger.warning("Request deadline exceeded while streaming, closing the upstream response")
+                break
+        finished = not expired
+    finally:
+        if finished:
+            idempotency_store.complete(idempotency_key, 'text/event-stream', b''.join(chunks or ()))
+        else:
+            idempotency_store.abandon(idempotency_key)
+        response.close()
+        concurrency_gate.release(slot)
+        if key is not None:
+            upstream_keys.release(key)
+        scanner.close()
+        record_tokens(client, model, scanner.total_tokens, workload)
+        if recorder is not None:
+            recorder.finish(scanner.total_tokens)
+        if timer is not None:
+            timer.tokens = scanner.total_tokens
+            timer.finish()
+            log_request(timer, '/api/chat', 200 if finished else 504 if expired else 499, stream=True)
+
+
+@app.route('/api/resumes', methods=['POST'])
+def upload_resume():
+    """
+    上传简历，返回内容哈希，之后的模板请求只需带 resume_hash
+    
+    请求体：{"resume": "简历文本"}
+    """
+    if not check_client_auth(request.headers.get('Authorization', '')):
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    data = request.get_json(silent=True)
+    resume = data.get('resume') if isinstance(data, dict) else None
+    if not isinstance(resume, str) or not resume.strip():
+        return jsonify({'error': 'Invalid request body'}), 400
+    size = len(resume.encode('utf-8'))
+    if size > RESUME_MAX_BYTES:
+        return jsonify({'error': f'Resume too large (max {RESUME_MAX_BYTES} bytes)'}), 413
+    
+    return jsonify({'resume_hash': resume_store.put(resume), 'bytes': size})
+
+
+@app.route('/api/resumes/<resume_hash>', methods=['GET'])
+def check_resume(resume_hash):
+    """检查简历是否已上传（不返回简历内容）"""
+    if not check_client_auth(request.headers.get('Authorization', '')):
+        return jsonify({'error': 'Unauthorized'}), 401
+    if resume_store.get(resume_hash) is None:
+        return jsonify({'error': 'Resume not found', 'code': 'resume_not_found'}), 404
+    return jsonify({'resume_hash': resume_hash})
+
+
+@app.route('/api/templates', methods=['GET'])
+def list_templates():
+    """可用的提示词模板"""
+    if not check_client_auth(request.headers.get('Authorization', '')):
+        return jsonify({'error': 'Unauthorized'}), 401
+    return jsonify({'templates': template_catalog()})
+
+
 @app.route('/api/stats', methods=['GET'])
 def get_stats():
-    """获取使用统计（需要认证）"""
-    auth_header = request.headers.get('Authorization', '')
-    if not auth_header.startswith('Bearer ') or auth_header[7:] != SERVER_API_KEY:
+    """
+    获取使用统计（需要认证）
+    
+    可选查询参数（按日期范围汇总）：
+    ?from=2024-01-01&to=2024-03-31&group_by=day,client,model
+    """
+    if not check_client_auth(request.headers.get('Authorization', ''), required=True):
         return jsonify({'error': 'Unauthorized'}), 401
     
-    reset_daily_stats()
-    return jsonify(usage_stats)
+    stats = dict(usage_summary(), cache=response_cache.stats(), coalescing=coalescer.stats(),
+                 rate_limit=rate_limiter.stats(), concurrency=concurrency_gate.stats(),
+                 priority_latency=priority_latency.stats(), circuit_breaker=circuit_breaker.stats(),
+                 hedging=hedger.stats(), upstream_keys=upstream_keys.stats(), resumes=resume_store.stats(),
+                 capture=traffic_capture.stats(), workloads=workload_stats.stats(),
+                 idempotency=idempotency_store.stats(), logging=log_handler.stats() if log_handler else None,
+                 peers=peer_ring.stats())
+    if request.args.get('from') or request.args.get('to') or request.args.get('group_by'):
+        stats['usage'] = usage_accounting.query(
+            request.args.get('from'), request.args.get('to'),
+            request.args.get('group_by', 'day').split(',')
+        )
+    return jsonify(stats)
 
 
 @app.route('/api/reset-stats', methods=['POST'])
 def reset_stats():
     """重置统计（需要认证）"""
-    auth_header = request.headers.get('Authorization', '')
-    if not auth_header.startswith('Bearer ') or auth_header[7:] != SERVER_API_KEY:
+    if not check_client_auth(request.headers.get('Authorization', ''), required=True):
         return jsonify({'error': 'Unauthorized'}), 401
     
-    usage_stats['total_requests'] = 0
-    usage_stats['total_tokens'] = 0
-    usage_stats['requests_today'] = 0
-    usage_stats['last_reset_date'] = datetime.now().strftime('%Y-%m-%d')
+    reset_usage_stats()
     
     return jsonify({'message': 'Stats reset successfully'})
 
 
+# gunicorn 每个 worker 导入模块时预热连接（异步引擎有自己的客户端）
+if PROXY_ENGINE != 'async':
+    warmup_upstream()
+
+
 if __name__ == '__main__':
     # 从环境变量读取配置
     host = os.getenv('HOST', '0.0.0.0')
     port = int(os.getenv('PORT', 5000))
     debug = os.getenv('DEBUG', 'False').lower() == 'true'
     
-    logger.info(f"Starting API Proxy Server on {host}:{port}")
-    logger.info(f"DeepSeek API Key: {DEEPSEEK_API_KEY[:10]}...")
+    logger.info(f"Starting API Proxy Server on {host}:{port} (engine: {PROXY_ENGINE})")
+    logger.info(f"DeepSeek API Keys: {len(upstream_keys.keys)} upstream key(s)")
     
-    app.run(host=host, port=port, debug=debug)
+    if PROXY_ENGINE == 'async':
+        import sys
+        import uvicorn
+        # api_proxy_async 以 api_proxy_server 的名字导入本模块，直接运行时避免再导入一份（指标重复注册）
+        sys.modules.setdefault('api_proxy_server', sys.modules[__name__])
+        uvicorn.run('api_proxy_async:app', host=host, port=port, log_level='info')
+    else:
+        app.run(host=host, port=port, debug=debug)
 
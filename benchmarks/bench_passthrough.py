@@ -0,0 +1,91 @@
+"""
+微基准：/api/chat 成功路径上每个请求的 CPU 耗时
+
+对比三种处理上游响应的方式（不含网络，只测代理 worker 上的 CPU）：
+- parse：response.json() 解析 → 读取 usage → jsonify 重新序列化（旧实现）
+- passthrough：原样返回上游字节，扫描 usage.total_tokens（当前默认）
+- lean：截取 choices[0].message.content 和 usage 的原始字节返回（X-Proxy-Response: lean）
+
+用法：python benchmarks/bench_passthrough.py [--requests 2000] [--content-chars 6000]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+os.environ.setdefault('UPSTREAM_WARMUP_CONNECTIONS', '0')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Response, jsonify  # noqa: E402
+
+import api_proxy_server as core  # noqa: E402
+
+
+def make_body(content_chars):
+    """构造一个与 DeepSeek 返回格式一致的响应体（中英文混合的简历正文）"""
+    content = ('负责数据平台的设计与开发，Python / SQL / Spark。' * (content_chars // 30 + 1))[:content_chars]
+    return json.dumps({
+        'id': 'chatcmpl-bench',
+        'object': 'chat.completion',
+        'created': 1700000000,
+        'model': 'deepseek-chat',
+        'choices': [{
+            'index': 0,
+            'message': {'role': 'assistant', 'content': content},
+            'logprobs': None,
+            'finish_reason': 'stop'
+        }],
+        'usage': {'prompt_tokens': 1500, 'completion_tokens': 1800, 'total_tokens': 3300},
+        'system_fingerprint': 'fp_bench'
+    }, ensure_ascii=False).encode('utf-8')
+
+
+def handle_parse(body):
+    result = json.loads(body)
+    tokens = result['usage'].get('total_tokens', 0) if 'usage' in result else 0
+    return jsonify(result), tokens
+
+
+def handle_passthrough(body):
+    tokens = core.scan_total_tokens(body)
+    return Response(body, mimetype='application/json'), tokens
+
+
+def handle_lean(body):
+    tokens = core.scan_total_tokens(body)
+    return Response(core.lean_body(body), mimetype='application/json'), tokens
+
+
+def measure(handler, body, requests):
+    """返回每个请求的 CPU 微秒数和响应体字节数"""
+    with core.app.test_request_context('/api/chat', method='POST'):
+        response, tokens = handler(body)
+        assert tokens == 3300
+        size = len(response.get_data())
+        started = time.process_time()
+        for _ in range(requests):
+            response, _ = handler(body)
+            response.get_data()
+        elapsed = time.process_time() - started
+    return elapsed / requests * 1e6, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description='代理成功路径的 CPU 微基准')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--content-chars', type=int, default=6000)
+    args = parser.parse_args()
+
+    body = make_body(args.content_chars)
+    print(f"upstream body: {len(body)} bytes, {args.requests} requests per mode")
+    baseline = None
+    for name, handler in (('parse', handle_parse), ('passthrough', handle_passthrough), ('lean', handle_lean)):
+        micros, size = measure(handler, body, args.requests)
+        baseline = baseline or micros
+        print(f"{name:<12} {micros:8.1f} us/request  {baseline / micros:5.1f}x  response {size} bytes")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+"""
+多节点缓存分片压测：启动 mock 上游和 N 个代理节点，客户端轮流把请求发给各节点（模拟 nginx 轮询），
+统计整体的缓存命中率。每个节点数分别压测两种模式：
+- local：各节点的缓存和请求合并互相独立（未设置 PEER_NODES），命中率随节点数增加而下降
+- peers：节点之间按缓存键一致性哈希分片（PEER_NODES），命中率应与单节点基本相同
+
+命中率按上游视角计算：1 - mock 收到的调用数 / 请求数。请求从 --keys 条固定的可缓存提示词中随机选取。
+
+也可以压测已经启动的集群（docker-compose.cluster.yml），--targets 为入口地址，--mock 为 mock 的根地址。
+
+用法：
+  python benchmarks/cluster.py --nodes 1,2,4
+  python benchmarks/cluster.py --nodes 1,2,4 --worker-model async:1 --output cluster.json
+  docker compose -f docker-compose.cluster.yml up -d --build
+  python benchmarks/cluster.py --targets http://127.0.0.1:8080 --mock http://127.0.0.1:18090
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import REPO_DIR, free_port, percentiles, start_mock, start_proxy, stop  # noqa: E402
+
+PEER_SECRET = 'cluster-bench'
+ADMIN_KEY = 'cluster-bench-admin'
+
+
+def run_requests(targets, keys, total, concurrency, api_key, timeout, seed):
+    """并发发送 total 个请求（第 i 个发给 targets[i % N]），返回样本列表"""
+    rng = random.Random(seed)
+    # 预先抽好提示词，不同模式、不同节点数下的请求序列完全相同
+    plan = [(targets[i % len(targets)], rng.randrange(keys)) for i in range(total)]
+    run_id = f"{seed}"
+    headers = {'Authorization': f"Bearer {api_key}"} if api_key else {}
+
+    def send(item):
+        target, n = item
+        body = {'messages': [{'role': 'user', 'content': f"Score resume against job #{n} ({run_id})."}],
+                'temperature': 0, 'max_tokens': 10}
+        started = time.perf_counter()
+        try:
+            response = requests.post(f"{target}/api/chat", json=body, headers=headers, timeout=timeout)
+            status = response.status_code
+            cache = response.headers.get('X-Proxy-Cache')
+        except requests.exceptions.RequestException as e:
+            status, cache = type(e).__name__, None
+        return {'status': status, 'cache': cache, 'latency': time.perf_counter() - started}
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(send, plan))
+
+
+def summarize(samples, upstream_calls, elapsed):
+    ok = [s for s in samples if s['status'] == 200]
+    return {
+        'requests': len(samples),
+        'duration_s': round(elapsed, 3),
+        'status': dict(Counter(str(s['status']) for s in samples)),
+        'upstream_calls': upstream_calls,
+        # 上游视角：没有调用上游的请求比例（缓存命中和请求合并）
+        'hit_ratio': round(1 - upstream_calls / len(samples), 4) if samples else None,
+        # 客户端视角：响应头 X-Proxy-Cache 为 HIT 的比例
+        'cache_hit_header_ratio': round(sum(1 for s in ok if s['cache'] == 'HIT') / len(ok), 4) if ok else None,
+        'latency_ms': percentiles([s['latency'] for s in ok]),
+    }
+
+
+def upstream_count(mock_base):
+    """mock 收到的调用数（/stats 同时按状态码和响应来源计数，只累加状态码）"""
+    served = requests.get(f"{mock_base}/stats", timeout=5).json()
+    return sum(count for key, count in served.items() if key.isdigit())
+
+
+def start_cluster(args, upstream_url, workdir, nodes, peers):
+    """启动 nodes 个代理节点，返回 [(进程, 地址)]"""
+    ports = [free_port() for _ in range(nodes)]
+    urls = [f"http://127.0.0.1:{port}" for port in ports]
+    started = []
+    try:
+        for index, (port, url) in enumerate(zip(ports, urls)):
+            node_dir = os.path.join(workdir, f"{'peers' if peers else 'local'}-{nodes}-node{index}")
+            os.makedirs(node_dir, exist_ok=True)
+            overrides = {'SERVER_API_KEY': ADMIN_KEY, 'CACHE_DIR': '', 'SHARED_DB_PATH': ''}
+            if peers:
+                overrides.update(PEER_NODES=','.join(urls), PEER_SELF=url, PEER_SECRET=PEER_SECRET)
+            started.append(start_proxy(args.proxy_dir, upstream_url, node_dir, overrides, args.worker_model, port))
+    except Exception:
+        for process, _ in started:
+            stop(process)
+        raise
+    return started
+
+
+def node_stats(url):
+    try:
+        stats = requests.get(f"{url}/api/stats", headers={'Authorization': f"Bearer {ADMIN_KEY}"}, timeout=5).json()
+    except (requests.exceptions.RequestException, ValueError):
+        return None
+    return {'cache_entries': stats['cache']['entries'], 'peers': stats.get('peers')}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='多节点缓存分片压测')
+    parser.add_argument('--nodes', default='1,2,4', help='逗号分隔的节点数')
+    parser.add_argument('--modes', default='local,peers', help='逗号分隔：local（节点独立）/ peers（一致性哈希分片）')
+    parser.add_argument('--worker-model', default='dev', help='每个节点的 worker 模型：dev / sync:N / gthread:NxT / async:N')
+    parser.add_argument('--proxy-dir', default=REPO_DIR, help='代理代码目录')
+    parser.add_argument('--keys', type=int, default=200, help='不同的可缓存提示词数量')
+    parser.add_argument('--requests', type=int, default=2000, help='每轮请求数')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--mock-latency', default='0.05', help='mock 上游的耗时分布（见 mock_deepseek.py --latency）')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--targets', help='已启动集群的入口地址（逗号分隔），设置后不启动节点')
+    parser.add_argument('--mock', help='已启动集群的 mock 根地址（与 --targets 一起使用）')
+    parser.add_argument('--api-key', default='', help='已启动集群的客户端密钥')
+    parser.add_argument('--output', help='结果 JSON 的写入路径（默认只打印）')
+    args = parser.parse_args()
+
+    result = {'config': {key: value for key, value in vars(args).items() if key != 'output'}, 'runs': []}
+
+    if args.targets:
+        if not args.mock:
+            parser.error('--mock is required with --targets')
+        targets = [url.strip().rstrip('/') for url in args.targets.split(',') if url.strip()]
+        before = upstream_count(args.mock)
+        started = time.perf_counter()
+        samples = run_requests(targets, args.keys, args.requests, args.concurrency, args.api_key, args.timeout,
+                               args.seed)
+        elapsed = time.perf_counter() - started
+        result['runs'].append(dict(targets=targets, **summarize(samples, upstream_count(args.mock) - before,
+                                                                elapsed)))
+    else:
+        workdir = tempfile.mkdtemp(prefix='proxy-cluster-')
+        mock, upstream_url, mock_base = start_mock(workdir, ['--latency', args.mock_latency, '--seed', str(args.seed)])
+        try:
+            for nodes in [int(value) for value in args.nodes.split(',')]:
+                for mode in [value.strip() for value in args.modes.split(',') if value.strip()]:
+                    cluster = start_cluster(args, upstream_url, workdir, nodes, mode == 'peers')
+                    try:
+                        before = upstream_count(mock_base)
+                        started = time.perf_counter()
+                        samples = run_requests([url for _, url in cluster], args.keys, args.requests,
+                                               args.concurrency, ADMIN_KEY, args.timeout, args.seed)
+                        elapsed = time.perf_counter() - started
+                        run = dict(nodes=nodes, mode=mode,
+                                   **summarize(samples, upstream_count(mock_base) - before, elapsed))
+                        run['node_stats'] = [node_stats(url) for _, url in cluster]
+                        result['runs'].append(run)
+                    finally:
+                        for process, _ in cluster:
+                            stop(process)
+                    print(f"nodes={nodes:<3} {mode:<6} hit ratio {run['hit_ratio']}, "
+                          f"p50 {(run['latency_ms'] or {}).get('p50')} ms", file=sys.stderr)
+        finally:
+            stop(mock)
+
+    output = json.dumps(result, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
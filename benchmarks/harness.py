@@ -0,0 +1,122 @@
+"""
+压测脚本共用的部分：启动 mock 上游和代理子进程、统计分位数
+"""
+
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import requests
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentiles(values):
+    """毫秒为单位的 p50 / p95 / p99 / max / mean（最近秩法），values 为秒"""
+    if not values:
+        return None
+    ordered = sorted(values)
+
+    def rank(p):
+        return ordered[min(int(len(ordered) * p), len(ordered) - 1)] * 1000
+
+    return {'p50': round(rank(0.50), 1), 'p95': round(rank(0.95), 1), 'p99': round(rank(0.99), 1),
+            'max': round(ordered[-1] * 1000, 1), 'mean': round(sum(ordered) / len(ordered) * 1000, 1)}
+
+
+def proxy_command(worker_model, port):
+    """
+    按 worker 模型构建代理的启动命令，返回 (命令, 额外的环境变量)：
+    - dev：python api_proxy_server.py（Flask 开发服务器，每个请求一个线程）
+    - sync:N：gunicorn N 个同步 worker（部署文档中的默认方式）
+    - gthread:NxT：gunicorn N 个 worker，每个 T 个线程
+    - async:N：gunicorn + UvicornWorker 运行异步引擎，N 个 worker
+    """
+    name, _, arg = worker_model.partition(':')
+    bind = ['-b', f'127.0.0.1:{port}', '--timeout', '120']
+    gunicorn = [sys.executable, '-m', 'gunicorn']
+    if name == 'dev':
+        return [sys.executable, 'api_proxy_server.py'], {}
+    if name == 'sync':
+        return gunicorn + ['-w', arg or '4'] + bind + ['api_proxy_server:app'], {}
+    if name == 'gthread':
+        workers, _, threads = (arg or '4x8').partition('x')
+        return gunicorn + ['-k', 'gthread', '-w', workers, '--threads', threads or '8'] + bind \
+            + ['api_proxy_server:app'], {}
+    if name == 'async':
+        return gunicorn + ['-k', 'uvicorn.workers.UvicornWorker', '-w', arg or '1'] + bind \
+            + ['api_proxy_async:app'], {'PROXY_ENGINE': 'async'}
+    raise ValueError(f"unknown worker model: {worker_model}")
+
+
+def wait_healthy(url, process, log_path, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with code {process.returncode}, see {log_path}")
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.exceptions.RequestException:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"{url} did not start, see {log_path}")
+
+
+def start_proxy(proxy_dir, upstream_url, workdir, overrides=None, worker_model='dev', port=None):
+    """启动一个指向 mock 上游的代理子进程，返回 (进程, 地址)；port 为空时选一个空闲端口"""
+    port = port or free_port()
+    command, engine_env = proxy_command(worker_model, port)
+    env = dict(os.environ)
+    env.update({
+        'HOST': '127.0.0.1',
+        'PORT': str(port),
+        'DEEPSEEK_API_KEY': 'sk-bench',
+        'DEEPSEEK_API_KEYS': '',
+        'DEEPSEEK_API_URLS': upstream_url,
+        # 压测时不鉴权、不录制，统计写到临时目录
+        'SERVER_API_KEY': '',
+        'SERVER_API_KEYS': '',
+        'CAPTURE_DIR': '',
+        'SHARED_DB_PATH': '',
+        'USAGE_DB_PATH': os.path.join(workdir, 'usage.db'),
+        'CACHE_DIR': '',
+    })
+    env.update(engine_env)
+    env.update(overrides or {})
+    log_path = os.path.join(workdir, f"proxy-{worker_model.replace(':', '-')}.log")
+    with open(log_path, 'wb') as log:
+        process = subprocess.Popen(command, cwd=proxy_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    url = f"http://127.0.0.1:{port}"
+    wait_healthy(f"{url}/health", process, log_path)
+    return process, url
+
+
+def start_mock(workdir, args=()):
+    """在子进程中启动 mock 上游（与压测端分开，避免争用 GIL），返回 (进程, 上游地址, mock 根地址)"""
+    port = free_port()
+    log_path = os.path.join(workdir, 'mock.log')
+    with open(log_path, 'wb') as log:
+        process = subprocess.Popen([sys.executable, os.path.join(BENCHMARKS_DIR, 'mock_deepseek.py'),
+                                    '--port', str(port)] + list(args), stdout=log, stderr=subprocess.STDOUT)
+    base = f"http://127.0.0.1:{port}"
+    wait_healthy(f"{base}/stats", process, log_path)
+    return process, f"{base}/v1/chat/completions", base
+
+
+def stop(process):
+    if process is not None and process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
@@ -0,0 +1,259 @@
+"""
+代理压测：在本机启动 mock 上游和代理，测量不同并发数和 worker 模型下的吞吐、延迟分位数和代理开销，
+结果写成 JSON，便于在不同提交之间比较（不需要网络和 API Key）
+
+每个 worker 模型启动一次代理，对 --concurrency 中的每个并发数先预热 --warmup 秒，再闭环压测 --duration 秒
+（每个并发连接收到响应后立即发下一个请求）。每个并发数同时直接压测 mock 上游作为基线：
+- overhead_ms：经过代理的延迟分位数减去直连 mock 的延迟分位数（客户端视角的代理开销）
+- server_overhead_ms：代理 Server-Timing 头中 total - upstream（代理进程内部的开销，含排队）
+mock 上游运行在单独的进程中，压测端、mock 和代理共用本机 CPU，结果只适合在同一台机器上相互比较。
+
+用法：
+  python benchmarks/loadtest.py --output bench-$(git rev-parse --short HEAD).json
+  python benchmarks/loadtest.py --worker-models dev,sync:4,gthread:2x16,async:1 --concurrency 1,8,32 --duration 10
+  python benchmarks/loadtest.py --mock-latency lognormal:0.5,0.4 --mock-error-rate 0.01 --mock-burst-429 20,2 \\
+      --stream-ratio 0.3 --repeat-ratio 0.2
+  python benchmarks/loadtest.py --compare bench-old.json bench-new.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import REPO_DIR, percentiles, start_mock, start_proxy, stop  # noqa: E402
+
+# 重复请求（--repeat-ratio）从这几条固定的提示词中选，温度为 0，可以被代理缓存和合并
+REPEATED_PROMPTS = [f"Rate how well this resume matches job #{n}. Reply with a number." for n in range(10)]
+
+
+class Workload:
+    """生成请求体：按比例混合流式请求和可缓存的重复请求，其余请求内容唯一（不会命中缓存）"""
+
+    def __init__(self, stream_ratio, repeat_ratio, max_tokens):
+        self.stream_ratio = stream_ratio
+        self.repeat_ratio = repeat_ratio
+        self.max_tokens = max_tokens
+        self.run_id = f"{time.time():.0f}"
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def body(self):
+        with self._lock:
+            self._counter += 1
+            n = self._counter
+        if random.random() < self.repeat_ratio:
+            return {'messages': [{'role': 'user', 'content': random.choice(REPEATED_PROMPTS)}],
+                    'temperature': 0, 'max_tokens': 10}
+        return {'messages': [{'role': 'user', 'content': f"load test {self.run_id}-{n}"}],
+                'temperature': 0.7, 'max_tokens': self.max_tokens,
+                'stream': random.random() < self.stream_ratio}
+
+
+def parse_server_timing(header):
+    """Server-Timing 头 → {阶段: 秒}"""
+    stages = {}
+    for item in (header or '').split(','):
+        name, _, duration = item.strip().partition(';dur=')
+        if duration:
+            stages[name] = float(duration) / 1000
+    return stages
+
+
+def run_level(url, concurrency, duration, workload, timeout):
+    """闭环压测一轮，返回 (样本列表, 实际耗时)"""
+    stop_at = time.perf_counter() + duration
+
+    def worker():
+        session = requests.Session()
+        samples = []
+        while time.perf_counter() < stop_at:
+            body = workload.body()
+            stream = bool(body.get('stream'))
+            started = time.perf_counter()
+            first_byte = None
+            overhead = None
+            try:
+                response = session.post(url, json=body, stream=stream, timeout=timeout)
+                for chunk in response.iter_content(chunk_size=None):
+                    if first_byte is None and chunk:
+                        first_byte = time.perf_counter() - started
+                status = response.status_code
+                stages = parse_server_timing(response.headers.get('Server-Timing'))
+                if 'total' in stages:
+                    overhead = stages['total'] - stages.get('upstream', 0.0)
+            except requests.exceptions.RequestException as e:
+                status = type(e).__name__
+            samples.append({'status': status, 'stream': stream, 'latency': time.perf_counter() - started,
+                            'ttfb': first_byte, 'overhead': overhead})
+        session.close()
+        return samples
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(worker) for _ in range(concurrency)]
+        samples = [sample for future in futures for sample in future.result()]
+    return samples, time.perf_counter() - started
+
+
+def summarize(samples, elapsed):
+    ok = [s for s in samples if s['status'] == 200]
+    return {
+        'requests': len(samples),
+        'duration_s': round(elapsed, 3),
+        'rps': round(len(ok) / elapsed, 2) if elapsed else None,
+        'status': dict(Counter(str(s['status']) for s in samples)),
+        'latency_ms': percentiles([s['latency'] for s in ok]),
+        'stream_ttfb_ms': percentiles([s['ttfb'] for s in ok if s['stream'] and s['ttfb'] is not None]),
+        'server_overhead_ms': percentiles([s['overhead'] for s in ok if s['overhead'] is not None]),
+    }
+
+
+def overhead(proxied, direct):
+    """经过代理与直连 mock 的延迟分位数之差（毫秒）"""
+    if not proxied or not direct:
+        return None
+    return {key: round(proxied[key] - direct[key], 1) for key in ('p50', 'p95', 'p99', 'mean')}
+
+
+def mock_stats(base):
+    return requests.get(f"{base}/stats", timeout=5).json()
+
+
+def git_info(path):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=path, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=path,
+                                    capture_output=True, text=True).stdout.strip())
+        return {'commit': commit, 'dirty': dirty}
+    except (OSError, subprocess.CalledProcessError):
+        return {'commit': None, 'dirty': None}
+
+
+def compare(old_path, new_path):
+    """按 (worker 模型, 并发数) 对比两份结果的吞吐和延迟"""
+    with open(old_path, encoding='utf-8') as f:
+        old = json.load(f)
+    with open(new_path, encoding='utf-8') as f:
+        new = json.load(f)
+    old_runs = {(run['worker_model'], run['concurrency']): run for run in old['runs']}
+    print(f"old: {old['meta']['commit']}  new: {new['meta']['commit']}")
+    print(f"{'worker model':<14}{'conc':>5}{'rps':>24}{'p50 ms':>24}{'p99 ms':>24}")
+
+    def cell(before, after):
+        if before is None or after is None:
+            return f"{'-':>24}"
+        change = f"{(after - before) / before * 100:+.0f}%" if before else ''
+        return f"{before:>9} -> {after:<8}{change:>5}"
+
+    for run in new['runs']:
+        before = old_runs.get((run['worker_model'], run['concurrency']))
+        if before is None:
+            continue
+        print(f"{run['worker_model']:<14}{run['concurrency']:>5}"
+              + cell(before['rps'], run['rps'])
+              + cell((before['latency_ms'] or {}).get('p50'), (run['latency_ms'] or {}).get('p50'))
+              + cell((before['latency_ms'] or {}).get('p99'), (run['latency_ms'] or {}).get('p99')))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='代理压测（本机 mock 上游）')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='对比两份结果后退出')
+    parser.add_argument('--proxy-dir', default=REPO_DIR, help='代理代码目录（比较不同版本）')
+    parser.add_argument('--worker-models', default='dev,sync:4,async:1',
+                        help='逗号分隔：dev / sync:N / gthread:NxT / async:N')
+    parser.add_argument('--concurrency', default='1,8,32', help='逗号分隔的并发数')
+    parser.add_argument('--duration', type=float, default=10, help='每轮压测秒数')
+    parser.add_argument('--warmup', type=float, default=2, help='每轮之前的预热秒数')
+    parser.add_argument('--stream-ratio', type=float, default=0.0, help='流式请求的比例')
+    parser.add_argument('--repeat-ratio', type=float, default=0.0, help='可缓存的重复请求的比例')
+    parser.add_argument('--max-tokens', type=int, default=200)
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--mock-latency', default='0.2', help='mock 上游的耗时分布（见 mock_deepseek.py --latency）')
+    parser.add_argument('--mock-chunk-interval', type=float, default=0.02)
+    parser.add_argument('--mock-error-rate', type=float, default=0.0)
+    parser.add_argument('--mock-burst-429', metavar='PERIOD,DURATION')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--proxy-env', action='append', default=[], metavar='KEY=VALUE',
+                        help='代理子进程的环境变量，可重复')
+    parser.add_argument('--no-baseline', action='store_true', help='不压测直连 mock 的基线')
+    parser.add_argument('--output', help='结果 JSON 的写入路径（默认只打印）')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    random.seed(args.seed)
+    levels = [int(value) for value in args.concurrency.split(',')]
+    worker_models = [value.strip() for value in args.worker_models.split(',') if value.strip()]
+    overrides = dict(item.split('=', 1) for item in args.proxy_env)
+    workload = Workload(args.stream_ratio, args.repeat_ratio, args.max_tokens)
+    mock_args = ['--latency', args.mock_latency, '--chunk-interval', str(args.mock_chunk_interval),
+                 '--error-rate', str(args.mock_error_rate), '--seed', str(args.seed)]
+    if args.mock_burst_429:
+        mock_args += ['--burst-429', args.mock_burst_429]
+
+    workdir = tempfile.mkdtemp(prefix='proxy-loadtest-')
+    result = {
+        'meta': dict(git_info(args.proxy_dir), started_at=datetime.now().isoformat(timespec='seconds'),
+                     python=platform.python_version(), platform=platform.platform(), cpus=os.cpu_count(),
+                     config={key: value for key, value in vars(args).items() if key not in ('compare', 'output')}),
+        'baseline': {},
+        'runs': []
+    }
+    mock, upstream_url, mock_base = start_mock(workdir, mock_args)
+    try:
+        if not args.no_baseline:
+            for concurrency in levels:
+                run_level(upstream_url, concurrency, args.warmup, workload, args.timeout)
+                samples, elapsed = run_level(upstream_url, concurrency, args.duration, workload, args.timeout)
+                result['baseline'][str(concurrency)] = summarize(samples, elapsed)
+                print(f"direct        c={concurrency:<4} {result['baseline'][str(concurrency)]['rps']} req/s",
+                      file=sys.stderr)
+
+        for worker_model in worker_models:
+            process, proxy_url = start_proxy(args.proxy_dir, upstream_url, workdir, overrides, worker_model)
+            try:
+                for concurrency in levels:
+                    run_level(f"{proxy_url}/api/chat", concurrency, args.warmup, workload, args.timeout)
+                    upstream_before = Counter(mock_stats(mock_base))
+                    samples, elapsed = run_level(f"{proxy_url}/api/chat", concurrency, args.duration, workload,
+                                                 args.timeout)
+                    run = dict(worker_model=worker_model, concurrency=concurrency, **summarize(samples, elapsed))
+                    run['upstream_calls'] = dict(Counter(mock_stats(mock_base)) - upstream_before)
+                    baseline = result['baseline'].get(str(concurrency))
+                    run['overhead_ms'] = overhead(run['latency_ms'], baseline and baseline['latency_ms'])
+                    result['runs'].append(run)
+                    print(f"{worker_model:<13} c={concurrency:<4} {run['rps']} req/s, "
+                          f"p50 {(run['latency_ms'] or {}).get('p50')} ms, p99 {(run['latency_ms'] or {}).get('p99')} ms",
+                          file=sys.stderr)
+            finally:
+                stop(process)
+    finally:
+        stop(mock)
+
+    output = json.dumps(result, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
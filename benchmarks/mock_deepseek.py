@@ -0,0 +1,343 @@
+"""
+本地 mock DeepSeek 上游：POST /v1/chat/completions（支持 stream），不需要网络和 API Key
+
+合成模式（默认）：响应耗时按 --latency 给出的分布抽样，流式响应每 --chunk-interval 秒输出一块；
+--error-rate 按比例返回 500，--burst-429 周期性地在一段时间内对所有请求返回 429（带 Retry-After）。
+
+回放模式（--replay）：读取代理的流量录制（CAPTURE_DIR 下的 capture-*.jsonl.gz），
+按请求体的缓存键匹配录制的上游响应，复现录制时的状态码、首字节耗时以及 SSE 分块的时间和大小；
+同一个请求录制了多次时依次轮流返回。--speedup 按倍数压缩所有等待时间。
+没有匹配到录制的请求返回合成的响应。错误注入对两种模式都生效。
+
+GET /stats 返回各状态码的响应次数。
+
+用法：
+  python benchmarks/mock_deepseek.py --port 18080 --latency lognormal:0.8,0.5 --error-rate 0.01 --burst-429 30,3
+  python benchmarks/mock_deepseek.py --port 18080 --replay 'captures/*.jsonl.gz' --speedup 4
+  DEEPSEEK_API_URLS=http://127.0.0.1:18080/v1/chat/completions python api_proxy_server.py
+"""
+
+import argparse
+import glob
+import gzip
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+import zlib
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+COMPLETIONS_PATH = '/v1/chat/completions'
+
+
+def cache_key(api_data):
+    """与 api_proxy_server.cache_key 一致：对 (model, messages, temperature, max_tokens) 取哈希"""
+    canonical = json.dumps(
+        [api_data.get('model'), api_data.get('messages'), api_data.get('temperature'), api_data.get('max_tokens')],
+        sort_keys=True, separators=(',', ':'), ensure_ascii=False
+    )
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def read_capture(patterns):
+    """
+    按文件名顺序读取录制文件中的记录
+    worker 被杀掉时文件末尾可能不完整，读到损坏处为止，丢弃最后半行
+    """
+    paths = sorted({path for pattern in patterns for path in glob.glob(pattern)})
+    for path in paths:
+        with gzip.open(path, 'rb') as f:
+            while True:
+                try:
+                    line = f.readline()
+                except (EOFError, OSError, zlib.error):
+                    break
+                if not line:
+                    break
+                if not line.endswith(b'\n'):
+                    break
+                yield json.loads(line)
+
+
+class ReplayTable:
+    """录制的上游响应，按 (缓存键, 是否流式) 索引"""
+
+    def __init__(self, records):
+        self._responses = {}
+        self._next = Counter()
+        self._lock = threading.Lock()
+        for record in records:
+            if record.get('type') == 'upstream':
+                self._responses.setdefault((record['key'], record['stream']), []).append(record)
+
+    def __len__(self):
+        return sum(len(items) for items in self._responses.values())
+
+    def lookup(self, api_data):
+        """返回与请求匹配的录制响应，没有录制返回 None"""
+        slot = (cache_key(api_data), bool(api_data.get('stream')))
+        items = self._responses.get(slot)
+        if not items:
+            return None
+        with self._lock:
+            index = self._next[slot]
+            self._next[slot] += 1
+        return items[index % len(items)]
+
+
+def completion_body(model, content, total_tokens):
+    """非流式响应体，格式与 DeepSeek 一致"""
+    return json.dumps({
+        'id': 'chatcmpl-mock',
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': model,
+        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+        'usage': {'prompt_tokens': total_tokens // 2, 'completion_tokens': total_tokens - total_tokens // 2,
+                  'total_tokens': total_tokens}
+    }, ensure_ascii=False).encode('utf-8')
+
+
+def sse_event(model, delta, finish_reason=None, usage=None):
+    chunk = {
+        'id': 'chatcmpl-mock',
+        'object': 'chat.completion.chunk',
+        'created': int(time.time()),
+        'model': model,
+        'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]
+    }
+    if usage is not None:
+        chunk['usage'] = usage
+    return b'data: ' + json.dumps(chunk, ensure_ascii=False).encode('utf-8') + b'\n\n'
+
+
+def sse_chunks(model, sizes, total_tokens):
+    """
+    按录制的各 chunk 字节数合成 SSE 分块：前面每块一个带填充内容的 delta 事件（大小接近录制值），
+    最后一块为带 usage 的结束事件和 [DONE]
+    """
+    overhead = len(sse_event(model, {'content': ''}))
+    pieces = [sse_event(model, {'content': 'x' * max(size - overhead, 1)}) for size in sizes[:-1]]
+    usage = {'prompt_tokens': total_tokens // 2, 'completion_tokens': total_tokens - total_tokens // 2,
+             'total_tokens': total_tokens}
+    pieces.append(sse_event(model, {}, 'stop', usage) + b'data: [DONE]\n\n')
+    return pieces
+
+
+def parse_latency(spec):
+    """
+    解析延迟分布，返回每次调用抽样一个秒数（不小于 0）的函数：
+    '0.2'（固定）、'uniform:最小,最大'、'normal:均值,标准差'、'lognormal:中位数,sigma'、'exponential:均值'
+    """
+    name, _, params = str(spec).partition(':')
+    if not params:
+        value = float(name)
+        return lambda: value
+    args = [float(value) for value in params.split(',')]
+    if name == 'uniform':
+        return lambda: random.uniform(args[0], args[1])
+    if name == 'normal':
+        return lambda: max(random.gauss(args[0], args[1]), 0.0)
+    if name == 'lognormal':
+        return lambda: random.lognormvariate(math.log(args[0]), args[1])
+    if name == 'exponential':
+        return lambda: random.expovariate(1 / args[0])
+    raise ValueError(f"unknown latency distribution: {spec}")
+
+
+def synthetic_record(api_data, latency, chunk_interval):
+    """
+    没有录制时的合成响应：回复长度取 max_tokens 的一半（按每 token 约 2 个字符）
+    非流式在 latency 秒后一次返回；流式 latency 秒后返回首块，之后每 chunk_interval 秒一块（约 20 个 token）
+    """
+    try:
+        max_tokens = int(api_data.get('max_tokens') or 100)
+    except (TypeError, ValueError):
+        max_tokens = 100
+    completion_tokens = max(max_tokens // 2, 1)
+    total_tokens = completion_tokens * 2
+    if api_data.get('stream'):
+        count = max(completion_tokens // 20, 1)
+        return {'status': 200, 'latency': latency, 'total_tokens': total_tokens,
+                'chunks': [[chunk_interval * i, 200] for i in range(count + 1)]}
+    return {'status': 200, 'latency': latency, 'total_tokens': total_tokens, 'content_chars': completion_tokens * 2}
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] == '/stats':
+            self._send_json(200, self.server.stats())
+        else:
+            self._send_json(404, {'error': {'message': 'Not found'}})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.path.split('?')[0] != COMPLETIONS_PATH:
+            self._send_json(404, {'error': {'message': 'Not found'}})
+            return
+        try:
+            api_data = json.loads(body)
+        except ValueError:
+            self._send_json(400, {'error': {'message': 'Invalid JSON'}})
+            return
+        server = self.server
+        retry_after = server.throttled_for()
+        if retry_after:
+            # 429 突发期间立即拒绝，与真实上游一样不消耗处理时间
+            server.count(429)
+            self._send_json(429, {'error': {'message': 'Rate limit reached (mock burst)', 'type': 'mock'}},
+                            {'Retry-After': str(max(int(math.ceil(retry_after)), 1))})
+            return
+        record = server.replay.lookup(api_data) if server.replay is not None else None
+        if record is None:
+            record = synthetic_record(api_data, server.latency(), server.chunk_interval)
+            server.count('synthetic')
+        else:
+            server.count('replayed')
+        if server.error_rate and random.random() < server.error_rate:
+            record = dict(record, status=500, error='Internal server error (mock)')
+        self.respond(api_data, record)
+
+    def respond(self, api_data, record):
+        server = self.server
+        model = api_data.get('model', 'deepseek-chat')
+        time.sleep(record['latency'] / server.speedup)
+        status = record['status']
+        server.count(status)
+        if status != 200:
+            headers = {'Retry-After': '1'} if status == 429 else {}
+            self._send_json(status, {'error': {'message': record.get('error') or 'mock error', 'type': 'mock'}},
+                            headers)
+            return
+        if 'chunks' in record:
+            self._send_stream(model, record)
+            return
+        if 'response' in record and 'choices' in record['response']:
+            payload = json.dumps(record['response'], ensure_ascii=False).encode('utf-8')
+        else:
+            content_chars = record.get('content_chars') or record.get('response', {}).get('bytes', 200)
+            payload = completion_body(model, 'x' * content_chars, record.get('total_tokens') or 100)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _send_stream(self, model, record):
+        chunks = record['chunks'] or [[0, 0]]
+        pieces = sse_chunks(model, [size for _, size in chunks], record.get('total_tokens') or 0)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        started = time.perf_counter()
+        try:
+            for (offset, _), piece in zip(chunks, pieces):
+                wait = offset / self.server.speedup - (time.perf_counter() - started)
+                if wait > 0:
+                    time.sleep(wait)
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(piece), piece))
+                self.wfile.flush()
+            self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def _send_json(self, status, data, headers=None):
+        payload = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class MockDeepSeek(ThreadingHTTPServer):
+    """mock 上游服务器，start() 在后台线程中运行"""
+
+    daemon_threads = True
+    # 压测时瞬间会有大量连接，默认的 listen backlog（5）会导致连接被重置
+    request_queue_size = 1024
+
+    def __init__(self, host='127.0.0.1', port=0, replay=None, speedup=1.0, latency='0.2', chunk_interval=0.02,
+                 error_rate=0.0, burst_429=None, handler=MockHandler):
+        """
+        latency 为延迟分布（见 parse_latency），error_rate 为返回 500 的比例，
+        burst_429 为 (周期秒数, 持续秒数)：每个周期开头的一段时间内所有请求返回 429
+        """
+        super().__init__((host, port), handler)
+        self.replay = replay
+        self.speedup = speedup
+        self.latency = parse_latency(latency)
+        self.chunk_interval = chunk_interval
+        self.error_rate = error_rate
+        self.burst_429 = burst_429
+        self.started = time.monotonic()
+        self.served = Counter()
+        self._lock = threading.Lock()
+
+    def throttled_for(self):
+        """处于 429 突发期时返回剩余秒数，否则返回 0"""
+        if not self.burst_429:
+            return 0
+        period, duration = self.burst_429
+        elapsed = (time.monotonic() - self.started) % period
+        return duration - elapsed if elapsed < duration else 0
+
+    def stats(self):
+        with self._lock:
+            return dict(self.served)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}{COMPLETIONS_PATH}"
+
+    def count(self, name):
+        with self._lock:
+            self.served[str(name)] += 1
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本地 mock DeepSeek 上游')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--replay', nargs='*', default=[], help='流量录制文件（支持通配符）')
+    parser.add_argument('--speedup', type=float, default=1.0, help='等待时间压缩倍数')
+    parser.add_argument('--latency', default='0.2',
+                        help='合成响应的耗时分布（秒）：0.2 / uniform:a,b / normal:mu,sd / lognormal:median,sigma / exponential:mean')
+    parser.add_argument('--chunk-interval', type=float, default=0.02, help='合成流式响应的分块间隔（秒）')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='返回 500 的比例')
+    parser.add_argument('--burst-429', metavar='PERIOD,DURATION', help='每 PERIOD 秒中前 DURATION 秒全部返回 429')
+    parser.add_argument('--seed', type=int, help='随机数种子（延迟和错误注入可复现）')
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    burst_429 = tuple(float(value) for value in args.burst_429.split(',')) if args.burst_429 else None
+    replay = ReplayTable(read_capture(args.replay)) if args.replay else None
+    server = MockDeepSeek(args.host, args.port, replay, args.speedup, args.latency, args.chunk_interval,
+                          args.error_rate, burst_429)
+    print(f"mock DeepSeek listening on {server.url}"
+          + (f" ({len(replay)} recorded responses)" if replay is not None else ''))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""
+回放录制的流量压测代理，输出吞吐和延迟分位数（JSON）
+
+读取代理的流量录制（CAPTURE_DIR 下的 capture-*.jsonl.gz），启动 mock 上游（benchmarks/mock_deepseek.py）
+按录制的耗时和 SSE 分块返回响应，再按录制的到达时间（除以 --speedup）把客户端请求发给代理。
+回放是开环的：请求按时间表发出，不等前一个请求完成。
+
+默认用 --proxy-dir 下的 api_proxy_server.py 启动一个指向 mock 上游的代理子进程，
+对两个版本（例如 git worktree）分别运行，比较输出中的 throughput_rps 和 latency_ms.p99。
+
+用法：
+  python benchmarks/replay.py 'captures/*.jsonl.gz' --speedup 10 --output before.json
+  python benchmarks/replay.py 'captures/*.jsonl.gz' --speedup 10 --proxy-dir ../proxy-new --output after.json
+  python benchmarks/replay.py 'captures/*.jsonl.gz' --worker-model async:1 --output async.json
+  python benchmarks/replay.py 'captures/*.jsonl.gz' --proxy http://127.0.0.1:5000   # 使用已启动的代理
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import REPO_DIR, percentiles, start_proxy, stop  # noqa: E402
+from mock_deepseek import MockDeepSeek, ReplayTable, read_capture  # noqa: E402
+
+
+class Replayer:
+    """按录制的到达时间把请求发给代理，记录每个请求的状态码、耗时和（流式的）首字节时间"""
+
+    def __init__(self, proxy_url, records, speedup, max_inflight, timeout):
+        self.proxy_url = proxy_url.rstrip('/')
+        self.records = records
+        self.speedup = speedup
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_inflight)
+        self._local = threading.local()
+        self.results = []
+        self.started = None
+        self.max_lag = 0.0
+
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def send(self, record, due):
+        # 发送线程和线程池都可能落后于时间表，较大时说明压测端本身成了瓶颈
+        self.max_lag = max(self.max_lag, time.perf_counter() - self.started - due)
+        body = record['body']
+        headers = dict(record.get('headers') or {})
+        # 每个录制的客户端用一个独立的 token，代理按客户端限流和统计时与线上一致
+        headers['Authorization'] = f"Bearer replay-{record.get('client', 'anonymous')}"
+        started = time.perf_counter()
+        first_byte = None
+        try:
+            response = self._session().post(f"{self.proxy_url}/api/chat", json=body, headers=headers,
+                                            timeout=self.timeout, stream=bool(body.get('stream')))
+            for chunk in response.iter_content(chunk_size=None):
+                if first_byte is None and chunk:
+                    first_byte = time.perf_counter() - started
+            status = response.status_code
+        except requests.exceptions.RequestException as e:
+            status = type(e).__name__
+        return {'status': status, 'stream': bool(body.get('stream')),
+                'latency': time.perf_counter() - started, 'ttfb': first_byte}
+
+    def run(self):
+        futures = []
+        origin = self.records[0]['ts']
+        self.started = time.perf_counter()
+        for record in self.records:
+            due = (record['ts'] - origin) / self.speedup
+            wait = due - (time.perf_counter() - self.started)
+            if wait > 0:
+                time.sleep(wait)
+            futures.append(self.executor.submit(self.send, record, due))
+        self.results = [future.result() for future in futures]
+        duration = time.perf_counter() - self.started
+        self.executor.shutdown()
+        return duration
+
+
+def main():
+    parser = argparse.ArgumentParser(description='回放录制的流量压测代理')
+    parser.add_argument('captures', nargs='+', help='流量录制文件（支持通配符）')
+    parser.add_argument('--speedup', type=float, default=1.0, help='到达间隔和上游耗时的压缩倍数')
+    parser.add_argument('--proxy', help='已启动的代理地址（其上游需指向 --mock-port 上的 mock）')
+    parser.add_argument('--proxy-dir', default=REPO_DIR, help='启动代理子进程的代码目录（比较不同版本）')
+    parser.add_argument('--worker-model', default='dev', help='代理子进程的 worker 模型：dev / sync:N / gthread:NxT / async:N')
+    parser.add_argument('--proxy-env', action='append', default=[], metavar='KEY=VALUE',
+                        help='代理子进程的环境变量，可重复')
+    parser.add_argument('--mock-port', type=int, default=0)
+    parser.add_argument('--max-inflight', type=int, default=256, help='最多同时在途的请求数')
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--output', help='结果 JSON 的写入路径（默认只打印）')
+    args = parser.parse_args()
+
+    records = list(read_capture(args.captures))
+    requests_ = sorted((r for r in records if r.get('type') == 'request'), key=lambda r: r['ts'])
+    if not requests_:
+        parser.error('no request records found in captures')
+
+    mock = MockDeepSeek(port=args.mock_port, replay=ReplayTable(records), speedup=args.speedup).start()
+    process = None
+    workdir = tempfile.mkdtemp(prefix='proxy-replay-')
+    try:
+        if args.proxy:
+            proxy_url = args.proxy
+        else:
+            overrides = dict(item.split('=', 1) for item in args.proxy_env)
+            process, proxy_url = start_proxy(args.proxy_dir, mock.url, workdir, overrides, args.worker_model)
+        replayer = Replayer(proxy_url, requests_, args.speedup, args.max_inflight, args.timeout)
+        duration = replayer.run()
+    finally:
+        stop(process)
+        mock.shutdown()
+
+    results = replayer.results
+    schedule = (requests_[-1]['ts'] - requests_[0]['ts']) / args.speedup
+    ok = [r for r in results if r['status'] == 200]
+    summary = {
+        'proxy': args.proxy or os.path.abspath(args.proxy_dir),
+        'worker_model': None if args.proxy else args.worker_model,
+        'proxy_env': args.proxy_env,
+        'speedup': args.speedup,
+        'requests': len(results),
+        'duration_s': round(duration, 3),
+        # 录制的到达速率（按 speedup 压缩后）和实际完成的成功请求速率
+        'offered_rps': round(len(results) / max(schedule, 1e-9), 2),
+        'throughput_rps': round(len(ok) / duration, 2) if duration else None,
+        'status': dict(Counter(str(r['status']) for r in results)),
+        'latency_ms': percentiles([r['latency'] for r in ok]),
+        'stream_ttfb_ms': percentiles([r['ttfb'] for r in ok if r['stream'] and r['ttfb'] is not None]),
+        'upstream': dict(mock.served),
+        # 请求实际发出时间落后于时间表的最大值，较大时调大 --max-inflight 或减小 --speedup
+        'max_schedule_lag_ms': round(replayer.max_lag * 1000, 1),
+    }
+    output = json.dumps(summary, indent=2, ensure_ascii=False)
+    print(output)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
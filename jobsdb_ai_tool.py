@@ -7,6 +7,7 @@ JobsDB 自动求职工具
 
 import tkinter as tk
 from tkinter import ttk, messagebox, scrolledtext, filedialog
+import hashlib
 import json
 import os
 import sys
@@ -14,9 +15,15 @@ import threading
 import time
 import random
 import re
+import sqlite3
+import uuid
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait as futures_wait
 from datetime import datetime
 from urllib.parse import urljoin, urlparse
 import requests
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
 from selenium import webdriver
 from selenium.webdriver.common.by import By
@@ -179,6 +186,404 @@ def check_chrome_running():
         return False, 0
 
 
+class LLMError(Exception):
+    """LLM 调用失败（重试用尽、HTTP 错误或响应格式错误），消息可以直接显示给用户"""
+
+
+class LLMCancelled(LLMError):
+    """调用方通过 cancel_event 取消了 LLM 调用"""
+
+
+class LLMClient:
+    """
+    统一的 LLM 调用客户端：所有请求共用一个保持连接的 Session（连接池），不再每次调用都重新建立 TLS 连接。
+    走代理服务器还是直连 DeepSeek 在创建时确定（api_config.json 的 use_proxy）。
+    429/5xx 和连接失败按指数退避加随机抖动重试（有 Retry-After 时至少等待该时长），
+    通过代理的请求带 Idempotency-Key，重试时代理不会重复调用上游。
+    取消：传入 cancel_event，退避等待和流式接收时检查；已发出的非流式请求收到响应后再放弃。
+    每次调用记录耗时、尝试次数和 token 用量，见 stats() 和 calls。
+    """
+    
+    DEEPSEEK_URL = "https://api.deepseek.com/v1/chat/completions"
+    MODEL = "deepseek-chat"
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    # 代理服务器对正在处理的相同幂等键返回 409 和 Retry-After
+    PROXY_RETRY_STATUSES = RETRY_STATUSES + (409,)
+    
+    def __init__(self, use_proxy=False, proxy_url="", server_api_key="", api_key_getter=None,
+                 max_retries=3, backoff_base=1.0, backoff_max=20.0, pool_size=8):
+        self.use_proxy = bool(use_proxy)
+        self.proxy_url = (proxy_url or "http://localhost:5000").rstrip('/')
+        self.server_api_key = server_api_key
+        self.api_key_getter = api_key_getter or (lambda: "")
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.target = "代理服务器" if self.use_proxy else "API"
+        
+        # 重试由 _send 控制，连接池本身不重试
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        
+        self.calls = deque(maxlen=200)  # 最近的调用记录
+        self.totals = {'calls': 0, 'errors': 0, 'cancelled': 0, 'retries': 0, 'latency': 0.0,
+                       'prompt_tokens': 0, 'completion_tokens': 0}
+        self._lock = threading.Lock()
+    
+    def chat(self, messages, temperature=0.7, max_tokens=2000, timeout=60, kind="chat", cancel_event=None):
+        """直连 DeepSeek，返回生成的文本"""
+        def send(call):
+            api_key = self.api_key_getter()
+            if not api_key:
+                raise LLMError("API Key未配置")
+            headers = {"Content-Type": "application/json", "Authorization": f"Bearer {api_key}"}
+            data = {"model": self.MODEL, "messages": messages, "temperature": temperature, "max_tokens": max_tokens}
+            response = self._send(self.DEEPSEEK_URL, data, headers, timeout, call, cancel_event)
+            return self._read(response, call, cancel_event)
+        return self._run(kind, send)
+    
+    def template(self, template_id, resume, fields, timeout=60, kind=None, cancel_event=None, on_token=None):
+        """
+        通过代理服务器的提示词模板生成，返回生成的文本：简历只发送内容哈希，由代理端展开提示词。
+        代理服务器还没有这份简历时先上传到 /api/resumes，再重新请求。
+        on_token: 可选回调，传入时使用流式输出，每收到一段文本调用一次
+        """
+        headers = {"Content-Type": "application/json", "X-Proxy-Response": "lean"}
+        if self.server_api_key:
+            headers["Authorization"] = f"Bearer {self.server_api_key}"
+        # 同一次调用的所有重试使用同一个幂等键
+        chat_headers = dict(headers, **{"Idempotency-Key": uuid.uuid4().hex})
+        data = dict(fields, model=self.MODEL, template_id=template_id,
+                    resume_hash=hashlib.sha256(resume.encode('utf-8')).hexdigest())
+        stream = on_token is not None
+        if stream:
+            data["stream"] = True
+        url = f"{self.proxy_url}/api/chat"
+        
+        def send(call):
+            response = self._send(url, data, chat_headers, timeout, call, cancel_event, stream)
+            if self._resume_not_found(response):
+                upload = self._send(f"{self.proxy_url}/api/resumes", {"resume": resume}, headers, timeout, call,
+                                    cancel_event)
+                with upload:
+                    self._check_status(upload)
+                response = self._send(url, data, chat_headers, timeout, call, cancel_event, stream)
+            return self._read(response, call, cancel_event, on_token)
+        return self._run(kind or template_id.split('@')[0], send)
+    
+    def stats(self):
+        """累计的调用次数、失败/取消/重试次数、平均耗时（秒）和 token 用量"""
+        with self._lock:
+            totals = dict(self.totals)
+        totals['avg_latency'] = totals['latency'] / totals['calls'] if totals['calls'] else 0.0
+        return totals
+    
+    def close(self):
+        self.session.close()
+    
+    def _run(self, kind, send):
+        """执行一次逻辑调用（可能包含多次 HTTP 请求）并记录耗时和用量"""
+        call = {'kind': kind, 'mode': 'proxy' if self.use_proxy else 'direct', 'result': 'error',
+                'status': None, 'attempts': 0, 'retries': 0, 'prompt_tokens': 0, 'completion_tokens': 0,
+                'time': datetime.now().isoformat(timespec='seconds')}
+        started = time.perf_counter()
+        try:
+            content = send(call)
+            call['result'] = 'ok'
+            return content
+        except LLMCancelled:
+            call['result'] = 'cancelled'
+            raise
+        except requests.exceptions.RequestException as e:
+            # 读取响应体时的网络错误（例如流式输出中途断开）
+            raise LLMError(f"{self.target}请求失败: {str(e)}")
+        finally:
+            call['latency'] = time.perf_counter() - started
+            with self._lock:
+                self.calls.append(call)
+                self.totals['calls'] += 1
+                self.totals['errors'] += call['result'] == 'error'
+                self.totals['cancelled'] += call['result'] == 'cancelled'
+                self.totals['retries'] += call['retries']
+                self.totals['latency'] += call['latency']
+                self.totals['prompt_tokens'] += call['prompt_tokens']
+                self.totals['completion_tokens'] += call['completion_tokens']
+    
+    def _send(self, url, data, headers, timeout, call, cancel_event=None, stream=False):
+        """发送 POST 请求，可重试的状态码和连接失败时退避重试，返回最后一次的 Response"""
+        retry_statuses = self.PROXY_RETRY_STATUSES if self.use_proxy else self.RETRY_STATUSES
+        for attempt in range(self.max_retries + 1):
+            self._check_cancel(cancel_event)
+            call['attempts'] += 1
+            try:
+                response = self.session.post(url, json=data, headers=headers, timeout=timeout, stream=stream)
+            except requests.exceptions.ConnectionError as e:
+                # 连接失败（含连接超时）时请求没有到达服务端，可以安全重试；读取超时不重试
+                if attempt >= self.max_retries:
+                    raise LLMError(f"{self.target}请求失败: {str(e)}")
+                call['retries'] += 1
+                self._backoff(attempt, None, cancel_event)
+                continue
+            except requests.exceptions.RequestException as e:
+                raise LLMError(f"{self.target}请求失败: {str(e)}")
+            call['status'] = response.status_code
+            if response.status_code not in retry_statuses or attempt >= self.max_retries:
+                return response
+            retry_after = response.headers.get('Retry-After')
+            response.close()
+            call['retries'] += 1
+            self._backoff(attempt, retry_after, cancel_event)
+    
+    def _backoff(self, attempt, retry_after, cancel_event):
+        """指数退避加随机抖动（避免多个请求同时重试），不少于服务端的 Retry-After"""
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt) * random.uniform(0.5, 1.0)
+        try:
+            delay = max(delay, min(float(retry_after), self.backoff_max))
+        except (TypeError, ValueError):
+            pass
+        if cancel_event is None:
+            time.sleep(delay)
+        elif cancel_event.wait(delay):
+            raise LLMCancelled("已取消")
+    
+    def _check_cancel(self, cancel_event):
+        if cancel_event is not None and cancel_event.is_set():
+            raise LLMCancelled("已取消")
+    
+    def _resume_not_found(self, response):
+        """代理服务器还没有这份简历（404 resume_not_found）"""
+        if response.status_code != 404:
+            return False
+        try:
+            code = response.json().get('code')
+        except ValueError:
+            code = None
+        if code != 'resume_not_found':
+            return False
+        response.close()
+        return True
+    
+    def _check_status(self, response):
+        if response.status_code >= 400:
+            raise LLMError(f"{self.target}请求失败: HTTP {response.status_code} {response.text[:200]}")
+    
+    def _record_usage(self, call, usage):
+        if isinstance(usage, dict):
+            call['prompt_tokens'] += usage.get('prompt_tokens') or 0
+            call['completion_tokens'] += usage.get('completion_tokens') or 0
+    
+    def _read(self, response, call, cancel_event, on_token=None):
+        """读取响应并返回生成的文本；流式响应逐段回调 on_token"""
+        with response:
+            self._check_status(response)
+            if on_token is None:
+                try:
+                    result = response.json()
+                    content = result['choices'][0]['message']['content']
+                except (ValueError, KeyError, IndexError, TypeError):
+                    raise LLMError(f"{self.target}返回格式错误")
+                self._record_usage(call, result.get('usage'))
+                self._check_cancel(cancel_event)
+                return content
+            
+            parts = []
+            for chunk in self._iter_sse(response):
+                self._check_cancel(cancel_event)
+                self._record_usage(call, chunk.get('usage'))
+                choices = chunk.get("choices") or []
+                delta = choices[0].get("delta", {}).get("content") if choices else None
+                if delta:
+                    parts.append(delta)
+                    on_token(delta)
+            if not parts:
+                raise LLMError(f"{self.target}返回格式错误")
+            return "".join(parts)
+    
+    def _iter_sse(self, response):
+        """解析SSE流式响应，逐个返回 JSON 数据块"""
+        for line in response.iter_lines(decode_unicode=False):
+            if not line or not line.startswith(b"data:"):
+                continue
+            payload = line[5:].strip()
+            if payload == b"[DONE]":
+                break
+            try:
+                yield json.loads(payload)
+            except ValueError:
+                continue
+
+
+# 提示词版本（代理模式下即模板ID）：修改本地提示词或代理模板时递增，旧的缓存结果随之失效
+PROMPT_VERSIONS = {
+    'score': 'score@1',
+    'tailor': 'tailor@1',
+    'cover_letter': 'cover_letter@1',
+}
+# 定制简历和Cover Letter缓存的有效期（秒）；匹配度不过期，只按缓存大小淘汰
+GENERATED_CACHE_TTL = 7 * 24 * 3600
+
+
+class LLMResultCache:
+    """
+    LLM结果的本地缓存：SQLite单文件，键为32字节的SHA-256，内容用zlib压缩。
+    键由提示词版本、模型、参数、规范化的岗位描述和简历版本（内容哈希）计算，
+    同一岗位和简历再次运行时直接复用结果；总大小超过 max_bytes 时按最近使用时间淘汰。
+    打开或读写数据库失败时缓存自动停用，不影响正常调用。
+    """
+    
+    def __init__(self, path="llm_cache.db", max_bytes=20 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        self._total_bytes = 0
+        self._disabled = False
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def make_key(kind, version, model, params, job_description, resume):
+        """计算缓存键：岗位描述只规范化空白，简历以内容哈希作为版本"""
+        normalized_jd = re.sub(r'\s+', ' ', job_description).strip()
+        resume_version = hashlib.sha256(resume.encode('utf-8')).hexdigest()
+        material = json.dumps([kind, version, model, params, normalized_jd, resume_version],
+                              ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(material.encode('utf-8')).digest()
+    
+    def _connect(self):
+        """首次使用时打开数据库（调用方持有锁）"""
+        if self._conn is None and not self._disabled:
+            try:
+                conn = sqlite3.connect(self.path, check_same_thread=False)
+                # 淘汰后释放的页面归还给文件系统，文件大小随之缩小
+                conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS results ('
+                    'key BLOB PRIMARY KEY, kind TEXT, value BLOB, size INTEGER, created REAL, accessed REAL'
+                    ') WITHOUT ROWID'
+                )
+                conn.execute('CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)')
+                conn.commit()
+                self._total_bytes = conn.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+                self._conn = conn
+            except Exception as e:
+                print(f"打开LLM结果缓存失败: {e}")
+                self._disabled = True
+        return self._conn
+    
+    def get(self, key, max_age=None):
+        """返回缓存的文本，没有或超过 max_age 秒时返回None"""
+        with self._lock:
+            conn = self._connect()
+            if conn is None:
+                return None
+            try:
+                row = conn.execute('SELECT value, created FROM results WHERE key = ?', (key,)).fetchone()
+                now = time.time()
+                if row is None or (max_age is not None and now - row[1] > max_age):
+                    self.misses += 1
+                    return None
+                conn.execute('UPDATE results SET accessed = ? WHERE key = ?', (now, key))
+                conn.commit()
+                self.hits += 1
+                return zlib.decompress(row[0]).decode('utf-8')
+            except Exception as e:
+                print(f"读取LLM结果缓存失败: {e}")
+                return None
+    
+    def put(self, key, kind, value):
+        """保存结果，总大小超过上限时淘汰最久未使用的条目"""
+        data = zlib.compress(value.encode('utf-8'), 9)
+        with self._lock:
+            conn = self._connect()
+            if conn is None:
+                return
+            try:
+                old = conn.execute('SELECT size FROM results WHERE key = ?', (key,)).fetchone()
+                now = time.time()
+                conn.execute('INSERT OR REPLACE INTO results (key, kind, value, size, created, accessed) '
+                             'VALUES (?, ?, ?, ?, ?, ?)', (key, kind, data, len(data), now, now))
+                self._total_bytes += len(data) - (old[0] if old else 0)
+                if self._total_bytes > self.max_bytes:
+                    self._evict(conn)
+                conn.commit()
+            except Exception as e:
+                print(f"保存LLM结果缓存失败: {e}")
+    
+    def _evict(self, conn):
+        """按最近使用时间淘汰，直到总大小降到上限的90%"""
+        target = self.max_bytes * 0.9
+        evicted = []
+        for key, size in conn.execute('SELECT key, size FROM results ORDER BY accessed').fetchall():
+            if self._total_bytes <= target:
+                break
+            evicted.append((key,))
+            self._total_bytes -= size
+        conn.executemany('DELETE FROM results WHERE key = ?', evicted)
+        conn.execute('PRAGMA incremental_vacuum')
+    
+    def clear(self):
+        """删除全部缓存结果"""
+        with self._lock:
+            conn = self._connect()
+            if conn is None:
+                return
+            conn.execute('DELETE FROM results')
+            conn.commit()
+            conn.execute('VACUUM')
+            self._total_bytes = 0
+    
+    def stats(self):
+        """本次运行的命中/未命中次数，以及缓存的条目数和压缩后的总大小"""
+        with self._lock:
+            conn = self._connect()
+            entries = conn.execute('SELECT COUNT(*) FROM results').fetchone()[0] if conn is not None else 0
+            return {'hits': self.hits, 'misses': self.misses, 'entries': entries, 'bytes': self._total_bytes}
+
+
+def run_concurrently(*calls):
+    """
+    在线程中同时执行多个无参数函数，全部完成后按参数顺序返回 [(结果, 异常), ...]，
+    某个函数抛出异常不影响其他函数
+    """
+    with ThreadPoolExecutor(max_workers=len(calls)) as executor:
+        futures = [executor.submit(call) for call in calls]
+    results = []
+    for future in futures:
+        try:
+            results.append((future.result(), None))
+        except Exception as e:
+            results.append((None, e))
+    return results
+
+
+class HostPacer:
+    """
+    按域名控制抓取间隔：上一次请求结束后，同一域名至少间隔 min_delay~max_delay 秒（随机）
+    才发起下一次请求，不同域名互不影响。url 需为绝对地址。
+    用法：先按 wait(url) 返回的秒数等待，请求结束（无论成功与否）后调用 done(url)
+    """
+    
+    def __init__(self, min_delay=3, max_delay=6):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self._next_allowed = {}
+        self._lock = threading.Lock()
+    
+    def wait(self, url):
+        """返回对 url 所在域名发起请求前需要等待的秒数"""
+        with self._lock:
+            next_allowed = self._next_allowed.get(urlparse(url).netloc, 0)
+        return max(0, next_allowed - time.monotonic())
+    
+    def done(self, url):
+        """请求结束：间隔从现在开始计算（请求本身的耗时不算在间隔内）"""
+        with self._lock:
+            self._next_allowed[urlparse(url).netloc] = time.monotonic() + random.uniform(self.min_delay, self.max_delay)
+
+
 class ResumeGeneratorApp:
     """主应用程序类"""
     
@@ -196,6 +601,8 @@ class ResumeGeneratorApp:
         self.is_paused = False
         self.pause_event = threading.Event()
         self.pause_event.set()  # 初始状态为运行
+        self.auto_cancel = threading.Event()  # 停止自动求职时取消进行中的LLM调用
+        self.fetch_pacer = HostPacer(3, 6)  # 岗位页面的抓取间隔
         
         # 存储GUI元素引用（用于语言切换）
         self.ui_labels = {}
@@ -209,6 +616,16 @@ class ResumeGeneratorApp:
         self.config_file = "config.json"
         self.load_config()
         
+        # LLM调用客户端（代理配置在load_config中读取，之后不再变化）
+        self.llm = LLMClient(
+            use_proxy=self.config.get('use_proxy', False),
+            proxy_url=self.config.get('proxy_url', ''),
+            server_api_key=self.config.get('server_api_key', ''),
+            api_key_getter=self.get_api_key
+        )
+        # LLM结果缓存（匹配度长期缓存，定制简历和Cover Letter按设置缓存）
+        self.llm_cache = LLMResultCache("llm_cache.db", int(self.config.get('llm_cache_max_mb', 20)) * 1024 * 1024)
+        
         # 恢复语言设置
         if 'language' in self.config:
             self.language = self.config['language']
@@ -443,6 +860,13 @@ class ResumeGeneratorApp:
         except Exception as e:
             print(f"保存配置失败: {e}")
     
+    def get_api_key(self):
+        """从配置中获取API Key，如果没有则从GUI输入框获取"""
+        api_key = self.config.get('api_key', '')
+        if not api_key and hasattr(self, 'api_key_entry'):
+            api_key = self.api_key_entry.get().strip()
+        return api_key
+    
     def create_widgets(self):
         """创建主界面"""
         # 创建Notebook（标签页容器）
@@ -794,13 +1218,16 @@ class ResumeGeneratorApp:
     
     def clear_cache(self):
         """清除缓存"""
-        if messagebox.askyesno("确认", "确定要清除所有缓存吗？\n\n这将清除：\n- 简历缓存\n- 配置信息\n\n此操作不可恢复！"):
+        if messagebox.askyesno("确认", "确定要清除所有缓存吗？\n\n这将清除：\n- 简历缓存\n- 配置信息\n- 匹配度和生成结果缓存\n\n此操作不可恢复！"):
             try:
                 # 清除简历缓存文件
                 cache_file = "resume_cache.txt"
                 if os.path.exists(cache_file):
                     os.remove(cache_file)
                 
+                # 清除LLM结果缓存
+                self.llm_cache.clear()
+                
                 # 清除配置文件
                 if os.path.exists(self.config_file):
                     os.remove(self.config_file)
@@ -941,6 +1368,18 @@ class ResumeGeneratorApp:
         ttk.Label(threshold_row, text="（0-100，建议70，只投递匹配度≥此值的岗位）", 
                  foreground="gray", font=("Arial", 9)).pack(side=tk.LEFT, padx=5)
         
+        # 结果缓存：相同岗位和简历复用上次的匹配度（可选复用定制简历和Cover Letter）
+        cache_row = ttk.Frame(self.search_frame)
+        cache_row.pack(fill=tk.X, pady=5)
+        self.bypass_cache_var = tk.BooleanVar(value=self.config.get('bypass_llm_cache', False))
+        ttk.Checkbutton(cache_row, text="跳过结果缓存（重新评分和生成）", variable=self.bypass_cache_var,
+                        command=self.auto_save_config).pack(side=tk.LEFT)
+        self.cache_generated_var = tk.BooleanVar(value=self.config.get('cache_generated', False))
+        ttk.Checkbutton(cache_row, text="缓存定制简历和Cover Letter", variable=self.cache_generated_var,
+                        command=self.auto_save_config).pack(side=tk.LEFT, padx=15)
+        ttk.Label(cache_row, text="（匹配度默认缓存，重复搜索同一岗位时不再调用API）", 
+                 foreground="gray", font=("Arial", 9)).pack(side=tk.LEFT, padx=5)
+        
         # 投递控制分组
         apply_control_frame = ttk.LabelFrame(self.tab_auto, text="⚙️ 投递控制（安全设置）" if self.language == "zh" else "⚙️ Application Control (Safety Settings)", padding="10")
         apply_control_frame.pack(fill=tk.X, pady=(0, 10))
@@ -1055,6 +1494,11 @@ class ResumeGeneratorApp:
         if self.is_auto_running:
             # 停止
             self.is_auto_running = False
+            self.auto_cancel.set()
+            # 暂停中停止时放行等待中的线程，让它们尽快退出
+            self.is_paused = False
+            self.pause_event.set()
+            self.pause_button.config(text=self.texts['button_pause'])
             self.start_auto_btn.config(text=self.texts['button_start_auto'])
             self.pause_button.config(state="disabled")
             self.update_status("已停止自动求职")
@@ -1084,6 +1528,7 @@ class ResumeGeneratorApp:
         
         # 开始自动求职
         self.is_auto_running = True
+        self.auto_cancel.clear()
         self.start_auto_btn.config(text="停止自动求职" if self.language == "zh" else "Stop Auto Search")
         self.pause_button.config(state="normal")
         
@@ -1175,197 +1620,249 @@ class ResumeGeneratorApp:
             
             self.log_auto_result(f"找到 {len(job_urls)} 个岗位，开始筛选...\n\n")
             
-            # 步骤2：对每个岗位计算匹配度并筛选
+            # 步骤2：逐个抓取岗位描述（按域名控制抓取间隔），匹配度交给线程池并发计算
             matched_jobs = []
             processed = 0
+            score_workers = max(1, int(self.config.get('score_workers', 4)))
+            executor = ThreadPoolExecutor(max_workers=score_workers)
+            pending = deque()  # (序号, 岗位信息, future)，按岗位顺序输出结果
             
-            for i, job_url in enumerate(job_urls, 1):
-                if not self.is_auto_running:
-                    self.log_auto_result("已停止\n")
-                    break
-                
-                # 等待暂停事件
+            def score_job(job_description):
+                # 暂停时不再发起新的计算，停止后直接放弃
                 self.pause_event.wait()
-                
-                self.log_auto_result(f"处理第 {i}/{len(job_urls)} 个岗位...\n")
-                
-                try:
-                    # 抓取岗位描述
-                    job_info, error = self.fetch_job_info(job_url)
-                    if error:
-                        self.log_auto_result(f"  抓取失败：{error}\n")
+                if not self.is_auto_running:
+                    return None
+                return self.calculate_match_score(job_description, original_resume, cancel_event=self.auto_cancel)
+            
+            def report_scores(wait=False):
+                """按岗位顺序输出已完成的匹配度（wait=True时等待全部完成），保证日志不会乱序"""
+                nonlocal processed
+                while pending:
+                    if not pending[0][2].done():
+                        if not wait or not self.is_auto_running:
+                            return
+                        futures_wait([pending[0][2]], timeout=1)
                         continue
-                    
-                    job_description = job_info.get('description', '')
-                    if not job_description:
-                        self.log_auto_result(f"  岗位描述为空，跳过\n")
+                    i, job_info, future = pending.popleft()
+                    try:
+                        match_score = future.result()
+                    except Exception as e:
+                        self.log_auto_result(f"第 {i}/{len(job_urls)} 个岗位匹配度计算异常：{str(e)}\n")
+                        continue
+                    if match_score is None or not self.is_auto_running:
                         continue
                     
-                    # 计算匹配度
-                    match_score = self.calculate_match_score(job_description, original_resume)
-                    self.log_auto_result(f"  匹配度：{match_score}%\n")
-                    
+                    self.log_auto_result(f"第 {i}/{len(job_urls)} 个岗位匹配度：{match_score}%（{job_info['title']}）\n")
                     # 筛选：只保留匹配度>=阈值的岗位
                     if match_score >= threshold:
-                        matched_jobs.append({
-                            'url': job_url,
-                            'title': job_info.get('title', 'Unknown'),
-                            'description': job_description,
-                            'match_score': match_score
-                        })
+                        matched_jobs.append(dict(job_info, match_score=match_score))
                         self.log_auto_result(f"  ✅ 匹配度达标，已加入队列\n")
                     else:
                         self.log_auto_result(f"  ❌ 匹配度不足，已跳过\n")
-                    
                     processed += 1
-                    
-                    # 随机延时
-                    if i < len(job_urls):
-                        delay = random.randint(3, 6)
-                        time.sleep(delay)
-                    
-                except Exception as e:
-                    self.log_auto_result(f"  处理异常：{str(e)}\n")
-                    continue
             
-            # 步骤3：生成定制简历并投递（受投递控制限制）
-            if matched_jobs:
-                self.log_auto_result(f"\n找到 {len(matched_jobs)} 个匹配岗位，开始生成简历并投递...\n\n")
-                
-                applied_count = 0  # 本次已投递数量
-                first_apply = True  # 标记是否为第一次投递（第一次不需要等待）
-                
-                for i, job in enumerate(matched_jobs, 1):
+            try:
+                for i, job_url in enumerate(job_urls, 1):
                     if not self.is_auto_running:
                         break
                     
-                    # 检查是否达到最大投递数量
-                    if applied_count >= max_apply_count:
-                        self.log_auto_result(f"\n⚠️ 已达到本次最大投递数量限制（{max_apply_count}个），停止投递\n")
-                        break
+                    # 等待暂停事件
+                    self.pause_event.wait()
+                    report_scores()
                     
-                    # 检查单日投递上限
-                    current_daily_count = self.get_daily_apply_count()
-                    if current_daily_count >= 15:
-                        self.log_auto_result(f"\n⚠️ 今日已投递15个岗位，已达到单日上限，停止投递\n")
+                    # 同一域名的抓取间隔：从上一次抓取结束时算起（与串行时相同，匹配度计算不占用抓取间隔）
+                    page_url = self.resolve_job_url(job_url)
+                    if not self._auto_sleep(self.fetch_pacer.wait(page_url)):
                         break
                     
-                    self.pause_event.wait()
-                    
-                    self.log_auto_result(f"处理岗位 {i}/{len(matched_jobs)}：{job['title']}\n")
-                    self.log_auto_result(f"  今日已投递：{current_daily_count}/15，本次已投递：{applied_count}/{max_apply_count}\n")
+                    self.log_auto_result(f"抓取第 {i}/{len(job_urls)} 个岗位...\n")
                     
                     try:
-                        # 生成定制简历
-                        self.log_auto_result(f"  正在生成定制简历...\n")
-                        custom_resume, error = self.generate_custom_resume(
-                            job['description'], original_resume, "auto"
-                        )
-                        
+                        # 抓取岗位描述
+                        try:
+                            job_info, error = self.fetch_job_info(job_url)
+                        finally:
+                            self.fetch_pacer.done(page_url)
                         if error:
-                            self.log_auto_result(f"  简历生成失败：{error}\n")
+                            self.log_auto_result(f"  抓取失败：{error}\n")
                             continue
                         
-                        # 生成Cover Letter
-                        self.log_auto_result(f"  正在生成Cover Letter...\n")
-                        cover_letter, error = self.generate_cover_letter(
-                            job['description'], 
-                            job['title'], 
-                            "Unknown",  # 公司名称，可以从job_info中获取
-                            original_resume
-                        )
-                        
-                        if error:
-                            self.log_auto_result(f"  Cover Letter生成失败：{error}，将使用默认文本\n")
-                            cover_letter = f"Dear Hiring Manager,\n\nI am writing to apply for the {job['title']} position. I believe my skills and experience make me a strong candidate for this role.\n\nSincerely,\n{self.config.get('user_name', '')}"
+                        job_description = job_info.get('description', '')
+                        if not job_description:
+                            self.log_auto_result(f"  岗位描述为空，跳过\n")
+                            continue
                         
-                        # 将简历转换为PDF
-                        self.log_auto_result(f"  正在转换简历为PDF...\n")
-                        resume_pdf_path = f"resume_{int(time.time())}.pdf"
-                        pdf_path, error = self.convert_resume_to_pdf(custom_resume, resume_pdf_path)
+                        job = {
+                            'url': job_url,
+                            'title': job_info.get('title', 'Unknown'),
+                            'description': job_description
+                        }
+                        pending.append((i, job, executor.submit(score_job, job_description)))
                         
-                        if error:
-                            self.log_auto_result(f"  PDF转换失败：{error}，将尝试直接上传文本\n")
-                            resume_pdf_path = None
+                    except Exception as e:
+                        self.log_auto_result(f"  处理异常：{str(e)}\n")
+                        continue
+                
+                if self.is_auto_running:
+                    report_scores(wait=True)
+            finally:
+                # 停止时取消还没开始的计算，进行中的LLM调用由auto_cancel取消
+                for _, _, future in pending:
+                    future.cancel()
+                executor.shutdown(wait=False)
+            
+            if not self.is_auto_running:
+                self.log_auto_result("已停止\n")
+            
+            # 步骤3：生成定制简历并投递（受投递控制限制）
+            if matched_jobs:
+                self.log_auto_result(f"\n找到 {len(matched_jobs)} 个匹配岗位，开始生成简历并投递...\n\n")
+                
+                applied_count = 0  # 本次已投递数量
+                first_apply = True  # 标记是否为第一次投递（第一次不需要等待）
+                
+                # 预取：投递间隔等待期间在后台准备后面几个岗位的简历、Cover Letter和PDF
+                prefetch_jobs = max(1, int(self.config.get('prefetch_jobs', 2)))
+                prefetch_executor = ThreadPoolExecutor(max_workers=prefetch_jobs)
+                prepared = {}  # 岗位序号 -> future
+                
+                def prefetch(start):
+                    # 最多预取prefetch_jobs个岗位，且不超过本次还能投递的数量
+                    window = min(prefetch_jobs, max_apply_count - applied_count)
+                    for index in range(start, min(start + window, len(matched_jobs) + 1)):
+                        if index not in prepared:
+                            prepared[index] = prefetch_executor.submit(
+                                self._prepare_application, matched_jobs[index - 1], original_resume, index
+                            )
+                
+                try:
+                    for i, job in enumerate(matched_jobs, 1):
+                        if not self.is_auto_running:
+                            break
                         
-                        # 准备用户信息
-                        user_info = {
-                            'name': self.config.get('user_name', ''),
-                            'email': self.config.get('user_email', ''),
-                            'phone': self.config.get('user_phone', ''),
-                            'expected_salary': self.config.get('expected_salary', '$20K')
-                        }
+                        # 检查是否达到最大投递数量
+                        if applied_count >= max_apply_count:
+                            self.log_auto_result(f"\n⚠️ 已达到本次最大投递数量限制（{max_apply_count}个），停止投递\n")
+                            break
                         
-                        # 自动投递
-                        self.log_auto_result(f"  正在自动投递...\n")
-                        # 构建申请URL（从岗位详情页跳转到申请页）
-                        apply_url = job['url']
-                        # JobsDB的申请URL通常是原URL加上/apply/或直接访问申请页面
-                        # 先尝试访问岗位详情页，然后点击申请按钮
-                        if '/job/' in apply_url and '/apply/' not in apply_url:
-                            # 尝试构建申请URL
-                            apply_url = apply_url.replace('/job/', '/apply/')
-                        # 如果URL已经是申请页，直接使用
+                        # 检查单日投递上限
+                        current_daily_count = self.get_daily_apply_count()
+                        if current_daily_count >= 15:
+                            self.log_auto_result(f"\n⚠️ 今日已投递15个岗位，已达到单日上限，停止投递\n")
+                            break
                         
-                        success, message = self.auto_apply_job(
-                            apply_url,
-                            custom_resume,
-                            cover_letter,
-                            user_info,
-                            resume_pdf_path
-                        )
+                        self.pause_event.wait()
                         
-                        if success:
-                            # 保存记录（标记为已投递）
-                            self.save_application_record(
-                                job['title'], 
-                                "Unknown", 
-                                job['url'], 
-                                job['match_score'], 
-                                "已投递"
-                            )
-                            applied_count += 1
-                            self.log_auto_result(f"  ✅ 投递成功（第{applied_count}个）\n")
-                        else:
-                            self.log_auto_result(f"  ❌ 投递失败：{message}\n")
+                        self.log_auto_result(f"处理岗位 {i}/{len(matched_jobs)}：{job['title']}\n")
+                        self.log_auto_result(f"  今日已投递：{current_daily_count}/15，本次已投递：{applied_count}/{max_apply_count}\n")
                         
-                        # 清理临时PDF文件
-                        if resume_pdf_path and os.path.exists(resume_pdf_path):
+                        try:
+                            prefetch(i)
+                            future = prepared.pop(i)
+                            if not future.done():
+                                self.log_auto_result(f"  正在生成定制简历、Cover Letter和PDF...\n")
+                            # 分段等待，以便可以响应停止
+                            while not future.done() and self.is_auto_running:
+                                futures_wait([future], timeout=1)
+                            if not self.is_auto_running:
+                                self._discard_prepared(future)
+                                break
+                            application = future.result()
+                            
+                            if application['resume_error']:
+                                self.log_auto_result(f"  简历生成失败：{application['resume_error']}\n")
+                                continue
+                            custom_resume = application['resume']
+                            
+                            cover_letter = application['cover_letter']
+                            if application['cover_letter_error']:
+                                self.log_auto_result(f"  Cover Letter生成失败：{application['cover_letter_error']}，将使用默认文本\n")
+                                cover_letter = f"Dear Hiring Manager,\n\nI am writing to apply for the {job['title']} position. I believe my skills and experience make me a strong candidate for this role.\n\nSincerely,\n{self.config.get('user_name', '')}"
+                            
+                            resume_pdf_path = application['pdf_path']
+                            if application['pdf_error']:
+                                self.log_auto_result(f"  PDF转换失败：{application['pdf_error']}，将尝试直接上传文本\n")
+                            self.log_auto_result(f"  定制简历、Cover Letter和PDF已准备好（耗时{application['seconds']:.1f}秒）\n")
+                            
+                            # 准备用户信息
+                            user_info = {
+                                'name': self.config.get('user_name', ''),
+                                'email': self.config.get('user_email', ''),
+                                'phone': self.config.get('user_phone', ''),
+                                'expected_salary': self.config.get('expected_salary', '$20K')
+                            }
+                            
+                            # 自动投递
+                            self.log_auto_result(f"  正在自动投递...\n")
+                            # 构建申请URL（从岗位详情页跳转到申请页）
+                            apply_url = job['url']
+                            # JobsDB的申请URL通常是原URL加上/apply/或直接访问申请页面
+                            # 先尝试访问岗位详情页，然后点击申请按钮
+                            if '/job/' in apply_url and '/apply/' not in apply_url:
+                                # 尝试构建申请URL
+                                apply_url = apply_url.replace('/job/', '/apply/')
+                            # 如果URL已经是申请页，直接使用
+                            
                             try:
-                                os.remove(resume_pdf_path)
-                            except:
-                                pass
-                        
-                        # 投递间隔控制（除了第一次投递）
-                        if not first_apply and applied_count < max_apply_count:
-                            # 随机选择间隔时间（分钟转秒）
-                            interval_seconds = random.randint(apply_interval_min, apply_interval_max) * 60
-                            interval_minutes = interval_seconds / 60
-                            self.log_auto_result(f"  ⏳ 等待 {interval_minutes:.1f} 分钟后继续投递（模拟真人操作）...\n")
+                                success, message = self.auto_apply_job(
+                                    apply_url,
+                                    custom_resume,
+                                    cover_letter,
+                                    user_info,
+                                    resume_pdf_path
+                                )
+                            finally:
+                                # 清理临时PDF文件（投递抛出异常时也要删除）
+                                self._remove_temp_file(resume_pdf_path)
                             
-                            # 分段等待，以便可以响应暂停/停止
-                            wait_chunks = interval_seconds // 10  # 每10秒检查一次
-                            for _ in range(wait_chunks):
-                                if not self.is_auto_running:
-                                    break
-                                self.pause_event.wait()
-                                time.sleep(10)
+                            if success:
+                                # 保存记录（标记为已投递）
+                                self.save_application_record(
+                                    job['title'], 
+                                    "Unknown", 
+                                    job['url'], 
+                                    job['match_score'], 
+                                    "已投递"
+                                )
+                                applied_count += 1
+                                self.log_auto_result(f"  ✅ 投递成功（第{applied_count}个）\n")
+                            else:
+                                self.log_auto_result(f"  ❌ 投递失败：{message}\n")
                             
-                            # 剩余时间
-                            remaining_seconds = interval_seconds % 10
-                            if remaining_seconds > 0 and self.is_auto_running:
-                                self.pause_event.wait()
-                                time.sleep(remaining_seconds)
-                        else:
-                            first_apply = False
-                        
-                    except Exception as e:
-                        self.log_auto_result(f"  处理异常：{str(e)}\n")
-                        continue
+                            # 投递间隔控制（除了第一次投递）
+                            if not first_apply and applied_count < max_apply_count:
+                                # 等待期间预取后面的岗位，间隔结束后可以立即投递
+                                prefetch(i + 1)
+                                # 随机选择间隔时间（分钟转秒）
+                                interval_seconds = random.randint(apply_interval_min, apply_interval_max) * 60
+                                interval_minutes = interval_seconds / 60
+                                self.log_auto_result(f"  ⏳ 等待 {interval_minutes:.1f} 分钟后继续投递（模拟真人操作）...\n")
+                                
+                                # 分段等待，以便可以响应暂停/停止
+                                self._auto_sleep(interval_seconds)
+                            else:
+                                first_apply = False
+                            
+                        except Exception as e:
+                            self.log_auto_result(f"  处理异常：{str(e)}\n")
+                            continue
+                finally:
+                    # 没有用上的预取：取消还没开始的，删除已经（或即将）生成的PDF
+                    for future in prepared.values():
+                        self._discard_prepared(future)
+                    prefetch_executor.shutdown(wait=False)
                 
                 self.log_auto_result(f"\n✅ 完成！共处理 {processed} 个岗位，匹配 {len(matched_jobs)} 个，本次投递 {applied_count} 个\n")
                 final_daily_count = self.get_daily_apply_count()
                 self.log_auto_result(f"📊 今日累计投递：{final_daily_count}/15\n")
+                llm_stats = self.llm.stats()
+                cache_stats = self.llm_cache.stats()
+                self.log_auto_result(
+                    f"📊 LLM累计调用：{llm_stats['calls']}次（失败{llm_stats['errors']}，重试{llm_stats['retries']}），"
+                    f"平均耗时{llm_stats['avg_latency']:.1f}秒，"
+                    f"tokens {llm_stats['prompt_tokens'] + llm_stats['completion_tokens']}，"
+                    f"缓存命中{cache_stats['hits']}次\n"
+                )
             else:
                 self.log_auto_result(f"\n未找到匹配度>= {threshold}% 的岗位\n")
             
@@ -1376,6 +1873,87 @@ class ResumeGeneratorApp:
             self.root.after(0, lambda: self.start_auto_btn.config(text=self.texts['button_start_auto']))
             self.root.after(0, lambda: self.pause_button.config(state="disabled"))
     
+    def _auto_sleep(self, seconds):
+        """自动求职中的等待：暂停时不计时，停止时立即返回False"""
+        deadline = time.monotonic() + seconds
+        while self.is_auto_running:
+            if not self.pause_event.is_set():
+                paused_at = time.monotonic()
+                self.pause_event.wait()
+                deadline += time.monotonic() - paused_at
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return True
+            if self.auto_cancel.wait(min(remaining, 1)):
+                return False
+        return False
+    
+    def _prepare_application(self, job, original_resume, index):
+        """
+        生成一个岗位投递所需的材料：定制简历、Cover Letter和PDF（在预取线程中运行，不写日志）。
+        返回字典，各步骤的错误放在 *_error 中由调用方输出；停止后返回的材料不完整
+        """
+        started = time.monotonic()
+        application = {'resume': None, 'cover_letter': None, 'pdf_path': None,
+                       'resume_error': None, 'cover_letter_error': None, 'pdf_error': None}
+        
+        self.pause_event.wait()
+        if not self.is_auto_running:
+            application['resume_error'] = "已停止"
+            return dict(application, seconds=time.monotonic() - started)
+        
+        # 定制简历和Cover Letter都只依赖岗位描述和原始简历，同时生成
+        (resume_result, resume_exc), (cover_result, cover_exc) = run_concurrently(
+            lambda: self.generate_custom_resume(
+                job['description'], original_resume, "auto", cancel_event=self.auto_cancel
+            ),
+            lambda: self.generate_cover_letter(
+                job['description'],
+                job['title'],
+                "Unknown",  # 公司名称，可以从job_info中获取
+                original_resume,
+                cancel_event=self.auto_cancel
+            )
+        )
+        if resume_exc:
+            resume_result = (None, f"生成失败: {str(resume_exc)}")
+        if cover_exc:
+            cover_result = (None, f"生成失败: {str(cover_exc)}")
+        custom_resume, application['resume_error'] = resume_result
+        application['cover_letter'], application['cover_letter_error'] = cover_result
+        if application['resume_error']:
+            return dict(application, seconds=time.monotonic() - started)
+        application['resume'] = custom_resume
+        
+        # 将简历转换为PDF（同时预取多个岗位，文件名带上岗位序号）
+        pdf_path, application['pdf_error'] = self.convert_resume_to_pdf(
+            custom_resume, f"resume_{int(time.time())}_{index}.pdf"
+        )
+        if not application['pdf_error']:
+            application['pdf_path'] = pdf_path
+        return dict(application, seconds=time.monotonic() - started)
+    
+    def _discard_prepared(self, future):
+        """放弃一个预取：还没开始的直接取消，已经开始的在完成后删除生成的PDF"""
+        if future.cancel():
+            return
+        
+        def cleanup(done):
+            try:
+                self._remove_temp_file(done.result()['pdf_path'])
+            except Exception:
+                pass
+        future.add_done_callback(cleanup)
+    
+    def _remove_temp_file(self, path):
+        """删除临时文件（例如投递用的PDF），失败时忽略"""
+        if path and os.path.exists(path):
+            try:
+                os.remove(path)
+            except:
+                pass
+    
     def log_auto_result(self, message):
         """在自动求职结果区域添加日志"""
         self.root.after(0, lambda: self.auto_result_text.insert(tk.END, message))
@@ -1598,20 +2176,38 @@ class ResumeGeneratorApp:
         self.result_text.delete("1.0", tk.END)
         self.result_text.insert("1.0", "正在生成，请稍候...")
         
+        first_token = [True]
+        
+        def on_token(delta):
+            # 流式输出：收到第一段文本时清空提示文字，之后逐段追加
+            def append():
+                if first_token[0]:
+                    self.result_text.delete("1.0", tk.END)
+                    first_token[0] = False
+                self.result_text.insert(tk.END, delta)
+                self.result_text.see(tk.END)
+            self.root.after(0, append)
+        
         def generate_worker():
             try:
-                custom_resume, error = self.generate_custom_resume(
-                    job_description, original_resume, resume_language
+                # 生成简历和计算匹配度互不依赖（匹配度按原始简历计算），同时发起
+                (generated, resume_exc), (match_score, score_exc) = run_concurrently(
+                    lambda: self.generate_custom_resume(
+                        job_description, original_resume, resume_language, on_token=on_token
+                    ),
+                    lambda: self.calculate_match_score(job_description, original_resume)
                 )
+                if resume_exc:
+                    raise resume_exc
+                custom_resume, error = generated
+                if score_exc:
+                    match_score = self._calculate_match_simple(job_description, original_resume)
                 
                 if error:
                     self.root.after(0, lambda: messagebox.showerror(self.texts['error'], error))
                     self.root.after(0, lambda: self.result_text.delete("1.0", tk.END))
                     self.root.after(0, lambda: self.update_status(self.texts['status_ready']))
                 else:
-                    # 计算匹配度
-                    match_score = self.calculate_match_score(job_description, original_resume)
-                    
                     # 更新UI
                     self.root.after(0, lambda: self.result_text.delete("1.0", tk.END))
                     self.root.after(0, lambda: self.result_text.insert("1.0", custom_resume))
@@ -1839,6 +2435,11 @@ class ResumeGeneratorApp:
                 self.config['apply_interval_max'] = max_interval
             except:
                 self.config['apply_interval_max'] = 12
+        # 保存结果缓存设置
+        if hasattr(self, 'bypass_cache_var'):
+            self.config['bypass_llm_cache'] = self.bypass_cache_var.get()
+        if hasattr(self, 'cache_generated_var'):
+            self.config['cache_generated'] = self.cache_generated_var.get()
         # 保存简历内容（从标签1的简历区域）
         if hasattr(self, 'resume_text_init'):
             resume_content = self.resume_text_init.get("1.0", tk.END).strip()
@@ -1933,106 +2534,60 @@ class ResumeGeneratorApp:
     
     # ========== 核心功能函数 ==========
     
-    def generate_custom_resume(self, job_description, original_resume, resume_language="auto"):
-        """使用DeepSeek API生成定制简历（支持代理服务器）"""
-        # 检查是否使用代理服务器
-        use_proxy = self.config.get('use_proxy', False)
-        
-        if use_proxy:
+    def generate_custom_resume(self, job_description, original_resume, resume_language="auto", on_token=None,
+                               cancel_event=None):
+        """
+        使用DeepSeek API生成定制简历（支持代理服务器）
+        on_token: 可选回调，通过代理流式生成时每收到一段文本调用一次
+        cancel_event: 可选，set()后放弃生成（返回"已取消"错误）
+        """
+        cache_key = self._llm_cache_key('tailor', {'language': resume_language, 'temperature': 0.7, 'max_tokens': 2000},
+                                        job_description, original_resume)
+        cached = self._read_llm_cache('tailor', cache_key)
+        if cached is not None:
+            if on_token is not None:
+                on_token(cached)
+            return cached, None
+        
+        if self.llm.use_proxy:
             # 使用代理服务器
-            return self._generate_via_proxy(job_description, original_resume, resume_language)
+            generated_resume, error = self._generate_via_proxy(job_description, original_resume, resume_language,
+                                                               on_token, cancel_event)
         else:
             # 直接调用API
-            return self._generate_direct_api(job_description, original_resume, resume_language)
+            generated_resume, error = self._generate_direct_api(job_description, original_resume, resume_language,
+                                                                cancel_event)
+        if not error:
+            self._write_llm_cache('tailor', cache_key, generated_resume)
+        return generated_resume, error
     
-    def _generate_via_proxy(self, job_description, original_resume, resume_language="auto"):
-        """通过代理服务器生成简历"""
-        proxy_url = self.config.get('proxy_url', 'http://localhost:5000')
-        server_api_key = self.config.get('server_api_key', '')
-        
+    def _generate_via_proxy(self, job_description, original_resume, resume_language="auto", on_token=None,
+                            cancel_event=None):
+        """通过代理服务器生成简历（传入on_token时使用流式输出）"""
         # 检测简历语言
         if resume_language == "auto":
             chinese_chars = len([c for c in original_resume if '\u4e00' <= c <= '\u9fff'])
             resume_language = "zh" if chinese_chars / max(len(original_resume), 1) > 0.3 else "en"
         
-        # 构建Prompt
-        if resume_language == "zh":
-            prompt = f"""你是一位专业的求职顾问。请根据下面的【岗位描述】，重写我的【原始简历】，突出与岗位最匹配的技能和经验。
-
-要求：
-1. 保持简历的专业性和真实性
-2. 突出与岗位要求最相关的经验和技能
-3. 使用专业、简洁的语言
-4. 保持简历结构清晰，不要超过一页
-5. 保留原始简历中的关键信息（姓名、联系方式、教育背景等）
-
-【岗位描述】
-{job_description}
-
-【原始简历】
-{original_resume}
-
-请生成定制后的简历："""
-        else:
-            prompt = f"""You are a professional career consultant. Please rewrite my original resume based on the job description below, highlighting the skills and experiences that best match the position.
-
-Requirements:
-1. Maintain professionalism and authenticity
-2. Highlight the most relevant experiences and skills for the job requirements
-3. Use professional and concise language
-4. Keep the resume structure clear, not exceeding one page
-5. Retain key information from the original resume (name, contact, education, etc.)
-
-【Job Description】
-{job_description}
-
-【Original Resume】
-{original_resume}
-
-Please generate the customized resume:"""
-        
         try:
-            # 调用代理服务器
-            headers = {
-                "Content-Type": "application/json"
-            }
-            
-            # 如果配置了服务器API Key，添加到请求头
-            if server_api_key:
-                headers["Authorization"] = f"Bearer {server_api_key}"
-            
+            # 提示词由代理服务器按模板展开，这里只发送简历哈希和岗位描述
             data = {
-                "model": "deepseek-chat",
-                "messages": [
-                    {"role": "user", "content": prompt}
-                ],
+                "job_description": job_description,
+                "language": resume_language,
                 "temperature": 0.7,
                 "max_tokens": 2000
             }
-            
-            proxy_endpoint = f"{proxy_url.rstrip('/')}/api/chat"
-            response = requests.post(proxy_endpoint, json=data, headers=headers, timeout=60)
-            response.raise_for_status()
-            
-            result = response.json()
-            if 'choices' in result and len(result['choices']) > 0:
-                generated_resume = result['choices'][0]['message']['content']
-                return generated_resume, None
-            else:
-                return None, "代理服务器返回格式错误"
-                
-        except requests.exceptions.RequestException as e:
-            return None, f"代理服务器请求失败: {str(e)}"
+            generated_resume = self.llm.template(PROMPT_VERSIONS['tailor'], original_resume, data, timeout=60,
+                                                 cancel_event=cancel_event, on_token=on_token)
+            return generated_resume, None
+        except LLMError as e:
+            return None, str(e)
         except Exception as e:
             return None, f"生成失败: {str(e)}"
     
-    def _generate_direct_api(self, job_description, original_resume, resume_language="auto"):
+    def _generate_direct_api(self, job_description, original_resume, resume_language="auto", cancel_event=None):
         """直接调用DeepSeek API生成简历"""
-        # 从配置中获取API Key，如果没有则从GUI输入框获取
-        api_key = self.config.get('api_key', '')
-        if not api_key and hasattr(self, 'api_key_entry'):
-            api_key = self.api_key_entry.get().strip()
-        if not api_key:
+        if not self.get_api_key():
             return None, "API Key未配置"
         
         # 检测简历语言
@@ -2078,54 +2633,37 @@ Requirements:
 Please generate the customized resume:"""
         
         try:
-            url = "https://api.deepseek.com/v1/chat/completions"
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {api_key}"
-            }
-            data = {
-                "model": "deepseek-chat",
-                "messages": [
-                    {"role": "user", "content": prompt}
-                ],
-                "temperature": 0.7,
-                "max_tokens": 2000
-            }
-            
-            response = requests.post(url, json=data, headers=headers, timeout=60)
-            response.raise_for_status()
-            
-            result = response.json()
-            if 'choices' in result and len(result['choices']) > 0:
-                generated_resume = result['choices'][0]['message']['content']
-                return generated_resume, None
-            else:
-                return None, "API返回格式错误"
-                
-        except requests.exceptions.RequestException as e:
-            return None, f"网络错误: {str(e)}"
+            generated_resume = self.llm.chat([{"role": "user", "content": prompt}], temperature=0.7, max_tokens=2000,
+                                             timeout=60, kind="tailor", cancel_event=cancel_event)
+            return generated_resume, None
+        except LLMError as e:
+            return None, str(e)
         except Exception as e:
             return None, f"生成失败: {str(e)}"
     
+    def resolve_job_url(self, job_url):
+        """把相对的岗位地址补全为当前地区JobsDB域名下的绝对地址"""
+        if job_url.startswith('http'):
+            return job_url
+        # 根据地区确定JobsDB域名
+        region = self.config.get('region', '香港 (hk)')
+        if 'hk' in region:
+            base_url = 'https://hk.jobsdb.com'
+        elif 'sg' in region:
+            base_url = 'https://sg.jobsdb.com'
+        elif 'my' in region:
+            base_url = 'https://my.jobsdb.com'
+        elif 'ph' in region:
+            base_url = 'https://ph.jobsdb.com'
+        else:
+            base_url = 'https://hk.jobsdb.com'
+        return urljoin(base_url, job_url)
+    
     def fetch_job_info(self, job_url):
         """抓取岗位信息"""
         try:
-            # 根据地区确定JobsDB域名
-            region = self.config.get('region', '香港 (hk)')
-            if 'hk' in region:
-                base_url = 'https://hk.jobsdb.com'
-            elif 'sg' in region:
-                base_url = 'https://sg.jobsdb.com'
-            elif 'my' in region:
-                base_url = 'https://my.jobsdb.com'
-            elif 'ph' in region:
-                base_url = 'https://ph.jobsdb.com'
-            else:
-                base_url = 'https://hk.jobsdb.com'
-            
             # 如果URL不完整，补全
-            if not job_url.startswith('http'):
-                job_url = urljoin(base_url, job_url)
+            job_url = self.resolve_job_url(job_url)
             
             headers = {
                 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
@@ -2292,13 +2830,30 @@ Please generate the customized resume:"""
             error_msg = f"启动Chrome失败。\n\n详细错误：{str(e)[:300]}\n\n建议解决方案：\n1. 确保已关闭所有Chrome窗口\n2. 检查Chrome用户数据目录路径是否正确\n3. 检查配置文件名称是否正确\n4. 以管理员身份运行程序（Windows）" if self.language == "zh" else f"Failed to start Chrome.\n\nError: {str(e)[:300]}\n\nSolutions:\n1. Ensure all Chrome windows are closed\n2. Check Chrome user data directory path\n3. Check profile name\n4. Run as administrator (Windows)"
             return None, error_msg
     
-    def generate_cover_letter(self, job_description, job_title, company_name, original_resume):
-        """使用DeepSeek API生成针对性的cover letter"""
-        api_key = self.config.get('api_key', '')
-        if not api_key and hasattr(self, 'api_key_entry'):
-            api_key = self.api_key_entry.get().strip()
+    def generate_cover_letter(self, job_description, job_title, company_name, original_resume, cancel_event=None):
+        """使用DeepSeek API生成针对性的cover letter（支持代理服务器）"""
+        cache_key = self._llm_cache_key(
+            'cover_letter', {'job_title': job_title, 'company_name': company_name, 'temperature': 0.7, 'max_tokens': 800},
+            job_description, original_resume
+        )
+        cached = self._read_llm_cache('cover_letter', cache_key)
+        if cached is not None:
+            return cached, None
         
-        if not api_key:
+        if self.llm.use_proxy:
+            cover_letter, error = self._generate_cover_letter_via_proxy(job_description, job_title, company_name,
+                                                                        original_resume, cancel_event)
+        else:
+            cover_letter, error = self._generate_cover_letter_direct_api(job_description, job_title, company_name,
+                                                                         original_resume, cancel_event)
+        if not error:
+            self._write_llm_cache('cover_letter', cache_key, cover_letter)
+        return cover_letter, error
+    
+    def _generate_cover_letter_direct_api(self, job_description, job_title, company_name, original_resume,
+                                          cancel_event=None):
+        """直接调用DeepSeek API生成cover letter"""
+        if not self.get_api_key():
             return None, "API Key未配置"
         
         # 检测语言
@@ -2353,28 +2908,35 @@ Requirements:
 Please generate the cover letter:"""
         
         try:
-            url = "https://api.deepseek.com/v1/chat/completions"
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {api_key}"
-            }
+            cover_letter = self.llm.chat([{"role": "user", "content": prompt}], temperature=0.7, max_tokens=800,
+                                         timeout=60, kind="cover_letter", cancel_event=cancel_event)
+            return cover_letter, None
+        except LLMError as e:
+            return None, str(e)
+        except Exception as e:
+            return None, f"生成失败: {str(e)}"
+    
+    def _generate_cover_letter_via_proxy(self, job_description, job_title, company_name, original_resume,
+                                         cancel_event=None):
+        """通过代理服务器生成cover letter"""
+        # 检测语言
+        chinese_chars = len([c for c in job_description if '\u4e00' <= c <= '\u9fff'])
+        is_chinese = chinese_chars / max(len(job_description), 1) > 0.3
+        
+        try:
             data = {
-                "model": "deepseek-chat",
-                "messages": [{"role": "user", "content": prompt}],
+                "job_description": job_description,
+                "job_title": job_title,
+                "company_name": company_name,
+                "language": "zh" if is_chinese else "en",
                 "temperature": 0.7,
                 "max_tokens": 800
             }
-            
-            response = requests.post(url, json=data, headers=headers, timeout=60)
-            response.raise_for_status()
-            result = response.json()
-            
-            if 'choices' in result and len(result['choices']) > 0:
-                cover_letter = result['choices'][0]['message']['content']
-                return cover_letter, None
-            else:
-                return None, "API返回格式错误"
-                
+            cover_letter = self.llm.template(PROMPT_VERSIONS['cover_letter'], original_resume, data, timeout=60,
+                                             cancel_event=cancel_event)
+            return cover_letter, None
+        except LLMError as e:
+            return None, str(e)
         except Exception as e:
             return None, f"生成失败: {str(e)}"
     
@@ -2603,74 +3165,63 @@ Please generate the cover letter:"""
             # 保持浏览器打开，让用户查看结果
             pass
     
-    def calculate_match_score(self, job_description, resume):
-        """使用DeepSeek API计算简历与岗位的匹配度（支持代理服务器）"""
-        # 检查是否使用代理服务器
-        use_proxy = self.config.get('use_proxy', False)
-        
-        if use_proxy:
-            return self._calculate_match_via_proxy(job_description, resume)
+    def calculate_match_score(self, job_description, resume, cancel_event=None):
+        """使用DeepSeek API计算简历与岗位的匹配度（支持代理服务器），结果长期缓存"""
+        cache_key = self._llm_cache_key('score', {'temperature': 0.3, 'max_tokens': 50}, job_description, resume)
+        cached = self._read_llm_cache('score', cache_key)
+        if cached is not None:
+            return int(cached)
+        
+        if self.llm.use_proxy:
+            score = self._calculate_match_via_proxy(job_description, resume, cancel_event)
         else:
-            return self._calculate_match_direct_api(job_description, resume)
+            score = self._calculate_match_direct_api(job_description, resume, cancel_event)
+        if score is None:
+            # API不可用时使用关键词匹配（不缓存）
+            return self._calculate_match_simple(job_description, resume)
+        self._write_llm_cache('score', cache_key, str(score))
+        return score
     
-    def _calculate_match_via_proxy(self, job_description, resume):
-        """通过代理服务器计算匹配度"""
-        proxy_url = self.config.get('proxy_url', 'http://localhost:5000')
-        server_api_key = self.config.get('server_api_key', '')
-        
-        prompt = f"""你是一位专业的HR顾问。请评估以下简历与岗位描述的匹配度。
-
-要求：
-1. 仔细分析岗位描述中的关键要求（技能、经验、学历等）
-2. 评估简历中是否包含这些关键要求
-3. 给出0-100分的匹配度评分
-4. 只输出一个数字（0-100之间的整数），不要输出其他文字
-
-【岗位描述】
-{job_description[:2000]}
-
-【简历内容】
-{resume[:2000]}
-
-请直接输出匹配度分数（0-100的整数）："""
-        
+    def _llm_cache_key(self, kind, params, job_description, resume):
+        """LLM结果的缓存键（代理模板和本地提示词不同，分开缓存）"""
+        version = f"{'proxy' if self.llm.use_proxy else 'direct'}:{PROMPT_VERSIONS[kind]}"
+        return self.llm_cache.make_key(kind, version, self.llm.MODEL, params, job_description, resume)
+    
+    def _read_llm_cache(self, kind, key):
+        """读取缓存：勾选「跳过结果缓存」时不读取；定制简历和Cover Letter只在开启缓存时读取"""
+        if self.config.get('bypass_llm_cache', False):
+            return None
+        if kind == 'score':
+            return self.llm_cache.get(key)
+        if not self.config.get('cache_generated', False):
+            return None
+        return self.llm_cache.get(key, max_age=GENERATED_CACHE_TTL)
+    
+    def _write_llm_cache(self, kind, key, value):
+        """保存结果（跳过缓存时也保存，下次可以复用最新的结果）"""
+        if kind == 'score' or self.config.get('cache_generated', False):
+            self.llm_cache.put(key, kind, value)
+    
+    def _calculate_match_via_proxy(self, job_description, resume, cancel_event=None):
+        """通过代理服务器计算匹配度，失败时返回None"""
         try:
-            headers = {"Content-Type": "application/json"}
-            if server_api_key:
-                headers["Authorization"] = f"Bearer {server_api_key}"
-            
+            # 提示词由代理服务器按模板展开，这里只发送简历哈希和岗位描述
             data = {
-                "model": "deepseek-chat",
-                "messages": [{"role": "user", "content": prompt}],
+                "job_description": job_description,
                 "temperature": 0.3,
                 "max_tokens": 50
             }
-            
-            proxy_endpoint = f"{proxy_url.rstrip('/')}/api/chat"
-            response = requests.post(proxy_endpoint, json=data, headers=headers, timeout=30)
-            response.raise_for_status()
-            result = response.json()
-            
-            if "choices" in result and len(result["choices"]) > 0:
-                score_text = result["choices"][0]["message"]["content"].strip()
-                score_match = re.search(r'\d+', score_text)
-                if score_match:
-                    score = int(score_match.group())
-                    return max(0, min(100, score))
-            
-            return self._calculate_match_simple(job_description, resume)
+            score_text = self.llm.template(PROMPT_VERSIONS['score'], resume, data, timeout=30,
+                                           cancel_event=cancel_event)
+            return self._parse_match_score(score_text)
             
         except Exception as e:
-            return self._calculate_match_simple(job_description, resume)
+            return None
     
-    def _calculate_match_direct_api(self, job_description, resume):
-        """直接调用API计算匹配度"""
-        api_key = self.config.get('api_key', '')
-        if not api_key and hasattr(self, 'api_key_entry'):
-            api_key = self.api_key_entry.get().strip()
-        
-        if not api_key:
-            return self._calculate_match_simple(job_description, resume)
+    def _calculate_match_direct_api(self, job_description, resume, cancel_event=None):
+        """直接调用API计算匹配度，失败时返回None"""
+        if not self.get_api_key():
+            return None
         
         prompt = f"""你是一位专业的HR顾问。请评估以下简历与岗位描述的匹配度。
 
@@ -2689,33 +3240,20 @@ Please generate the cover letter:"""
 请直接输出匹配度分数（0-100的整数）："""
         
         try:
-            url = "https://api.deepseek.com/v1/chat/completions"
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {api_key}"
-            }
-            data = {
-                "model": "deepseek-chat",
-                "messages": [{"role": "user", "content": prompt}],
-                "temperature": 0.3,
-                "max_tokens": 50
-            }
-            
-            response = requests.post(url, json=data, headers=headers, timeout=30)
-            response.raise_for_status()
-            result = response.json()
-            
-            if "choices" in result and len(result["choices"]) > 0:
-                score_text = result["choices"][0]["message"]["content"].strip()
-                score_match = re.search(r'\d+', score_text)
-                if score_match:
-                    score = int(score_match.group())
-                    return max(0, min(100, score))
-            
-            return self._calculate_match_simple(job_description, resume)
+            score_text = self.llm.chat([{"role": "user", "content": prompt}], temperature=0.3, max_tokens=50,
+                                       timeout=30, kind="score", cancel_event=cancel_event)
+            return self._parse_match_score(score_text)
             
         except Exception as e:
-            return self._calculate_match_simple(job_description, resume)
+            return None
+    
+    def _parse_match_score(self, score_text):
+        """从模型输出中取出0-100的分数，没有数字时返回None"""
+        score_match = re.search(r'\d+', score_text.strip())
+        if score_match:
+            score = int(score_match.group())
+            return max(0, min(100, score))
+        return None
     
     def _calculate_match_simple(self, job_description, resume):
         """简单关键词匹配（备用方案）"""
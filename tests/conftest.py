@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+代理服务器测试的公共配置：导入 api_proxy_server 之前把数据库等路径指向临时目录，
+上游 DeepSeek API 用进程内的假响应代替（同步引擎替换 UpstreamClient.post，异步引擎用 httpx.MockTransport）
+"""
+
+import asyncio
+import json
+import os
+import sys
+import tempfile
+
+import httpx
+import pytest
+
+_TMP_DIR = tempfile.mkdtemp(prefix='proxy-tests-')
+os.environ.update({
+    'USAGE_DB_PATH': os.path.join(_TMP_DIR, 'usage.db'),
+    'SERVER_API_KEY': 'test-admin-key',
+    'DEEPSEEK_API_KEY': 'sk-test',
+    'DEEPSEEK_API_URLS': 'http://upstream.test/chat/completions',
+    'LOG_FORMAT': 'text',
+    'LOG_SAMPLE_RATE': '0',
+    'CIRCUIT_ENABLED': 'False',
+    'UPSTREAM_WARMUP_CONNECTIONS': '0',
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import api_proxy_server as core  # noqa: E402
+import api_proxy_async  # noqa: E402
+
+ADMIN_HEADERS = {'Authorization': 'Bearer test-admin-key'}
+
+
+def completion_body(content='ok', total_tokens=10):
+    return json.dumps({
+        'id': 'chatcmpl-test', 'object': 'chat.completion', 'model': 'deepseek-chat',
+        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+        'usage': {'prompt_tokens': total_tokens - 2, 'completion_tokens': 2, 'total_tokens': total_tokens}
+    }).encode('utf-8')
+
+
+def sse_body(content='ok', total_tokens=10):
+    chunks = [{'choices': [{'index': 0, 'delta': {'content': char}}]} for char in content]
+    chunks.append({'choices': [], 'usage': {'total_tokens': total_tokens}})
+    return b''.join(f"data: {json.dumps(chunk)}\n\n".encode('utf-8') for chunk in chunks) + b'data: [DONE]\n\n'
+
+
+class FakeUpstream:
+    """
+    记录收到的请求；默认按最后一条消息回显。
+    responder 可以设为返回 (状态码, 响应体) 的函数，返回 None 时仍按默认回显
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.responder = None
+
+    def respond(self, payload):
+        self.calls.append(payload)
+        if self.responder is not None:
+            result = self.responder(payload)
+            if result is not None:
+                return result
+        if payload.get('stream'):
+            return 200, sse_body(payload['messages'][-1]['content'])
+        return 200, completion_body(payload['messages'][-1]['content'])
+
+
+def reset_state():
+    """清空缓存、幂等记录、简历和统计"""
+    core.response_cache._entries.clear()
+    core.response_cache._bytes = 0
+    core.resume_store._cache.clear()
+    for table in ('idempotency', 'resumes'):
+        core.usage_accounting.store.execute(f'DELETE FROM {table}')
+    core.reset_usage_stats()
+
+
+@pytest.fixture(autouse=True)
+def clean_state():
+    reset_state()
+    yield
+
+
+@pytest.fixture
+def fake_upstream(monkeypatch):
+    fake = FakeUpstream()
+
+    def post(self, url, timeout=None, json=None, stream=False, **kwargs):
+        status_code, body = fake.respond(json)
+        response = core.requests.Response()
+        response.status_code = status_code
+        response.headers['Content-Type'] = 'text/event-stream' if json.get('stream') else 'application/json'
+        response._content = body
+        response._content_consumed = True
+        return response
+
+    monkeypatch.setattr(core.UpstreamClient, 'post', post)
+    return fake
+
+
+@pytest.fixture
+def sync_client(fake_upstream):
+    core.app.config['TESTING'] = True
+    client = core.app.test_client()
+    client.environ_base['HTTP_AUTHORIZATION'] = ADMIN_HEADERS['Authorization']
+    return client
+
+
+@pytest.fixture
+def async_client(fake_upstream):
+    """返回 call(method, path, **kwargs) -> httpx.Response，在同一个事件循环里依次执行"""
+    def handler(request):
+        status_code, body = fake_upstream.respond(json.loads(request.content))
+        return httpx.Response(status_code, content=body)
+
+    return AsyncEngine(handler)
+
+
+class AsyncEngine:
+    """在测试里驱动异步引擎：上游客户端换成 MockTransport，不经过 lifespan"""
+
+    def __init__(self, handler):
+        self.handler = handler
+
+    async def __aenter__(self):
+        upstream = api_proxy_async.upstream
+        upstream.semaphore = asyncio.Semaphore(api_proxy_async.ASYNC_MAX_INFLIGHT)
+        upstream.client = httpx.AsyncClient(transport=httpx.MockTransport(self.handler))
+        self.client = httpx.AsyncClient(transport=httpx.ASGITransport(app=api_proxy_async.app),
+                                        base_url='http://proxy.test', headers=ADMIN_HEADERS)
+        return self.client
+
+    async def __aexit__(self, *exc_info):
+        await self.client.aclose()
+        await api_proxy_async.upstream.close()
+
+    def call(self, method, path, **kwargs):
+        async def run():
+            async with self as client:
+                return await client.request(method, path, **kwargs)
+        return asyncio.run(run())
+
+
+class Reply:
+    """两个引擎的响应统一成相同的字段，便于比较"""
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+
+def engine_call(name, sync_client, async_client):
+    """call(method, path, **kwargs) -> Reply，在指定的引擎上运行"""
+    if name == 'sync':
+        def call(method, path, **kwargs):
+            response = sync_client.open(path, method=method, **kwargs)
+            return Reply(response.status_code, response.headers, response.data)
+    else:
+        def call(method, path, **kwargs):
+            response = async_client.call(method, path, **kwargs)
+            return Reply(response.status_code, response.headers, response.content)
+    call.name = name
+    return call
+
+
+@pytest.fixture(params=['sync', 'async'])
+def engine(request, sync_client, async_client):
+    """分别在同步引擎和异步引擎上运行的 call(method, path, **kwargs)"""
+    return engine_call(request.param, sync_client, async_client)
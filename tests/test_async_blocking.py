@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""异步引擎：SQLite / 磁盘上的同步调用在线程池中执行，一个调用卡住时其他请求照常处理"""
+
+import asyncio
+import threading
+
+import pytest
+
+import api_proxy_server as core
+
+
+def _blocking(monkeypatch, target, name):
+    """把 target.name 换成先等待 release 的版本，返回 (entered, release)"""
+    original = getattr(target, name)
+    entered = threading.Event()
+    release = threading.Event()
+
+    def blocked(*args, **kwargs):
+        entered.set()
+        assert release.wait(10)
+        return original(*args, **kwargs)
+
+    monkeypatch.setattr(target, name, blocked)
+    return entered, release
+
+
+CHAT = {'messages': [{'role': 'user', 'content': 'hello'}], 'temperature': 0}
+
+BLOCKED_CALLS = {
+    'resume_store.get': (lambda: (core.resume_store, 'get'), 'GET', '/api/resumes/' + 'a' * 64, {}),
+    'idempotency.try_begin': (lambda: (core.idempotency_store, 'try_begin'), 'POST', '/api/chat',
+                              {'json': CHAT, 'headers': {core.IDEMPOTENCY_HEADER: 'key-1'}}),
+    'usage_summary': (lambda: (core.usage_accounting, 'summary'), 'GET', '/api/stats', {}),
+    'response_cache.get_disk': (lambda: (core.response_cache, 'get_disk'), 'POST', '/api/chat', {'json': CHAT}),
+}
+
+
+@pytest.mark.parametrize('name', sorted(BLOCKED_CALLS))
+def test_blocked_store_call_does_not_stall_event_loop(monkeypatch, async_client, name):
+    target, method, path, kwargs = BLOCKED_CALLS[name]
+    if name == 'response_cache.get_disk':
+        monkeypatch.setattr(core.response_cache, 'cache_dir', 'unused')
+        monkeypatch.setattr(core.response_cache, '_disk_get', lambda key, now: None)
+        monkeypatch.setattr(core.response_cache, '_disk_set', lambda key, expires_at, body: None)
+    entered, release = _blocking(monkeypatch, *target())
+
+    async def scenario():
+        async with async_client as client:
+            slow = asyncio.ensure_future(client.request(method, path, **kwargs))
+            assert await asyncio.to_thread(entered.wait, 5)
+            # 卡住的调用在线程池里等待，事件循环继续处理其他请求
+            for index in range(5):
+                response = await asyncio.wait_for(client.get('/health'), 2)
+                assert response.status_code == 200
+                response = await asyncio.wait_for(client.post('/api/chat', json={
+                    'messages': [{'role': 'user', 'content': f'other {index}'}], 'temperature': 1.0}), 2)
+                assert response.status_code == 200
+            assert not slow.done()
+            release.set()
+            response = await asyncio.wait_for(slow, 5)
+            assert response.status_code in (200, 404)
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        release.set()
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""异步引擎的请求合并：发起方断开时，合并到同一上游调用的其他请求照常拿到结果"""
+
+import asyncio
+
+import pytest
+
+import api_proxy_server as core
+from api_proxy_async import AsyncCoalescer
+
+
+@pytest.fixture(autouse=True)
+def coalescing_enabled(monkeypatch):
+    monkeypatch.setattr(core, 'COALESCE_ENABLED', True)
+
+
+def test_leader_cancellation_does_not_fail_waiters():
+    coalescer = AsyncCoalescer()
+    calls = []
+
+    async def upstream_call():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return 200, b'shared'
+
+    async def scenario():
+        leader = asyncio.ensure_future(coalescer.run('key', upstream_call))
+        await asyncio.sleep(0)
+        waiters = [asyncio.ensure_future(coalescer.run('key', upstream_call)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        # 发起请求的客户端断开
+        leader.cancel()
+        results = await asyncio.gather(*waiters)
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return results
+
+    assert asyncio.run(scenario()) == [(200, b'shared')] * 3
+    assert len(calls) == 1
+    assert coalescer.stats()['in_flight'] == 0
+
+
+def test_waiter_cancellation_does_not_cancel_shared_call():
+    coalescer = AsyncCoalescer()
+
+    async def upstream_call():
+        await asyncio.sleep(0.05)
+        return 200, b'shared'
+
+    async def scenario():
+        leader = asyncio.ensure_future(coalescer.run('key', upstream_call))
+        await asyncio.sleep(0)
+        waiter = asyncio.ensure_future(coalescer.run('key', upstream_call))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        return await leader
+
+    assert asyncio.run(scenario()) == (200, b'shared')
+
+
+def test_errors_reach_every_waiter_and_clear_the_flight():
+    coalescer = AsyncCoalescer()
+
+    async def upstream_call():
+        await asyncio.sleep(0.01)
+        raise RuntimeError('upstream down')
+
+    async def scenario():
+        results = await asyncio.gather(*(coalescer.run('key', upstream_call) for _ in range(3)),
+                                       return_exceptions=True)
+        await asyncio.sleep(0)
+        return results
+
+    results = asyncio.run(scenario())
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert coalescer.stats() == dict(coalescer.stats(), in_flight=0, upstream_calls=1, saved_upstream_calls=2)
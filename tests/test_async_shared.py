@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+异步引擎使用共享存储：请求合并和并发名额在 worker 之间生效（其他 worker 用同步引擎的实现模拟）；
+两个引擎 /health 的连接池字段相同
+"""
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+import api_proxy_server as core
+from api_proxy_async import AsyncCoalescer, AsyncConcurrencyGate
+
+
+@pytest.fixture
+def store(tmp_path):
+    return core.SharedStore(str(tmp_path / 'shared.db'))
+
+
+@pytest.fixture(autouse=True)
+def coalescing_enabled(monkeypatch):
+    monkeypatch.setattr(core, 'COALESCE_ENABLED', True)
+
+
+def test_async_waiter_gets_result_from_another_worker(store):
+    other = core.RequestCoalescer(store)
+    coalescer = AsyncCoalescer(store)
+    assert other.claim_shared('key')
+    # 其他 worker 稍后发布结果
+    threading.Timer(0.2, other.publish, ('key', 200, b'from-other-worker')).start()
+    calls = []
+
+    async def upstream_call():
+        calls.append(1)
+        return 200, b'own'
+
+    assert asyncio.run(coalescer.run('key', upstream_call)) == (200, b'from-other-worker')
+    assert calls == []
+    stats = coalescer.stats()
+    assert stats['shared'] and stats['saved_upstream_calls'] == 1
+
+
+def test_async_leader_publishes_for_other_workers(store):
+    other = core.RequestCoalescer(store)
+    coalescer = AsyncCoalescer(store)
+    results = []
+
+    async def upstream_call():
+        # 上游调用进行中时其他 worker 的相同请求开始等待
+        waiter = threading.Thread(target=lambda: results.append(other.run('key', lambda: (200, b'other'))))
+        waiter.start()
+        await asyncio.sleep(0.2)
+        return 200, b'from-async-worker'
+
+    assert asyncio.run(coalescer.run('key', upstream_call)) == (200, b'from-async-worker')
+    time.sleep(0.2)
+    assert results == [(200, b'from-async-worker')]
+
+
+def test_async_gate_counts_slots_of_other_workers(store):
+    other = core.ConcurrencyGate(store, limit=1, budgets={})
+    gate = AsyncConcurrencyGate(store, limit=1, budgets={}, queue_timeout=2)
+    slot, _ = other.acquire('normal')
+    # 其他 worker 稍后归还名额
+    threading.Timer(0.3, other.release, (slot,)).start()
+
+    async def scenario():
+        waited = await gate.acquire('high')
+        assert gate.stats()['active'] == 1
+        rows = store.execute("SELECT state, priority FROM slots").fetchall()
+        gate.release('high')
+        # 归还名额时在后台删除记录
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if not store.execute('SELECT COUNT(*) FROM slots').fetchone()[0]:
+                break
+        return waited, rows
+
+    waited, rows = asyncio.run(scenario())
+    assert waited >= 0.25
+    assert rows == [('active', 'high')]
+    assert store.execute('SELECT COUNT(*) FROM slots').fetchone()[0] == 0
+    assert gate.stats()['active'] == 0
+
+
+def test_async_gate_shared_queue_timeout(store):
+    other = core.ConcurrencyGate(store, limit=1, budgets={})
+    gate = AsyncConcurrencyGate(store, limit=1, budgets={}, queue_timeout=0.2)
+    slot, _ = other.acquire('normal')
+
+    async def scenario():
+        with pytest.raises(core.RateLimited):
+            await gate.acquire('normal')
+        # 对冲请求不排队
+        assert not await gate.try_acquire('high')
+
+    asyncio.run(scenario())
+    other.release(slot)
+    assert gate.rejected == 1
+    assert store.execute('SELECT COUNT(*) FROM slots').fetchone()[0] == 0
+
+
+def test_health_reports_the_same_pool_fields(engine):
+    response = engine('GET', '/health')
+    assert response.status_code == 200
+    pool = response.json()['upstream_pool']
+    assert pool['engine'] == engine.name
+    assert set(pool) == {'engine', 'http2', 'pool_size', 'max_inflight', 'idle_connections', 'active_connections',
+                         'waiting_requests', 'connections_opened', 'requests', 'reuse_ratio'}
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""异步引擎的上游客户端：流式请求的并发名额一直占用到响应体转发完（aclose），而不是收到响应头为止"""
+
+import asyncio
+
+import httpx
+
+import api_proxy_async
+from conftest import AsyncEngine, sse_body
+
+
+def _streaming_client(chunks):
+    client = api_proxy_async.AsyncUpstreamClient()
+    client.semaphore = asyncio.Semaphore(1)
+
+    async def body():
+        for chunk in chunks:
+            await asyncio.sleep(0)
+            yield chunk
+
+    client.client = httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(200, content=body())))
+    return client
+
+
+def test_stream_holds_slot_until_aclose():
+    async def scenario():
+        client = _streaming_client([b'data: a\n\n', b'data: b\n\n'])
+        response = await client.stream('http://upstream.test/chat/completions', json={})
+        # 收到响应头后仍占用名额，后面的请求排队
+        assert (client.active, client.semaphore.locked()) == (1, True)
+        waiter = asyncio.ensure_future(client.post('http://upstream.test/chat/completions', json={}))
+        await asyncio.sleep(0.05)
+        assert not waiter.done() and client.waiting == 1
+        chunks = []
+        async for chunk in response.aiter_bytes():
+            chunks.append(chunk)
+            assert client.active == 1 and not waiter.done()
+        # 读完响应体时 httpx 自动 aclose，名额随之归还
+        assert b''.join(chunks) == b'data: a\n\ndata: b\n\n'
+        await asyncio.wait_for(waiter, 1)
+        # 重复 aclose 不会多归还名额
+        await response.aclose()
+        assert client.active == 0 and client.waiting == 0
+        assert client.semaphore._value == 1
+        await client.close()
+
+    asyncio.run(scenario())
+
+
+def test_stream_slot_released_when_send_fails():
+    async def scenario():
+        client = api_proxy_async.AsyncUpstreamClient()
+        client.semaphore = asyncio.Semaphore(1)
+
+        def fail(request):
+            raise httpx.ConnectError('refused')
+
+        client.client = httpx.AsyncClient(transport=httpx.MockTransport(fail))
+        try:
+            await client.stream('http://upstream.test/chat/completions', json={})
+        except httpx.ConnectError:
+            pass
+        assert client.active == 0 and client.semaphore._value == 1
+        await client.close()
+
+    asyncio.run(scenario())
+
+
+def test_relay_counts_as_active_until_finished(fake_upstream):
+    active_during_relay = []
+
+    async def body():
+        yield sse_body('hi').split(b'\n\n')[0] + b'\n\n'
+        await asyncio.sleep(0)
+        active_during_relay.append(api_proxy_async.upstream.active)
+        yield b'data: [DONE]\n\n'
+
+    engine = AsyncEngine(lambda request: httpx.Response(200, content=body()))
+    response = engine.call('POST', '/api/chat', json={'messages': [{'role': 'user', 'content': 'hi'}],
+                                                      'stream': True})
+    assert response.status_code == 200 and response.content.endswith(b'data: [DONE]\n\n')
+    assert active_during_relay == [1]
+    assert api_proxy_async.upstream.active == 0
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""批量接口：失败的项单独返回错误，不影响其他项；流式时每完成一项输出一行"""
+
+import json
+
+import api_proxy_server as core
+
+
+def _item(content, **params):
+    return dict({'messages': [{'role': 'user', 'content': content}], 'temperature': 1.0}, **params)
+
+
+def _respond(payload):
+    if payload['messages'][-1]['content'] == 'fail':
+        return 502, b'{"error": {"message": "bad gateway"}}'
+    return 200, b'{"choices": [{"message": {"role": "assistant", "content": "ok"}}], "usage": {"total_tokens": 7}}'
+
+
+ITEMS = [
+    _item('first'),
+    {'messages': []},
+    _item('fail'),
+    {'template_id': 'score@1', 'resume_hash': '0' * 64, 'job_description': 'jd'},
+    'not an object',
+    _item('last'),
+]
+
+
+def _check(results):
+    by_index = {result['index']: result for result in results}
+    assert sorted(by_index) == list(range(len(ITEMS)))
+    assert by_index[0]['status_code'] == by_index[5]['status_code'] == 200
+    assert by_index[0]['response']['choices'][0]['message']['content'] == 'ok'
+    assert by_index[1] == {'index': 1, 'status_code': 400, 'error': 'Invalid request item'}
+    assert by_index[2]['status_code'] == 502
+    assert 'bad gateway' in by_index[2]['message']
+    assert (by_index[3]['status_code'], by_index[3]['code']) == (404, 'resume_not_found')
+    assert by_index[4]['status_code'] == 400
+
+
+def test_per_item_errors(engine, fake_upstream):
+    fake_upstream.responder = _respond
+    response = engine('POST', '/api/chat/batch', json={'requests': ITEMS})
+    assert response.status_code == 200
+    results = response.json()['results']
+    # 非流式按提交顺序返回
+    assert [result['index'] for result in results] == list(range(len(ITEMS)))
+    _check(results)
+    assert len(fake_upstream.calls) == 3
+
+
+def test_streamed_per_item_errors(engine, fake_upstream):
+    fake_upstream.responder = _respond
+    response = engine('POST', '/api/chat/batch', json={'requests': ITEMS, 'stream': True})
+    assert response.status_code == 200
+    assert response.headers['Content-Type'].startswith('application/x-ndjson')
+    _check([json.loads(line) for line in response.content.splitlines()])
+
+
+def test_lean_items_and_shared_cache(engine, fake_upstream):
+    fake_upstream.responder = _respond
+    items = [_item('same', temperature=0)] * 2
+    response = engine('POST', '/api/chat/batch', json={'requests': items}, headers={'X-Proxy-Response': 'lean'})
+    results = response.json()['results']
+    assert all(result['response'] == {'choices': [{'message': {'role': 'assistant', 'content': 'ok'}}],
+                                      'usage': {'total_tokens': 7}} for result in results)
+    # 相同的可缓存项只调用一次上游（合并或缓存命中）
+    assert len(fake_upstream.calls) == 1
+
+
+def test_invalid_batches(engine, fake_upstream):
+    assert engine('POST', '/api/chat/batch', json={'requests': []}).status_code == 400
+    assert engine('POST', '/api/chat/batch', json={'items': [_item('x')]}).status_code == 400
+    too_many = {'requests': [_item('x')] * (core.BATCH_MAX_ITEMS + 1)}
+    assert engine('POST', '/api/chat/batch', json=too_many).status_code == 400
+    assert fake_upstream.calls == []
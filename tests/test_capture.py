@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""流量录制：内容脱敏（相同内容替换结果相同）、始终抹掉密钥，按缓存键确定性抽样，队列满时丢弃不阻塞"""
+
+import gzip
+import json
+import os
+
+import pytest
+
+import api_proxy_server as core
+from conftest import completion_body
+
+SECRET = 'sk-' + 'a1B2c3D4e5F6g7H8i9J0'
+
+
+def _payload(content, **fields):
+    return dict({'model': 'deepseek-chat', 'messages': [{'role': 'user', 'content': content}]}, **fields)
+
+
+def test_redact_text_is_deterministic_and_keeps_length():
+    redacted = core.redact_text('我的简历：五年 Python 经验')
+    assert redacted == core.redact_text('我的简历：五年 Python 经验')
+    assert len(redacted) == len('我的简历：五年 Python 经验')
+    assert 'Python' not in redacted
+    assert core.redact_text('another') != core.redact_text('anotheR')
+    assert core.redact_text(None) is None and core.redact_text('') == ''
+
+
+def test_secrets_are_masked_when_content_is_kept(monkeypatch):
+    monkeypatch.setattr(core, 'CAPTURE_REDACT_CONTENT', False)
+    text = f'use key {SECRET} with Bearer abcdefgh12345'
+    redacted = core.redact_text(text)
+    assert SECRET not in redacted and 'abcdefgh12345' not in redacted
+    assert redacted.startswith('use key ')
+
+
+def test_redact_payload_only_replaces_message_content():
+    api_data = _payload('secret resume', temperature=0.2, max_tokens=50)
+    redacted = core.redact_payload(api_data)
+    assert api_data['messages'][0]['content'] == 'secret resume'
+    assert redacted['messages'][0]['content'] != 'secret resume'
+    assert redacted['messages'][0]['role'] == 'user'
+    assert (redacted['model'], redacted['temperature'], redacted['max_tokens']) == ('deepseek-chat', 0.2, 50)
+
+
+def test_redact_response():
+    redacted = core.redact_response(completion_body('a tailored cover letter', total_tokens=42))
+    assert redacted['choices'][0]['message']['content'] != 'a tailored cover letter'
+    assert redacted['usage']['total_tokens'] == 42
+    assert core.redact_response(b'not json') == {'bytes': 8}
+
+
+def test_sampling_is_deterministic_per_request(tmp_path):
+    capture = core.TrafficCapture(directory=str(tmp_path), sample_rate=0.5)
+    payloads = [_payload(f'prompt {index}') for index in range(400)]
+    decisions = [capture._sampled(payload) for payload in payloads]
+    # 相同的请求每次的抽样结果相同
+    assert decisions == [capture._sampled(payload) for payload in payloads]
+    assert 0.35 < sum(decisions) / len(decisions) < 0.65
+    assert all(core.TrafficCapture(directory=str(tmp_path), sample_rate=1)._sampled(p) for p in payloads)
+    assert not core.TrafficCapture(directory='', sample_rate=1).enabled
+
+
+def test_records_are_written_redacted(tmp_path):
+    capture = core.TrafficCapture(directory=str(tmp_path), sample_rate=1)
+    api_data = _payload('my private resume', temperature=0)
+    headers = {'Authorization': f'Bearer {SECRET}', 'X-Priority': 'high'}
+    capture.request(api_data, headers, 'client-hash', '/api/chat')
+    capture.upstream(api_data, 200, 0.25, completion_body('private answer'))
+    capture.upstream(api_data, 401, 0.01, f'{{"error": "invalid key {SECRET}"}}'.encode('utf-8'))
+    capture.close()
+
+    names = os.listdir(tmp_path)
+    assert len(names) == 1 and names[0].endswith('.jsonl.gz')
+    with gzip.open(tmp_path / names[0], 'rt', encoding='utf-8') as f:
+        text = f.read()
+    assert SECRET not in text and 'private' not in text
+    request, response, error = [json.loads(line) for line in text.splitlines()]
+    assert request['headers'] == {'X-Priority': 'high'}
+    assert request['client'] == 'client-hash'
+    # mock 上游按脱敏后请求体的缓存键匹配
+    assert response['key'] == core.cache_key(core.redact_payload(api_data))
+    assert (response['status'], response['latency']) == (200, 0.25)
+    assert error['status'] == 401 and '***' in error['error']
+    assert capture.stats()['captured'] == 3
+
+
+def test_full_queue_drops_instead_of_blocking(tmp_path):
+    capture = core.TrafficCapture(directory=str(tmp_path), sample_rate=1, max_pending=2)
+    # 不启动写盘线程，队列只进不出
+    capture._writer_pid = os.getpid()
+    for index in range(5):
+        capture.request(_payload(f'prompt {index}'), {}, 'client', '/api/chat')
+    assert capture.stats()['pending'] == 2
+    assert capture.stats()['dropped'] == 3
+
+
+@pytest.mark.parametrize('sample_rate', [0, 1])
+def test_chat_requests_are_captured_when_sampled(monkeypatch, tmp_path, engine, sample_rate):
+    capture = core.TrafficCapture(directory=str(tmp_path), sample_rate=sample_rate)
+    monkeypatch.setattr(core, 'traffic_capture', capture)
+    assert engine('POST', '/api/chat', json=_payload('hello', temperature=0.9)).status_code == 200
+    capture.close()
+    records = []
+    for name in os.listdir(tmp_path):
+        with gzip.open(tmp_path / name, 'rt', encoding='utf-8') as f:
+            records.extend(json.loads(line) for line in f)
+    assert [record['type'] for record in records] == (['request', 'upstream'] if sample_rate else [])
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+请求合并：跨 worker 等待时，持有者被限流 / 熔断的异常原样转给等待方（保留 retry_after）；
+只合并可缓存的请求，高温度的相同请求各自调用上游
+"""
+
+import asyncio
+import threading
+import time
+
+import httpx
+import pytest
+
+import api_proxy_server as core
+from conftest import AsyncEngine, completion_body
+
+
+@pytest.fixture(autouse=True)
+def coalescing_enabled(monkeypatch):
+    monkeypatch.setattr(core, 'COALESCE_ENABLED', True)
+
+
+@pytest.fixture
+def store(tmp_path):
+    return core.SharedStore(str(tmp_path / 'shared.db'))
+
+
+@pytest.mark.parametrize('error, expected', [
+    (core.RateLimited('All upstream keys are rate limited', 7), core.RateLimited),
+    (core.CircuitOpen('Upstream circuit is open', 12), core.CircuitOpen),
+    (RuntimeError('connection reset'), core.UpstreamError),
+])
+def test_shared_waiter_reraises_the_leader_error(store, error, expected):
+    leader = core.RequestCoalescer(store)
+    waiter = core.RequestCoalescer(store)
+    assert leader.claim_shared('key')
+    threading.Timer(0.1, leader.publish_error, ('key', error)).start()
+
+    with pytest.raises(expected) as raised:
+        waiter.run('key', lambda: pytest.fail('waiter must not call upstream'))
+    assert str(raised.value) == str(error)
+    if expected is not core.UpstreamError:
+        assert raised.value.retry_after == error.retry_after
+
+
+def test_shared_rate_limit_reaches_the_client_as_429(monkeypatch, sync_client, store):
+    body = {'messages': [{'role': 'user', 'content': 'score'}], 'temperature': 0}
+    keys = []
+    # 其他 worker 正在处理同一个请求，随后被限流
+    other = core.RequestCoalescer(store)
+    monkeypatch.setattr(core, 'coalescer', core.RequestCoalescer(store))
+    original_run = core.coalescer.run
+
+    def run(key, fn):
+        keys.append(key)
+        other.claim_shared(key)
+        threading.Timer(0.1, other.publish_error, (key, core.RateLimited('Server is busy', 5))).start()
+        return original_run(key, fn)
+
+    monkeypatch.setattr(core.coalescer, 'run', run)
+    response = sync_client.post('/api/chat', json=body)
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '5'
+    assert len(keys) == 1
+
+
+def _concurrent_sync(sync_client, body, count=3):
+    responses = []
+    threads = [threading.Thread(target=lambda: responses.append(sync_client.post('/api/chat', json=body)))
+               for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return [response.status_code for response in responses]
+
+
+@pytest.mark.parametrize('temperature, upstream_calls', [(0, 1), (0.9, 3)])
+def test_sync_only_cacheable_requests_are_coalesced(sync_client, fake_upstream, temperature, upstream_calls):
+    def slow(payload):
+        time.sleep(0.2)
+        return 200, completion_body('same')
+
+    fake_upstream.responder = slow
+    body = {'messages': [{'role': 'user', 'content': 'write'}], 'temperature': temperature}
+    assert _concurrent_sync(sync_client, body) == [200] * 3
+    assert len(fake_upstream.calls) == upstream_calls
+
+
+@pytest.mark.parametrize('temperature, upstream_calls', [(0, 1), (0.9, 3)])
+def test_async_only_cacheable_requests_are_coalesced(temperature, upstream_calls):
+    calls = []
+
+    async def handler(request):
+        calls.append(request)
+        await asyncio.sleep(0.2)
+        return httpx.Response(200, content=completion_body('same'))
+
+    body = {'messages': [{'role': 'user', 'content': 'write'}], 'temperature': temperature}
+
+    async def scenario():
+        async with AsyncEngine(handler) as client:
+            responses = await asyncio.gather(*(client.post('/api/chat', json=body) for _ in range(3)))
+        return [response.status_code for response in responses]
+
+    assert asyncio.run(scenario()) == [200] * 3
+    assert len(calls) == upstream_calls
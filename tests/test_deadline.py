@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""X-Deadline-Ms 是总耗时上限：上游持续发送保活空行（每次读取都不超时）时，到截止时间也要结束"""
+
+import asyncio
+import time
+
+import httpx
+import pytest
+
+import api_proxy_server as core
+from conftest import AsyncEngine, engine_call, sse_body
+
+# 上游每隔 INTERVAL 秒发送一次保活数据，共持续 DURATION 秒
+INTERVAL = 0.05
+DURATION = 3.0
+
+
+def trickle(first, keepalive):
+    """先发送 first，然后一直发送保活数据，DURATION 秒后才结束"""
+    yield first
+    stop = time.perf_counter() + DURATION
+    while time.perf_counter() < stop:
+        time.sleep(INTERVAL)
+        yield keepalive
+
+
+async def atrickle(first, keepalive):
+    yield first
+    stop = time.perf_counter() + DURATION
+    while time.perf_counter() < stop:
+        await asyncio.sleep(INTERVAL)
+        yield keepalive
+
+
+class TrickleRaw:
+    """代替 urllib3 响应的原始数据流，requests 按 read() 逐块读取"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+
+    def read(self, amt=None):
+        if self.closed:
+            return b''
+        return next(self.chunks, b'')
+
+    def close(self):
+        self.closed = True
+
+
+def first_and_keepalive(payload):
+    if payload.get('stream'):
+        return sse_body('hi').split(b'\n\n')[0] + b'\n\n', b': keep-alive\n\n'
+    return b'\n', b'\n'
+
+
+@pytest.fixture
+def trickling(monkeypatch, sync_client):
+    """两个引擎的上游都换成慢速发送的假上游，返回 {引擎名: call}"""
+    raws = []
+
+    def post(self, url, timeout=None, json=None, stream=False, **kwargs):
+        response = core.requests.Response()
+        response.status_code = 200
+        response.raw = TrickleRaw(trickle(*first_and_keepalive(json)))
+        raws.append(response.raw)
+        return response
+
+    monkeypatch.setattr(core.UpstreamClient, 'post', post)
+
+    def handler(request):
+        return httpx.Response(200, content=atrickle(*first_and_keepalive(core.json.loads(request.content))))
+
+    calls = {
+        'sync': engine_call('sync', sync_client, None),
+        'async': engine_call('async', None, AsyncEngine(handler)),
+    }
+    calls['raws'] = raws
+    return calls
+
+
+@pytest.mark.parametrize('name', ['sync', 'async'])
+def test_trickling_response_stops_at_deadline(trickling, name):
+    body = {'messages': [{'role': 'user', 'content': 'slow'}], 'temperature': 0.7}
+    started = time.perf_counter()
+    response = trickling[name]('POST', '/api/chat', json=body, headers={core.DEADLINE_HEADER: '300'})
+    assert response.status_code == 504
+    assert time.perf_counter() - started < 1.5
+    if name == 'sync':
+        # 超时后关闭上游连接
+        assert all(raw.closed for raw in trickling['raws'])
+
+
+@pytest.mark.parametrize('name', ['sync', 'async'])
+def test_trickling_stream_is_cut_at_deadline(trickling, name):
+    body = {'messages': [{'role': 'user', 'content': 'slow'}], 'stream': True}
+    started = time.perf_counter()
+    response = trickling[name]('POST', '/api/chat', json=body, headers={core.DEADLINE_HEADER: '300'})
+    # 响应头已经发出，只能截断 SSE 流
+    assert response.status_code == 200
+    assert response.content.startswith(b'data: ')
+    assert b'[DONE]' not in response.content
+    assert time.perf_counter() - started < 1.5
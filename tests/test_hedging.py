@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+对冲请求：温度不是数字时不对冲（不报 500）；对冲请求占用并发名额，没有空闲名额时不对冲；
+落后的请求关闭响应并统计 token；对冲等待时间不包括主请求在线程池里排队的时间
+"""
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import pytest
+
+import api_proxy_async
+import api_proxy_server as core
+from conftest import completion_body
+
+
+@pytest.fixture
+def hedging(monkeypatch):
+    monkeypatch.setattr(core.hedger, 'enabled', True)
+    monkeypatch.setattr(core.hedger, 'hedged', 0)
+    monkeypatch.setattr(core.hedger, 'skipped', 0)
+    monkeypatch.setattr(core.hedger, 'hedge_wins', 0)
+    # 固定的对冲等待时间，不依赖耗时样本
+    monkeypatch.setattr(core.hedger, 'delay', lambda: 0.05)
+    return core.hedger
+
+
+@pytest.mark.parametrize('temperature', ['warm', None, [0.1]])
+def test_applies_ignores_non_numeric_temperature(hedging, temperature):
+    assert not hedging.applies({'messages': [], 'temperature': temperature}, 'high')
+    assert hedging.applies({'messages': [], 'temperature': '0.1'}, 'high')
+
+
+def test_non_numeric_temperature_is_not_a_server_error(hedging, sync_client, async_client):
+    body = {'messages': [{'role': 'user', 'content': 'score'}], 'temperature': 'warm', 'max_tokens': 10}
+    assert sync_client.post('/api/chat', json=body).status_code == 200
+    assert async_client.call('POST', '/api/chat', json=body).status_code == 200
+
+
+def _sync_send(calls, latency):
+    def send_upstream(upstream_client, api_data, deadline=None, stream=False):
+        calls.append(api_data)
+        time.sleep(latency)
+        response = core.requests.Response()
+        response.status_code = 200
+        return response, core.upstream_keys.acquire()
+    return send_upstream
+
+
+@pytest.mark.parametrize('limit, hedged', [(1, False), (2, True)])
+def test_sync_hedge_needs_a_free_slot(monkeypatch, hedging, limit, hedged):
+    gate = core.ConcurrencyGate(limit=limit, budgets={})
+    monkeypatch.setattr(core, 'concurrency_gate', gate)
+    calls = []
+    monkeypatch.setattr(core, 'send_upstream', _sync_send(calls, 0.2))
+
+    # 主请求占用一个名额（与 complete_chat 中一致）
+    slot, _ = gate.acquire('high')
+    response = core.post_upstream(None, {'messages': []}, hedge=True)
+    gate.release(slot)
+    assert response.status_code == 200
+    assert len(calls) == (2 if hedged else 1)
+    assert (hedging.hedged, hedging.skipped) == ((1, 0) if hedged else (0, 1))
+    # 落后的请求在后台结束后归还名额
+    deadline = time.monotonic() + 2
+    while gate.active and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert gate.active == 0
+
+
+def test_shared_gate_hedge_does_not_jump_the_queue(tmp_path):
+    gate = core.ConcurrencyGate(store=core.SharedStore(str(tmp_path / 'shared.db')), limit=2, budgets={})
+    granted, slot = gate.try_acquire('high')
+    assert granted and gate.active == 1
+    gate.release(slot)
+    assert gate.active == 0
+    # 其他 worker 有请求在排队时，即使有空闲名额也不对冲
+    gate.store.execute("INSERT INTO slots (state, started, priority) VALUES ('waiting', ?, 'normal')", (time.time(),))
+    assert gate.try_acquire('high') == (False, None)
+
+
+@pytest.mark.parametrize('limit, hedged', [(1, False), (2, True)])
+def test_async_hedge_needs_a_free_slot(monkeypatch, hedging, limit, hedged):
+    gate = api_proxy_async.AsyncConcurrencyGate(limit=limit, budgets={})
+    monkeypatch.setattr(api_proxy_async, 'concurrency_gate', gate)
+    calls = []
+
+    async def send_upstream(api_data, deadline=None, stream=False):
+        calls.append(api_data)
+        await asyncio.sleep(0.2)
+        return httpx.Response(200), core.upstream_keys.acquire()
+
+    monkeypatch.setattr(api_proxy_async, 'send_upstream', send_upstream)
+
+    async def scenario():
+        await gate.acquire('high')
+        try:
+            response = await api_proxy_async.post_upstream({'messages': []}, hedge=True)
+        finally:
+            gate.release('high')
+        # 落后的请求被取消，名额随之归还
+        await asyncio.sleep(0)
+        return response
+
+    assert asyncio.run(scenario()).status_code == 200
+    assert len(calls) == (2 if hedged else 1)
+    assert (hedging.hedged, hedging.skipped) == ((1, 0) if hedged else (0, 1))
+    assert sum(gate.active_by_class.values()) == 0
+
+
+class TrackedResponse(core.requests.Response):
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_sync_losing_hedge_is_closed_and_counted(monkeypatch, hedging):
+    monkeypatch.setattr(core, 'concurrency_gate', core.ConcurrencyGate(limit=2, budgets={}))
+    recorded = []
+    monkeypatch.setattr(core, 'record_tokens', lambda *args: recorded.append(args))
+    # 主请求慢，对冲请求先返回
+    latencies = iter([0.3, 0.05])
+    responses = []
+
+    def send_upstream(upstream_client, api_data, deadline=None, stream=False):
+        time.sleep(next(latencies))
+        response = TrackedResponse()
+        response.status_code = 200
+        response._content = completion_body(total_tokens=7)
+        responses.append(response)
+        return response, core.upstream_keys.acquire()
+
+    monkeypatch.setattr(core, 'send_upstream', send_upstream)
+    response = core.post_upstream(None, {'model': 'deepseek-chat', 'messages': []}, hedge=True,
+                                  client='alice', workload='match_score')
+    assert response is responses[0] and not response.closed
+    assert hedging.hedge_wins == 1
+    # 落后的主请求结束后关闭响应，token 照样计入该客户端
+    deadline = time.monotonic() + 2
+    while not recorded and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert recorded == [('alice', 'deepseek-chat', 7, 'match_score')]
+    assert responses[1].closed
+
+
+def test_sync_hedge_delay_excludes_executor_queue(monkeypatch, hedging):
+    monkeypatch.setattr(core, 'concurrency_gate', core.ConcurrencyGate(limit=2, budgets={}))
+    executor = ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(core, '_hedge_executor', executor)
+    calls = []
+    monkeypatch.setattr(core, 'send_upstream', _sync_send(calls, 0.01))
+    # 线程池被占满，主请求排队的时间比对冲等待时间长，但主请求本身很快
+    executor.submit(time.sleep, 0.2)
+    response = core.post_upstream(None, {'messages': []}, hedge=True)
+    executor.shutdown()
+    assert response.status_code == 200
+    assert len(calls) == 1
+    assert hedging.hedged == 0
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""桌面端 HostPacer：同一域名的抓取间隔从上一次抓取结束时算起，不同域名互不影响"""
+
+import threading
+
+import pytest
+
+import jobsdb_ai_tool as tool
+
+
+class FakeClock:
+    """代替 time 模块：monotonic 返回手动推进的时间"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(tool, 'time', clock)
+    return clock
+
+
+def test_first_request_does_not_wait(clock):
+    pacer = tool.HostPacer(3, 6)
+    assert pacer.wait('https://hk.jobsdb.com/job/1') == 0
+
+
+def test_spacing_starts_when_the_request_ends(clock, monkeypatch):
+    monkeypatch.setattr(tool.random, 'uniform', lambda low, high: 4.0)
+    pacer = tool.HostPacer(3, 6)
+    # 请求本身耗时 10 秒，间隔不包含这段时间
+    clock.now += 10
+    pacer.done('https://hk.jobsdb.com/job/1')
+    assert pacer.wait('https://hk.jobsdb.com/job/2') == 4.0
+    clock.now += 2.5
+    assert pacer.wait('https://hk.jobsdb.com/job/2') == 1.5
+    clock.now += 2
+    assert pacer.wait('https://hk.jobsdb.com/job/2') == 0
+
+
+def test_spacing_is_random_within_the_range(clock):
+    pacer = tool.HostPacer(3, 6)
+    waits = set()
+    for _ in range(50):
+        pacer.done('https://hk.jobsdb.com/job/1')
+        waits.add(pacer.wait('https://hk.jobsdb.com/job/1'))
+    assert all(3 <= wait <= 6 for wait in waits)
+    assert len(waits) > 1
+
+
+def test_hosts_are_paced_independently(clock):
+    pacer = tool.HostPacer(3, 6)
+    pacer.done('https://hk.jobsdb.com/job/1')
+    assert pacer.wait('https://hk.jobsdb.com/job/2') >= 3
+    assert pacer.wait('https://sg.jobsdb.com/job/2') == 0
+    # 同一域名的不同端口视为不同主机
+    assert pacer.wait('https://hk.jobsdb.com:8443/job/2') == 0
+
+
+def test_concurrent_done_calls_keep_one_entry_per_host(clock):
+    pacer = tool.HostPacer(3, 6)
+    threads = [threading.Thread(target=pacer.done, args=(f'https://hk.jobsdb.com/job/{index}',))
+               for index in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert list(pacer._next_allowed) == ['hk.jobsdb.com']
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""幂等键的状态机：新请求、重放、处理中（等待其结果，超时 409）、键被用于不同的请求（422）；两个引擎行为一致"""
+
+import threading
+import time
+
+import api_proxy_server as core
+from conftest import ADMIN_HEADERS, completion_body
+
+CHAT = {'messages': [{'role': 'user', 'content': 'write a cover letter'}], 'temperature': 1.0}
+
+
+def _scoped(key):
+    return core.idempotency_store.scoped_key(core.client_id(ADMIN_HEADERS['Authorization']), key)
+
+
+def _start_in_flight(key):
+    """模拟另一个 worker 正在处理同一个键的请求"""
+    scoped = _scoped(key)
+    assert core.idempotency_store.try_begin(scoped, core.build_upstream_payload(CHAT)) == ('new', None)
+    return scoped
+
+
+def test_retry_attaches_to_in_flight_request(engine, fake_upstream):
+    scoped = _start_in_flight('busy')
+    stored = completion_body('from the first request')
+    finisher = threading.Timer(0.2, core.idempotency_store.complete, (scoped, 'application/json', stored))
+    finisher.start()
+    try:
+        response = engine('POST', '/api/chat', json=CHAT, headers={core.IDEMPOTENCY_HEADER: 'busy'})
+    finally:
+        finisher.join()
+    assert response.status_code == 200
+    assert response.content == stored
+    assert response.headers['Idempotent-Replayed'] == 'true'
+    assert fake_upstream.calls == []
+
+
+def test_in_progress_wait_is_bounded(engine, fake_upstream, monkeypatch):
+    monkeypatch.setattr(core.idempotency_store, 'wait_timeout', 0.3)
+    _start_in_flight('slow')
+    started = time.monotonic()
+    response = engine('POST', '/api/chat', json=CHAT, headers={core.IDEMPOTENCY_HEADER: 'slow'})
+    assert 0.2 < time.monotonic() - started < 2
+    assert response.status_code == 409
+    assert response.json()['code'] == 'idempotency_in_progress'
+    assert response.headers['Retry-After'] == '1'
+    assert fake_upstream.calls == []
+
+
+def test_in_progress_wait_stops_at_request_deadline(engine, fake_upstream):
+    _start_in_flight('deadline')
+    started = time.monotonic()
+    response = engine('POST', '/api/chat', json=CHAT,
+                      headers={core.IDEMPOTENCY_HEADER: 'deadline', core.DEADLINE_HEADER: '200'})
+    assert time.monotonic() - started < 2
+    assert response.status_code == 409
+
+
+def test_replay_returns_stored_response_without_upstream_call(engine, fake_upstream):
+    headers = {core.IDEMPOTENCY_HEADER: 'replay'}
+    first = engine('POST', '/api/chat', json=CHAT, headers=headers)
+    second = engine('POST', '/api/chat', json=CHAT, headers=headers)
+    assert first.status_code == second.status_code == 200
+    assert second.content == first.content
+    assert second.headers['Idempotent-Replayed'] == 'true'
+    assert 'Idempotent-Replayed' not in first.headers
+    assert len(fake_upstream.calls) == 1
+    assert core.idempotency_store.stats()['replayed'] >= 1
+
+
+def test_stream_replay_returns_full_sse(engine, fake_upstream):
+    headers = {core.IDEMPOTENCY_HEADER: 'stream'}
+    body = dict(CHAT, stream=True)
+    first = engine('POST', '/api/chat', json=body, headers=headers)
+    second = engine('POST', '/api/chat', json=body, headers=headers)
+    assert first.content.endswith(b'data: [DONE]\n\n')
+    assert second.content == first.content
+    assert second.headers['Content-Type'].startswith('text/event-stream')
+    assert len(fake_upstream.calls) == 1
+
+
+def test_key_reused_for_different_request_returns_422(engine, fake_upstream):
+    headers = {core.IDEMPOTENCY_HEADER: 'reused'}
+    assert engine('POST', '/api/chat', json=CHAT, headers=headers).status_code == 200
+    other = {'messages': [{'role': 'user', 'content': 'something else'}]}
+    response = engine('POST', '/api/chat', json=other, headers=headers)
+    assert response.status_code == 422
+    assert response.json()['code'] == 'idempotency_key_reused'
+    assert len(fake_upstream.calls) == 1
+
+
+def test_failed_request_is_retried_upstream(engine, fake_upstream):
+    headers = {core.IDEMPOTENCY_HEADER: 'retry'}
+    fake_upstream.responder = lambda payload: (500, b'{"error": {"message": "upstream failed"}}')
+    assert engine('POST', '/api/chat', json=CHAT, headers=headers).status_code == 500
+    # 失败时 pending 记录被删除，用同一个键重试会重新调用上游
+    fake_upstream.responder = None
+    response = engine('POST', '/api/chat', json=CHAT, headers=headers)
+    assert response.status_code == 200
+    assert 'Idempotent-Replayed' not in response.headers
+    assert len(fake_upstream.calls) == 2
+
+
+def test_keys_are_scoped_per_client():
+    payload = core.build_upstream_payload(CHAT)
+    assert core.idempotency_store.scoped_key('a', 'same') != core.idempotency_store.scoped_key('b', 'same')
+    assert core.idempotency_store.scoped_key('a', '') is None
+    assert core.idempotency_store.try_begin(_scoped('scoped'), payload) == ('new', None)
+    assert core.idempotency_store.try_begin(_scoped('scoped'), payload) == ('pending', None)
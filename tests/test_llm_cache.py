@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""桌面端 LLMResultCache：超过大小上限时按最近使用时间淘汰，生成结果按有效期过期；「跳过结果缓存」时不读取但照常写入"""
+
+import os
+import zlib
+from types import SimpleNamespace
+
+import pytest
+
+import jobsdb_ai_tool as tool
+
+
+class FakeClock:
+    """代替 time 模块：time() 返回手动推进的时间"""
+
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(tool, 'time', clock)
+    return clock
+
+
+def _key(name):
+    return tool.LLMResultCache.make_key('score', 'direct:score@1', 'deepseek-chat', {}, name, 'resume')
+
+
+def _value():
+    # 随机内容几乎不能压缩，每条的大小相同
+    return os.urandom(500).hex()
+
+
+def test_round_trip_and_counters(tmp_path):
+    cache = tool.LLMResultCache(str(tmp_path / 'cache.db'))
+    assert cache.get(_key('a')) is None
+    cache.put(_key('a'), 'score', '87')
+    assert cache.get(_key('a')) == '87'
+    cache.put(_key('a'), 'score', '90')
+    assert cache.get(_key('a')) == '90'
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries']) == (2, 1, 1)
+    assert stats['bytes'] == len(zlib.compress(b'90', 9))
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, clock):
+    size = len(zlib.compress(_value().encode('utf-8'), 9))
+    cache = tool.LLMResultCache(str(tmp_path / 'cache.db'), max_bytes=int(size * 3.5))
+    for name in ('a', 'b', 'c'):
+        clock.now += 1
+        cache.put(_key(name), 'score', _value())
+    # 读取 a 之后，最久未使用的是 b
+    clock.now += 1
+    assert cache.get(_key('a')) is not None
+    clock.now += 1
+    cache.put(_key('d'), 'score', _value())
+
+    assert cache.get(_key('b')) is None
+    for name in ('a', 'c', 'd'):
+        assert cache.get(_key(name)) is not None
+    assert cache.stats()['entries'] == 3
+    assert cache.stats()['bytes'] <= cache.max_bytes * 0.9
+
+
+def test_size_is_restored_when_reopened(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    cache = tool.LLMResultCache(path)
+    for name in ('a', 'b'):
+        cache.put(_key(name), 'score', _value())
+    reopened = tool.LLMResultCache(path)
+    assert reopened.stats()['bytes'] == cache.stats()['bytes']
+    assert reopened.get(_key('a')) is not None
+
+
+def test_max_age(tmp_path, clock):
+    cache = tool.LLMResultCache(str(tmp_path / 'cache.db'))
+    cache.put(_key('a'), 'tailor', 'tailored resume')
+    clock.now += tool.GENERATED_CACHE_TTL - 1
+    assert cache.get(_key('a'), max_age=tool.GENERATED_CACHE_TTL) == 'tailored resume'
+    clock.now += 2
+    assert cache.get(_key('a'), max_age=tool.GENERATED_CACHE_TTL) is None
+    # 不限有效期时仍然可用
+    assert cache.get(_key('a')) == 'tailored resume'
+
+
+def test_unusable_database_disables_the_cache(tmp_path):
+    cache = tool.LLMResultCache(str(tmp_path / 'missing' / 'cache.db'))
+    cache.put(_key('a'), 'score', '87')
+    assert cache.get(_key('a')) is None
+    assert cache.stats() == {'hits': 0, 'misses': 0, 'entries': 0, 'bytes': 0}
+
+
+def test_key_ignores_whitespace_but_not_the_resume():
+    key = tool.LLMResultCache.make_key('score', 'v', 'm', {'temperature': 0.3}, 'Python  developer\n', 'resume')
+    assert key == tool.LLMResultCache.make_key('score', 'v', 'm', {'temperature': 0.3}, ' Python developer', 'resume')
+    assert key != tool.LLMResultCache.make_key('score', 'v', 'm', {'temperature': 0.3}, 'Python developer', 'resume2')
+    assert key != tool.LLMResultCache.make_key('score', 'v2', 'm', {'temperature': 0.3}, 'Python developer', 'resume')
+    assert len(key) == 32
+
+
+@pytest.fixture
+def app(tmp_path):
+    """不创建窗口的 ResumeGeneratorApp，匹配度由桩函数计算并记录调用次数"""
+    app = object.__new__(tool.ResumeGeneratorApp)
+    app.config = {}
+    app.llm = SimpleNamespace(use_proxy=False, MODEL='deepseek-chat')
+    app.llm_cache = tool.LLMResultCache(str(tmp_path / 'cache.db'))
+    app.scored = []
+    app._calculate_match_direct_api = lambda job_description, resume, cancel_event=None: \
+        app.scored.append(job_description) or 80 + len(app.scored)
+    return app
+
+
+def test_scores_are_cached(app):
+    assert app.calculate_match_score('Python developer', 'resume') == 81
+    assert app.calculate_match_score('Python   developer', 'resume') == 81
+    assert app.scored == ['Python developer']
+
+
+def test_bypass_skips_reads_but_still_writes(app):
+    app.calculate_match_score('Python developer', 'resume')
+    app.config['bypass_llm_cache'] = True
+    # 跳过缓存时重新评分，新结果覆盖旧结果
+    assert app.calculate_match_score('Python developer', 'resume') == 82
+    app.config['bypass_llm_cache'] = False
+    assert app.calculate_match_score('Python developer', 'resume') == 82
+    assert len(app.scored) == 2
+
+
+def test_generated_text_is_cached_only_when_enabled(app):
+    key = app._llm_cache_key('tailor', {}, 'Python developer', 'resume')
+    app._write_llm_cache('tailor', key, 'tailored resume')
+    assert app._read_llm_cache('tailor', key) is None
+    app.config['cache_generated'] = True
+    app._write_llm_cache('tailor', key, 'tailored resume')
+    assert app._read_llm_cache('tailor', key) == 'tailored resume'
+    app.config['bypass_llm_cache'] = True
+    assert app._read_llm_cache('tailor', key) is None
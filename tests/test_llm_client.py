@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""桌面端 LLMClient：429/5xx 和连接失败按指数退避重试（不少于 Retry-After），代理返回 409 时用同一个幂等键重试，可以取消"""
+
+import json
+
+import pytest
+import requests
+
+import jobsdb_ai_tool as tool
+
+MESSAGES = [{'role': 'user', 'content': 'hi'}]
+
+
+def _response(status_code, body=None, headers=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    if body is None:
+        body = {'choices': [{'message': {'content': 'done'}}], 'usage': {'prompt_tokens': 5, 'completion_tokens': 3}}
+    response._content = json.dumps(body).encode('utf-8') if isinstance(body, dict) else body
+    response._content_consumed = True
+    return response
+
+
+class FakeSession:
+    """按顺序返回预设的结果（Response 或要抛出的异常），并记录请求"""
+
+    def __init__(self, *results):
+        self.results = list(results)
+        self.requests = []
+
+    def post(self, url, json=None, headers=None, timeout=None, stream=False):
+        self.requests.append({'url': url, 'json': json, 'headers': dict(headers)})
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+class RecordingEvent:
+    """代替 cancel_event：记录退避时长，不真正等待"""
+
+    def __init__(self, cancel_after=None):
+        self.delays = []
+        self.cancel_after = cancel_after
+
+    def is_set(self):
+        return False
+
+    def wait(self, delay):
+        self.delays.append(delay)
+        return self.cancel_after is not None and len(self.delays) >= self.cancel_after
+
+
+def _client(*results, use_proxy=False, **kwargs):
+    client = tool.LLMClient(use_proxy=use_proxy, api_key_getter=lambda: 'sk-test', **kwargs)
+    client.session = FakeSession(*results)
+    return client
+
+
+@pytest.fixture(autouse=True)
+def no_jitter(monkeypatch):
+    monkeypatch.setattr(tool.random, 'uniform', lambda low, high: high)
+
+
+def test_retries_with_exponential_backoff():
+    client = _client(_response(503), _response(429), _response(502), _response(200),
+                     max_retries=3, backoff_base=1.0, backoff_max=3.0)
+    event = RecordingEvent()
+    assert client.chat(MESSAGES, cancel_event=event) == 'done'
+    # 1、2、4 秒，以 backoff_max 为上限
+    assert event.delays == [1.0, 2.0, 3.0]
+    call = client.calls[-1]
+    assert (call['result'], call['attempts'], call['retries'], call['status']) == ('ok', 4, 3, 200)
+    stats = client.stats()
+    assert (stats['retries'], stats['errors'], stats['prompt_tokens'], stats['completion_tokens']) == (3, 0, 5, 3)
+
+
+def test_backoff_honours_retry_after():
+    client = _client(_response(429, headers={'Retry-After': '7'}), _response(429, headers={'Retry-After': '99'}),
+                     _response(200), backoff_base=1.0, backoff_max=20.0)
+    event = RecordingEvent()
+    client.chat(MESSAGES, cancel_event=event)
+    # 不少于 Retry-After，但不超过 backoff_max
+    assert event.delays == [7.0, 20.0]
+
+
+def test_jitter_stays_within_half_to_full_delay(monkeypatch):
+    monkeypatch.setattr(tool.random, 'uniform', lambda low, high: low)
+    client = _client(backoff_base=2.0, backoff_max=20.0)
+    event = RecordingEvent()
+    client._backoff(2, None, event)
+    assert event.delays == [4.0]
+
+
+def test_gives_up_after_max_retries():
+    client = _client(*[_response(503, body=b'busy') for _ in range(3)], max_retries=2)
+    with pytest.raises(tool.LLMError, match='HTTP 503 busy'):
+        client.chat(MESSAGES, cancel_event=RecordingEvent())
+    assert len(client.session.requests) == 3
+    assert client.calls[-1]['result'] == 'error' and client.stats()['errors'] == 1
+
+
+def test_client_errors_are_not_retried():
+    client = _client(_response(400, body=b'bad request'))
+    with pytest.raises(tool.LLMError, match='HTTP 400'):
+        client.chat(MESSAGES, cancel_event=RecordingEvent())
+    assert client.calls[-1]['retries'] == 0
+
+
+def test_connection_errors_are_retried_but_read_timeouts_are_not():
+    client = _client(requests.exceptions.ConnectionError('refused'), _response(200))
+    event = RecordingEvent()
+    assert client.chat(MESSAGES, cancel_event=event) == 'done'
+    assert len(event.delays) == 1
+
+    # 读取超时时请求可能已经到达服务端，不重试
+    client = _client(requests.exceptions.ReadTimeout('slow'), _response(200))
+    with pytest.raises(tool.LLMError, match='slow'):
+        client.chat(MESSAGES, cancel_event=RecordingEvent())
+    assert len(client.session.requests) == 1
+
+
+def test_proxy_409_is_retried_with_the_same_idempotency_key():
+    client = _client(_response(409, headers={'Retry-After': '1'}), _response(409), _response(200), use_proxy=True)
+    event = RecordingEvent()
+    assert client.template('score@1', 'my resume', {'job_description': 'jd'}, cancel_event=event) == 'done'
+    keys = {request['headers']['Idempotency-Key'] for request in client.session.requests}
+    assert len(client.session.requests) == 3 and len(keys) == 1
+    assert client.calls[-1]['kind'] == 'score'
+
+    # 下一次逻辑调用使用新的幂等键
+    client.session = FakeSession(_response(200))
+    client.template('score@1', 'my resume', {'job_description': 'jd'}, cancel_event=event)
+    assert client.session.requests[0]['headers']['Idempotency-Key'] not in keys
+
+
+def test_direct_409_is_not_retried():
+    client = _client(_response(409, body=b'conflict'))
+    with pytest.raises(tool.LLMError, match='HTTP 409'):
+        client.chat(MESSAGES, cancel_event=RecordingEvent())
+    assert len(client.session.requests) == 1
+
+
+def test_cancel_during_backoff():
+    client = _client(_response(503), _response(503), _response(200))
+    with pytest.raises(tool.LLMCancelled):
+        client.chat(MESSAGES, cancel_event=RecordingEvent(cancel_after=1))
+    assert len(client.session.requests) == 1
+    assert client.stats()['cancelled'] == 1 and client.stats()['errors'] == 0
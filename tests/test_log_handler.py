@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""异步日志：emit 只入队不等待写出，队列满时丢弃并计数，close 时写完队列中剩余的日志"""
+
+import json
+import logging
+import threading
+import time
+
+import api_proxy_server as core
+
+
+class SlowTarget(logging.Handler):
+    """记录写出的消息；release 之前写线程卡在第一条记录上，模拟阻塞的 stderr"""
+
+    def __init__(self):
+        super().__init__()
+        self.released = threading.Event()
+        self.started = threading.Event()
+        self.messages = []
+        self.flushed = False
+
+    def handle(self, record):
+        self.started.set()
+        self.released.wait(5)
+        self.messages.append(self.format(record))
+
+    def flush(self):
+        self.flushed = True
+
+
+def _logger(handler):
+    logger = logging.getLogger(f'test-log-handler-{id(handler)}')
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+    return logger
+
+
+def test_full_queue_drops_without_blocking():
+    target = SlowTarget()
+    handler = core.AsyncLogHandler(target, maxsize=2)
+    logger = _logger(handler)
+    logger.info('first')
+    # 写线程取走第一条后卡住，之后队列只进不出
+    assert target.started.wait(2)
+    started = time.perf_counter()
+    for index in range(10):
+        logger.info('message %d', index)
+    assert time.perf_counter() - started < 0.5
+    assert handler.stats()['queued'] == 2
+    assert handler.dropped == 8
+
+    target.released.set()
+    handler.close()
+    assert target.messages == ['first', 'message 0', 'message 1']
+    assert target.flushed
+
+
+def test_close_writes_remaining_records():
+    target = SlowTarget()
+    handler = core.AsyncLogHandler(target)
+    logger = _logger(handler)
+    for index in range(100):
+        logger.info('message %d', index)
+    target.released.set()
+    handler.close()
+    assert target.messages == [f'message {index}' for index in range(100)]
+    assert handler._thread is None
+
+
+def test_close_with_full_queue_still_drains():
+    target = SlowTarget()
+    handler = core.AsyncLogHandler(target, maxsize=3)
+    logger = _logger(handler)
+    logger.info('message 0')
+    assert target.started.wait(2)
+    for index in range(1, 4):
+        logger.info('message %d', index)
+    assert handler.stats()['queued'] == 3
+    threading.Timer(0.1, target.released.set).start()
+    started = time.perf_counter()
+    handler.close()
+    assert time.perf_counter() - started < 1.5
+    assert target.messages == [f'message {index}' for index in range(4)]
+
+
+def test_messages_are_rendered_and_truncated_in_the_caller():
+    target = SlowTarget()
+    target.released.set()
+    target.setFormatter(core.JsonLogFormatter())
+    handler = core.AsyncLogHandler(target, max_chars=10)
+    logger = _logger(handler)
+    payload = {'value': 'before'}
+    logger.info('payload %s', payload, extra={'fields': {'route': '/api/chat'}})
+    # 入队之后再修改参数，不影响已经记录的消息
+    payload['value'] = 'after'
+    try:
+        raise ValueError('boom')
+    except ValueError:
+        logger.exception('failed')
+    handler.close()
+
+    first, second = [json.loads(message) for message in target.messages]
+    assert first['msg'] == "payload {'...(17 chars truncated)"
+    assert first['route'] == '/api/chat' and first['level'] == 'INFO'
+    assert second['msg'] == 'failed'
+    assert 'ValueError: boom' in second['exc']
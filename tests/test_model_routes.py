@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""按工作负载路由模型：路由在缓存查询之前生效，缓存键按路由之后的上游请求体计算"""
+
+import pytest
+
+import api_proxy_server as core
+
+MESSAGES = [{'role': 'user', 'content': '这个岗位和简历的匹配度是多少？'}]
+
+
+@pytest.fixture
+def score_route(monkeypatch):
+    monkeypatch.setattr(core, 'MODEL_ROUTES', {'score': {'model': 'deepseek-lite', 'temperature': 0, 'max_tokens': 20}})
+
+
+def test_workload_classification():
+    assert core.classify_workload({'template_id': 'score@1'}, {}) == 'score'
+    assert core.classify_workload({}, {'X-Workload': 'Tailor'}) == 'tailor'
+    assert core.classify_workload({'template_id': 'score@1'}, {'X-Workload': 'cover_letter'}) == 'cover_letter'
+    assert core.classify_workload({}, {'X-Workload': 'made-up'}) == 'default'
+
+
+def test_apply_model_route_only_replaces_route_params(score_route):
+    data = {'messages': MESSAGES, 'model': 'deepseek-chat', 'temperature': 0.7, 'stream': True}
+    routed = core.apply_model_route(data, 'score')
+    assert routed == dict(data, model='deepseek-lite', temperature=0, max_tokens=20)
+    assert core.apply_model_route(data, 'default') is data
+
+
+def test_route_is_applied_before_cache_lookup(engine, fake_upstream, score_route):
+    body = {'messages': MESSAGES, 'temperature': 0.7, 'max_tokens': 200}
+    routed = engine('POST', '/api/chat', json=body, headers={'X-Workload': 'score'})
+    assert routed.headers['X-Proxy-Cache'] == 'MISS'
+    payload, = fake_upstream.calls
+    assert (payload['model'], payload['temperature'], payload['max_tokens']) == ('deepseek-lite', 0, 20)
+
+    # 同一个请求体走默认路由：温度高、不缓存，也不会命中路由后的缓存
+    unrouted = engine('POST', '/api/chat', json=body)
+    assert unrouted.headers['X-Proxy-Cache'] == 'BYPASS'
+    assert fake_upstream.calls[-1]['model'] == 'deepseek-chat'
+
+    again = engine('POST', '/api/chat', json=body, headers={'X-Workload': 'score'})
+    assert again.headers['X-Proxy-Cache'] == 'HIT'
+    assert again.content == routed.content
+    assert len(fake_upstream.calls) == 2
+
+
+def test_routed_requests_do_not_share_cache_with_default_model(engine, fake_upstream, score_route):
+    body = {'messages': MESSAGES, 'temperature': 0, 'max_tokens': 20}
+    assert engine('POST', '/api/chat', json=body).headers['X-Proxy-Cache'] == 'MISS'
+    assert engine('POST', '/api/chat', json=body, headers={'X-Workload': 'score'}).headers['X-Proxy-Cache'] == 'MISS'
+    assert [call['model'] for call in fake_upstream.calls] == ['deepseek-chat', 'deepseek-lite']
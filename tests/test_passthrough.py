@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""非流式响应原样转发：只扫描原始字节的 lean_body 和 scan_total_tokens 与完整解析的结果一致"""
+
+import json
+
+import pytest
+
+import api_proxy_server as core
+from conftest import completion_body
+
+TRICKY = [
+    'plain',
+    '带引号的 "content" 和 "usage": {"total_tokens": 999}',
+    'escaped \\" backslash \\\\ and newline\n',
+    '',
+]
+
+
+@pytest.mark.parametrize('content', TRICKY)
+def test_lean_body_matches_lean_result(content):
+    body = completion_body(content, total_tokens=42)
+    assert json.loads(core.lean_body(body)) == core.lean_result(json.loads(body))
+
+
+def test_lean_body_with_unusual_layout():
+    body = json.dumps({
+        'usage': {'total_tokens': 5},
+        'choices': [{'message': {'content': 'x', 'role': 'assistant'}}],
+    }, indent=2).encode('utf-8')
+    assert json.loads(core.lean_body(body)) == core.lean_result(json.loads(body))
+    missing_usage = json.dumps({'choices': [{'message': {'content': 'x'}}]}).encode('utf-8')
+    assert json.loads(core.lean_body(missing_usage)) == core.lean_result(json.loads(missing_usage))
+
+
+@pytest.mark.parametrize('content', TRICKY)
+def test_scan_total_tokens(content):
+    assert core.scan_total_tokens(completion_body(content, total_tokens=1234)) == 1234
+
+
+def test_scan_total_tokens_without_usage():
+    assert core.scan_total_tokens(b'{"choices": []}') == 0
+    assert core.scan_total_tokens(b'{"usage": {"total_tokens": null}}') == 0
+    assert core.scan_total_tokens(b'{"usage": {"total_tokens" : 17 }}') == 17
+
+
+def test_upstream_bytes_are_returned_unchanged(engine, fake_upstream):
+    upstream_body = completion_body('原样返回', total_tokens=12)
+    fake_upstream.responder = lambda payload: (200, upstream_body)
+    chat = {'messages': [{'role': 'user', 'content': 'hi'}]}
+    assert engine('POST', '/api/chat', json=chat).content == upstream_body
+    lean = engine('POST', '/api/chat', json=chat, headers={'X-Proxy-Response': 'lean'})
+    assert lean.json() == core.lean_result(json.loads(upstream_body))
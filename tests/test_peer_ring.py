@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""多节点缓存分片：每个节点算出的 owner 相同，增减节点只移动约 1/N 的键，连接不上的节点暂时跳过；节点间接口校验令牌"""
+
+import hashlib
+import time
+
+import pytest
+
+import api_proxy_server as core
+
+NODES = ['http://node-a:5000', 'http://node-b:5000', 'http://node-c:5000']
+SECRET = 'peer-secret'
+KEYS = [hashlib.sha256(str(index).encode('utf-8')).hexdigest() for index in range(2000)]
+
+
+def _owners(ring):
+    """每个键的 owner（本节点负责时为本节点地址）"""
+    return [ring.owner(key) or ring.self_url for key in KEYS]
+
+
+def test_every_node_agrees_on_the_owner():
+    views = [_owners(core.PeerRing(NODES, node, SECRET)) for node in NODES]
+    assert views[0] == views[1] == views[2]
+    # 虚拟节点让键大致均匀地分到每个节点
+    for node in NODES:
+        assert 0.2 < views[0].count(node) / len(KEYS) < 0.47
+
+
+def test_adding_a_node_moves_only_its_share():
+    before = _owners(core.PeerRing(NODES, NODES[0], SECRET))
+    after = _owners(core.PeerRing(NODES + ['http://node-d:5000'], NODES[0], SECRET))
+    moved = [(old, new) for old, new in zip(before, after) if old != new]
+    # 换 owner 的键都归新节点，数量约为 1/4
+    assert all(new == 'http://node-d:5000' for _, new in moved)
+    assert 0.15 < len(moved) / len(KEYS) < 0.35
+
+
+def test_removing_a_node_moves_only_its_keys():
+    before = _owners(core.PeerRing(NODES, NODES[0], SECRET))
+    after = _owners(core.PeerRing(NODES[:2], NODES[0], SECRET))
+    for old, new in zip(before, after):
+        assert old == new or old == NODES[2]
+
+
+def test_unreachable_node_is_skipped_until_retry():
+    ring = core.PeerRing(NODES, NODES[0], SECRET, retry_seconds=0.1)
+    before = _owners(ring)
+    ring.mark_down(NODES[1])
+    during = _owners(ring)
+    assert NODES[1] not in during
+    # 其他节点的键不受影响，node-b 的键由环上的下一个节点负责
+    assert all(old == new for old, new in zip(before, during) if old != NODES[1])
+    assert {new for old, new in zip(before, during) if old == NODES[1]} == {NODES[0], NODES[2]}
+    assert ring.stats()['down'] == [NODES[1]]
+    time.sleep(0.15)
+    assert _owners(ring) == before
+
+
+@pytest.mark.parametrize('nodes, self_url, secret', [
+    ([], NODES[0], SECRET),
+    (NODES, 'http://elsewhere:5000', SECRET),
+    (NODES, NODES[0], ''),
+])
+def test_incomplete_configuration_disables_peer_mode(nodes, self_url, secret):
+    ring = core.PeerRing(nodes, self_url, secret)
+    assert not ring.enabled
+    assert ring.owner(KEYS[0]) is None
+    assert not ring.check_token(secret)
+    assert not ring.check_token('')
+
+
+def test_check_token():
+    ring = core.PeerRing(NODES, NODES[0], SECRET)
+    assert ring.check_token(SECRET)
+    for token in ('', 'peer-secre', SECRET + 'x', SECRET.upper()):
+        assert not ring.check_token(token)
+
+
+@pytest.fixture
+def peer_ring(monkeypatch):
+    ring = core.PeerRing(NODES, NODES[0], SECRET)
+    monkeypatch.setattr(core, 'peer_ring', ring)
+    return ring
+
+
+@pytest.mark.parametrize('token', [None, '', 'wrong-secret'])
+def test_peer_endpoint_rejects_bad_tokens(peer_ring, fake_upstream, engine, token):
+    headers = {} if token is None else {core.PEER_TOKEN_HEADER: token}
+    body = {'messages': [{'role': 'user', 'content': 'hi'}], 'temperature': 0}
+    response = engine('POST', core.PEER_PATH, json=body, headers=headers)
+    assert response.status_code == 403
+    assert fake_upstream.calls == []
+    assert peer_ring.stats()['served_for_peers'] == 0
+
+
+def test_peer_endpoint_serves_requests_with_the_token(peer_ring, fake_upstream, engine):
+    body = {'messages': [{'role': 'user', 'content': 'hi'}], 'temperature': 0}
+    headers = {core.PEER_TOKEN_HEADER: SECRET, core.PEER_CLIENT_HEADER: 'client-hash'}
+    response = engine('POST', core.PEER_PATH, json=body, headers=headers)
+    assert response.status_code == 200
+    assert response.headers[core.PEER_RESULT_HEADER] == 'ok'
+    assert response.json()['choices'][0]['message']['content'] == 'hi'
+    # 转发来的请求由本节点处理，不会再次转发
+    assert len(fake_upstream.calls) == 1
+    assert peer_ring.stats()['served_for_peers'] == 1 and peer_ring.stats()['forwarded'] == 0
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""桌面端预取：放弃的预取（还没开始的取消，已经开始的完成后删除 PDF），停止或投递异常时不留下临时 PDF"""
+
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+import jobsdb_ai_tool as tool
+
+JOB = {'url': 'https://hk.jobsdb.com/job/1', 'title': 'Engineer', 'description': 'Python'}
+
+
+class FakeRoot:
+    def after(self, delay, callback):
+        callback()
+
+
+@pytest.fixture
+def app(tmp_path):
+    """不创建窗口的 ResumeGeneratorApp：LLM、PDF 和投递都换成桩函数，PDF 写到 tmp_path"""
+    app = object.__new__(tool.ResumeGeneratorApp)
+    app.config = {'resume_content': 'my resume', 'api_key': 'sk-test', 'max_apply_count': 15,
+                  'prefetch_jobs': 2, 'score_workers': 2}
+    app.root = FakeRoot()
+    app.texts = {'button_start_auto': 'start'}
+    app.start_auto_btn = app.pause_button = SimpleNamespace(config=lambda **kwargs: None)
+    app.search_keyword_entry = SimpleNamespace(get=lambda: 'python')
+    app.search_location_entry = SimpleNamespace(get=lambda: '')
+    app.match_threshold_entry = SimpleNamespace(get=lambda: '70')
+    app.region_var = SimpleNamespace(get=lambda: 'hk')
+    app.pause_event = threading.Event()
+    app.pause_event.set()
+    app.auto_cancel = threading.Event()
+    app.is_auto_running = True
+    app.fetch_pacer = tool.HostPacer(0, 0)
+    app.llm = SimpleNamespace(stats=lambda: {'calls': 0, 'errors': 0, 'retries': 0, 'avg_latency': 0.0,
+                                              'prompt_tokens': 0, 'completion_tokens': 0})
+    app.llm_cache = SimpleNamespace(stats=lambda: {'hits': 0})
+    app.log = []
+    app.log_auto_result = app.log.append
+    app.get_daily_apply_count = lambda: 0
+    app.save_application_record = lambda *args, **kwargs: None
+    app.scrape_job_urls = lambda criteria, max_pages=3: (True, [f'https://hk.jobsdb.com/job/{i}' for i in range(3)])
+    app.resolve_job_url = lambda url: url
+    app.fetch_job_info = lambda url: ({'title': url, 'description': 'Python'}, None)
+    app.calculate_match_score = lambda *args, **kwargs: 90
+    app.generate_custom_resume = lambda *args, **kwargs: ('tailored resume', None)
+    app.generate_cover_letter = lambda *args, **kwargs: ('cover letter', None)
+
+    def convert_resume_to_pdf(resume_content, output_path=None):
+        path = str(tmp_path / output_path)
+        with open(path, 'w') as f:
+            f.write(resume_content)
+        return path, None
+
+    app.convert_resume_to_pdf = convert_resume_to_pdf
+    app.pdf_dir = tmp_path
+    return app
+
+
+def test_discarding_a_queued_prefetch_cancels_it(app):
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        blocker = threading.Event()
+        executor.submit(blocker.wait, 5)
+        future = executor.submit(app._prepare_application, JOB, 'my resume', 1)
+        app._discard_prepared(future)
+        blocker.set()
+    assert future.cancelled()
+    assert os.listdir(app.pdf_dir) == []
+
+
+def test_discarding_a_running_prefetch_removes_its_pdf_when_done(app):
+    started, release = threading.Event(), threading.Event()
+
+    def slow_resume(*args, **kwargs):
+        started.set()
+        release.wait(5)
+        return 'tailored resume', None
+
+    app.generate_custom_resume = slow_resume
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(app._prepare_application, JOB, 'my resume', 1)
+        assert started.wait(2)
+        app._discard_prepared(future)
+        release.set()
+    assert future.result()['pdf_path'] is not None
+    assert os.listdir(app.pdf_dir) == []
+
+
+def test_discarding_a_finished_or_failed_prefetch(app):
+    future = Future()
+    future.set_result(app._prepare_application(JOB, 'my resume', 1))
+    assert len(os.listdir(app.pdf_dir)) == 1
+    app._discard_prepared(future)
+    assert os.listdir(app.pdf_dir) == []
+
+    failed = Future()
+    failed.set_exception(RuntimeError('boom'))
+    app._discard_prepared(failed)
+
+
+def test_prepare_after_stop_generates_nothing(app):
+    app.is_auto_running = False
+    application = app._prepare_application(JOB, 'my resume', 1)
+    assert application['resume'] is None and application['pdf_path'] is None
+    assert application['resume_error'] == '已停止'
+    assert os.listdir(app.pdf_dir) == []
+
+
+def test_stopping_removes_prefetched_pdfs(app):
+    applied = []
+
+    def auto_apply_job(job_url, custom_resume, cover_letter, user_info, resume_pdf_path=None):
+        applied.append(resume_pdf_path)
+        # 投递第一个岗位时停止，第二个岗位已经预取
+        app.is_auto_running = False
+        return True, 'ok'
+
+    app.auto_apply_job = auto_apply_job
+    app.auto_job_search_worker()
+    assert len(applied) == 1
+    # 等预取线程结束后再检查
+    deadline = tool.time.monotonic() + 2
+    while os.listdir(app.pdf_dir) and tool.time.monotonic() < deadline:
+        tool.time.sleep(0.01)
+    assert os.listdir(app.pdf_dir) == []
+
+
+def test_pdf_is_removed_when_applying_raises(app):
+    applied = []
+
+    def auto_apply_job(job_url, custom_resume, cover_letter, user_info, resume_pdf_path=None):
+        applied.append(resume_pdf_path)
+        raise RuntimeError('browser crashed')
+
+    app.auto_apply_job = auto_apply_job
+    app.auto_job_search_worker()
+    assert len(applied) == 3
+    assert any('browser crashed' in message for message in app.log)
+    assert os.listdir(app.pdf_dir) == []
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+优先级队列：短的评分请求先于长的生成请求放行，每个类别的并发预算，
+排队超过 max_wait 的低优先级请求被提前（防饿死）；共享存储下在 worker 之间按同样的规则放行
+"""
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+import api_proxy_async
+import api_proxy_server as core
+
+
+@pytest.mark.parametrize('api_data, headers, expected', [
+    ({'max_tokens': 50}, {}, 'high'),
+    ({'max_tokens': core.PRIORITY_HIGH_MAX_TOKENS + 1}, {}, 'normal'),
+    ({}, {}, 'normal'),
+    ({'max_tokens': 'many'}, {}, 'normal'),
+    ({'max_tokens': 50}, {'X-Priority': 'LOW'}, 'low'),
+    ({'max_tokens': 4000}, {'X-Priority': 'urgent'}, 'normal'),
+])
+def test_classify_priority(api_data, headers, expected):
+    assert core.classify_priority(api_data, headers) == expected
+
+
+def test_pick_next_class_rules():
+    now = time.time()
+    heads = {'normal': now - 1, 'high': now}
+    assert core.pick_next_class(heads, {}, 0, 2, {}, 5, now) == 'high'
+    # 达到全局上限
+    assert core.pick_next_class(heads, {}, 2, 2, {}, 5, now) is None
+    # high 的预算用完时放行 normal
+    assert core.pick_next_class(heads, {'high': 1}, 1, 4, {'high': 1}, 5, now) == 'normal'
+    # normal 等待超过 max_wait，先于 high
+    assert core.pick_next_class(heads, {}, 0, 2, {}, 0.5, now) == 'normal'
+
+
+def _queue_in_order(gate, priorities, order=None):
+    """依次让每个优先级的请求开始排队，返回 (线程列表, 获得名额的顺序)"""
+    order = [] if order is None else order
+    threads = []
+    queued = gate.stats()['waiting']
+    for priority in priorities:
+        def run(priority=priority):
+            slot, _ = gate.acquire(priority)
+            order.append(priority)
+            time.sleep(0.05)
+            gate.release(slot)
+        thread = threading.Thread(target=run)
+        thread.start()
+        threads.append(thread)
+        deadline = time.monotonic() + 2
+        while gate.stats()['waiting'] < queued + len(threads) and time.monotonic() < deadline:
+            time.sleep(0.01)
+    return threads, order
+
+
+def _gates(kind, tmp_path, **kwargs):
+    """(持有名额的 gate, 排队的 gate)：本地时是同一个，共享存储时模拟两个 worker"""
+    if kind == 'local':
+        gate = core.ConcurrencyGate(**kwargs)
+        return gate, gate
+    store = core.SharedStore(str(tmp_path / 'shared.db'))
+    return core.ConcurrencyGate(store, **kwargs), core.ConcurrencyGate(store, **kwargs)
+
+
+@pytest.mark.parametrize('kind', ['local', 'shared'])
+def test_high_priority_goes_first(tmp_path, kind):
+    holder, gate = _gates(kind, tmp_path, limit=1, queue_timeout=5, budgets={}, max_wait=60)
+    slot, _ = holder.acquire('normal')
+    threads, order = _queue_in_order(gate, ['low', 'normal', 'high'])
+    holder.release(slot)
+    for thread in threads:
+        thread.join()
+    assert order == ['high', 'normal', 'low']
+
+
+@pytest.mark.parametrize('kind', ['local', 'shared'])
+def test_starving_request_is_promoted(tmp_path, kind):
+    holder, gate = _gates(kind, tmp_path, limit=1, queue_timeout=5, budgets={}, max_wait=0.2)
+    slot, _ = holder.acquire('normal')
+    threads, order = _queue_in_order(gate, ['low'])
+    time.sleep(0.25)
+    high, _ = _queue_in_order(gate, ['high'], order)
+    holder.release(slot)
+    for thread in threads + high:
+        thread.join()
+    # low 已经等待超过 max_wait，先于后来的 high
+    assert order == ['low', 'high']
+
+
+@pytest.mark.parametrize('kind', ['local', 'shared'])
+def test_class_budget_limits_only_that_class(tmp_path, kind):
+    holder, gate = _gates(kind, tmp_path, limit=3, queue_timeout=0.2, budgets={'normal': 1}, max_wait=60)
+    slot, _ = holder.acquire('normal')
+    # normal 的预算已用完，即使还有空闲名额也排队直到超时
+    with pytest.raises(core.RateLimited):
+        gate.acquire('normal')
+    # 其他类别不受影响
+    high, _ = gate.acquire('high')
+    low, _ = gate.acquire('low')
+    for gate_, held in ((holder, slot), (gate, high), (gate, low)):
+        gate_.release(held)
+    if kind == 'shared':
+        assert holder.store.execute('SELECT COUNT(*) FROM slots').fetchone()[0] == 0
+
+
+def test_async_gate_follows_the_same_order():
+    gate = api_proxy_async.AsyncConcurrencyGate(limit=1, queue_timeout=5, budgets={'low': 1}, max_wait=60)
+    order = []
+
+    async def request(priority):
+        await gate.acquire(priority)
+        order.append(priority)
+        await asyncio.sleep(0.01)
+        gate.release(priority)
+
+    async def scenario():
+        await gate.acquire('normal')
+        tasks = []
+        for priority in ('low', 'normal', 'high'):
+            tasks.append(asyncio.ensure_future(request(priority)))
+            await asyncio.sleep(0.01)
+        assert gate.stats()['waiting'] == 3
+        gate.release('normal')
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+    assert order == ['high', 'normal', 'low']
+    assert gate.stats()['active'] == 0
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""限流与削峰：每个客户端的请求令牌桶和 token 额度（允许透支），并发上限的有界队列"""
+
+import threading
+import time
+
+import pytest
+
+import api_proxy_server as core
+
+
+def test_request_bucket_allows_burst_then_refills():
+    limiter = core.TokenBucketLimiter(rps=20, burst=2, tpm=0)
+    limiter.check('alice')
+    limiter.check('alice')
+    with pytest.raises(core.RateLimited) as raised:
+        limiter.check('alice')
+    assert str(raised.value) == 'Too many requests'
+    assert raised.value.retry_after == 1
+    # 其他客户端不受影响
+    limiter.check('bob')
+    time.sleep(0.06)
+    limiter.check('alice')
+    assert limiter.stats()['rejected'] == 1
+
+
+def test_token_quota_is_overdrawn_then_blocks_until_refilled():
+    limiter = core.TokenBucketLimiter(rps=0, burst=0, tpm=600)
+    limiter.check('alice')
+    # 请求完成后按实际用量扣除，可以透支
+    limiter.consume_tokens('alice', 700)
+    with pytest.raises(core.RateLimited) as raised:
+        limiter.check('alice')
+    assert str(raised.value) == 'Token quota exceeded'
+    # 透支 100 个 token，每秒补回 10 个
+    assert raised.value.retry_after == 10
+
+
+def test_disabled_limiter_never_rejects():
+    limiter = core.TokenBucketLimiter(rps=0, burst=0, tpm=0)
+    for _ in range(100):
+        limiter.check('alice')
+    limiter.consume_tokens('alice', 10 ** 9)
+    limiter.check('alice')
+    assert not limiter.shared
+
+
+def test_shared_buckets_are_used_by_every_worker(tmp_path):
+    store = core.SharedStore(str(tmp_path / 'shared.db'))
+    worker_a = core.TokenBucketLimiter(store, rps=0.01, burst=2, tpm=0)
+    worker_b = core.TokenBucketLimiter(store, rps=0.01, burst=2, tpm=0)
+    assert worker_a.shared
+    worker_a.check('alice')
+    worker_b.check('alice')
+    with pytest.raises(core.RateLimited):
+        worker_a.check('alice')
+    # 被拒绝时桶状态不变
+    requests_left, = store.execute("SELECT requests FROM rate_buckets WHERE client = 'alice'").fetchone()
+    assert requests_left < 1
+    worker_b.check('bob')
+
+
+def test_rate_limited_request_returns_429_with_retry_after(monkeypatch, engine):
+    monkeypatch.setattr(core, 'rate_limiter', core.TokenBucketLimiter(rps=0.5, burst=1, tpm=0))
+    body = {'messages': [{'role': 'user', 'content': 'hi'}], 'temperature': 0.9}
+    assert engine('POST', '/api/chat', json=body).status_code == 200
+    response = engine('POST', '/api/chat', json=body)
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '2'
+    assert response.json()['error'] == 'Rate limit exceeded'
+
+
+def test_gate_rejects_when_queue_is_full():
+    gate = core.ConcurrencyGate(limit=1, max_queue=1, queue_timeout=2, budgets={})
+    slot, _ = gate.acquire('normal')
+    granted = []
+    waiter = threading.Thread(target=lambda: granted.append(gate.acquire('normal')))
+    waiter.start()
+    while gate.stats()['waiting'] < 1:
+        time.sleep(0.01)
+    # 队列已满时立即拒绝，不再排队
+    started = time.perf_counter()
+    with pytest.raises(core.RateLimited) as raised:
+        gate.acquire('normal')
+    assert str(raised.value) == 'Server is busy, queue is full'
+    assert time.perf_counter() - started < 0.5
+    gate.release(slot)
+    waiter.join()
+    gate.release(granted[0][0])
+    assert gate.stats()['rejected'] == 1 and gate.stats()['active'] == 0
+
+
+def test_gate_queue_times_out():
+    gate = core.ConcurrencyGate(limit=1, max_queue=5, queue_timeout=0.1, budgets={})
+    slot, _ = gate.acquire('normal')
+    started = time.perf_counter()
+    with pytest.raises(core.RateLimited) as raised:
+        gate.acquire('normal')
+    assert str(raised.value) == 'Timed out waiting for an upstream slot'
+    assert time.perf_counter() - started >= 0.1
+    gate.release(slot)
+    assert gate.stats()['waiting'] == 0 and gate.stats()['active'] == 0
+
+
+def test_gate_hands_released_slot_to_waiter():
+    gate = core.ConcurrencyGate(limit=1, max_queue=5, queue_timeout=2, budgets={})
+    slot, _ = gate.acquire('normal')
+    threading.Timer(0.1, gate.release, (slot,)).start()
+    second, waited = gate.acquire('normal')
+    assert waited >= 0.05
+    assert gate.stats()['active'] == 1
+    gate.release(second)
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""响应缓存：规范化的缓存键、按字节数限制的 LRU、过期时间、磁盘层，以及客户端跳过缓存的请求头"""
+
+import time
+
+import api_proxy_server as core
+
+MESSAGES = [{'role': 'user', 'content': '这个岗位和简历的匹配度是多少？'}]
+
+
+def test_cache_key_is_canonical():
+    base = {'model': 'deepseek-chat', 'messages': MESSAGES, 'temperature': 0, 'max_tokens': 50}
+    reordered = {'max_tokens': 50, 'temperature': 0, 'messages': MESSAGES, 'model': 'deepseek-chat'}
+    assert core.cache_key(base) == core.cache_key(reordered)
+    # 不影响结果的字段不参与缓存键；影响结果的字段参与
+    assert core.cache_key(base) == core.cache_key(dict(base, stream_options={'include_usage': True}))
+    for field, value in (('model', 'deepseek-reasoner'), ('temperature', 0.2), ('max_tokens', 51),
+                         ('messages', MESSAGES + [{'role': 'user', 'content': '?'}])):
+        assert core.cache_key(base) != core.cache_key(dict(base, **{field: value}))
+
+
+def test_only_low_temperature_requests_are_cacheable():
+    assert core.is_cacheable({'temperature': 0.3}, {})
+    assert not core.is_cacheable({'temperature': 0.7}, {})
+    assert not core.is_cacheable({}, {})
+    assert not core.is_cacheable({'temperature': 'cold'}, {})
+    assert not core.is_cacheable({'temperature': 0, 'stream': True}, {})
+
+
+def test_lru_is_bounded_by_bytes():
+    cache = core.ResponseCache(max_bytes=10, cache_dir='')
+    cache.set('a', b'1234', 60)
+    cache.set('b', b'5678', 60)
+    assert cache.get('a') == b'1234'
+    # 超出字节上限时淘汰最久未用的 b
+    cache.set('c', b'90ab', 60)
+    assert cache.get('b') is None
+    assert cache.get('a') == b'1234' and cache.get('c') == b'90ab'
+    assert cache.evictions == 1
+    # 比整个缓存还大的响应不缓存
+    cache.set('big', b'x' * 11, 60)
+    assert cache.get('big') is None
+
+
+def test_entries_expire(monkeypatch):
+    cache = core.ResponseCache(max_bytes=100, cache_dir='')
+    cache.set('key', b'body', 10)
+    cache.set('never', b'body', 0)
+    now = time.time()
+    monkeypatch.setattr(core.time, 'time', lambda: now + 11)
+    assert cache.get('key') is None
+    assert cache.get('never') is None
+
+
+def test_disk_tier_is_shared_between_instances(tmp_path):
+    writer = core.ResponseCache(max_bytes=100, cache_dir=str(tmp_path))
+    writer.set('ab' * 32, b'cached body', 60)
+    reader = core.ResponseCache(max_bytes=100, cache_dir=str(tmp_path))
+    assert reader.get_memory('ab' * 32) is None
+    assert reader.get('ab' * 32) == b'cached body'
+    assert (reader.disk_hits, reader.hits) == (1, 0)
+    # 磁盘命中后回填内存层
+    assert reader.get_memory('ab' * 32) == b'cached body'
+
+
+def test_cache_bypass_headers(engine, fake_upstream):
+    body = {'messages': MESSAGES, 'temperature': 0}
+    assert engine('POST', '/api/chat', json=body).headers['X-Proxy-Cache'] == 'MISS'
+    assert engine('POST', '/api/chat', json=body).headers['X-Proxy-Cache'] == 'HIT'
+    assert engine('POST', '/api/chat', json=body, headers={'X-Proxy-Cache': 'bypass'}).headers['X-Proxy-Cache'] == 'BYPASS'
+    assert engine('POST', '/api/chat', json=body, headers={'Cache-Control': 'no-cache'}).headers['X-Proxy-Cache'] == 'BYPASS'
+    assert engine('POST', '/api/chat', json=dict(body, temperature=0.9)).headers['X-Proxy-Cache'] == 'BYPASS'
+    assert len(fake_upstream.calls) == 4
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""桌面端 run_concurrently：多个调用同时执行，按参数顺序返回 (结果, 异常)，一个调用失败不影响其他调用"""
+
+import threading
+import time
+
+import jobsdb_ai_tool as tool
+
+
+def test_results_are_returned_in_argument_order():
+    def slow(value, delay):
+        time.sleep(delay)
+        return value
+
+    results = tool.run_concurrently(lambda: slow('first', 0.1), lambda: slow('second', 0), lambda: None)
+    assert results == [('first', None), ('second', None), (None, None)]
+
+
+def test_calls_run_at_the_same_time():
+    barrier = threading.Barrier(3, timeout=2)
+    started = time.perf_counter()
+    results = tool.run_concurrently(*[lambda: barrier.wait() is not None for _ in range(3)])
+    assert results == [(True, None)] * 3
+    assert time.perf_counter() - started < 1
+
+
+def test_errors_are_passed_back_without_stopping_other_calls():
+    finished = threading.Event()
+
+    def fail():
+        raise tool.LLMError('HTTP 503')
+
+    def succeed():
+        time.sleep(0.05)
+        finished.set()
+        return 'ok'
+
+    (failed, error), (result, no_error) = tool.run_concurrently(fail, succeed)
+    assert failed is None and isinstance(error, tool.LLMError) and str(error) == 'HTTP 503'
+    assert (result, no_error) == ('ok', None)
+    assert finished.is_set()
+
+
+def test_prepare_application_reports_each_failure_separately(tmp_path):
+    app = object.__new__(tool.ResumeGeneratorApp)
+    app.pause_event = threading.Event()
+    app.pause_event.set()
+    app.is_auto_running = True
+    app.auto_cancel = threading.Event()
+    app.generate_custom_resume = lambda *args, **kwargs: ('tailored resume', None)
+
+    def cover_letter_fails(*args, **kwargs):
+        raise tool.LLMError('timed out')
+
+    app.generate_cover_letter = cover_letter_fails
+    app.convert_resume_to_pdf = lambda content, output_path=None: (str(tmp_path / output_path), None)
+    job = {'title': 'Engineer', 'description': 'Python'}
+
+    application = app._prepare_application(job, 'my resume', 1)
+    # Cover Letter 失败时简历和 PDF 照常生成
+    assert application['resume'] == 'tailored resume' and application['pdf_path']
+    assert application['cover_letter'] is None
+    assert application['cover_letter_error'] == '生成失败: timed out'
+
+    def resume_fails(*args, **kwargs):
+        raise tool.LLMError('HTTP 500')
+
+    app.generate_custom_resume = resume_fails
+    app.generate_cover_letter = lambda *args, **kwargs: ('cover letter', None)
+    application = app._prepare_application(job, 'my resume', 2)
+    assert application['resume_error'] == '生成失败: HTTP 500'
+    assert application['cover_letter'] == 'cover letter'
+    assert application['pdf_path'] is None
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""SSE 流式转发：上游的 chunk 原样转发给客户端，转发的同时从最后一个 chunk 取出 token 用量"""
+
+import pytest
+
+import api_proxy_server as core
+from conftest import sse_body
+
+CHAT = {'messages': [{'role': 'user', 'content': 'stream me'}], 'stream': True}
+
+
+def test_stream_is_passed_through(engine, fake_upstream):
+    response = engine('POST', '/api/chat', json=CHAT)
+    assert response.status_code == 200
+    assert response.headers['Content-Type'].startswith('text/event-stream')
+    assert response.headers['X-Accel-Buffering'] == 'no'
+    assert response.content == sse_body('stream me')
+    payload, = fake_upstream.calls
+    # 要求上游在最后一个 chunk 中返回 usage
+    assert payload['stream'] is True and payload['stream_options'] == {'include_usage': True}
+
+
+def test_stream_upstream_error_is_returned_as_json(engine, fake_upstream):
+    fake_upstream.responder = lambda payload: (500, b'{"error": {"message": "server error"}}')
+    response = engine('POST', '/api/chat', json=CHAT)
+    assert response.status_code == 500
+    assert response.json()['error'] == 'API request failed'
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 7, 64, 10000])
+def test_sse_usage_scanner_across_chunk_boundaries(chunk_size):
+    body = sse_body('带 "usage" 的正文', total_tokens=321)
+    scanner = core.SSEUsageScanner()
+    for start in range(0, len(body), chunk_size):
+        scanner.feed(body[start:start + chunk_size])
+    scanner.close()
+    assert scanner.total_tokens == 321
+
+
+def test_sse_usage_scanner_without_trailing_newline():
+    scanner = core.SSEUsageScanner()
+    scanner.feed(b'data: {"choices": []}\n\ndata: {"usage": {"total_tokens": 9}}')
+    assert scanner.total_tokens == 0
+    scanner.close()
+    assert scanner.total_tokens == 9
+
+
+def test_sse_usage_scanner_ignores_bad_lines():
+    scanner = core.SSEUsageScanner()
+    scanner.feed(b'data: {"usage": broken\n: comment "usage"\ndata: {"usage": null}\n')
+    scanner.close()
+    assert scanner.total_tokens == 0
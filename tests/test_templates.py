@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""提示词模板和简历存储：未上传的简历返回 404（resume_not_found），重新上传后同一请求成功"""
+
+import api_proxy_server as core
+
+RESUME = '张三\n五年 Python 后端开发经验，熟悉 Flask 和 SQLite。'
+SCORE = {'template_id': 'score@1', 'resume_hash': core.ResumeStore.hash_of(RESUME),
+         'job_description': '招聘 Python 后端工程师，要求熟悉 Flask。'}
+
+
+def test_unknown_resume_then_reupload(engine, fake_upstream):
+    response = engine('POST', '/api/chat', json=SCORE)
+    assert response.status_code == 404
+    assert response.json()['code'] == 'resume_not_found'
+    assert engine('GET', f"/api/resumes/{SCORE['resume_hash']}").status_code == 404
+    assert fake_upstream.calls == []
+
+    uploaded = engine('POST', '/api/resumes', json={'resume': RESUME})
+    assert uploaded.status_code == 200
+    assert uploaded.json() == {'resume_hash': SCORE['resume_hash'], 'bytes': len(RESUME.encode('utf-8'))}
+    assert engine('GET', f"/api/resumes/{SCORE['resume_hash']}").json() == {'resume_hash': SCORE['resume_hash']}
+
+    response = engine('POST', '/api/chat', json=SCORE)
+    assert response.status_code == 200
+    payload, = fake_upstream.calls
+    # 模板在代理端展开：简历和岗位描述都在提示词中，使用模板的默认参数
+    assert RESUME in payload['messages'][0]['content']
+    assert SCORE['job_description'] in payload['messages'][0]['content']
+    assert (payload['temperature'], payload['max_tokens']) == (0.3, 50)
+
+
+def test_resume_survives_memory_cache_eviction(engine, fake_upstream):
+    engine('POST', '/api/resumes', json={'resume': RESUME})
+    core.resume_store._cache.clear()
+    assert engine('POST', '/api/chat', json=SCORE).status_code == 200
+
+
+def test_template_errors(engine, fake_upstream):
+    response = engine('POST', '/api/chat', json=dict(SCORE, template_id='nope@1'))
+    assert response.status_code == 400
+    assert response.json()['code'] == 'unknown_template'
+    assert engine('POST', '/api/resumes', json={'resume': '  '}).status_code == 400
+    too_large = 'x' * (core.RESUME_MAX_BYTES + 1)
+    assert engine('POST', '/api/resumes', json={'resume': too_large}).status_code == 413
+    assert fake_upstream.calls == []
+
+
+def test_request_parameters_override_template_defaults(engine, fake_upstream):
+    engine('POST', '/api/resumes', json={'resume': RESUME})
+    assert engine('POST', '/api/chat', json=dict(SCORE, max_tokens=20, temperature=0)).status_code == 200
+    assert (fake_upstream.calls[0]['temperature'], fake_upstream.calls[0]['max_tokens']) == (0, 20)
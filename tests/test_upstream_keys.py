@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""多个上游 key：按在途请求最少选择，收到 429 的 key 按限流响应头冷却，请求自动换用下一个 key"""
+
+import httpx
+import pytest
+
+import api_proxy_server as core
+from conftest import AsyncEngine, completion_body, engine_call
+
+URL = 'http://upstream.test/chat/completions'
+
+
+@pytest.mark.parametrize('value, seconds', [
+    ('2', 2.0), ('1.5', 1.5), ('1m30s', 90.0), ('250ms', 0.25), ('1h', 3600.0), ('', None), ('soon', None),
+])
+def test_parse_reset_seconds(value, seconds):
+    assert core.parse_reset_seconds(value) == seconds
+
+
+@pytest.mark.parametrize('status_code, headers, cooldown', [
+    (429, {'Retry-After': '3'}, 3.0),
+    (429, {'X-RateLimit-Reset-Tokens': '6s'}, 6.0),
+    (429, {}, core.UPSTREAM_KEY_COOLDOWN),
+    (200, {'X-RateLimit-Remaining-Requests': '0', 'X-RateLimit-Reset-Requests': '2s'}, 2.0),
+    (200, {'X-RateLimit-Remaining-Requests': '5', 'X-RateLimit-Reset-Requests': '2s'}, 0),
+    (500, {}, 0),
+])
+def test_rate_limit_cooldown(status_code, headers, cooldown):
+    assert core.rate_limit_cooldown(status_code, headers) == cooldown
+
+
+def test_least_outstanding_key_is_chosen():
+    pool = core.UpstreamKeyPool(['sk-a', 'sk-b', 'sk-c'], [URL])
+    held = [pool.acquire() for _ in range(3)]
+    assert sorted(key.api_key for key in held) == ['sk-a', 'sk-b', 'sk-c']
+    # 释放 sk-b 后它是唯一在途请求最少的 key
+    pool.release(held[1])
+    assert pool.acquire() is held[1]
+
+
+def test_cooled_down_key_is_skipped_until_all_are_throttled():
+    pool = core.UpstreamKeyPool(['sk-a', 'sk-b'], [URL])
+    key_a, key_b = pool.keys
+    pool.observe(key_a, 429, {'Retry-After': '30'})
+    for _ in range(3):
+        key = pool.acquire()
+        assert key is key_b
+        pool.release(key)
+    assert pool.has_ready_key()
+
+    pool.observe(key_b, 429, {'Retry-After': '10'})
+    assert not pool.has_ready_key()
+    with pytest.raises(core.RateLimited) as raised:
+        pool.acquire()
+    # 按最先结束冷却的 key 给出重试时间
+    assert raised.value.retry_after == 10
+    stats = {entry['key']: entry for entry in pool.stats()}
+    assert stats['key0']['throttled'] == 1 and stats['key0']['cooldown_seconds'] > 20
+
+
+def test_keys_are_paired_with_urls():
+    assert [(key.api_key, key.url) for key in core.UpstreamKeyPool(['sk-a', 'sk-b'], ['u1', 'u2']).keys] == \
+        [('sk-a', 'u1'), ('sk-b', 'u2')]
+    assert len(core.UpstreamKeyPool(['sk-a', 'sk-b'], ['u1', 'u2', 'u3']).keys) == 6
+
+
+def _respond(authorization):
+    """sk-a 被限流，其他 key 正常返回"""
+    if authorization == 'Bearer sk-a':
+        return 429, {'Retry-After': '30'}, b'{"error": "rate limited"}'
+    return 200, {}, completion_body('from ' + authorization[-4:])
+
+
+@pytest.fixture
+def two_keys(monkeypatch, sync_client):
+    monkeypatch.setattr(core, 'upstream_keys', core.UpstreamKeyPool(['sk-a', 'sk-b'], [URL]))
+    calls = []
+
+    def post(self, url, timeout=None, json=None, stream=False, headers=None, **kwargs):
+        calls.append(headers['Authorization'])
+        status_code, response_headers, body = _respond(headers['Authorization'])
+        response = core.requests.Response()
+        response.status_code = status_code
+        response.headers.update(response_headers)
+        response._content = body
+        response._content_consumed = True
+        return response
+
+    monkeypatch.setattr(core.UpstreamClient, 'post', post)
+
+    def handler(request):
+        calls.append(request.headers['Authorization'])
+        status_code, response_headers, body = _respond(request.headers['Authorization'])
+        return httpx.Response(status_code, headers=response_headers, content=body)
+
+    return calls, {'sync': engine_call('sync', sync_client, None),
+                   'async': engine_call('async', None, AsyncEngine(handler))}
+
+
+@pytest.mark.parametrize('name', ['sync', 'async'])
+def test_throttled_key_fails_over_to_the_next(two_keys, name):
+    calls, engines = two_keys
+    body = {'messages': [{'role': 'user', 'content': 'hi'}], 'temperature': 0.9}
+    responses = [engines[name]('POST', '/api/chat', json=body) for _ in range(3)]
+    assert [response.status_code for response in responses] == [200] * 3
+    assert all(response.json()['choices'][0]['message']['content'] == 'from sk-b' for response in responses)
+    # 第一个请求先发给 sk-a，收到 429 后换 sk-b 重试；之后 sk-a 在冷却中
+    assert calls == ['Bearer sk-a'] + ['Bearer sk-b'] * 3
+    assert core.upstream_keys.stats()[0]['throttled'] == 1
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""使用量统计：记录先进内存队列，flush 时按天汇总写入；清零对其他 worker 尚未写入的记录同样生效"""
+
+import time
+
+import pytest
+
+import api_proxy_server as core
+
+
+@pytest.fixture
+def store(tmp_path):
+    return core.SharedStore(str(tmp_path / 'usage.db'))
+
+
+def _worker(store):
+    # 测试中手动 flush，后台线程不参与
+    return core.UsageAccounting(store, flush_interval=3600)
+
+
+def test_records_are_aggregated_on_flush(store):
+    usage = _worker(store)
+    usage.record('alice', 'deepseek-chat', requests=1)
+    usage.record('alice', 'deepseek-chat', tokens=120)
+    usage.record('bob', None, requests=1, tokens=30)
+    # 热路径不写盘
+    assert store.execute('SELECT COUNT(*) FROM usage_daily').fetchone()[0] == 0
+
+    usage.flush()
+    rows = usage.query(group_by=('client', 'model'))
+    assert rows == [
+        {'client': 'alice', 'model': 'deepseek-chat', 'requests': 1, 'tokens': 120},
+        {'client': 'bob', 'model': '', 'requests': 1, 'tokens': 30},
+    ]
+    summary = usage.summary()
+    assert (summary['total_requests'], summary['total_tokens'], summary['requests_today']) == (2, 150, 2)
+
+
+def test_flushes_accumulate_into_the_same_day(store):
+    usage = _worker(store)
+    for _ in range(3):
+        usage.record('alice', 'deepseek-chat', requests=1, tokens=10)
+        usage.flush()
+    assert usage.query(group_by=('day',))[0]['requests'] == 3
+    assert store.execute('SELECT COUNT(*) FROM usage_daily').fetchone()[0] == 1
+
+
+def test_reset_drops_pending_records_of_other_workers(store):
+    worker_a = _worker(store)
+    worker_b = _worker(store)
+    worker_a.record('alice', 'deepseek-chat', requests=1, tokens=100)
+    worker_b.record('bob', 'deepseek-chat', requests=1, tokens=50)
+    worker_b.flush()
+
+    # worker_b 清零时，worker_a 的记录还在内存队列中
+    worker_b.reset()
+    assert worker_b.summary()['total_requests'] == 0
+    worker_a.flush()
+    assert worker_a.summary()['total_requests'] == 0
+
+    # 清零之后的记录照常计入
+    time.sleep(0.01)
+    worker_a.record('alice', 'deepseek-chat', requests=1, tokens=7)
+    worker_a.flush()
+    summary = worker_b.summary()
+    assert (summary['total_requests'], summary['total_tokens']) == (1, 7)
+
+
+def test_reset_clears_own_pending_records(store):
+    usage = _worker(store)
+    usage.record('alice', 'deepseek-chat', requests=1)
+    usage.reset()
+    usage.flush()
+    assert usage.summary()['total_requests'] == 0